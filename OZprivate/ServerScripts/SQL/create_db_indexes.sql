@@ -37,6 +37,9 @@ call MakeFullUnicode('images_by_ott', 'rights');
 call MakeFullUnicode('images_by_ott', 'licence');
 call MakeFullUnicode('images_by_name', 'rights');
 call MakeFullUnicode('images_by_name', 'licence');
+call MakeFullUnicode('recent_sponsorships', 'rights');
+call MakeFullUnicode('recent_sponsorships', 'licence');
+call MakeFullUnicode('sponsor_search_tokens', 'token');
 call MakeFullUnicode('search_log', 'search_string');
 
 # note make sure that the name column in vernacular_by_name and the name column in ordered_leaves and ordered_nodes are of the same character set otherwise search can get incredibly slow even with indexes.
@@ -95,9 +98,33 @@ CREATE INDEX verified_index      ON reservations (verified_kind)    USING HASH;
 DROP   INDEX verifiedtime_index  ON reservations;
 CREATE INDEX verifiedtime_index  ON reservations (verified_time);
 
+DROP   INDEX ott_verified_index  ON reservations;
+CREATE INDEX ott_verified_index  ON reservations (OTT_ID, verified_time);
+
 DROP   INDEX user_time_index     ON reservations;
 CREATE INDEX user_time_index     ON reservations (user_updated_time);
 
+DROP   INDEX reserve_time_index  ON reservations;
+CREATE INDEX reserve_time_index  ON reservations (reserve_time);
+
+DROP   INDEX sponsor_ends_index  ON reservations;
+CREATE INDEX sponsor_ends_index  ON reservations (sponsorship_ends);
+
+DROP   INDEX email_dedup_index   ON email_outbox;
+CREATE UNIQUE INDEX email_dedup_index ON email_outbox (ott, email_type, recipient, pending);
+
+DROP   INDEX email_due_index     ON email_outbox;
+CREATE INDEX email_due_index     ON email_outbox (pending, next_attempt_time);
+
+DROP   INDEX recent_time_index   ON recent_sponsorships;
+CREATE INDEX recent_time_index   ON recent_sponsorships (verified_time, reserve_time);
+
+DROP   INDEX token_index         ON sponsor_search_tokens;
+CREATE INDEX token_index         ON sponsor_search_tokens (token, verified, expires);
+
+DROP   INDEX ott_index           ON sponsor_search_tokens;
+CREATE INDEX ott_index           ON sponsor_search_tokens (OTT_ID);
+
 DROP   INDEX PP_e_mail_index     ON reservations;
 CREATE INDEX PP_e_mail_index     ON reservations (PP_e_mail)        USING HASH;
 
@@ -53,6 +53,7 @@ Populating IUCN IDs using EOL csv file (or if absent, wikidata)
 
 import sys
 import csv
+import gc
 import re
 import gzip
 import json
@@ -105,7 +106,9 @@ def is_unnamed_OTT(OTTid):
     except TypeError:
         return False
 
-def get_OTT_species(taxonomy_file):
+def get_OTT_species(taxonomy_file, taxonomy_cache=None):
+    if taxonomy_cache is not None:
+        return set(taxonomy_cache.otts_with_rank('species').tolist())
     species_list = set()
     taxonomy_file.seek(0)
     reader = csv.DictReader(taxonomy_file, delimiter='\t')
@@ -440,6 +443,62 @@ def resolve_polytomies_add_popularity(tree, seed):
                 #probably popularity values undefined for one of the children
                 pass
 
+def resolve_polytomies_and_ladderize(tree, seed, ascending=True, verbosity=0):
+    """
+    The same as resolve_polytomies_add_popularity(tree, seed) followed by
+    tree.ladderize(ascending), but done on parent and child-offset arrays (see
+    ChildArrays in tree_arrays.py), so that the only dendropy nodes touched are the new
+    ones and those whose children have changed. The random resolutions are identical
+    to those made by dendropy for the same seed.
+    
+    Returns a list of all the nodes in the resolved tree (not in any particular order)
+    """
+    from tree_arrays import TreeArrays, ChildArrays
+    arrays = TreeArrays(tree)
+    original = ChildArrays.from_tree_arrays(arrays)
+    resolved = original.resolve_polytomies(random.Random(seed))
+    info(" {} extra nodes created".format(len(resolved) - len(original)))
+    final = resolved.ladderized(ascending)
+    nodes = arrays.nodes
+    #creating many small objects triggers repeated garbage collection passes over the
+    #whole (large) tree, which take far longer than making the nodes themselves
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(len(original), len(final)):
+            node = Node()
+            node.edge.length = 0.0
+            nodes.append(node)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    children = final.children.tolist()
+    child_start = final.child_start.tolist()
+    for p in final.changed_parents(original).tolist():
+        nodes[p].set_child_nodes([nodes[c] for c in children[child_start[p]:child_start[p+1]]])
+    for node in nodes[len(original):]:
+        #this is a new node - it should always have 2 children
+        try:
+            n = ancestor_pop_sum = descendant_pop_sum = n_ancestors_sum = n_descendants_sum = 0
+            for c in node._child_nodes:
+                n += 1
+                ancestor_pop_sum += c.ancestors_popsum
+                descendant_pop_sum += c.descendants_popsum
+                n_ancestors_sum += c.n_ancestors
+                n_descendants_sum += c.n_descendants
+            node.data={
+                'raw_popularity':0,
+                'popularity':popularity_function(
+                    ancestor_pop_sum/n,
+                    descendant_pop_sum,
+                    n_ancestors_sum/n,
+                    n_descendants_sum)
+                }
+        except AttributeError:
+            #probably popularity values undefined for one of the children
+            pass
+    return nodes
+
 def create_leaf_popularity_rankings(tree, verbosity=0):
     """
     Make a rank of all existing leaves by phylogenetic popularity
@@ -461,6 +520,26 @@ def create_leaf_popularity_rankings(tree, verbosity=0):
         #there are some Nones in the popularity. We cannot set ranks.
         pass
 
+def create_leaf_popularity_rankings_arrays(tree, nodes=None, verbosity=0):
+    """
+    As create_leaf_popularity_rankings(), but ranking all the leaves with a single
+    argsort (see descending_ranks() in tree_arrays.py). If a list of all the nodes
+    in the tree is given, it is used rather than walking the tree to find the leaves.
+    """
+    from tree_arrays import descending_ranks
+    if nodes is None:
+        leaves = list(tree.leaf_node_iter())
+    else:
+        leaves = [node for node in nodes if not node._child_nodes]
+    popularities = [leaf.data.get('popularity') for leaf in leaves]
+    if None in popularities:
+        if any(p is not None for p in popularities):
+            #there are some Nones in the popularity. We cannot set ranks.
+            return
+        popularities = [0] * len(leaves) #all share the same rank
+    for leaf, rank in zip(leaves, descending_ranks(popularities).tolist()):
+        leaf.data['popularity_rank'] = rank
+
 
 def write_popularity_tree(tree, outdir, filename, version, verbosity=0):
     Node.write_pop_newick = write_pop_newick
@@ -468,7 +547,7 @@ def write_popularity_tree(tree, outdir, filename, version, verbosity=0):
         tree.seed_node.write_pop_newick(popularity_newick)
 
 
-def output_simplified_tree(tree, taxonomy_file, outdir, version, seed, verbosity=0, save_sql=True):
+def output_simplified_tree(tree, taxonomy_file, outdir, version, seed, verbosity=0, save_sql=True, taxonomy_cache=None, use_arrays=True):
     """
     We should now have leaf entries attached to each node in the tree like
     data = {
@@ -498,6 +577,10 @@ def output_simplified_tree(tree, taxonomy_file, outdir, version, seed, verbosity
      'eol': 281897}
      
     Removes non-species from tips, outputs simplified versions.
+    
+    Polytomies are resolved, leaves ranked, and the tree ladderized using numpy arrays
+    (see resolve_polytomies_and_ladderize), unless use_arrays is False, in which case the
+    slower dendropy-based functions are used (giving the same result, kept for verification)
     """
     from dendropy_extras import prune_children_of_otts, prune_non_species, set_node_ages, \
         set_real_parent_nodes, write_preorder_ages, write_preorder_to_csv, write_brief_newick, \
@@ -515,7 +598,7 @@ def output_simplified_tree(tree, taxonomy_file, outdir, version, seed, verbosity
     Tree.resolve_polytomies_add_popularity = resolve_polytomies_add_popularity
     Node.write_brief_newick = write_brief_newick
     
-    n = len(tree.prune_children_of_otts(get_OTT_species(taxonomy_file), verbosity=verbosity))
+    n = len(tree.prune_children_of_otts(get_OTT_species(taxonomy_file, taxonomy_cache), verbosity=verbosity))
     info("-> removed all children of {} nodes (nodes labeled as 'species' in '{}')".format(n, taxonomy_file.name))
     
     bad_sp =['cf.', 'aff.', 'subsp.', 'environmental sample'] #species names containing these (even initially) are discarded
@@ -532,19 +615,28 @@ def output_simplified_tree(tree, taxonomy_file, outdir, version, seed, verbosity
     info(" (removed {} unifurcations)".format(n_deleted_nodes))
     
     
-    info("-> breaking polytomies at random with seed={}".format(seed))
-    tree.resolve_polytomies_add_popularity(seed)
-
-    
-    #NB: we shouldn't need to (re)set popularity or ages, since deleting nodes 
-    #does not affect these, and both have been calculated *after* new
-    #nodes were created by resolve_polytomies. 
-    info("-> setting real parents and ranking leaf popularity")
-    tree.set_real_parent_nodes()
-    tree.create_leaf_popularity_rankings()
-    
-    info("-> ladderizing tree (groups with fewer leaves first)")
-    tree.ladderize(ascending=True) #warning: ladderize ascending is needed for the short OZ newick-like form
+    if use_arrays:
+        info("-> breaking polytomies at random with seed={} and ladderizing tree (groups with fewer leaves first)".format(seed))
+        #warning: ladderize ascending is needed for the short OZ newick-like form
+        nodes = resolve_polytomies_and_ladderize(tree, seed, ascending=True, verbosity=verbosity)
+        
+        info("-> setting real parents and ranking leaf popularity")
+        tree.set_real_parent_nodes()
+        create_leaf_popularity_rankings_arrays(tree, nodes)
+    else:
+        info("-> breaking polytomies at random with seed={}".format(seed))
+        tree.resolve_polytomies_add_popularity(seed)
+        
+        
+        #NB: we shouldn't need to (re)set popularity or ages, since deleting nodes 
+        #does not affect these, and both have been calculated *after* new
+        #nodes were created by resolve_polytomies. 
+        info("-> setting real parents and ranking leaf popularity")
+        tree.set_real_parent_nodes()
+        tree.create_leaf_popularity_rankings()
+        
+        info("-> ladderizing tree (groups with fewer leaves first)")
+        tree.ladderize(ascending=True) #warning: ladderize ascending is needed for the short OZ newick-like form
     
     info("-> writing tree, dates, and csv to files")
     with open(os.path.join(outdir, "ordered_tree_{}.nwk".format(version)), 'w+') as condensed_newick, \
@@ -641,6 +733,12 @@ def main():
         help='A unique version number for the tree, to be saved in the DB tables & output files. Defaults to minutes since epoch (time()/60)')
     parser.add_argument('--extra_source_file', default=None, type=str, 
         help='An optional additional file to supplement the taxonomy.tsv file, providing additional mappings from OTTs to source ids (useful for overriding . The first line should be a header contining "uid" and "sourceinfo" column headers, as taxonomy.tsv. NB the OTT can be a number, or an ID of the form "mrcaott409215ott616649").')
+    parser.add_argument('--taxonomy_cache_dir', default=None, 
+        help='(Optional) a directory in which to cache the parsed OpenTreeTaxonomy file, so that later runs with the same taxonomy file do not need to parse it again')
+    parser.add_argument('--pageview_cache_dir', default=None, 
+        help='(Optional) a directory in which to cache the parsed pageview files, so that each month is only read once: later runs with the same files (and wikilang) are much faster')
+    parser.add_argument('--processes', type=int, default=None, 
+        help='(Optional) the number of pageview files to parse in parallel, when using --pageview_cache_dir')
     parser.add_argument('--info_on_focal_labels', nargs='*', default=[], 
         help='Output some extra information for these named taxa, for debugging purposes')        
     parser.add_argument('--verbosity', '-v', action="count", default=0, 
@@ -661,9 +759,17 @@ def main():
     info("Creating tree structure")
     tree, OTT_ptrs = get_tree_and_OTT_list(args.Tree, sources, args.verbosity)
     
+    taxonomy_cache = None
+    if args.taxonomy_cache_dir:
+        from taxonomy_cache import TaxonomyCache
+        info("Loading cached taxonomy")
+        taxonomy_cache = TaxonomyCache.for_file(
+            args.OpenTreeTaxonomy, args.taxonomy_cache_dir, args.verbosity)
+    
     info("Adding source IDs")
     source_ptrs = OTT_popularity_mapping.create_from_taxonomy(
-        args.OpenTreeTaxonomy, sources, OTT_ptrs, args.verbosity, args.extra_source_file)
+        args.OpenTreeTaxonomy, sources, OTT_ptrs, args.verbosity, args.extra_source_file,
+        taxonomy_cache)
     
     info("Adding EOL IDs from EOL csv file")
     add_eol_IDs_from_EOL_table_dump(source_ptrs, args.EOLidentifiers, sources, args.verbosity)
@@ -692,7 +798,8 @@ def main():
         OTT_popularity_mapping.add_pagesize_for_titles(
             wiki_title_ptrs, args.wikipediaSQLDumpFile, args.verbosity)
         OTT_popularity_mapping.add_pageviews_for_titles(
-            wiki_title_ptrs, args.wikipedia_totals_bz2_pageviews, args.wikilang, args.verbosity)
+            wiki_title_ptrs, args.wikipedia_totals_bz2_pageviews, args.wikilang, args.verbosity,
+            cache_dir=args.pageview_cache_dir, processes=args.processes)
         
         info("Calculating base popularity measures")    
         OTT_popularity_mapping.calc_popularities_for_wikitaxa(
@@ -727,7 +834,7 @@ def main():
     info("Writing out results to {}/xxx".format(args.output_location))
     output_simplified_tree(
         tree, args.OpenTreeTaxonomy, args.output_location, args.version, 
-        random_seed_addition, args.verbosity)
+        random_seed_addition, args.verbosity, taxonomy_cache=taxonomy_cache)
         
 
 if __name__ == "__main__":
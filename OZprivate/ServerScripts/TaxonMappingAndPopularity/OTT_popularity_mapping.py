@@ -130,9 +130,12 @@ import csv
 import re
 import gzip
 import bz2
-import os.path
+import os
 import json
+import hashlib
+from array import array
 from collections import defaultdict, OrderedDict
+from itertools import compress, count
 
 __author__ = "Yan Wong"
 __license__ = '''This is free and unencumbered software released into the public domain by the author, Yan Wong, for OneZoom CIO.
@@ -156,7 +159,7 @@ def memory_usage_resource():
     mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rusage_denom
     return mem
 
-def create_from_taxonomy(OTTtaxonomy_file, sources, OTT_ptrs, verbosity=0, extra_taxonomy_file=None):
+def create_from_taxonomy(OTTtaxonomy_file, sources, OTT_ptrs, verbosity=0, extra_taxonomy_file=None, taxonomy_cache=None):
     '''
     Creates object data and a source_ptrs array pointing to elements within it.
     Also fills out the OTT_ptrs array to point to the right place.
@@ -166,6 +169,9 @@ def create_from_taxonomy(OTTtaxonomy_file, sources, OTT_ptrs, verbosity=0, extra
     
     "extra_taxonomy_map" allows us to inject mappings that are missing from the OpenTree
     e.g.
+    
+    If taxonomy_cache (a TaxonomyCache object from taxonomy_cache.py) is given, the source ids
+    are read from the cache rather than by parsing OTTtaxonomy_file.
     '''
 
     unused_sources = set()
@@ -175,7 +181,11 @@ def create_from_taxonomy(OTTtaxonomy_file, sources, OTT_ptrs, verbosity=0, extra
     silva_regexp = re.compile(r'ncbi:(\d+),silva:([^,$]+)')
     silva_sub = r'ncbi_silva:\1'  #keep the ncbi_id as ncbi_silva, but chop off the silva ID since it is not used in wikidata/EoL
     
-    data_files = [OTTtaxonomy_file]
+    if taxonomy_cache is None:
+        data_files = [OTTtaxonomy_file]
+    else:
+        taxonomy_cache.add_sources(sources, OTT_ptrs, source_ptrs, unused_sources, verbosity)
+        data_files = []
     if extra_taxonomy_file is not None:
         try:
             data_files.append(open(extra_taxonomy_file, "r"))
@@ -535,7 +545,8 @@ def identify_best_wikidata(OTT_ptrs, order_to_trust, verbosity):
     if verbosity:
         print(" NB: of {} OpenTree taxa, {} ({:.2f}%) have wikidata entries. mem usage {:.1f} Mb".format(allOTTs, OTTs_with_wd, OTTs_with_wd/allOTTs * 100, memory_usage_resource()), file=sys.stderr)
 
-def add_pagesize_for_titles(wiki_title_ptrs, wikipedia_SQL_dump, verbosity):
+def add_pagesize_for_titles(wiki_title_ptrs, wikipedia_SQL_dump, verbosity, processes=None,
+    namespace_column=2, title_column=3, pagelen_column=11):
     """
     looks through the sql insertion file for page sizes. This file has extremely long lines with each csv entry
     brace-delimited within a line, e.g.
@@ -546,43 +557,85 @@ def add_pagesize_for_titles(wiki_title_ptrs, wikipedia_SQL_dump, verbosity):
     Column 3 gives the title (in unicode).
     The page length is in Column 11
     
-    Note that titles have had spaces replaced with underscores
+    Note that titles have had spaces replaced with underscores, and that quotes in titles
+    are escaped with a backslash, as in any mysqldump output.
+    
+    If processes > 1, lines are decompressed here but parsed in that many worker processes.
     """
     used = 0
-    #the column numbers for each datum are specified in the SQL file, and hardcoded here.
-    page_table_namespace_column = 2
-    page_table_title_column = 3
-    page_table_pagelen_column = 11
-    with gzip.open(wikipedia_SQL_dump, 'rt', encoding='utf-8') as file: #use csv reader as it copes well e.g. with escaped SQL quotes in fields etc.
-        pagelen_file = csv.reader(file, quotechar='\'',doublequote=True)
-        match_line = "INSERT INTO `page` VALUES"
-        for fields in filter(lambda x: False if len(x)==0 else x[0].startswith(match_line), pagelen_file):
-            if (pagelen_file.line_num % 500 == 0) and verbosity:
-                print("Reading page details from SQL dump to find page sizes: {} lines ({} pages) read: mem usage {:.1f} Mb".format(pagelen_file.line_num,pagelen_file.line_num*1000, memory_usage_resource()), file=sys.stderr)
-            field_num=0
-            #the records are all on the same line, separated by '),(', so we need to count fields into the line.
-            for f in fields:
-                try:
-                    if f.lstrip()[0]=="(":
-                        field_num=0
-                        namespace = None
-                        title = None
-                except IndexError:
-                    pass
-                field_num+=1;
-                if field_num == page_table_namespace_column:
-                    namespace = f
-                if field_num == page_table_title_column:
-                    title = f
-                elif field_num == page_table_pagelen_column and namespace == '0':
-                    if title in wiki_title_ptrs:
-                        wiki_title_ptrs[title]['PGsz'] = int(f)
-                        used += 1
+    n_lines = 0
+    match_line = "INSERT INTO `page` VALUES "
+    titles = set(wiki_title_ptrs)
+    columns = (namespace_column, title_column, pagelen_column)
+    with gzip.open(wikipedia_SQL_dump, 'rt', encoding='utf-8') as file:
+        lines = (line for line in file if line.startswith(match_line))
+        if processes and processes > 1:
+            from multiprocessing import Pool
+            pool = Pool(processes, initializer=_init_pagesize_parser, initargs=(titles, columns))
+            results = pool.imap(_pagesizes_in_line, lines)
+        else:
+            pool = None
+            results = (pagesizes_in_line(line, titles, *columns) for line in lines)
+        try:
+            for found in results:
+                n_lines += 1
+                if (n_lines % 500 == 0) and verbosity:
+                    print("Reading page details from SQL dump to find page sizes: {} lines ({} pages) read: mem usage {:.1f} Mb".format(n_lines, n_lines*1000, memory_usage_resource()), file=sys.stderr)
+                for title, pagelen in found:
+                    wiki_title_ptrs[title]['PGsz'] = pagelen
+                    used += 1
+        finally:
+            if pool is not None:
+                pool.terminate()
     if verbosity:
         print(" NB: of {} titles of taxa on the {} wikipedia, {} ({:.2f}%) have page size data. mem usage {:.1f} Mb".format(len(wiki_title_ptrs), wikipedia_SQL_dump if isinstance(wikipedia_SQL_dump, str) else wikipedia_SQL_dump.name, used, used/len(wiki_title_ptrs) * 100, memory_usage_resource()), file=sys.stderr)
 
+def pagesizes_in_line(line, titles, namespace_column=2, title_column=3, pagelen_column=11):
+    """
+    Return a list of (title, page length) for the namespace 0 pages in a single
+    `INSERT INTO ... VALUES (...),(...)` line of an SQL dump, whose title is in the
+    set `titles`. 
+    
+    The line is split into fields by the (C-coded) csv module, set up to unescape SQL 
+    strings ('It\\'s' -> It's). Since every (...) tuple has the same number of fields, 
+    the columns we need can then be picked out of the list of fields using a stride, 
+    and only the titles that are in `titles` are looked at in any more detail.
+    """
+    fields = next(csv.reader([line], quotechar="'", doublequote=False, escapechar='\\'))
+    width = sql_tuple_width(fields)
+    namespaces = fields[namespace_column-1::width]
+    page_titles = fields[title_column-1::width]
+    pagelens = fields[pagelen_column-1::width]
+    found = []
+    for i in compress(count(), map(titles.__contains__, page_titles)):
+        if namespaces[i] == '0':
+            found.append((page_titles[i], int(pagelens[i].rstrip(');\n'))))
+    return found
+
+def sql_tuple_width(fields):
+    """
+    The number of fields in each (...) tuple, given the fields of an entire
+    `INSERT INTO ... VALUES (...),(...)` line (each tuple after the first starts with '(')
+    """
+    for width in range(1, len(fields) + 1):
+        if len(fields) % width == 0 and fields[width-1].rstrip(';\n').endswith(')'):
+            if all(f.startswith('(') for f in fields[width::width]):
+                return width
+    raise ValueError("Cannot find the tuples in the SQL line starting {}".format(fields[:3]))
+
+_pagesize_parser_args = None
+
+def _init_pagesize_parser(*args):
+    global _pagesize_parser_args
+    _pagesize_parser_args = args
 
-def add_pageviews_for_titles(wiki_title_ptrs, array_of_opened_files, wikilang, verbosity, wiki_suffix="z"):
+def _pagesizes_in_line(line):
+    titles, columns = _pagesize_parser_args
+    return pagesizes_in_line(line, titles, *columns)
+
+
+def add_pageviews_for_titles(wiki_title_ptrs, array_of_opened_files, wikilang, verbosity, wiki_suffix="z",
+    cache_dir=None, processes=None):
     '''
     Append monthly page visits to the data objects pointed to by wiki_title_ptrs. 
     We expect several months of data, each corresponding to a file, so we append 
@@ -597,13 +650,29 @@ def add_pageviews_for_titles(wiki_title_ptrs, array_of_opened_files, wikilang, v
     wiki_suffix taken from https://dumps.wikimedia.org/other/pagecounts-ez/ 
     [b (wikibooks), k (wiktionary), n (wikinews), o (wikivoyage), q (wikiquote), s (wikisource), v (wikiversity), z (wikipedia)]
     
+    If cache_dir is given, each monthly file is only parsed once (per wikicode): the views
+    for every title in that month are saved in cache_dir (see pageview_cache()), and 
+    later runs simply look up the titles they need. Months that are not yet cached are 
+    parsed in parallel using `processes` worker processes.
     '''
     wikicode = wikilang + '.' + wiki_suffix
 
     for title, obj in wiki_title_ptrs.items():     #fill arrays with 0 to start with: missing data indicates no hits that month
         obj['PGviews'] = len(array_of_opened_files)*[0]
-    for index, pageviews_file in enumerate(array_of_opened_files):
-        visits_for_titles(wiki_title_ptrs, pageviews_file, index, wikicode, verbosity)
+    if cache_dir is None:
+        for index, pageviews_file in enumerate(array_of_opened_files):
+            visits_for_titles(wiki_title_ptrs, pageviews_file, index, wikicode, verbosity)
+    else:
+        cache_files = pageview_caches(array_of_opened_files, wikicode, cache_dir, processes, verbosity)
+        titles = list(wiki_title_ptrs)
+        title_hashes = title_hash_array(titles)
+        for index, cache_file in enumerate(cache_files):
+            used = 0
+            for i, views in cached_visits(cache_file, title_hashes):
+                wiki_title_ptrs[titles[i]]['PGviews'][index] = views
+                used += 1
+            if verbosity:
+                print(" NB: of {} WikiData taxon entries, {} ({:.2f}%) have pageview data for {} in '{}'. mem usage {:.1f} Mb".format(len(wiki_title_ptrs), used, used/len(wiki_title_ptrs) * 100, wikicode, cache_file, memory_usage_resource()), file=sys.stderr)
 
 
 def visits_for_titles(wiki_title_ptrs, wiki_visits_pagecounts_file, file_index, wikicode, verbosity):
@@ -615,6 +684,21 @@ def visits_for_titles(wiki_title_ptrs, wiki_visits_pagecounts_file, file_index,
     In the more recent files, missing values indicate <5 hits in that month, so we set these to 0
     
     Having several values (one per month) allows us to trim off any that show an unusual spike
+    '''
+    used = 0
+    for title, views in project_pagecounts(wiki_visits_pagecounts_file, wikicode, verbosity, file_index):
+        try:
+            wiki_title_ptrs[title]['PGviews'][file_index] = (wiki_title_ptrs[title]['PGviews'][file_index] or 0) + views #sometimes there are multiple encodings of the same title, with different visit numbers
+            used += 1
+        except KeyError:
+            pass #title not in wiki_title_ptrs - this is expected for most entries
+    if verbosity:
+        print(" NB: of {} WikiData taxon entries, {} ({:.2f}%) have pageview data for {} in '{}'. mem usage {:.1f} Mb".format(len(wiki_title_ptrs), used, used/len(wiki_title_ptrs) * 100, wikicode, wiki_visits_pagecounts_file if isinstance(wiki_visits_pagecounts_file, str) else wiki_visits_pagecounts_file.name, memory_usage_resource()), file=sys.stderr)
+
+def project_pagecounts(wiki_visits_pagecounts_file, wikicode, verbosity, file_index=0):
+    '''
+    Yield (title, views) for each entry for the `wikicode` project (e.g. 'en.z') in a 
+    pagecounts file. The same title can be yielded more than once.
     
     NB: see https://dumps.wikimedia.org/other/pagecounts-ez/ for format.
     Pageviews totals files have a wikicode project name in ascii followed by .z for wikipedias (e.g. en.z) followed by space, 
@@ -627,42 +711,141 @@ def visits_for_titles(wiki_title_ptrs, wiki_visits_pagecounts_file, file_index,
     or properly encoded in utf-8.
     '''
     from urllib.parse import unquote_to_bytes
-    used = 0
     match_project = (wikicode +' ').encode() 
     start_char = len(match_project)
+    name = wiki_visits_pagecounts_file if isinstance(wiki_visits_pagecounts_file, str) else wiki_visits_pagecounts_file.name
     
     with bz2.open(wiki_visits_pagecounts_file, 'rb') as PAGECOUNTfile:
         try:
             problem_lines = [] #there are apparently some errors in the unicode dumps
             for n, line in enumerate(PAGECOUNTfile):
                 if (n % 10000000 == 0) and verbosity:
-                    print("Reading pagecount file of number of page views: {} entries read from file {} ({}): mem usage {} Mb".format(n, file_index, wiki_visits_pagecounts_file.name, memory_usage_resource()), file=sys.stderr)
+                    print("Reading pagecount file of number of page views: {} entries read from file {} ({}): mem usage {} Mb".format(n, file_index, name, memory_usage_resource()), file=sys.stderr)
                 if line.startswith(match_project):
                     try:
                         info = line[start_char:].rstrip(b'\r\n\\rn').rsplit(b' ', 1)
                         title = unquote_to_bytes(info[0]).decode('UTF-8').replace(" ", "_") #even though most titles should not have spaces, some can sneak in via uri escaping
-                        wiki_title_ptrs[title]['PGviews'][file_index] = (wiki_title_ptrs[title]['PGviews'][file_index] or 0) + int(info[1]) #sometimes there are multiple encodings of the same title, with different visit numbers
-                        used += 1
+                        views = int(info[1])
                     except UnicodeDecodeError:
                         problem_lines.append(str(n))
-                    except KeyError:
-                        pass #title not in wiki_title_ptrs - this is expected for most entries
-                    except ValueError as e:
+                        continue
+                    except (ValueError, IndexError) as e:
                         if verbosity:
                             print(e, file=sys.stderr)
                             print(" Problem converting page view to an integer for {}".format(line), file=sys.stderr)
+                        continue
+                    yield title, views
         except EOFError as e:
             #this happens sometimes, dunno why
             if verbosity:
-                print(" Problem with end of file: {}. Used {} entries (should be {}: {}%. Skipping to next".format(e.args[-1],used, len(wiki_title_ptrs), used/len(wiki_title_ptrs) * 100), file=sys.stderr)
+                print(" Problem with end of file {}: {}. Skipping to next".format(name, e.args[-1]), file=sys.stderr)
         if len(problem_lines):
             if verbosity>0:
                 if verbosity<=2:
                     print(" Problem decoding {} lines, but these will be ones with strange accents etc, so should mostly not be taxa.".format(len(problem_lines)), file=sys.stderr)
                 else:
                     print(" Problem decoding certain lines: the following lines have been ignored:\n{}".format("  \n".join(problem_lines)), file=sys.stderr)
+
+def title_hash(title):
+    '''
+    A 64 bit hash of a wikipedia title that, unlike hash(), is the same between runs. 
+    With a few million titles per month, the chance of any collision is ~1e-6
+    '''
+    return int.from_bytes(hashlib.blake2b(title.encode('UTF-8'), digest_size=8).digest(), 'little')
+
+def title_hash_array(titles):
+    import numpy as np
+    return np.fromiter(map(title_hash, titles), dtype=np.uint64, count=len(titles))
+
+def file_checksum(filename, blocksize=1<<20):
+    checksum = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def pageview_cache(pageviews_filename, wikicode, cache_filename, verbosity=0):
+    '''
+    Parse a pagecounts file once, saving the total views of every `wikicode` title in 
+    it as a .npy array of (title_hash, views) sorted by title hash, which can be 
+    memory mapped and searched (see cached_visits). Returns cache_filename.
+    '''
+    import numpy as np
+    hashes = array('Q')
+    views = array('Q')
+    for title, n_views in project_pagecounts(pageviews_filename, wikicode, verbosity):
+        hashes.append(title_hash(title))
+        views.append(n_views)
+    hashes = np.frombuffer(hashes, dtype=np.uint64)
+    views = np.frombuffer(views, dtype=np.uint64)
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    #sum the views for titles that appear more than once (e.g. under different encodings)
+    starts = np.flatnonzero(np.diff(hashes, prepend=hashes[:1] + 1)) if len(hashes) else order
+    total_views = np.add.reduceat(views[order], starts) if len(hashes) else views
+    views_dtype = '<u4' if len(hashes) == 0 or total_views.max() < 2**32 else '<u8'
+    cache = np.empty(len(starts), dtype=[('hash', '<u8'), ('views', views_dtype)])
+    cache['hash'] = hashes[starts]
+    cache['views'] = total_views
+    tmp_filename = cache_filename + ".{}.tmp".format(os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        np.save(f, cache)
+    os.replace(tmp_filename, cache_filename)
     if verbosity:
-        print(" NB: of {} WikiData taxon entries, {} ({:.2f}%) have pageview data for {} in '{}'. mem usage {:.1f} Mb".format(len(wiki_title_ptrs), used, used/len(wiki_title_ptrs) * 100, wikicode, wiki_visits_pagecounts_file if isinstance(wiki_visits_pagecounts_file, str) else wiki_visits_pagecounts_file.name, memory_usage_resource()), file=sys.stderr)
+        print(" Cached views of {} titles for {} from {} in {}".format(len(cache), wikicode, pageviews_filename, cache_filename), file=sys.stderr)
+    return cache_filename
+
+def _pageview_cache(args):
+    return pageview_cache(*args)
+
+def pageview_caches(pageviews_files, wikicode, cache_dir, processes=None, verbosity=0):
+    '''
+    Return a list of cache file names, one for each (opened or named) pagecounts file,
+    creating any that do not yet exist. Caches are named by the wikicode and the sha1 
+    of the pagecounts file, so a renamed file is still found, and a changed one reparsed.
+    '''
+    filenames = [f if isinstance(f, str) else f.name for f in pageviews_files]
+    os.makedirs(cache_dir, exist_ok=True)
+    pool = None
+    if processes and processes > 1 and len(filenames) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(processes, len(filenames)))
+    try:
+        checksums = (pool.map if pool else map)(file_checksum, filenames)
+        cache_files = [
+            os.path.join(cache_dir, "pageviews_{}_{}.npy".format(wikicode, checksum))
+            for checksum in checksums]
+        to_parse = [
+            (filename, wikicode, cache_file, verbosity)
+            for filename, cache_file in zip(filenames, cache_files)
+            if not os.path.isfile(cache_file)]
+        if verbosity:
+            print(" {} of {} pageview files already cached in {}".format(len(filenames) - len(to_parse), len(filenames), cache_dir), file=sys.stderr)
+        if pool and len(to_parse) > 1:
+            pool.map(_pageview_cache, to_parse, chunksize=1)
+        else:
+            for args in to_parse:
+                pageview_cache(*args)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return cache_files
+
+def cached_visits(cache_filename, title_hashes):
+    '''
+    Yield (i, views) for each hash in title_hashes (an array returned by title_hash_array)
+    which has views recorded in the cache file
+    '''
+    import numpy as np
+    cache = np.load(cache_filename, mmap_mode='r')
+    if len(cache) == 0:
+        return
+    cached_hashes = cache['hash']
+    pos = np.searchsorted(cached_hashes, title_hashes)
+    pos[pos == len(cached_hashes)] = 0
+    found = np.flatnonzero(cached_hashes[pos] == title_hashes)
+    for i, views in zip(found.tolist(), cache['views'][pos[found]].tolist()):
+        yield i, views
 
 def calc_popularities_for_wikitaxa(wiki_items, popularity_function, verbosity=0, trim_highest=2):
     ''' calculate popularities for wikidata entries, based on page size & page views
@@ -680,14 +863,14 @@ def calc_popularities_for_wikitaxa(wiki_items, popularity_function, verbosity=0,
             trMeanViews = mean(sorted([x for x in data['PGviews'] if x is not None],  reverse=True)[trim_highest:])
             data['pop'] = (float(data['PGsz']) * trMeanViews)**0.5 #take the sqrt transform
             used += 1
-        except (StatisticsError, ValueError, KeyError):   #perhaps data is absent, a number is NA or we are trying to take a mean of an empty list - if so, ignore
+        except (StatisticsError, ValueError, KeyError, TypeError):   #perhaps data is absent, a number is NA or we are trying to take a mean of an empty list - if so, ignore
             pass
     if verbosity:
         print(" NB: of {} WikiData taxon entries, {} ({:.2f}%) have popularity measures. mem usage {:.1f} Mb".format(len(wiki_items), used, used/len(wiki_items) * 100, memory_usage_resource()), file=sys.stderr)
 
 
     
-def sum_popularity_over_tree(tree, OTT_ptrs=None, exclude=[], pop_store='pop', verbosity=0):
+def sum_popularity_over_tree(tree, OTT_ptrs=None, exclude=[], pop_store='pop', verbosity=0, use_arrays=True):
     """Add popularity indices for branch lengths based on a phylogenetic tree (and return the tree, or the number of root descendants).
     We might want to exclude some names from the popularity metric (e.g. exclude archosaurs, 
     to make sure birds don't gather popularity intended for dinosaurs). This is done by passing an
@@ -711,6 +894,11 @@ def sum_popularity_over_tree(tree, OTT_ptrs=None, exclude=[], pop_store='pop', v
     
     we also flag up the poor seed plants (Spermatophyta_ott1007992)- we could add a little to their pop value later
     
+    The sums are calculated using numpy arrays (see tree_arrays.py), unless use_arrays is False, in which
+    case we walk the dendropy nodes directly (this is slower on the full tree, but is kept for verification).
+    Reading each node's popularity, and storing the results on the nodes and in OTT_ptrs, are not vectorised:
+    they take a python pass over the nodes each, which is now most of the time taken. Each node's
+    OTT_ptrs entry is looked up only once, in the first of these passes.
     """
     from dendropy import Tree
     
@@ -720,18 +908,90 @@ def sum_popularity_over_tree(tree, OTT_ptrs=None, exclude=[], pop_store='pop', v
     if verbosity:
         print(" Tree read for phylogenetic popularity calc: mem usage {:.1f} Mb".format(memory_usage_resource()), file=sys.stderr)
     
-    #put popularity into the pop_store attribute
-    for node in tree.preorder_node_iter():
+    if use_arrays:
+        from tree_arrays import TreeArrays
+        arrays = TreeArrays(tree)
+        nodes = arrays.nodes #iterating over this list is much faster than using tree.preorder_node_iter()
+    else:
+        nodes = list(tree.preorder_node_iter())
+    exclude = set(exclude or [])
+    
+    #put popularity into the pop_store attribute, noting the OTT_ptrs entry of each node for later
+    ptrs = []
+    for node in nodes:
+        ptr = None
+        if OTT_ptrs:
+            try:
+                ptr = OTT_ptrs[int(node.label.rsplit("_ott",1)[1])]
+            except (LookupError, AttributeError, ValueError):
+                pass
+        ptrs.append(ptr)
         if node.label in exclude:
             node.pop_store=0
         else:
             try:
-                node.pop_store = float(OTT_ptrs[int(node.label.rsplit("_ott",1)[1])]['wd']['final_wiki_item']['pop']) if OTT_ptrs else node.data['wd']['final_wiki_item']['pop']
+                node.pop_store = float(ptr['wd']['final_wiki_item']['pop']) if OTT_ptrs else node.data['wd']['final_wiki_item']['pop']
                 node.has_pop = True
-            except (LookupError, AttributeError, ValueError):
+            except (LookupError, AttributeError, ValueError, TypeError):
                 node.pop_store=0
                 node.has_pop = False
     
+    if use_arrays:
+        sum_popularity_over_tree_arrays(arrays)
+    else:
+        sum_popularity_over_tree_nodes(tree)
+    
+    #place these values into the OTT_ptrs structure
+    if OTT_ptrs:
+        for node, ptr in zip(nodes, ptrs):
+            if ptr is None:
+                continue
+            try:
+                ptr['pop_self'] = node.pop_store
+                ptr['pop_ancst'] = node.ancestors_popsum #nb, this includes popularity of self
+                ptr['pop_dscdt'] = node.descendants_popsum
+                ptr['n_ancst'] = node.n_ancestors
+                ptr['n_dscdt'] = node.n_descendants
+                ptr['n_pop_ancst'] = node.n_pop_ancestors
+                ptr['is_seed_plant'] = node.seedplant
+            except (LookupError, AttributeError):
+                pass
+    return tree
+
+def sum_popularity_over_tree_arrays(arrays):
+    """
+    Set the descendants_popsum, n_descendants, ancestors_popsum, n_ancestors, n_pop_ancestors 
+    and seedplant attributes of each node in a TreeArrays object, given the pop_store and 
+    has_pop attributes, by vectorised passes up and down the arrays
+    """
+    import numpy as np
+    nodes = arrays.nodes
+    pop = np.array([node.pop_store for node in nodes], dtype=np.float64)
+    has_pop = np.array([bool(getattr(node, 'has_pop', None)) for node in nodes], dtype=np.int64)
+    is_seedplant_root = np.array([node.label == 'Spermatophyta' for node in nodes], dtype=np.int64)
+    if is_seedplant_root[1:].any():
+        print("Found plant root", file=sys.stderr)
+    
+    columns = (
+        arrays.descendant_sums(pop),
+        arrays.descendant_sums(np.ones(len(nodes), dtype=np.int64)),
+        arrays.ancestor_sums(pop),
+        arrays.depth,
+        arrays.ancestor_sums(has_pop),
+        arrays.ancestor_sums(is_seedplant_root) > 0,
+    )
+    for node, d_pop, n_d, a_pop, n_a, n_pop_a, seedplant in zip(nodes, *[c.tolist() for c in columns]):
+        node.descendants_popsum = d_pop
+        node.n_descendants = n_d
+        node.ancestors_popsum = a_pop
+        node.n_ancestors = n_a
+        node.n_pop_ancestors = n_pop_a
+        node.seedplant = seedplant
+
+def sum_popularity_over_tree_nodes(tree):
+    """
+    As sum_popularity_over_tree_arrays(), but walking the dendropy node objects
+    """
     #go up the tree from the tips, summing up the popularity indices beneath and adding the number of descendants
     for node in tree.postorder_node_iter():
         if node.is_leaf():
@@ -768,21 +1028,6 @@ def sum_popularity_over_tree(tree, OTT_ptrs=None, exclude=[], pop_store='pop', v
                 print("Found plant root", file=sys.stderr)
             else:
                 node.seedplant = node._parent_node.seedplant
-    
-    #place these values into the OTT_ptrs structure
-    if OTT_ptrs:
-        for node in tree.preorder_node_iter():
-            try:
-                OTT_ptrs[int(node.label.rsplit("_ott",1)[1])]['pop_self'] = node.pop_store
-                OTT_ptrs[int(node.label.rsplit("_ott",1)[1])]['pop_ancst'] = node.ancestors_popsum #nb, this includes popularity of self
-                OTT_ptrs[int(node.label.rsplit("_ott",1)[1])]['pop_dscdt'] = node.descendants_popsum
-                OTT_ptrs[int(node.label.rsplit("_ott",1)[1])]['n_ancst'] = node.n_ancestors
-                OTT_ptrs[int(node.label.rsplit("_ott",1)[1])]['n_dscdt'] = node.n_descendants
-                OTT_ptrs[int(node.label.rsplit("_ott",1)[1])]['n_pop_ancst'] = node.n_pop_ancestors
-                OTT_ptrs[int(node.label.rsplit("_ott",1)[1])]['is_seed_plant'] = node.seedplant
-            except (LookupError, AttributeError):
-                pass
-    return tree
 
 if __name__ == "__main__":
     import argparse
@@ -797,17 +1042,25 @@ if __name__ == "__main__":
     parser.add_argument('--exclude', nargs='*', help='(optional) a number of taxa to exclude, such as Dinosauria_ott90215, Archosauria_ott335588')
     parser.add_argument('--csvoutfile', '-o', type=argparse.FileType('w', encoding='UTF-8'), default=sys.stdout, help='The file in which to save the output, as comma separated values')
     parser.add_argument('--wikilang', '-l', default='en', help='The language wikipedia to check, e.g. "en"')
+    parser.add_argument('--taxonomy_cache_dir', default=None, help='(Optional) a directory in which to cache the parsed OpenTreeTaxonomy file, so that it is only parsed once')
+    parser.add_argument('--pageview_cache_dir', default=None, help='(Optional) a directory in which to cache the parsed pageview files, so that each month is only read once')
+    parser.add_argument('--processes', type=int, default=None, help='(Optional) the number of pageview files to parse in parallel, when using --pageview_cache_dir')
     parser.add_argument('--verbosity', '-v', action="count", default=0, help='verbosity: output extra non-essential info: -v=normal. -vv also show entries with no wikipedia page -vvv also show entries with wikidata database IDs that are not present in OTT')
     
     args = parser.parse_args()
         
     sources = ['ncbi','if','worms','irmng','gbif'] #wikidata does not have irmng, but it is useful for other reasons, e.g. to get EoL ids
     OTT_ptrs = {} #this gets filled out
-    source_ptrs = create_from_taxonomy(args.OpenTreeTaxonomy, sources, OTT_ptrs, args.verbosity)
+    taxonomy_cache = None
+    if args.taxonomy_cache_dir:
+        from taxonomy_cache import TaxonomyCache
+        taxonomy_cache = TaxonomyCache.for_file(args.OpenTreeTaxonomy, args.taxonomy_cache_dir, args.verbosity)
+    source_ptrs = create_from_taxonomy(args.OpenTreeTaxonomy, sources, OTT_ptrs, args.verbosity, taxonomy_cache=taxonomy_cache)
     wiki_title_ptrs = add_wikidata_info(source_ptrs, args.wikidataDumpFile, args.wikilang, args.verbosity, None)
     identify_best_wikidata(OTT_ptrs, sources, args.verbosity)
     add_pagesize_for_titles(wiki_title_ptrs, args.wikipediaSQLDumpFile, args.verbosity)
-    add_pageviews_for_titles(wiki_title_ptrs, args.wikipedia_totals_bz2_pageviews, args.wikilang, args.verbosity)
+    add_pageviews_for_titles(wiki_title_ptrs, args.wikipedia_totals_bz2_pageviews, args.wikilang, args.verbosity,
+        cache_dir=args.pageview_cache_dir, processes=args.processes)
     calc_popularities_for_wikitaxa(wiki_title_ptrs.values(), "", args.verbosity)
     
     if args.OpenTreeFile:
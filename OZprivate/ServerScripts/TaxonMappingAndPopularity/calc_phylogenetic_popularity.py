@@ -25,7 +25,26 @@ In this particular instance, it seems sensible to sum up the total of the subspe
 try e.g. 
 
 ServerScripts/TaxonMappingAndPopularity/calc_phylogenetic_popularity.py data/output_files/raw_pop data/OpenTree/draftversion5.tre -p sum_ancestor_and_descendant_popularities -b ../static/FinalOutputs/Life_full_tree.phy -v -x Dinosauria_ott90215 -x Archosauria_ott335588 > data/output_files/Data_phylo.csv
+
+To compare many variants of the popularity function at once, give a grid of parameters to --sweep 
+(see sweep_parameters() for their meaning). Each combination is output as a column of leaf popularities,
+and the spearman rank correlations between the columns can be saved using --sweep_summary, e.g.
+
+ServerScripts/TaxonMappingAndPopularity/calc_phylogenetic_popularity.py data/output_files/raw_pop data/OpenTree/draftversion5.tre -x Dinosauria_ott90215 Archosauria_ott335588 --sweep trim_highest=0,2,4 log_power=0,0.5,1 ancestor_weight=0,1 --sweep_summary sweep_correlations.csv > sweep.csv
 """
+import argparse
+import csv
+import re
+import sys
+import random
+from collections import OrderedDict
+from itertools import product
+import numpy as np
+from dendropy import Tree
+from statistics import mean, StatisticsError
+from OTT_popularity_mapping import sum_popularity_over_tree, calc_popularities_for_wikitaxa
+from tree_arrays import TreeArrays
+
 
 def create_structure_from_file(OTTfile):
     """
@@ -48,107 +67,252 @@ def create_structure_from_file(OTTfile):
     for row in csvin:
         [int(row[col]) for col in viewcols if row[col] and row[col].isdigit()]
         d = OTT_ptrs[int(row["OTT_ID"])] = {}
-        d['Q'] = None if row["Qid"] == '' else int(row["Qid"])
-        d['PGsz'] = None if row["PageSize"] == '' else int(row["PageSize"])
+        d['Q'] = None if not row["Qid"] else int(row["Qid"]) #rows without wikidata info may have missing columns
+        d['PGsz'] = None if not row["PageSize"] else int(row["PageSize"])
         d['PGviews'] = [int(row[col]) for col in viewcols if row[col] and row[col].isdigit()]
         if "PopBase" in row:
-            d['oldpop'] = None if row["PopBase"] == '' else float(row["PopBase"])
+            d['oldpop'] = None if not row["PopBase"] else float(row["PopBase"])
     return OTT_ptrs
 
 
-import argparse
-import csv
-import re
-import sys
-import random
-from dendropy import Tree
-from statistics import mean, StatisticsError
-from OTT_popularity_mapping import sum_popularity_over_tree, calc_popularities_for_wikitaxa
+SWEEP_DEFAULTS = OrderedDict([
+    ('trim_highest', 2),
+    ('size_power', 0.5),
+    ('views_power', 0.5),
+    ('ancestor_weight', 1.0),
+    ('descendant_weight', 1.0),
+    ('log_power', 1.0),
+])
 
-parser = argparse.ArgumentParser(description='Create a phylogenetic tree of life with branch lengths as popularity indices.')
-parser.add_argument('popularity_csvfile', type=argparse.FileType('r', encoding='UTF-8'), help='A csv data file with headers containing OTT_ID, PageSize, and various pagecounts columns')
-parser.add_argument('intree', type=argparse.FileType('r', encoding='UTF-8'), help='A newick-formatted input tree, e.g. the entire tree of life (draftversion4.tre) or fulltree.phy. Note that it may help if the tree still contains unifurcations')
-parser.add_argument('--pop_measure', '-p', choices=['popularity', 'sum_ancestor_popularities', 'sum_descendant_popularities', 'sum_ancestor_and_descendant_popularities'], help='what should the measures or branch lengths in the new tree represent? (NB: "ancestor" popularities include the popularity of self)', default='popularity')
-parser.add_argument('--print_leaves_from_bespoke_tree', '-b', type=argparse.FileType('r', encoding='UTF-8'), help='If another newick file is specified here, instead of outputting a newick file, the program will output the immediate branch_length values for each leaf from this tree, sorted by popularity')
-parser.add_argument('--exclude', '-x', nargs='*', help='(optional) a number of taxa to exclude, such as Dinosauria_ott90215, Archosauria_ott335588')
-parser.add_argument('--verbosity', '-v', action="count", help='verbosity level for outputting extra non-essential info')
-
-args = parser.parse_args()
-
-def warn(*objs):
-    print(*objs, file=sys.stderr)
-
-OTT_ptrs = create_structure_from_file(args.popularity_csvfile)
-calc_popularities_for_wikitaxa(OTT_ptrs, '', args.verbosity)
-tree = sum_popularity_over_tree(OTT_ptrs, args.intree, args.exclude, args.verbosity)
-
-if args.print_leaves_from_bespoke_tree:
-    print("Outputting leaf data", file=sys.stderr)
-    data_from_bespoke_tree = []
-    colmap = ['id','pop','name','raw_pop', 'ancst_pop', 'dscdt_pop','n_ancst','n_dscdt','n_pop_ancst', 'seedplant']
-    leaves_from_tree = Tree.get(file=args.print_leaves_from_bespoke_tree, schema='newick', preserve_underscores=True, suppress_leaf_node_taxa=True)
-    for leaf in leaves_from_tree.leaf_node_iter():
-        
-        try:
-            nm, OTTid = leaf.label.rsplit("_ott",1)
-            OTTid = int(OTTid)
-            try:
-                raw_pop = OTT_ptrs[OTTid]['wd']['pop']
-            except:
-                raw_pop = 0
-            try:
-                apop = OTT_ptrs[OTTid]['pop_ancst']
-            except:
-                apop = 0
-            try:
-                dpop = OTT_ptrs[OTTid]['pop_dscdt']
-            except:
-                dpop = 0
-            try:
-                na = OTT_ptrs[OTTid]['n_ancst']
-            except:
-                na = 0
-            try:
-                nd = OTT_ptrs[OTTid]['n_dscdt']
-            except:
-                nd = 0
-            try:
-                npa = OTT_ptrs[OTTid]['n_pop_ancst']
-            except:
-                npa = 0
+def sweep_parameters(sweep_specs):
+    """
+    Turn a list of strings such as ['trim_highest=0,2', 'log_power=0,0.5,1'] into a list of
+    OrderedDicts, one for each combination of values. Parameters that are not given take their
+    value from SWEEP_DEFAULTS. For each taxon, the parameters are used to calculate
+    
+    base = PageSize**size_power * (mean PageViews, omitting the trim_highest months)**views_power
+    popularity = (ancestor_weight * sum of base over self and ancestors + descendant_weight * sum of base over descendants)
+                  / log(number of ancestors + number of descendants)**log_power
+    
+    so that the defaults give the standard measure (see popularity_function() in CSV_base_table_creator.py)
+    """
+    values = OrderedDict((k, [v]) for k, v in SWEEP_DEFAULTS.items())
+    for spec in sweep_specs:
+        name, _, vals = spec.partition("=")
+        if name not in SWEEP_DEFAULTS or not vals:
+            raise ValueError("Sweep parameters should be given as name=value1,value2,... where name is one of {}".format(", ".join(SWEEP_DEFAULTS)))
+        values[name] = [type(SWEEP_DEFAULTS[name])(v) for v in vals.split(",")]
+    return [OrderedDict(zip(values.keys(), combination)) for combination in product(*values.values())]
+
+def sweep_column_name(params, param_sets):
+    """Name a column by the parameters that vary between the different sets"""
+    varying = [k for k in params if len(set(p[k] for p in param_sets)) > 1]
+    return " ".join("{}={}".format(k, params[k]) for k in varying) or "popularity"
+
+def load_popularity_arrays(OTTfile):
+    """
+    Like create_structure_from_file(), but return numpy arrays of (OTT ids, page sizes, page views),
+    where page views is a 2D array with a column for each month, and missing values are NaN
+    """
+    csvin = csv.DictReader(OTTfile)
+    viewcols = [col for col in csvin.fieldnames if 'pagecounts' in col]
+    def number(val):
+        return float(val) if val and val.isdigit() else np.nan
+    otts = []
+    page_sizes = []
+    page_views = []
+    for row in csvin:
+        otts.append(int(row["OTT_ID"]))
+        page_sizes.append(number(row.get("PageSize")))
+        page_views.append([number(row[col]) for col in viewcols])
+    return (
+        np.array(otts, dtype=np.int64),
+        np.array(page_sizes, dtype=np.float64),
+        np.array(page_views, dtype=np.float64).reshape(len(otts), len(viewcols)))
+
+def base_popularity(page_sizes, page_views, trim_highest, size_power, views_power):
+    """
+    A vectorised version of calc_popularities_for_wikitaxa() (from OTT_popularity_mapping.py).
+    Taxa without a page size, or with no months left after trimming, get NaN
+    """
+    descending_views = -np.sort(-page_views, axis=1) #NaNs remain at the end
+    n_months = np.count_nonzero(~np.isnan(page_views), axis=1) - trim_highest
+    with np.errstate(invalid='ignore', divide='ignore'):
+        trimmed_mean = np.nansum(descending_views[:, trim_highest:], axis=1) / n_months
+        trimmed_mean[n_months <= 0] = np.nan
+        return page_sizes**size_power * trimmed_mean**views_power
+
+def sweep_popularity(tree, otts, page_sizes, page_views, param_sets, exclude=(), all_nodes=False):
+    """
+    Calculate the popularity of each leaf (or each node, if all_nodes is True) in a dendropy tree 
+    for each of the parameter sets returned by sweep_parameters(), summing over the tree only once.
+    Returns (labels, matrix) where matrix has a row for each labelled taxon and a column for each 
+    parameter set
+    """
+    arrays = TreeArrays(tree)
+    exclude = set(exclude or [])
+    row_for_ott = {ott: i for i, ott in enumerate(otts.tolist())}
+    node_rows = np.full(len(arrays), -1, dtype=np.int64)
+    for i, node in enumerate(arrays.nodes):
+        if node.label and node.label not in exclude:
             try:
-                sp = 1 if OTT_ptrs[OTTid]['is_seed_plant'] else 0
-            except:
-                sp = 0
-
-            if args.pop_measure == 'sum_ancestor_popularities':
-                pop = apop
-            elif args.pop_measure == 'sum_descendant_popularities':
-                pop = dpop
-            elif args.pop_measure == 'sum_ancestor_and_descendant_popularities':
-                pop = apop + dpop
-            else:
-                pop = raw_pop
-
-            data_from_bespoke_tree.append([OTTid, pop, nm, raw_pop, apop, dpop, na, nd, npa, sp])
-        except (ValueError):
-            pass
-    nodewriter = csv.writer(sys.stdout, quoting=csv.QUOTE_MINIMAL, delimiter = '\t')
-    nodewriter.writerow(colmap)
-    for row in sorted(data_from_bespoke_tree, reverse = True, key = lambda row: row[1]):
-        nodewriter.writerow(row)
-else:
-    print("Outputting new tree", file=sys.stderr)
-
-    #Before doing this, we might want to set the edge lengths to either ancestor_sum_popularities, descendant
-    for nodes in tree.preorder_node_iter():
-        if node.edge.length:
-            if args.pop_measure == 'popularity':
-                node
-            elif args.pop_measure == 'sum_ancestor_popularities':
+                node_rows[i] = row_for_ott[int(node.label.rsplit("_ott",1)[1])]
+            except (IndexError, ValueError, KeyError):
                 pass
-            elif args.pop_measure == 'sum_descendant_popularities':
-                pass
-            elif args.pop_measure == 'sum_ancestor_and_descendant_popularities':
+    
+    #one set of base popularities (a column in node_pop) for each distinct base parameter set
+    base_keys = ('trim_highest', 'size_power', 'views_power')
+    bases = OrderedDict.fromkeys(tuple(p[k] for k in base_keys) for p in param_sets)
+    base_column = {key: i for i, key in enumerate(bases)}
+    node_pop = np.zeros((len(arrays), len(bases)))
+    has_data = node_rows >= 0
+    for key, i in base_column.items():
+        node_pop[has_data, i] = base_popularity(page_sizes, page_views, *key)[node_rows[has_data]]
+    np.nan_to_num(node_pop, copy=False, nan=0.0)
+    
+    ancestors_popsum = arrays.ancestor_sums(node_pop)
+    descendants_popsum = arrays.descendant_sums(node_pop)
+    n_nodes = arrays.depth + arrays.descendant_sums(np.ones(len(arrays), dtype=np.int64))
+    
+    is_leaf = np.array([not node._child_nodes for node in arrays.nodes])
+    selected = np.flatnonzero(np.array([bool(node.label) for node in arrays.nodes]) & (all_nodes | is_leaf))
+    columns = np.array([base_column[tuple(p[k] for k in base_keys)] for p in param_sets])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        matrix = (
+            ancestors_popsum[selected][:, columns] * np.array([p['ancestor_weight'] for p in param_sets]) +
+            descendants_popsum[selected][:, columns] * np.array([p['descendant_weight'] for p in param_sets])
+        ) / np.log(n_nodes[selected])[:, None]**np.array([p['log_power'] for p in param_sets])
+    return [arrays.nodes[i].label for i in selected], matrix
+
+def average_ranks(values):
+    """Rank the values (1 = lowest, NaNs ranked lowest), giving tied values their average rank"""
+    values = np.where(np.isnan(values), -np.inf, values)
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    starts = np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+    ends = np.r_[starts[1:], len(values)]
+    ranks = np.empty(len(values))
+    ranks[order] = np.repeat((starts + ends + 1) / 2, ends - starts)
+    return ranks
+
+def spearman_correlations(matrix):
+    """The matrix of spearman rank correlations between the columns of a matrix"""
+    ranks = np.column_stack([average_ranks(matrix[:, i]) for i in range(matrix.shape[1])])
+    return np.atleast_2d(np.corrcoef(ranks, rowvar=False))
+
+def output_sweep(args):
+    param_sets = sweep_parameters(args.sweep)
+    names = [sweep_column_name(p, param_sets) for p in param_sets]
+    otts, page_sizes, page_views = load_popularity_arrays(args.popularity_csvfile)
+    tree = Tree.get(file=args.intree, schema='newick', suppress_edge_lengths=True, preserve_underscores=True, suppress_leaf_node_taxa=True)
+    labels, matrix = sweep_popularity(tree, otts, page_sizes, page_views, param_sets, args.exclude, args.sweep_all_nodes)
+    if args.sweep_summary:
+        correlations = spearman_correlations(matrix)
+        summarywriter = csv.writer(args.sweep_summary, quoting=csv.QUOTE_MINIMAL)
+        summarywriter.writerow(["spearman"] + names)
+        for name, row in zip(names, correlations.tolist()):
+            summarywriter.writerow([name] + ["{:.4f}".format(r) for r in row])
+    print("Outputting {} popularity measures for {} taxa".format(len(names), len(labels)), file=sys.stderr)
+    nodewriter = csv.writer(sys.stdout, quoting=csv.QUOTE_MINIMAL)
+    nodewriter.writerow(["name"] + names)
+    for label, row in zip(labels, matrix.tolist()):
+        nodewriter.writerow([label] + row)
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a phylogenetic tree of life with branch lengths as popularity indices.')
+    parser.add_argument('popularity_csvfile', type=argparse.FileType('r', encoding='UTF-8'), help='A csv data file with headers containing OTT_ID, PageSize, and various pagecounts columns')
+    parser.add_argument('intree', type=argparse.FileType('r', encoding='UTF-8'), help='A newick-formatted input tree, e.g. the entire tree of life (draftversion4.tre) or fulltree.phy. Note that it may help if the tree still contains unifurcations')
+    parser.add_argument('--pop_measure', '-p', choices=['popularity', 'sum_ancestor_popularities', 'sum_descendant_popularities', 'sum_ancestor_and_descendant_popularities'], help='what should the measures or branch lengths in the new tree represent? (NB: "ancestor" popularities include the popularity of self)', default='popularity')
+    parser.add_argument('--print_leaves_from_bespoke_tree', '-b', type=argparse.FileType('r', encoding='UTF-8'), help='If another newick file is specified here, instead of outputting a newick file, the program will output the immediate branch_length values for each leaf from this tree, sorted by popularity')
+    parser.add_argument('--exclude', '-x', nargs='*', help='(optional) a number of taxa to exclude, such as Dinosauria_ott90215, Archosauria_ott335588')
+    parser.add_argument('--verbosity', '-v', action="count", help='verbosity level for outputting extra non-essential info')
+    parser.add_argument('--sweep', nargs='+', metavar='NAME=VALUES', help='Instead of outputting a tree, output the leaf popularities calculated using a grid of parameters to the popularity function, one column per combination of parameters, e.g. trim_highest=0,2 log_power=0,0.5,1. Possible names are {}'.format(", ".join(SWEEP_DEFAULTS)))
+    parser.add_argument('--sweep_summary', type=argparse.FileType('w', encoding='UTF-8'), help='When using --sweep, save the spearman rank correlations between each pair of popularity measures in this csv file')
+    parser.add_argument('--sweep_all_nodes', action='store_true', help='When using --sweep, output the popularities of all the labelled nodes in the tree, not just the leaves')
+
+    args = parser.parse_args()
+    
+    if args.sweep:
+        output_sweep(args)
+        return
+
+    def warn(*objs):
+        print(*objs, file=sys.stderr)
+
+    OTT_ptrs = {OTTid: {'wd': {'final_wiki_item': d}} for OTTid, d in create_structure_from_file(args.popularity_csvfile).items()}
+    calc_popularities_for_wikitaxa([p['wd']['final_wiki_item'] for p in OTT_ptrs.values()], '', args.verbosity)
+    tree = sum_popularity_over_tree(args.intree, OTT_ptrs, args.exclude, verbosity=args.verbosity)
+
+    if args.print_leaves_from_bespoke_tree:
+        print("Outputting leaf data", file=sys.stderr)
+        data_from_bespoke_tree = []
+        colmap = ['id','pop','name','raw_pop', 'ancst_pop', 'dscdt_pop','n_ancst','n_dscdt','n_pop_ancst', 'seedplant']
+        leaves_from_tree = Tree.get(file=args.print_leaves_from_bespoke_tree, schema='newick', preserve_underscores=True, suppress_leaf_node_taxa=True)
+        for leaf in leaves_from_tree.leaf_node_iter():
+        
+            try:
+                nm, OTTid = leaf.label.rsplit("_ott",1)
+                OTTid = int(OTTid)
+                try:
+                    raw_pop = OTT_ptrs[OTTid]['wd']['final_wiki_item']['pop']
+                except:
+                    raw_pop = 0
+                try:
+                    apop = OTT_ptrs[OTTid]['pop_ancst']
+                except:
+                    apop = 0
+                try:
+                    dpop = OTT_ptrs[OTTid]['pop_dscdt']
+                except:
+                    dpop = 0
+                try:
+                    na = OTT_ptrs[OTTid]['n_ancst']
+                except:
+                    na = 0
+                try:
+                    nd = OTT_ptrs[OTTid]['n_dscdt']
+                except:
+                    nd = 0
+                try:
+                    npa = OTT_ptrs[OTTid]['n_pop_ancst']
+                except:
+                    npa = 0
+                try:
+                    sp = 1 if OTT_ptrs[OTTid]['is_seed_plant'] else 0
+                except:
+                    sp = 0
+
+                if args.pop_measure == 'sum_ancestor_popularities':
+                    pop = apop
+                elif args.pop_measure == 'sum_descendant_popularities':
+                    pop = dpop
+                elif args.pop_measure == 'sum_ancestor_and_descendant_popularities':
+                    pop = apop + dpop
+                else:
+                    pop = raw_pop
+
+                data_from_bespoke_tree.append([OTTid, pop, nm, raw_pop, apop, dpop, na, nd, npa, sp])
+            except (ValueError):
                 pass
-    print(tree.as_string(schema='newick', unquoted_underscores=True, suppress_leaf_node_labels=False))
\ No newline at end of file
+        nodewriter = csv.writer(sys.stdout, quoting=csv.QUOTE_MINIMAL, delimiter = '\t')
+        nodewriter.writerow(colmap)
+        for row in sorted(data_from_bespoke_tree, reverse = True, key = lambda row: row[1]):
+            nodewriter.writerow(row)
+    else:
+        print("Outputting new tree", file=sys.stderr)
+
+        #Before doing this, we might want to set the edge lengths to either ancestor_sum_popularities, descendant
+        for node in tree.preorder_node_iter():
+            if node.edge.length:
+                if args.pop_measure == 'popularity':
+                    node
+                elif args.pop_measure == 'sum_ancestor_popularities':
+                    pass
+                elif args.pop_measure == 'sum_descendant_popularities':
+                    pass
+                elif args.pop_measure == 'sum_ancestor_and_descendant_popularities':
+                    pass
+        print(tree.as_string(schema='newick', unquoted_underscores=True, suppress_leaf_node_labels=False))
+
+if __name__ == "__main__":
+    main()
@@ -271,7 +271,7 @@ def write_preorder_ages(self, node_dates_filehandle, leaf_dates_filehandle=None,
     node_dates_filehandle.write(end[-1])
     node_dates_filehandle.flush()
 
-def write_preorder_to_csv(self, leaf_file, extra_leaf_data_properties, node_file, extra_node_data_properties, root_parent_id):
+def write_preorder_to_csv(self, leaf_file, extra_leaf_data_properties, node_file, extra_node_data_properties, root_parent_id, rows_per_write=10000):
     """
     Write the leaf and node info for this tree to csv files.
     * for leaves, always write the parent, name, and extinction_data
@@ -280,140 +280,223 @@ def write_preorder_to_csv(self, leaf_file, extra_leaf_data_properties, node_file
     contained in the data property dictionary of each node (or blank if the property does not exist), 
     e.g. for leaves this might be extinction_date,ott,wikidata,wikipedia_lang_flag,eol,iucn,popularity,popularity_rank,price,ncbi,ifung,worms,irmng,gbif
     for nodes: age,ott,wikidata,wikipedia_lang_flag,eol,popularity,ncbi,ifung,worms,irmng,gbif,vern_synth,rep1,...,rtr1,...,iucnNE,...
+    
+    The tree is walked using a list of the nodes in preorder, and the rows are written
+    in batches of rows_per_write
     """
     import csv
-    from collections import OrderedDict
-    from warnings import warn
     leaf_csv = csv.writer(leaf_file, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
     leaf_csv.writerow(['parent','real_parent','name', 'extinction_date'] + list(extra_leaf_data_properties.keys()))
     node_csv = csv.writer(node_file, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
     node_csv.writerow(['parent','real_parent','node_rgt','leaf_lft','leaf_rgt','name', 'age'] + list(extra_node_data_properties.keys()))
+    leaf_keys = list(extra_leaf_data_properties.values())
+    node_keys = list(extra_node_data_properties.values())
     
+    nodes = preorder_nodes(self.seed_node)
     #allocate node numbers
     internal_node_number = 0
-    for node in self.preorder_internal_node_iter():
-        internal_node_number += 1 #NB: increment first, since we use a 1-base numbering system, for mySQL row numbering
-        node.id = internal_node_number
+    for node in nodes:
+        if node._child_nodes:
+            internal_node_number += 1 #NB: increment first, since we use a 1-base numbering system, for mySQL row numbering
+            node.id = internal_node_number
     
-    #postorder traversal to allocate rgt side of ranges
-    internal_leaf_count = 0
-    prev_node = None
-    for node in self.postorder_node_iter():
-        #find rightmost leaf by postorder iteration.
-        #For rightmost node, if previously visited node is a leaf, then (because we are ladderized ascending)
-        # the rightmost node must be self (i.e. this is a terminal internal node). Otherwise it is the previously visted node 
-        if node.is_leaf():
-            internal_leaf_count += 1
+    #reverse preorder traversal (children before parents) to count leaves and allocate rgt side of ranges.
+    #The node_rgt is the node itself if the last child is a leaf (because we are ladderized ascending this
+    #is a terminal internal node), otherwise it is the same as the node_rgt of the last child
+    #(dicts are keyed by id(node), which is much faster than hashing a dendropy node)
+    n_leaves = {}
+    node_rgt = {}
+    for node in reversed(nodes):
+        child_nodes = node._child_nodes
+        if child_nodes:
+            n_leaves[id(node)] = sum([n_leaves[id(ch)] for ch in child_nodes])
+            node_rgt[id(node)] = node_rgt.get(id(child_nodes[-1]), node.id)
         else:
-            node.last_leaf = internal_leaf_count #should have counted all the internal leaves by now
-            if prev_node.is_leaf():
-                node.node_rgt = node.id #node_rgt == self
-            else:
-                #the node_rgt should be the same as the node_rgt of the previous node
-                node.node_rgt = prev_node.node_rgt
-        prev_node = node
+            n_leaves[id(node)] = 1
     
     leaf_count = 1
-    extra_leaf_output = OrderedDict()
-    extra_node_output = OrderedDict()
-    for node in self.preorder_node_iter():
-        if node.is_leaf():
-            base_output = [node.parent_node.id, 
-                           #negative real_parent ids if this is a polytomy
-                           -node.real_parent_node.id if node.edge.length==0 else node.real_parent_node.id,
-                           node.label,
-                           getattr(node, 'extinction_date', None)]
-            for colname, keys in extra_leaf_data_properties.items():
-                try:
-                    extra_leaf_output[colname] = node.data
-                    for k in keys:
-                        extra_leaf_output[colname] = extra_leaf_output[colname][k]
-                except (KeyError, TypeError, AttributeError): #catch none existent key name, None, or no data attribute (e.g. for polytomies)
-                    extra_leaf_output[colname] = None           
-            leaf_csv.writerow(base_output + list(extra_leaf_output.values()))
-            leaf_count += 1
+    leaf_rows = []
+    node_rows = []
+    for node in nodes:
+        if node._child_nodes:
+            node_rows.append([
+                node._parent_node.id if node._parent_node else root_parent_id,
+                (-node.real_parent_node.id if node.edge.length==0 else node.real_parent_node.id) if hasattr(node,'real_parent_node') else 0,
+                node_rgt[id(node)],
+                leaf_count,
+                leaf_count + n_leaves[id(node)] - 1,
+                node.label,
+                getattr(node, 'age', None)] + data_values(node, node_keys))
+            if len(node_rows) >= rows_per_write:
+                node_csv.writerows(node_rows)
+                node_rows = []
         else:
-            base_output = [node.parent_node.id if node.parent_node else root_parent_id,
-                           (-node.real_parent_node.id if node.edge.length==0 else node.real_parent_node.id) if hasattr(node,'real_parent_node') else 0,
-                           node.node_rgt,
-                           leaf_count,
-                           node.last_leaf,
-                           node.label,
-                           getattr(node, 'age', None)]
-            for colname, keys in extra_node_data_properties.items():
-                try:
-                    extra_node_output[colname] = node.data
-                    for k in keys:
-                        extra_node_output[colname] = extra_node_output[colname][k]
-                except (KeyError, TypeError, AttributeError): #catch none existent key name, None, or no data attribute (e.g. for polytomies)
-                    extra_node_output[colname] = None
-            node_csv.writerow(base_output + list(extra_node_output.values()))
+            leaf_rows.append([
+                node._parent_node.id,
+                #negative real_parent ids if this is a polytomy
+                -node.real_parent_node.id if node.edge.length==0 else node.real_parent_node.id,
+                node.label,
+                getattr(node, 'extinction_date', None)] + data_values(node, leaf_keys))
+            leaf_count += 1
+            if len(leaf_rows) >= rows_per_write:
+                leaf_csv.writerows(leaf_rows)
+                leaf_rows = []
+    leaf_csv.writerows(leaf_rows)
+    node_csv.writerows(node_rows)
+
+
+def data_values(node, key_lists):
+    """
+    Look up a nested item in the data property dictionary of the node for each list of keys
+    in key_lists, using None for any which do not exist. Plain dicts are looked up using get()
+    since raising and catching a KeyError for every missing item is slow
+    """
+    try:
+        data = node.data
+    except AttributeError: #no data attribute (e.g. for polytomies)
+        return [None] * len(key_lists)
+    values = []
+    for keys in key_lists:
+        value = data
+        try:
+            for k in keys:
+                if value.__class__ is dict:
+                    value = value.get(k)
+                    if value is None:
+                        break
+                else:
+                    value = value[k]
+        except (KeyError, TypeError, AttributeError): #catch none existent key name, or None
+            value = None
+        values.append(value)
+    return values
+
+
+def preorder_nodes(node):
+    """
+    A list of the node and all its descendants, in preorder (the same order as dendropy's
+    preorder_node_iter), found without recursion so that very deep trees can be handled
+    """
+    nodes = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        if node._child_nodes:
+            stack.extend(reversed(node._child_nodes))
+    return nodes
 
 
 #
 # To be patched into the Node object
 #
 
-def write_brief_newick(self, out, polytomy_braces="()", write_otts=False):
+def write_brief_newick(self, out, polytomy_braces="()", write_otts=False, items_per_write=100000):
     """
-    Copied from the default dendropy 4 function Node._write_newick
+    Based on the default dendropy 4 function Node._write_newick
     The function requires a binary tree, and the tree should have been ladderized beforehand 
     It outputs id a string consisting of braces only (no commas), such that the number of tips 
     (and therefore the number of nodes-1, since this is a binary tree) is equal to the number of 
     characters in the string. Edges lengths are not output, but internal nodes that have an edge 
-    length of 0 are represented by 'polytomy_braces' which can be specified, e.g. '{}' or '<>'
+    length of 0 are represented by 'polytomy_braces' which can be specified, e.g. '{}' or '<>'.
+    If write_otts is True, the ott of this (the top) node is written after its closing brace.
+    
+    The tree is walked using a stack rather than by recursion, so that very deep trees can be
+    output, and the output is written in chunks of items_per_write strings
     """
-    child_nodes = self.child_nodes()
-    if child_nodes:
-        if self.edge and self.edge.length==0: #if 0, this is a polytomy
-            out.write(polytomy_braces[0]) #added
+    if not self._child_nodes:
+        return
+    buf = []
+    #the stack contains internal nodes still to be output, and the strings to output after them.
+    #Leaves are output as empty strings, so they never need to go on the stack
+    stack = [self]
+    while stack:
+        node = stack.pop()
+        if node.__class__ is str:
+            buf.append(node)
+            continue
+        child_nodes = node._child_nodes
+        assert(len(child_nodes)==2)
+        f_child, s_child = child_nodes
+        if node.edge and node.edge.length==0: #if 0, this is a polytomy
+            open_brace, close_brace = polytomy_braces[0], polytomy_braces[1]
         else:
-            out.write('(')
-        assert(len(child_nodes)==2) #added
-        f_child = child_nodes[0]
-        for child in child_nodes:
-            if child is not f_child:
-                out.write(',')
-            child.write_brief_newick(out, polytomy_braces)
-        if self.edge and self.edge.length==0:
-            out.write(polytomy_braces[1]) #added
-            if write_otts and 'ott' in self.data:
-                out.write(str(self.data['ott']))
+            open_brace, close_brace = '(', ')'
+        if write_otts and node is self and 'ott' in self.data:
+            close_brace += str(self.data['ott'])
+        if s_child._child_nodes:
+            stack.append(close_brace)
+            stack.append(s_child)
+            after_f_child = ','
         else:
-            out.write(')')
-            if write_otts and 'ott' in self.data:
-                out.write(str(self.data['ott']))
+            after_f_child = ',' + close_brace
+        if f_child._child_nodes:
+            stack.append(after_f_child)
+            stack.append(f_child)
+            buf.append(open_brace)
+        else:
+            buf.append(open_brace + after_f_child)
+        if len(buf) >= items_per_write:
+            out.write("".join(buf))
+            buf = []
+    out.write("".join(buf))
 
-def write_pop_newick(self, out):
+def write_pop_newick(self, out, items_per_write=100000):
     """
-    Copied from the default dendropy 4 function Node._write_newick
+    Based on the default dendropy 4 function Node._write_newick
     This returns the Node as a NEWICK statement but uses node.pop_store
     instead of node.edge.length for the edge length values.
+    
+    Like write_brief_newick, this uses a stack rather than recursion, and writes in chunks
     """
-    child_nodes = self.child_nodes()
-    if child_nodes:
-        out.write('(')
+    if not self._child_nodes:
+        out.write(pop_newick_token(self))
+        return
+    buf = []
+    #as in write_brief_newick, but leaves are output along with the strings either side of them
+    stack = [self]
+    while stack:
+        node = stack.pop()
+        if node.__class__ is str:
+            buf.append(node)
+            continue
+        child_nodes = node._child_nodes
+        after = pop_newick_token(node, ')')
+        for child in reversed(child_nodes[1:]):
+            if child._child_nodes:
+                stack.append(after)
+                stack.append(child)
+                after = ','
+            else:
+                after = ',' + pop_newick_token(child) + after
         f_child = child_nodes[0]
-        for child in child_nodes:
-            if child is not f_child:
-                out.write(',')
-            child.write_pop_newick(out)
-        out.write(')')
-    
-    label = self._get_node_token(
+        if f_child._child_nodes:
+            stack.append(after)
+            stack.append(f_child)
+            buf.append('(')
+        else:
+            buf.append('(' + pop_newick_token(f_child) + after)
+        if len(buf) >= items_per_write:
+            out.write("".join(buf))
+            buf = []
+    out.write("".join(buf))
+
+def pop_newick_token(node, prefix=""):
+    """The label (with ott) and popularity "edge length" of a node, as output by write_pop_newick"""
+    label = node._get_node_token(
             suppress_leaf_node_labels=False,
             suppress_rooting=True,
             unquoted_underscores = True)
     try:
-        ott = self.data['ott']
+        ott = node.data['ott']
         if label.endswith('\''):
-            out.write(label[:-1] + '_ott{}\''.format(ott))
+            label = label[:-1] + '_ott{}\''.format(ott)
         else:
-            out.write(label + '_ott{}'.format(ott))
+            label = label + '_ott{}'.format(ott)
     except (AttributeError, KeyError):
-        out.write(label)
+        pass
     
-
+    sel = getattr(node, 'pop_store', None)
     if sel is not None:
         s = ""
         try:
@@ -422,7 +505,8 @@ def write_pop_newick(self, out):
         except ValueError:
             s = str(sel)
         if s:
-            out.write(":%s" % s)
+            label += ":%s" % s
+    return prefix + label
 
 if __name__ == "__main__":
     #test
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+A columnar, memory-mappable copy of the parsed OpenTree taxonomy.tsv file, so that the
+file (millions of lines) only needs to be parsed once, rather than on every tree build.
+
+The cache for a taxonomy file is a directory named by the sha1 checksum of the file,
+containing a meta.json file and numpy .npy arrays (which are memory mapped when loaded,
+and only loaded when first needed):
+
+    ott.npy            the OTT id in each row of the file
+    rank.npy           an index into meta['ranks'] for each row
+    flags.npy          an index into meta['flags'] (the distinct flag strings) for each row
+    event_row.npy      for each source id listed in the rows, the row index ...
+    event_source.npy   ... and an index into meta['sources'] (e.g. "ncbi")
+    ids_N.npy          the ids for source N, in the order they appear in the event arrays.
+                       Stored as integers unless they cannot be round-tripped through int()
+
+The source "events" are stored in the order in which create_from_taxonomy() in
+OTT_popularity_mapping.py processes them (including the ncbi_silva hack), so that
+replaying them gives exactly the same data structures as parsing the file.
+"""
+import csv
+import json
+import os
+import re
+import shutil
+import sys
+from array import array
+
+import numpy as np
+
+from OTT_popularity_mapping import file_checksum, memory_usage_resource
+
+class TaxonomyCache(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self._arrays = {}
+
+    @classmethod
+    def for_file(cls, taxonomy_file, cache_dir, verbosity=0):
+        """
+        Return the cache for an (opened or named) taxonomy file, building it in cache_dir
+        if no cache exists for a file with the same checksum
+        """
+        filename = taxonomy_file if isinstance(taxonomy_file, str) else taxonomy_file.name
+        path = os.path.join(cache_dir, "taxonomy_" + file_checksum(filename))
+        if not os.path.isfile(os.path.join(path, "meta.json")):
+            build_taxonomy_cache(filename, path, verbosity)
+        elif verbosity:
+            print(" Using cached taxonomy in {}".format(path), file=sys.stderr)
+        return cls(path)
+
+    def __len__(self):
+        return self.meta['n_rows']
+
+    def array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name + ".npy"), mmap_mode='r')
+        return self._arrays[name]
+
+    def source_ids(self, source, start=0, stop=None):
+        """The ids (as strings) for a named source, in event order"""
+        ids = self.array("ids_{}".format(self.meta['sources'].index(source)))[start:stop]
+        return ids.tolist() if ids.dtype.kind == 'U' else list(map(str, ids.tolist()))
+
+    def otts_with_rank(self, rank):
+        """An array of the (integer) OTT ids of all the rows with a given rank, e.g. 'species'"""
+        try:
+            code = self.meta['ranks'].index(rank)
+        except ValueError:
+            return np.zeros(0, dtype=np.int64)
+        selected = np.flatnonzero(self.array("rank") == code)
+        if self.meta['non_int_uids']:
+            selected = np.setdiff1d(selected, [int(row) for row in self.meta['non_int_uids']])
+        return self.array("ott")[selected]
+
+    def add_sources(self, sources, OTT_ptrs, source_ptrs, unused_sources=None, verbosity=0, chunksize=1000000):
+        """
+        Fill out source_ptrs (a dict of dicts, keyed by the names in `sources`) and OTT_ptrs
+        as create_from_taxonomy() does when reading the taxonomy file
+        """
+        if unused_sources is None:
+            unused_sources = set()
+        codes = {name: i for i, name in enumerate(self.meta['sources'])}
+        used_codes = [codes[s] for s in sources if s in codes]
+        for name in self.meta['sources']:
+            if name not in source_ptrs and name not in unused_sources:
+                if verbosity:
+                    print(" New and unused source: {}".format(name), file=sys.stderr)
+                unused_sources.add(name)
+        #replay the events in chunks, to avoid making python objects for all of them at once
+        names = self.meta['sources']
+        event_source = self.array("event_source")
+        event_row = self.array("event_row")
+        ott = self.array("ott")
+        non_int_uids = {int(row): uid for row, uid in self.meta['non_int_uids'].items()}
+        n_used = 0
+        next_id = {code: 0 for code in used_codes}
+        for start in range(0, len(event_source), chunksize):
+            chunk_sources = event_source[start:start+chunksize]
+            used = np.flatnonzero(np.isin(chunk_sources, used_codes))
+            codes = chunk_sources[used]
+            ids = {}
+            for code in used_codes:
+                n = np.count_nonzero(codes == code)
+                ids[code] = iter(self.source_ids(names[code], next_id[code], next_id[code] + n))
+                next_id[code] += n
+            rows = event_row[start:start+chunksize][used]
+            otts = ott[rows].tolist()
+            for i in np.flatnonzero(np.isin(rows, list(non_int_uids))).tolist():
+                otts[i] = non_int_uids[int(rows[i])]
+            n_used += len(used)
+            for OTTid, code in zip(otts, codes.tolist()):
+                src = names[code]
+                id = next(ids[code])
+                source_ptrs[src][id] = {'id':id}
+                try:
+                    if OTTid < 0:
+                        print(" Skipping source ID matching for negative ott ({}) representing unlabelled node".format(OTTid))
+                        continue
+                except TypeError:
+                    pass
+                if OTTid not in OTT_ptrs:
+                    OTT_ptrs[OTTid]={'sources':{}}
+                OTT_ptrs[OTTid]['sources'][src]=source_ptrs[src][id]
+        if verbosity:
+            print(" Read {} source ids for {} taxa from the cached taxonomy: mem usage {:.1f} Mb".format(n_used, len(self), memory_usage_resource()), file=sys.stderr)
+
+
+def build_taxonomy_cache(taxonomy_filename, path, verbosity=0):
+    """Parse a taxonomy.tsv file into a cache directory at `path` (see the module docstring)"""
+    #hack for NCBI_via_silva (see https://groups.google.com/d/msg/opentreeoflife/L2x3Ond16c4/CVp6msiiCgAJ), as in create_from_taxonomy
+    silva_regexp = re.compile(r'ncbi:(\d+),silva:([^,$]+)')
+    silva_sub = r'ncbi_silva:\1'
+    ranks = {}
+    flags = {}
+    sources = {}
+    non_int_uids = {}
+    otts = array('q')
+    row_ranks = array('L')
+    row_flags = array('L')
+    event_row = array('q')
+    event_source = array('L')
+    source_ids = []
+    with open(taxonomy_filename, encoding='UTF-8') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        for row_num, OTTrow in enumerate(reader):
+            if (row_num % 1000000 == 0) and verbosity:
+                print("Caching taxonomy file {}: {} rows read, mem usage {:.1f} Mb".format(taxonomy_filename, row_num, memory_usage_resource()), file=sys.stderr)
+            try:
+                otts.append(int(OTTrow['uid']))
+            except ValueError:
+                otts.append(0)
+                non_int_uids[str(row_num)] = OTTrow['uid']
+            row_ranks.append(ranks.setdefault(OTTrow.get('rank') or '', len(ranks)))
+            row_flags.append(flags.setdefault(OTTrow.get('flags') or '', len(flags)))
+            sourceinfo = silva_regexp.sub(silva_sub, OTTrow['sourceinfo'])
+            ncbi = False
+            for source in reversed(sourceinfo.split(",")):
+                src, id = source.split(':',1)
+                if (src=="ncbi"):
+                    ncbi = True
+                elif (src=="ncbi_silva") and (not ncbi):
+                    src = "ncbi"
+                if src not in sources:
+                    sources[src] = len(sources)
+                    source_ids.append([])
+                event_row.append(row_num)
+                event_source.append(sources[src])
+                source_ids[sources[src]].append(id)
+
+    tmp_path = path + ".{}.tmp".format(os.getpid())
+    os.makedirs(tmp_path)
+    try:
+        def save(name, values, dtype):
+            np.save(os.path.join(tmp_path, name + ".npy"), np.frombuffer(values, dtype=values.typecode).astype(dtype))
+        save("ott", otts, np.int64)
+        save("rank", row_ranks, np.uint16 if len(ranks) < 2**16 else np.uint32)
+        save("flags", row_flags, np.uint16 if len(flags) < 2**16 else np.uint32)
+        save("event_row", event_row, np.int64)
+        save("event_source", event_source, np.uint16)
+        for code, ids in enumerate(source_ids):
+            if all(id.isascii() and id.isdigit() and id == str(int(id)) and int(id) < 2**63 for id in ids):
+                ids = np.array([int(id) for id in ids], dtype=np.int64)
+            else:
+                ids = np.array(ids, dtype=np.str_)
+            np.save(os.path.join(tmp_path, "ids_{}.npy".format(code)), ids)
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                'taxonomy_file': os.path.basename(taxonomy_filename),
+                'n_rows': len(otts),
+                'ranks': list(ranks),
+                'flags': list(flags),
+                'sources': list(sources),
+                'non_int_uids': non_int_uids,
+            }, f)
+        if os.path.exists(path):
+            shutil.rmtree(path) #an incomplete cache, without a meta.json file
+        os.replace(tmp_path, path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    if verbosity:
+        print(" Cached {} taxonomy rows with {} source ids in {}: mem usage {:.1f} Mb".format(len(otts), len(event_row), path, memory_usage_resource()), file=sys.stderr)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+An array-based view of a dendropy tree, built once, so that values can be summed up
+and down the tree in a few vectorised numpy passes, rather than by walking millions
+of dendropy node objects in python for each sum. Building the arrays, and copying
+values from and to the nodes, still take a python pass over the nodes each.
+
+Nodes are numbered in preorder (index 0 is the root). For each node we store the
+index of its parent (-1 for the root) and its depth, and we group the nodes into
+levels of equal depth. No node in a level is the ancestor of any other in the same
+level, so each level can be processed in a single vectorised operation: going up the
+tree, level by level, from the deepest, or down the tree, level by level, from the root.
+"""
+import numpy as np
+
+class TreeArrays(object):
+    def __init__(self, tree):
+        """
+        Build the arrays from a dendropy tree. The dendropy node objects are kept
+        in self.nodes (in preorder, so that self.nodes[i] corresponds to index i)
+        """
+        nodes = []
+        parent = []
+        depth = []
+        stack = [(tree.seed_node, -1, 0)]
+        while stack:
+            node, parent_index, node_depth = stack.pop()
+            index = len(nodes)
+            nodes.append(node)
+            parent.append(parent_index)
+            depth.append(node_depth)
+            if node._child_nodes:
+                stack.extend([(child, index, node_depth + 1) for child in reversed(node._child_nodes)])
+        self.nodes = nodes
+        self.parent = np.array(parent, dtype=np.int64)
+        self.depth = np.array(depth, dtype=np.int64)
+        by_depth = np.argsort(self.depth, kind='stable')
+        level_starts = np.searchsorted(self.depth[by_depth], np.arange(self.depth.max() + 2))
+        self.levels = [by_depth[level_starts[d]:level_starts[d+1]] for d in range(len(level_starts) - 1)]
+        self._postorder = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def preorder(self):
+        """The node indices in preorder (which is simply the order in which they are stored)"""
+        return np.arange(len(self.nodes))
+
+    @property
+    def postorder(self):
+        """
+        The node indices in postorder, as given by dendropy's postorder_node_iter().
+        A node is visited after all the nodes before it in preorder except its
+        ancestors, and after all its descendants.
+        """
+        if self._postorder is None:
+            n_descendants = self.descendant_sums(np.ones(len(self), dtype=np.int64))
+            position = self.preorder - self.depth + n_descendants
+            self._postorder = np.empty_like(position)
+            self._postorder[position] = self.preorder
+        return self._postorder
+
+    def descendant_sums(self, values):
+        """
+        For each node, the sum of `values` (an array indexed by node) over all of its
+        descendants, not including the node itself. Leaves get zero.
+        """
+        totals = np.zeros_like(values)
+        for level in reversed(self.levels[1:]):
+            np.add.at(totals, self.parent[level], values[level] + totals[level])
+        return totals
+
+    def ancestor_sums(self, values):
+        """
+        For each node, the sum of `values` over the node itself and all of its
+        ancestors except the root (so the root always gets zero).
+        """
+        totals = np.zeros_like(values)
+        for level in self.levels[1:]:
+            totals[level] = totals[self.parent[level]] + values[level]
+        return totals
+
+
+class ChildArrays(object):
+    """
+    A tree stored as an array of parent indices (-1 for the root) plus child offsets:
+    the children of node i, in order, are children[child_start[i]:child_start[i+1]].
+    Unlike TreeArrays, the nodes need not be numbered in preorder, so that new nodes
+    (e.g. when resolving polytomies) can simply be appended, and the children of every
+    node can be reordered (e.g. when ladderizing) by a single sort of the arrays.
+    """
+    def __init__(self, parent, position):
+        """
+        Build the child offsets from the parent of each node and its position among
+        its siblings (positions only need to sort in the right order)
+        """
+        self.parent = np.asarray(parent, dtype=np.int64)
+        is_child = self.parent >= 0
+        self.children = np.lexsort((position, self.parent))[np.count_nonzero(~is_child):]
+        self.child_start = np.zeros(len(self.parent) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.parent[is_child], minlength=len(self.parent)), out=self.child_start[1:])
+        self.position = np.zeros(len(self.parent), dtype=np.int64)
+        self.position[self.children] = np.arange(len(self.children)) - self.child_start[self.parent[self.children]]
+        self._levels = None
+
+    @classmethod
+    def from_tree_arrays(cls, arrays):
+        """The same tree as a TreeArrays object, using the same (preorder) node indices"""
+        return cls(arrays.parent, np.arange(len(arrays)))
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def n_children(self):
+        return np.diff(self.child_start)
+
+    def child_nodes(self, i):
+        return self.children[self.child_start[i]:self.child_start[i+1]]
+
+    @property
+    def levels(self):
+        """
+        The node indices grouped by depth, as in TreeArrays. Depths are found by pointer
+        jumping: after k rounds each node has counted its first 2**k ancestors
+        """
+        if self._levels is None:
+            depth = (self.parent >= 0).astype(np.int64)
+            ancestor = self.parent.copy()
+            jump = np.flatnonzero(ancestor >= 0)
+            while len(jump):
+                depth[jump] += depth[ancestor[jump]]
+                ancestor[jump] = ancestor[ancestor[jump]]
+                jump = jump[ancestor[jump] >= 0]
+            self.depth = depth
+            by_depth = np.argsort(depth, kind='stable')
+            level_starts = np.searchsorted(depth[by_depth], np.arange(depth.max() + 2))
+            self._levels = [by_depth[level_starts[d]:level_starts[d+1]] for d in range(len(level_starts) - 1)]
+        return self._levels
+
+    def descendant_sums(self, values):
+        """As TreeArrays.descendant_sums()"""
+        totals = np.zeros_like(values)
+        for level in reversed(self.levels[1:]):
+            np.add.at(totals, self.parent[level], values[level] + totals[level])
+        return totals
+
+    def preorder_rank(self):
+        """
+        The position of each node in a preorder traversal. A child comes one after its
+        parent, plus the sizes of the subtrees of all its earlier siblings.
+        """
+        size = self.descendant_sums(np.ones(len(self), dtype=np.int64)) + 1
+        before = np.zeros(len(self.children) + 1, dtype=np.int64)
+        np.cumsum(size[self.children], out=before[1:])
+        offset = np.zeros(len(self), dtype=np.int64)
+        offset[self.children] = before[:-1] - before[self.child_start[self.parent[self.children]]]
+        rank = np.zeros(len(self), dtype=np.int64)
+        for level in self.levels[1:]:
+            rank[level] = rank[self.parent[level]] + 1 + offset[level]
+        return rank
+
+    @property
+    def postorder(self):
+        """The node indices in postorder, as given by dendropy's postorder_node_iter()"""
+        rank = self.preorder_rank()
+        position = rank - self.depth + self.descendant_sums(np.ones(len(self), dtype=np.int64))
+        postorder = np.empty_like(position)
+        postorder[position] = np.arange(len(self))
+        return postorder
+
+    def resolve_polytomies(self, rng, limit=2):
+        """
+        Return a new ChildArrays in which any node with more than `limit` children has
+        been randomly resolved by adding new nodes, with indices from len(self) upwards.
+        The polytomies are visited in postorder, making exactly the same calls to
+        rng.sample() and rng.choice() as dendropy's Tree.resolve_polytomies(rng=rng), and
+        the resulting topology (including the order of children) is the same as dendropy
+        would give, so that a given seed always gives the same tree either way.
+        """
+        polytomies = self.postorder[self.n_children[self.postorder] > limit]
+        n_nodes = len(self)
+        new_parent = []
+        child_lists = {}
+        for node in polytomies.tolist():
+            child_nodes = self.child_nodes(node).tolist()
+            to_attach = rng.sample(child_nodes, len(child_nodes) - limit)
+            attached = set(to_attach)
+            kept = [c for c in child_nodes if c not in attached]
+            child_lists[node] = kept
+            parent_of = {c: node for c in kept}
+            attachment_points = kept + [node]
+            while to_attach:
+                next_child = to_attach.pop()
+                next_sib = rng.choice(attachment_points)
+                new_node = n_nodes + len(new_parent)
+                if next_sib == node:
+                    new_parent.append(node)
+                    child_lists[new_node] = child_lists[node]
+                    for c in child_lists[new_node]:
+                        parent_of[c] = new_node
+                    child_lists[node] = [new_node, next_child]
+                    parent_of[new_node] = parent_of[next_child] = node
+                else:
+                    p = parent_of[next_sib]
+                    new_parent.append(p)
+                    siblings = child_lists[p]
+                    siblings.remove(next_sib)
+                    siblings.append(new_node)
+                    child_lists[new_node] = [next_sib, next_child]
+                    parent_of[new_node] = p
+                    parent_of[next_sib] = parent_of[next_child] = new_node
+                attachment_points.append(new_node)
+                attachment_points.append(next_child)
+        parent = np.concatenate((self.parent, np.array(new_parent, dtype=np.int64)))
+        position = np.concatenate((self.position, np.zeros(len(new_parent), dtype=np.int64)))
+        for p, child_nodes in child_lists.items():
+            parent[child_nodes] = p
+            position[child_nodes] = np.arange(len(child_nodes))
+        return self.__class__(parent, position)
+
+    def ladderized(self, ascending=True):
+        """
+        Return a new ChildArrays with the children of each node stably sorted by their
+        number of descendants, as dendropy's Tree.ladderize() does, in a single sort
+        """
+        n_descendants = self.descendant_sums(np.ones(len(self), dtype=np.int64))
+        return self.__class__(self.parent, np.lexsort(
+            (self.position, n_descendants if ascending else -n_descendants, self.parent)).argsort())
+
+    def changed_parents(self, other):
+        """
+        The nodes whose children differ from those in `other`, a ChildArrays of which
+        this tree is an extension (any extra nodes in this tree have the highest indices)
+        """
+        n = len(other)
+        moved = np.ones(len(self), dtype=bool)
+        moved[:n] = (self.parent[:n] != other.parent) | (self.position[:n] != other.position)
+        moved &= self.parent >= 0
+        return np.unique(self.parent[moved])
+
+
+def descending_ranks(values):
+    """
+    The rank of each value when sorted from highest to lowest, with equal values sharing
+    the same (highest) rank, e.g. [5, 7, 5, 1] gives [2, 1, 2, 4]. Only needs one argsort.
+    """
+    values = np.asarray(values)
+    order = np.argsort(-values, kind='stable')
+    sorted_values = values[order]
+    is_first = np.ones(len(values), dtype=bool)
+    is_first[1:] = sorted_values[1:] != sorted_values[:-1]
+    ranks = np.empty(len(values), dtype=np.int64)
+    ranks[order] = np.maximum.accumulate(np.where(is_first, np.arange(len(values)), 0)) + 1
+    return ranks
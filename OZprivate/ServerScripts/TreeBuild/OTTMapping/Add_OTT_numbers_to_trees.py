@@ -15,6 +15,10 @@ For more information, please refer to <http://unlicense.org/>
 This script looks through the leaves of multiple newick trees and replaces the taxa with matches from the Open Tree of Life
 using their name resolution API (https://github.com/OpenTreeOfLife/opentree/wiki/Open-Tree-of-Life-APIs#match_names)
 
+If --taxonomy_dir is given, names are first resolved locally using the taxonomy.tsv and synonyms.tsv files
+in that dir (see name_resolution.py), and only names that cannot be resolved locally are sent to the API.
+Answers from the API can be cached in a file given by --tnrs_cache, so that names are never looked up twice.
+
 cd applications/OneZoom/OZ_private/YanTree/BespokeTree/include_noAutoOTT
 ../../../../ServerScripts/TreeBuild/OTTMapping/Add_OTT_numbers_to_trees.py --savein ../include_OTT2.9 *.phy *.PHY
 
@@ -23,23 +27,27 @@ cd OZ_yan/user/include_noAutoOTT
 perl -ne 'print if s|(^\$tree.*include_files/([^/\.]*\.phy).*)|$2|i' ../ATlife_selected_tree.js | xargs ../../../server_scripts/Add_OTT_numbers_to_trees.py  --savein ../include_OTT2.9 PasserinesOneZoom.phy PoriferaOneZoom.phy AmphibiansOneZoom.phy > ../include_OTT2.9/ottmatches
 
 """
-import json
 from dendropy import Tree
-import urllib
 import re
 import sys
 import os
-from itertools import islice
 import argparse
 
+from name_resolution import LocalNameIndex, TNRSCache, match_names
+
 parser = argparse.ArgumentParser(description='Read newick files and append OpenTree Taxonomy IDs to the taxa in the style of OToL (e.g. Homo_sapiens becomes Homo_sapiens_ott770315). If --savein dir is given, save a set of equivalent newick files with appended OTT numbers in "dir", and create a symlink to that directory in the parent dir')
 parser.add_argument('--savein', help="Store replacement newick files in this dir. Without this flag, the script is simply run to produce stats/warnings")
 parser.add_argument('--output_info', default="info_about_matches.txt", help="file in --savein to save info about matches. If no --savein, print to stdout")
 parser.add_argument('--symlink', default="include_files", help="If --savein is a dir, also create a symlink to the new dir in its parent dir (requires permission to create symlinks in windows)")
 parser.add_argument('--leavesonly', action="store_true", help="Only add ott numbers to leaves on the trees, not to internal nodes")
+parser.add_argument('--taxonomy_dir', help="A dir containing the OpenTree taxonomy.tsv and synonyms.tsv files, used to resolve names locally where possible, e.g. OZprivate/data/OpenTree/ott3.0")
+parser.add_argument('--tnrs_cache', help="A JSON file in which to cache answers from the OpenTree name resolution API (created if it does not exist)")
+parser.add_argument('--offline', action="store_true", help="Do not use the OpenTree name resolution API: names that cannot be resolved locally (using --taxonomy_dir, which must be given) are left unmatched")
 parser.add_argument('newick_files', nargs=argparse.REMAINDER)
 
 args = parser.parse_args()
+if args.offline and not args.taxonomy_dir:
+    parser.error("--offline needs --taxonomy_dir, to resolve names locally")
 outinfo = sys.stdout
 if args.savein:
     if not os.path.isdir(args.savein):
@@ -51,71 +59,66 @@ if args.savein:
         outinfo = open(os.path.join(args.savein, args.output_info), mode='w')
 
 
+local_index = None
+if args.taxonomy_dir:
+    synonyms_file = os.path.join(args.taxonomy_dir, "synonyms.tsv")
+    local_index = LocalNameIndex(
+        os.path.join(args.taxonomy_dir, "taxonomy.tsv"),
+        synonyms_file if os.path.isfile(synonyms_file) else None,
+        verbosity=1)
+tnrs_cache = TNRSCache(args.tnrs_cache) if args.tnrs_cache else None
 
 unambiguous = 0
 synonyms = 0
 unidentified = 0
 
 def lookup_OTT(name_node_dict, context):
-    '''This should process a dictionary of name:<Dendropy_node> items in batches looking up the
-    name in OTT and appending _ottNODENUM to the label for that node. Assumes all nodes have labels, not taxa'''
-    batch_size = 995
+    '''This should process a dictionary of name:<Dendropy_node> items looking up the
+    name in OTT (locally if possible, then in batches using the API) and appending _ottNODENUM
+    to the label for that node. Assumes all nodes have labels, not taxa'''
     global unambiguous
     global synonyms
     global unidentified
-    it = iter(name_node_dict)
-    for s in (islice(name_node_dict, pos, pos + batch_size) for pos in range(0, len(name_node_dict), batch_size)):
-        #print("Next batch includes {}".format([l.label for l in batch][s][:5]))
-        params = json.dumps({'context_name':context, 'do_approximate_matching': False,
-                            'names': [l for l in s]}).encode('utf8')
-        req = urllib.request.Request("https://api.opentreeoflife.org/v3/tnrs/match_names", data=params,
-                         headers={'content-type': 'application/json'})
-        try:
-            response = urllib.request.urlopen(req)
-        except:
-            print("Problem with getting {}".format(req))
-            raise
-        response_string = response.read().decode('utf8')
-        OToLdata=json.loads(response_string)
-        unambiguous += len(OToLdata["unambiguous_names"])
-        unidentified += len(OToLdata["unmatched_names"])
-        synonyms += (len(OToLdata["matched_names"])-len(OToLdata["unambiguous_names"]))
-        print(" {} names matched unambigously, first 10 are {}".format(len(OToLdata["unambiguous_names"]),OToLdata["unambiguous_names"][:10]), file=outinfo)
-        print(" ++> {} ambiguous taxa in one batch from {}: {}".format(len(OToLdata["matched_names"])-len(OToLdata["unambiguous_names"]),f,[name for name in OToLdata["matched_names"] if name not in OToLdata["unambiguous_names"]]), file=outinfo)
-        print(" ==> {} unmatched taxa in one batch from {}: {}".format(len(OToLdata["unmatched_names"]),f,OToLdata["unmatched_names"]), file=outinfo)
-        #print({k:v for (k,v) in OToLdata.items() if k.startswith('includes')}, file=sys.stderr) #sanity check
-        multiples = [r['name'] for r in OToLdata['results'] if r['matches'] and len(r['matches'])>1]
-        if len(multiples):
-            print(" !!> {} taxa from {} have multiple matches (some may be synonyms): {}".format(len(multiples),f,multiples), file=outinfo)
-        results = {}
-        for res in OToLdata['results']:
-            orig = [m["taxon"]["ott_id"] for m in res['matches'] if not m['is_synonym']]
-            syno = [m["taxon"]["ott_id"] for m in res['matches'] if m['is_synonym']]
-            if res['name'] in OToLdata['unambiguous_names']:
-                if len(orig) == 1:
-                    results[res['name']]=orig[0]
-                elif len(orig) > 1:
-                    print("WARNING: more than one non-synonym for unambiguous taxon {}".format(res['name']), file=outinfo)
-                else:
-                    print("WARNING: something's wrong for {}: no non-synonyms for unambiguous taxon".format(res['name']), file=outinfo)
+    OToLdata = match_names(name_node_dict.keys(), context, local_index, tnrs_cache, remote=not args.offline)
+    unambiguous_names = set(OToLdata['unambiguous_names'])
+    unambiguous += len(OToLdata["unambiguous_names"])
+    unidentified += len(OToLdata["unmatched_names"])
+    synonyms += (len(OToLdata["matched_names"])-len(OToLdata["unambiguous_names"]))
+    print(" {} names matched unambigously, first 10 are {}".format(len(OToLdata["unambiguous_names"]),OToLdata["unambiguous_names"][:10]), file=outinfo)
+    print(" ++> {} ambiguous taxa from {}: {}".format(len(OToLdata["matched_names"])-len(OToLdata["unambiguous_names"]),f,[name for name in OToLdata["matched_names"] if name not in unambiguous_names]), file=outinfo)
+    print(" ==> {} unmatched taxa from {}: {}".format(len(OToLdata["unmatched_names"]),f,OToLdata["unmatched_names"]), file=outinfo)
+    multiples = [r['name'] for r in OToLdata['results'] if r['matches'] and len(r['matches'])>1]
+    if len(multiples):
+        print(" !!> {} taxa from {} have multiple matches (some may be synonyms): {}".format(len(multiples),f,multiples), file=outinfo)
+    results = {}
+    for res in OToLdata['results']:
+        orig = [m["taxon"]["ott_id"] for m in res['matches'] if not m['is_synonym']]
+        syno = [m["taxon"]["ott_id"] for m in res['matches'] if m['is_synonym']]
+        if res['name'] in unambiguous_names:
+            if len(orig) == 1:
+                results[res['name']]=orig[0]
+            elif len(orig) > 1:
+                print("WARNING: more than one non-synonym for unambiguous taxon {}".format(res['name']), file=outinfo)
+            else:
+                print("WARNING: something's wrong for {}: no non-synonyms for unambiguous taxon".format(res['name']), file=outinfo)
+        else:
+            if len(orig) == 1:
+                print("WARNING: something's wrong for {}: listed as ambiguous but has single non-synonymous result".format(res['name']), file=outinfo)
+                results[res['name']]=orig[0]
+            elif len(orig) > 1:
+                print("WARNING: more than one non-synonym for ambiguous taxon {}: none taken".format(res['name']), file=outinfo)
             else:
-                if len(orig) == 1:
-                    print("WARNING: something's wrong for {}: listed as ambiguous but has single non-synonymous result".format(res['name']), file=outinfo)
-                    results[res['name']]=orig[0]
-                elif len(orig) > 1:
-                    print("WARNING: more than one non-synonym for ambiguous taxon {}: none taken".format(res['name']), file=outinfo)
+                #no orig hits
+                if len(syno) == 1:
+                    results[res['name']]=syno[0]
+                elif len(syno) > 1:
+                    print("WARNING: more than one synonym for ambiguous taxon {}: none taken".format(res['name']), file=outinfo)
                 else:
-                    #no orig hits
-                    if len(syno) == 1:
-                        results[res['name']]=syno[0]
-                    elif len(syno) > 1:
-                        print("WARNING: more than one synonym for ambiguous taxon {}: none taken".format(res['name']), file=outinfo)
-                    else:
-                        print("WARNING: no hits for taxon {}".format(res['name']), file=outinfo)
-
-        for k in results.keys():
-            #replace the names - these should by now not contain any '_ottXXX' strings.
-            name_node_dict[k].label = name_node_dict[k].label + "_ott" + str(results[k])
+                    print("WARNING: no hits for taxon {}".format(res['name']), file=outinfo)
+
+    for k in results.keys():
+        #replace the names - these should by now not contain any '_ottXXX' strings.
+        name_node_dict[k].label = name_node_dict[k].label + "_ott" + str(results[k])
     
     
 OTTre = re.compile(r'(_ott\d+|_mrcaott\d+ott\d+)(@\d*)?$')
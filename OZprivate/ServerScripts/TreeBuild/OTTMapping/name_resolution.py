@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resolve taxon names to OpenTree Taxonomy (OTT) ids, locally where possible, using an index
+built from the OpenTree taxonomy.tsv and synonyms.tsv files, and otherwise using the OpenTree
+TNRS match_names API (https://github.com/OpenTreeOfLife/germinator/wiki/TNRS-API-v3#match_names),
+whose answers can be cached on disk.
+
+Both return a dict in the same format as the match_names API, e.g.
+
+    {'results': [{'name': 'Homo sapiens', 'matches': [
+        {'matched_name': 'Homo sapiens', 'is_synonym': False, 'taxon': {'ott_id': 770315}}]}],
+     'matched_names': ['Homo sapiens'], 'unambiguous_names': ['Homo sapiens'],
+     'unmatched_names': []}
+
+so that results from the two sources can be combined and interpreted in the same way.
+For names looked up locally, a name is unambiguous if it matches exactly one taxon (not
+counting synonyms); for names sent to the API, the API's own unambiguous_names are kept.
+"""
+import json
+import os
+import re
+import sys
+import unicodedata
+import urllib.request
+from collections import Counter, defaultdict
+
+#The TNRS contexts (https://github.com/OpenTreeOfLife/germinator/wiki/TNRS-API-v3#contexts)
+#and the name of the taxon at the base of each. Any other context is treated as a taxon name
+CONTEXTS = {
+    'All life': None,
+    'Bacteria': 'Bacteria',
+    'SAR group': 'SAR',
+    'Archaea': 'Archaea',
+    'Excavata': 'Excavata',
+    'Amoebozoa': 'Amoebozoa',
+    'Fungi': 'Fungi',
+    'Land plants': 'Embryophyta',
+    'Hornworts': 'Anthocerotophyta',
+    'Mosses': 'Bryophyta',
+    'Liverworts': 'Marchantiophyta',
+    'Vascular plants': 'Tracheophyta',
+    'Club mosses': 'Lycopodiophyta',
+    'Ferns': 'Moniliformopses',
+    'Seed plants': 'Spermatophyta',
+    'Flowering plants': 'Magnoliophyta',
+    'Monocots': 'Liliopsida',
+    'Eudicots': 'eudicotyledons',
+    'Animals': 'Metazoa',
+    'Birds': 'Aves',
+    'Tetrapods': 'Tetrapoda',
+    'Mammals': 'Mammalia',
+    'Amphibians': 'Amphibia',
+    'Vertebrates': 'Vertebrata',
+    'Arthropods': 'Arthropoda',
+    'Molluscs': 'Mollusca',
+    'Nematodes': 'Nematoda',
+    'Platyhelminthes': 'Platyhelminthes',
+    'Annelids': 'Annelida',
+    'Cnidarians': 'Cnidaria',
+    'Arachnids': 'Arachnida',
+    'Insects': 'Insecta',
+}
+
+#taxa with these flags are only chosen if there is no other candidate
+DISFAVOURED_FLAGS = {'not_otu', 'environmental', 'environmental_inherited', 'viral', 'hidden',
+    'hidden_inherited', 'was_container', 'barren', 'unplaced', 'incertae_sedis_inherited'}
+
+TNRS_URL = "https://api.opentreeoflife.org/v3/tnrs/match_names"
+
+
+def normalize_name(name):
+    """
+    A form of the name used for looser matching: lower case, without accents or
+    quotes, and with runs of spaces and underscores replaced by a single space
+    """
+    if not name.isascii():
+        name = unicodedata.normalize('NFKD', name)
+        name = "".join(c for c in name if not unicodedata.combining(c))
+    return re.sub(r"[\s_]+", " ", name.replace("'", "").replace('"', "")).strip().lower()
+
+
+def empty_response():
+    return {'results': [], 'matched_names': [], 'unambiguous_names': [], 'unmatched_names': []}
+
+
+def add_result(response, name, matches, unambiguous=None):
+    """
+    Add the matches for a name to a match_names style response. If unambiguous is None,
+    the name is unambiguous if exactly one of the matches is not a synonym
+    """
+    if matches:
+        response['results'].append({'name': name, 'matches': matches})
+        response['matched_names'].append(name)
+        if unambiguous is None:
+            unambiguous = sum(not m['is_synonym'] for m in matches) == 1
+        if unambiguous:
+            response['unambiguous_names'].append(name)
+    else:
+        response['unmatched_names'].append(name)
+
+
+def resolved_ott(matches):
+    """The ott id chosen for a list of matches, as in Add_OTT_numbers_to_trees.py, or None"""
+    orig = [m['taxon']['ott_id'] for m in matches if not m['is_synonym']]
+    syno = [m['taxon']['ott_id'] for m in matches if m['is_synonym']]
+    if len(orig) == 1:
+        return orig[0]
+    if len(orig) == 0 and len(syno) == 1:
+        return syno[0]
+    return None
+
+
+def taxonomy_rows(filename):
+    """Yield the rows in an OpenTree .tsv file (columns separated by \\t|\\t) as dicts"""
+    with open(filename, encoding='utf-8') as f:
+        header = None
+        for line in f:
+            fields = line.rstrip("\n").split("\t|\t")
+            if fields[-1].endswith("\t|"):
+                fields[-1] = fields[-1][:-2]
+            if header is None:
+                header = fields
+            else:
+                yield dict(zip(header, fields))
+
+
+class LocalNameIndex(object):
+    """
+    An index of the names and synonyms in the OpenTree taxonomy. Names are first looked up
+    exactly, then in normalized form (see normalize_name). Where there are several matches
+    (e.g. a genus name used both for a plant and an animal) they are narrowed down, if
+    possible, by the context given, then by the kingdom which most of the other names in
+    the same batch resolve to (if over half of them do), and finally by avoiding taxa with "suppressed" flags.
+    """
+    def __init__(self, taxonomy_file, synonyms_file=None, verbosity=0):
+        self.exact = defaultdict(list)
+        self.normalized = defaultdict(list)
+        self.synonyms = defaultdict(list)
+        self.normalized_synonyms = defaultdict(list)
+        self.parent = {}
+        self.kingdoms = set()
+        self.disfavoured = set()
+        for row in taxonomy_rows(taxonomy_file):
+            try:
+                uid = int(row['uid'])
+            except ValueError:
+                continue
+            try:
+                self.parent[uid] = int(row['parent_uid'])
+            except ValueError:
+                pass #the root has no parent
+            name = row['name']
+            self.exact[name].append(uid)
+            self.normalized[normalize_name(name)].append((uid, name))
+            if row.get('rank') == 'kingdom':
+                self.kingdoms.add(uid)
+            if row.get('flags') and not DISFAVOURED_FLAGS.isdisjoint(row['flags'].split(",")):
+                self.disfavoured.add(uid)
+        if synonyms_file:
+            for row in taxonomy_rows(synonyms_file):
+                try:
+                    uid = int(row['uid'])
+                except ValueError:
+                    continue
+                self.synonyms[row['name']].append(uid)
+                self.normalized_synonyms[normalize_name(row['name'])].append((uid, row['name']))
+        if verbosity:
+            print("Indexed {} names and {} synonyms from the OpenTree taxonomy".format(
+                len(self.exact), len(self.synonyms)), file=sys.stderr)
+
+    def lookup(self, name):
+        """
+        Return lists of (ott, matched_name) for taxa and synonyms matching the name: exact
+        matches if there are any, otherwise matches on the normalized name
+        """
+        taxa = [(uid, name) for uid in self.exact.get(name, [])]
+        synonyms = [(uid, name) for uid in self.synonyms.get(name, [])]
+        if not taxa and not synonyms:
+            normalized = normalize_name(name)
+            taxa = self.normalized.get(normalized, [])
+            synonyms = self.normalized_synonyms.get(normalized, [])
+        #a taxon may be matched by several synonyms, or by both its name and a synonym
+        taxa = list(dict(taxa).items())
+        synonyms = [(uid, n) for uid, n in dict(synonyms).items() if uid not in dict(taxa)]
+        return taxa, synonyms
+
+    def ancestors(self, uid):
+        while uid in self.parent:
+            uid = self.parent[uid]
+            yield uid
+
+    def kingdom(self, uid):
+        if uid in self.kingdoms:
+            return uid
+        for anc in self.ancestors(uid):
+            if anc in self.kingdoms:
+                return anc
+        return None
+
+    def context_roots(self, context):
+        """The set of uids at the base of a context, or None for no restriction"""
+        taxon_name = CONTEXTS.get(context, context)
+        if taxon_name is None:
+            return None
+        roots = set(self.exact.get(taxon_name, []))
+        if not roots:
+            print("WARNING: context '{}' not found in the taxonomy: matching names across all life".format(context), file=sys.stderr)
+            return None
+        return roots
+
+    def in_context(self, uid, roots):
+        return roots is None or uid in roots or not roots.isdisjoint(self.ancestors(uid))
+
+    def match_names(self, names, context="All life"):
+        """
+        Return a dict like the TNRS match_names API response for a list of names, with
+        the candidate matches narrowed down as described for the class
+        """
+        roots = self.context_roots(context)
+        candidates = {}
+        for name in names:
+            taxa, synonyms = self.lookup(name)
+            candidates[name] = (
+                [t for t in taxa if self.in_context(t[0], roots)],
+                [s for s in synonyms if self.in_context(s[0], roots)])
+
+        #the kingdom of most (over half) of the names with a single match
+        kingdom_counts = Counter()
+        for taxa, synonyms in candidates.values():
+            single = taxa if taxa else synonyms
+            if len(single) == 1:
+                kingdom_counts[self.kingdom(single[0][0])] += 1
+        main_kingdom = None
+        if kingdom_counts:
+            kingdom, count = kingdom_counts.most_common(1)[0]
+            if count * 2 > sum(kingdom_counts.values()):
+                main_kingdom = kingdom
+
+        response = empty_response()
+        for name in names:
+            taxa, synonyms = candidates[name]
+            taxa = self.narrow(taxa, main_kingdom)
+            if not taxa:
+                synonyms = self.narrow(synonyms, main_kingdom)
+            add_result(response, name,
+                [{'matched_name': n, 'is_synonym': False, 'taxon': {'ott_id': uid}} for uid, n in taxa] +
+                [{'matched_name': n, 'is_synonym': True, 'taxon': {'ott_id': uid}} for uid, n in synonyms])
+        return response
+
+    def narrow(self, matches, main_kingdom):
+        """Where there are several (ott, name) matches, try to reduce them to a single one"""
+        if len(matches) > 1 and main_kingdom is not None:
+            in_kingdom = [m for m in matches if self.kingdom(m[0]) == main_kingdom]
+            if in_kingdom:
+                matches = in_kingdom
+        if len(matches) > 1:
+            favoured = [m for m in matches if m[0] not in self.disfavoured]
+            if favoured:
+                matches = favoured
+        return matches
+
+
+class TNRSCache(object):
+    """
+    Answers from the TNRS match_names API, keyed by context and name, stored as a JSON file
+    so that names only ever need to be sent to the API once. Each answer is a dict of the
+    matches, and whether the API listed the name in its unambiguous_names
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename, encoding='utf-8') as f:
+                self.answers = json.load(f)
+        except FileNotFoundError:
+            self.answers = {}
+
+    @staticmethod
+    def key(context, name):
+        return context + "\t" + name
+
+    def get(self, context, name):
+        """The (matches, unambiguous) answer for a name, or None if it is not cached"""
+        answer = self.answers.get(self.key(context, name))
+        if not isinstance(answer, dict):
+            return None
+        return answer['matches'], answer['unambiguous']
+
+    def set(self, context, name, matches, unambiguous):
+        self.answers[self.key(context, name)] = {'matches': matches, 'unambiguous': unambiguous}
+
+    def save(self):
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w", encoding='utf-8') as f:
+            json.dump(self.answers, f)
+        os.replace(tmp_filename, self.filename)
+
+
+def tnrs_request(names, context):
+    """Send a list of names to the TNRS match_names API and return the decoded response"""
+    params = json.dumps({'context_name':context, 'do_approximate_matching': False,
+                        'names': names}).encode('utf8')
+    req = urllib.request.Request(TNRS_URL, data=params, headers={'content-type': 'application/json'})
+    try:
+        response = urllib.request.urlopen(req)
+    except:
+        print("Problem with getting {}".format(req))
+        raise
+    return json.loads(response.read().decode('utf8'))
+
+
+def remote_match_names(names, context="All life", cache=None, batch_size=995, request=tnrs_request):
+    """
+    Look up names using the TNRS match_names API (or the cache, if given), returning a
+    response dict in the same format, including the API's unambiguous_names. Only names
+    not in the cache are sent, in batches
+    """
+    answers = {}
+    to_send = []
+    for name in names:
+        cached = cache.get(context, name) if cache else None
+        if cached is None:
+            to_send.append(name)
+        else:
+            answers[name] = cached
+    for batch in (to_send[pos:pos + batch_size] for pos in range(0, len(to_send), batch_size)):
+        OToLdata = request(batch, context)
+        unambiguous_names = set(OToLdata['unambiguous_names'])
+        for name in batch:
+            answers[name] = ([], False)
+        for res in OToLdata['results']:
+            answers[res['name']] = ([
+                {'matched_name': m.get('matched_name'), 'is_synonym': m['is_synonym'], 'taxon': {'ott_id': m['taxon']['ott_id']}}
+                for m in res['matches']], res['name'] in unambiguous_names)
+        if cache:
+            for name in batch:
+                cache.set(context, name, *answers[name])
+            cache.save()
+    response = empty_response()
+    for name in names:
+        add_result(response, name, *answers[name])
+    return response
+
+
+def match_names(names, context="All life", local_index=None, cache=None, remote=True, request=tnrs_request):
+    """
+    Match names using the local index if given, sending those which cannot be resolved to
+    a single ott locally to the TNRS match_names API (unless remote is False)
+    """
+    names = list(names)
+    if local_index is None:
+        return remote_match_names(names, context, cache, request=request) if remote else empty_response()
+    local = local_index.match_names(names, context)
+    if not remote:
+        return local
+    local_matches = {res['name']: res['matches'] for res in local['results']}
+    unresolved = [name for name in names if resolved_ott(local_matches.get(name, [])) is None]
+    if not unresolved:
+        return local
+    remote = remote_match_names(unresolved, context, cache, request=request)
+    remote_matches = {res['name']: res['matches'] for res in remote['results']}
+    remote_unambiguous = set(remote['unambiguous_names'])
+    unresolved = set(unresolved)
+    response = empty_response()
+    for name in names:
+        if name in unresolved:
+            add_result(response, name, remote_matches.get(name, []), name in remote_unambiguous)
+        else:
+            add_result(response, name, local_matches[name])
+    return response
@@ -39,48 +39,110 @@ def leave_only(self, to_keep_dict):
     We have to be careful with non-branching twigs (a series of unifurcations)
     because we want the tip to be left, and the rest pruned (so that a 
     single species is left on the tree)
+    
+    Clades with no taxa to keep are collapsed into a single tip labelled with the number
+    of species pruned (e.g. 'Homo#2'), if they are the child of a node that does have
+    taxa to keep. The tree is stored as arrays of nodes in preorder, so that all the
+    flags and counts can be calculated in a single pass, then rebuilt in one go.
     '''
-    to_keep = self.taxon_namespace.get_taxa(labels=to_keep_dict.keys())
-    #flag up the routes to keep 
-    for nd in self.postorder_node_iter():
-        if hasattr(nd, 'keep') or (nd.taxon and nd.taxon in to_keep):
-            if (nd.parent_node):
-                nd.parent_node.keep = True
-      
-    to_prune = set([t for t in self.taxon_namespace if t not in to_keep])
+    label_key = taxon_label_key(self.taxon_namespace)
+    keep_labels = set(label_key(label) for label in to_keep_dict)
     
-    for lf in self.leaf_node_iter(lambda n: n.taxon in to_prune):
-        lf.spp=1;
+    #store the tree as a preorder list of nodes, with the index of the parent of each
+    nodes = []
+    parent = []
+    stack = [(self.seed_node, -1)]
+    while stack:
+        node, parent_index = stack.pop()
+        index = len(nodes)
+        nodes.append(node)
+        parent.append(parent_index)
+        if node._child_nodes:
+            stack.extend([(child, index) for child in reversed(node._child_nodes)])
     
-    for nd in self.postorder_node_iter():
-        if (hasattr(nd, 'spp')):
-            if (nd.parent_node and not hasattr(nd.parent_node, 'keep')):
-                if (hasattr(nd.parent_node, 'spp')):
-                    nd.parent_node.spp += nd.spp
-                else:
-                    nd.parent_node.spp = nd.spp
-                    
+    #single pass from the tips down (children before parents). For each node find
+    # keep: if any descendant has a taxon to keep
+    # spp: the number of species (tips with taxa) not kept, summed up to a node with keep set
+    # alive: if the node will remain after removing tips without taxa (and resulting bare nodes)
+    # size: the number of nodes in the subtree, so that children can be found in the arrays
+    n = len(nodes)
+    keep = [False] * n
+    spp = [0] * n
+    n_alive_children = [0] * n
+    alive = [False] * n
+    size = [1] * n
+    to_collapse = []
+    for i in range(n - 1, -1, -1):
+        node = nodes[i]
+        taxon = node.taxon
+        kept = taxon is not None and taxon.label is not None and label_key(taxon.label) in keep_labels
+        if node._child_nodes:
+            if keep[i]:
+                spp[i] = 0
+            elif spp[i] > 1:
+                to_collapse.append(i) #if it turns out that the parent has keep set
+        elif taxon is not None and not kept:
+            spp[i] = 1
+        alive[i] = taxon is not None or n_alive_children[i] > 0
+        p = parent[i]
+        if p >= 0:
+            if kept or keep[i]:
+                keep[p] = True
+            spp[p] += spp[i]
+            n_alive_children[p] += alive[i]
+            size[p] += size[i]
+    
+    collapsed = set()
+    for i in to_collapse:
+        if parent[i] < 0 or keep[parent[i]]:
+            nd = nodes[i]
+            if (nd.taxon):
+                nd.taxon.label += '#%d' % (spp[i])
             else:
-                if (nd.spp > 1):
-                    if (nd.taxon):
-                        nd.taxon.label += '#%d' % (nd.spp)
-                    else:
-                        if (nd.label):
-                            nd.taxon = Taxon(label=nd.label + '#%d' % (nd.spp))
-                        else:
-                            warn("Couldn't find a label for a node with multiple descendants. Using label 'unknown'.")
-                            nd.taxon = Taxon(label='unknown#%d' % (nd.spp))
-                    nd.set_child_nodes([])
-    self.prune_leaves_without_taxa(update_bipartitions=False,suppress_unifurcations=False)
+                if (nd.label):
+                    nd.taxon = Taxon(label=nd.label + '#%d' % (spp[i]))
+                else:
+                    warn("Couldn't find a label for a node with multiple descendants. Using label 'unknown'.")
+                    nd.taxon = Taxon(label='unknown#%d' % (spp[i]))
+            collapsed.add(i)
+    
+    #rebuild the tree from the root, only keeping the alive children of uncollapsed nodes
+    stack = [0]
+    while stack:
+        i = stack.pop()
+        node = nodes[i]
+        if i in collapsed:
+            node.set_child_nodes([])
+        elif node._child_nodes:
+            children = []
+            c = i + 1
+            while c < i + size[i]:
+                if alive[c]:
+                    children.append(c)
+                c += size[c]
+            if len(children) != len(node._child_nodes):
+                node.set_child_nodes([nodes[c] for c in children])
+            stack.extend(children)
     check_list_against_taxa(self, to_keep_dict)
 
 Tree.leave_only = leave_only
 
+def taxon_label_key(taxon_namespace):
+    '''
+    A function returning the form of a label used to match it to a taxon in the namespace,
+    as in dendropy's own label lookup (which is case-insensitive by default)
+    '''
+    if taxon_namespace.is_case_sensitive:
+        return lambda label: label
+    return lambda label: str(label).lower()
+
 def check_list_against_taxa(tree, checklist):
     '''take a dendropy tree and look for any taxa that correspond to keys in the "keep" dictionary,
     incrementing the value of each one found'''
+    label_key = taxon_label_key(tree.taxon_namespace)
+    taxon_labels = set(label_key(t.label) for t in tree.taxon_namespace if t.label is not None)
     for n in checklist:
-        if tree.taxon_namespace.has_taxon_label(n):
+        if label_key(n) in taxon_labels:
             checklist[n] += 1 #count each matched label from the keep list
     
 def check_list_against_tree(treepath, checklist):
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+Fill out the recent_sponsorships table (read by the home and sponsored pages) from the
+live sponsorships in the reservations table, when the table is first created. After
+that, it is kept up to date as sponsorships change. Run once (it is safe to run again),
+with the models loaded, from the top of the web2py directory:
+
+web2py.py -S OZtree -M -R applications/OZtree/OZprivate/ServerScripts/Utilities/OneOff/fill_recent_sponsorships.py
+"""
+from sponsorship import update_recent_sponsorships
+
+n_live = update_recent_sponsorships(db, request.now)
+db.commit()
+print("Copied {} live sponsorships to recent_sponsorships".format(n_live))
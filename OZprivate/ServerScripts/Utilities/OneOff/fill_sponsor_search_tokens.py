@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+Fill out the sponsor_search_tokens table (used by API/search_for_sponsor) from the
+sponsor text in the reservations table, when the table is first created. After that,
+it is kept up to date as sponsor text changes. Run once (it is safe to run again), with
+the models loaded, from the top of the web2py directory:
+
+web2py.py -S OZtree -M -R applications/OZtree/OZprivate/ServerScripts/Utilities/OneOff/fill_sponsor_search_tokens.py
+"""
+from sponsorship import update_sponsor_search_tokens
+
+n_tokens = update_sponsor_search_tokens(db)
+db.commit()
+print("Added {} tokens to sponsor_search_tokens".format(n_tokens))
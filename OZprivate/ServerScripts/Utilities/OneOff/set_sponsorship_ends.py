@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""
+Fill out reservations.sponsorship_ends for sponsorships verified before it was set by
+manage/SPONSOR_UPDATE, so that cron/sweep_reservations.py can expire them (if
+sponsorship.expiry_grace_days is set in appconfig.ini). Renewed leaves are listed rather
+than set, as their end date must be worked out by hand. Run once (it is safe to run
+again), with the models loaded, from the top of the web2py directory:
+
+web2py.py -S OZtree -M -R applications/OZtree/OZprivate/ServerScripts/Utilities/OneOff/set_sponsorship_ends.py
+"""
+from sponsorship import set_sponsorship_ends, renewed_leaves_without_ends
+
+print("Set sponsorship_ends for {} sponsorships".format(set_sponsorship_ends(db)))
+renewed = renewed_leaves_without_ends(db)
+if renewed:
+    print("These renewed leaves need sponsorship_ends to be set by hand: {}".format(
+        ", ".join(str(ott) for ott in renewed)))
@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
-import fileinput
 import json
 import os
 import shutil
+from collections import deque
 from subprocess import call
 
 # argparse  -> boolean
@@ -28,11 +28,10 @@ def parameter_valid(args):
 # Input: '../../data/output_files/ordered_tree_test.nwk' -> '((,),)'
 # Output: '(())'
 def tidy_newick(newick_filepath):
-    res = ""
-    for line in fileinput.input(files=(newick_filepath)):
-        res += line.replace(',', '').replace(';', '').replace('\n', '')
-    return res
+    with open(newick_filepath) as f:
+        return f.read().translate(tidy_table)
 
+tidy_table = str.maketrans('', '', ',;\n')
 
 # String -> String
 # Given tidied newick string, return rawData and metadata in completetree.js 
@@ -46,34 +45,53 @@ def generate_rawdata_metadata(newick_str):
 # String, Number -> String
 # Given tidied newick(polytomy) string, return stringified cut position map for binary tree and polytomy tree
 def generate_cut_position_map(newick_str, threshold):
-  binary_cut_map = generate_binary_cut_position_map(newick_str, threshold)
-  polytomy_cut_map = generate_polytomy_cut_position_map(newick_str, threshold)
+  match = matching_brackets(newick_str)
+  binary_cut_map = generate_binary_cut_position_map(newick_str, threshold, match)
+  polytomy_cut_map = generate_polytomy_cut_position_map(newick_str, threshold, match)
   cut_threshold = "var cut_threshold = " + str(threshold) + ";"
   return binary_cut_map + "\n\n" + polytomy_cut_map + "\n\n" + cut_threshold;
   
 
+# String -> Array
+# Given tidied newick string, return an array giving the index of the matching bracket
+# for each position, using a single pass with a stack. Round and curly brackets are
+# treated alike, as in the cut position maps.
+# Input: '(()){}'
+# Output: [3, 2, 1, 0, 5, 4]
+def matching_brackets(newick_str):
+    match = [None] * len(newick_str)
+    stack = []
+    for index, c in enumerate(newick_str):
+        if c == '(' or c == '{':
+            stack.append(index)
+        elif c == ')' or c == '}':
+            if not stack:
+                raise ValueError("newick str has an unmatched closing bracket at position {}".format(index))
+            open_index = stack.pop()
+            match[open_index] = index
+            match[index] = open_index
+        else:
+            raise ValueError("newick str contains non bracket character: " + c)
+    if stack:
+        raise ValueError("newick str has an unmatched opening bracket at position {}".format(stack[-1]))
+    return match
+
 # String, Number -> String
 # Given tidied newick string, return stringified cut_position_map object.
 # Output example: '{"4203700":1302201,"4203701":685684,"4203702":685609,"4203703":683568,"4203704":7901,"4203705":7900,"4203706":6417,"4203707":6396}'
-def generate_binary_cut_position_map(newick_str, threshold):  
-  count_arr = [None] * len(newick_str)
-  count = 0
-  for index, c in enumerate(reversed(newick_str)):
-      index = len(newick_str) - index - 1
-      if c is '(' or c is '{':
-          count = count-1
-      elif c is ')' or c is '}':
-          count = count + 1
-      else:
-          raise ValueError("newick str contains non bracket character: " + c)
-      count_arr[index] = count
-
-  start_end_arr = [0, len(count_arr)-1]
+# The string should be a binary tree (as output by write_brief_newick), in which each node
+# is a pair of brackets enclosing its 2 children, and leaves are empty strings. For a node
+# at start..end, the cut position is just before the start of the last child, which
+# is found from the matching bracket of end-1 (if end-1 is a closing bracket). Nodes are
+# visited in breadth-first order, so the output is in the same order as before.
+def generate_binary_cut_position_map(newick_str, threshold, match=None):
+  if match is None:
+      match = matching_brackets(newick_str)
+  start_end_arr = deque([(0, len(newick_str)-1)]) if newick_str else deque()
   cut_position_map = {}
-  while len(start_end_arr) > 0:
-      start = start_end_arr.pop(0)
-      end = start_end_arr.pop(0)
-      build_cut_position_map(start, end, start_end_arr, count_arr, cut_position_map, threshold)
+  while start_end_arr:
+      start, end = start_end_arr.popleft()
+      build_cut_position_map(start, end, start_end_arr, newick_str, match, cut_position_map, threshold)
   cut_position_map = json.dumps(cut_position_map)
   cut_position_map = "var cut_position_map_json_str = '" + cut_position_map +"';"
   return cut_position_map
@@ -84,133 +102,134 @@ def generate_binary_cut_position_map(newick_str, threshold):
 # The key of the output json string is the end position of a string in the newick_str.
 # The value is an array: [start_sub1, end_sub1, start_sub2, end_sub2, ..., start_subN, end_subN]. start_subN means the start position of 
 # its nth child, end_subN is the end position of its nth child.
-def generate_polytomy_cut_position_map(newick_str, threshold):
-    start_end_arr = [0, len(newick_str) - 1]
+def generate_polytomy_cut_position_map(newick_str, threshold, match=None):
+    if match is None:
+        match = matching_brackets(newick_str)
+    start_end_arr = deque([(0, len(newick_str) - 1)])
     cut_position_map = {}
-    while len(start_end_arr) > 0:
-        start = start_end_arr.pop(0)
-        end = start_end_arr.pop(0)
-        cut_position_map[end] = get_polytomy_substring_pos(start, end, start_end_arr, threshold, newick_str)
+    while start_end_arr:
+        start, end = start_end_arr.popleft()
+        cut_position_map[end] = get_polytomy_substring_pos(start, end, start_end_arr, threshold, newick_str, match)
     cut_position_map = json.dumps(cut_position_map)
     cut_position_map = "var polytomy_cut_position_map_json_str = '" + cut_position_map + "';"
     return cut_position_map
 
-# Number, Number, Array, Array, Map, Number
+# Number, Number, Deque, String, Array, Map, Number
 # start, end represent indices of a node A on rawData. 
 # this function finds cut position of node A on rawData, then store it in cut_position_map and put its children start and end position in start_end_arr
-def build_cut_position_map(start, end, start_end_arr, count_arr, cut_position_map, threshold):
-    endValue = count_arr[end];
-    for index in reversed(range(start, end)):
-        if count_arr[index] == endValue:
-            cut_position_map[end] = index-1
-            if (index-start-2) >= threshold:
-                start_end_arr.append(start+1)
-                start_end_arr.append(index-1)
-            if (end-index-1) >= threshold:
-                start_end_arr.append(index)
-                start_end_arr.append(end-1)
-            break
+def build_cut_position_map(start, end, start_end_arr, newick_str, match, cut_position_map, threshold):
+    if end - 1 < start or newick_str[end-1] == '(' or newick_str[end-1] == '{':
+        return
+    index = match[end-1]
+    if index < start:
+        return
+    cut_position_map[end] = index-1
+    if (index-start-2) >= threshold:
+        start_end_arr.append((start+1, index-1))
+    if (end-index-1) >= threshold:
+        start_end_arr.append((index, end-1))
 
 #This function finds substring start and end position given a string representing polytomy tree.
 #Substring's start and end position would be pushed into start_end_arr if its distance is larger than threshold.
-def get_polytomy_substring_pos(start, end, start_end_arr, threshold, newick_str, called_by_self = False):
+#Nodes marked with curly brackets are polytomy-resolving nodes, which are expanded so that 
+#their children are listed instead. This is done depth first, using a stack rather than
+#recursion, so that huge polytomies do not hit the recursion limit.
+def get_polytomy_substring_pos(start, end, start_end_arr, threshold, newick_str, match):
     res = []
-    if (end <= start or (called_by_self and newick_str[end] is ')')):
-        res = res + [start, end]
-        if ((end - start) > threshold):
-            start_end_arr.append(start)
-            start_end_arr.append(end)
-        return res
-        
-    cut_point = None
-    bracket_count = 0
-    for index in reversed(range(start, end+1)):
-        c = newick_str[index]
-        if c is ')' or c is '}':
-            bracket_count = bracket_count + 1
-        elif c is '(' or c is '{':
-            bracket_count = bracket_count - 1
-            if (bracket_count is 1):
-                cut_point = index - 1
-                break
-    if (cut_point is not None):
-        res = res + get_polytomy_substring_pos(start+1, cut_point, start_end_arr, threshold, newick_str, True)
-        res = res + get_polytomy_substring_pos(cut_point+1, end-1, start_end_arr, threshold, newick_str, True)
-    else:
-        res = res + [start, start, end, end]
+    stack = [(start, end, False)]
+    while stack:
+        start, end, called_by_self = stack.pop()
+        if (end <= start or (called_by_self and newick_str[end] == ')')):
+            res.extend([start, end])
+            if ((end - start) > threshold):
+                start_end_arr.append((start, end))
+            continue
+        cut_index = None
+        if newick_str[end] == ')' or newick_str[end] == '}':
+            if newick_str[end-1] == ')' or newick_str[end-1] == '}':
+                if match[end-1] >= start:
+                    cut_index = match[end-1]
+        if (cut_index is not None):
+            # push the second part first, so the first part is processed first
+            stack.append((cut_index, end-1, True))
+            stack.append((start+1, cut_index-1, True))
+        else:
+            res.extend([start, start, end, end])
     return res
+
 #rawData string + metadata -> output result into file.
 
-#produce cut_position_map.js and completetree.js given newick tree.
-parser = argparse.ArgumentParser(
-    description="Generate rawData, metadata and cut_position_map given newick string", 
-    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-
-#pick the most recent ordered_tree_XXX.nwk file
-import glob
-import re
-
-datafile_name = "ordered_{data}_{version}.{ext}"
-input_file = glob.glob(os.path.join(os.path.dirname(__file__),'..','..','data','output_files', 
-    datafile_name.format(data='tree', version='*', ext="poly")))
-parser.add_argument(
-    '--npath', 
-    default=input_file,
-    nargs = '+',
-    help='filepath of polytomy-marked newick string')
-
-parser.add_argument(
-    '--outdir','-o', 
-    default= os.path.join(os.path.dirname(__file__),'..','..','..','static','FinalOutputs', 'data'), 
-    help='output filepath of cut_position_map')
-
-parser.add_argument(
-    '--treefilename', 
-    default='completetree_{version}.js', 
-    help='output filepath of rawData and metadata')
+if __name__ == '__main__':
+    #produce cut_position_map.js and completetree.js given newick tree.
+    parser = argparse.ArgumentParser(
+        description="Generate rawData, metadata and cut_position_map given newick string", 
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    #pick the most recent ordered_tree_XXX.nwk file
+    import glob
+    import re
+
+    datafile_name = "ordered_{data}_{version}.{ext}"
+    input_file = glob.glob(os.path.join(os.path.dirname(__file__),'..','..','data','output_files', 
+        datafile_name.format(data='tree', version='*', ext="poly")))
+    parser.add_argument(
+        '--npath', 
+        default=input_file,
+        nargs = '+',
+        help='filepath of polytomy-marked newick string')
+
+    parser.add_argument(
+        '--outdir','-o', 
+        default= os.path.join(os.path.dirname(__file__),'..','..','..','static','FinalOutputs', 'data'), 
+        help='output filepath of cut_position_map')
+
+    parser.add_argument(
+        '--treefilename', 
+        default='completetree_{version}.js', 
+        help='output filepath of rawData and metadata')
     
-parser.add_argument(
-    '--cutfilename', 
-    default= 'cut_position_map_{version}.js', 
-    help='output filepath of cut_position_map')
-
-parser.add_argument(
-    '--datefilename', 
-    default= 'dates_{version}.js', 
-    help='output filepath of json dates file (copied from {} in the same dir as the treefile)'.format(
-        datafile_name.format(data='dates', version='XXXXX', ext='js')))
+    parser.add_argument(
+        '--cutfilename', 
+        default= 'cut_position_map_{version}.js', 
+        help='output filepath of cut_position_map')
+
+    parser.add_argument(
+        '--datefilename', 
+        default= 'dates_{version}.js', 
+        help='output filepath of json dates file (copied from {} in the same dir as the treefile)'.format(
+            datafile_name.format(data='dates', version='XXXXX', ext='js')))
     
-parser.add_argument(
-    '--threshold', 
-    default=10000, 
-    type=int, 
-    help='Threshold for deciding if a node and its descendants needs to be recorded in cut_position_map')
-
-args = parser.parse_args()
-#tidy up the file names to include versioning numbers
-args.npath = max(args.npath, key=os.path.getctime)
-version_number = re.search(datafile_name.format(data='tree', version="([^/]+)", ext="(nwk|poly)"), args.npath).group(1)
-print("Using version number: {}".format(version_number))
-treefile_path = os.path.join(args.outdir, args.treefilename.format(version=version_number))
-cutfile_path  = os.path.join(args.outdir, args.cutfilename.format(version=version_number))
-datefile_inpath  = os.path.join(os.path.dirname(args.npath), datafile_name.format(data='dates', version=version_number, ext='js'))
-datefile_outpath = os.path.join(args.outdir, args.datefilename.format(version=version_number))
-if parameter_valid(args):
-    newick_str = tidy_newick(args.npath)
-    treedata_str = generate_rawdata_metadata(newick_str)
-    cutmap_str = generate_cut_position_map(newick_str, args.threshold)
-    with open(treefile_path, 'wt') as tree:
-        tree.write(treedata_str)
-    print("Generated file: " + treefile_path)
-    call(['gzip', '-9fk', treefile_path])
-    print("Gzipped tree file")
-    with open(cutfile_path, 'wt') as cutfile:
-        cutfile.write(cutmap_str)
-    print("Generated file: " + cutfile_path)
-    call(['gzip', '-9fk', cutfile_path])
-    print("Gzipped cutmap file")
-    print("Copying date file {} to {}".format(datefile_inpath, datefile_outpath))
-    shutil.copyfile(datefile_inpath, datefile_outpath)
-    call(['gzip', '-9fk', datefile_outpath])
-    print("Gzipped date file")
-    print("Done")
+    parser.add_argument(
+        '--threshold', 
+        default=10000, 
+        type=int, 
+        help='Threshold for deciding if a node and its descendants needs to be recorded in cut_position_map')
+
+    args = parser.parse_args()
+    #tidy up the file names to include versioning numbers
+    args.npath = max(args.npath, key=os.path.getctime)
+    version_number = re.search(datafile_name.format(data='tree', version="([^/]+)", ext="(nwk|poly)"), args.npath).group(1)
+    print("Using version number: {}".format(version_number))
+    treefile_path = os.path.join(args.outdir, args.treefilename.format(version=version_number))
+    cutfile_path  = os.path.join(args.outdir, args.cutfilename.format(version=version_number))
+    datefile_inpath  = os.path.join(os.path.dirname(args.npath), datafile_name.format(data='dates', version=version_number, ext='js'))
+    datefile_outpath = os.path.join(args.outdir, args.datefilename.format(version=version_number))
+    if parameter_valid(args):
+        newick_str = tidy_newick(args.npath)
+        treedata_str = generate_rawdata_metadata(newick_str)
+        cutmap_str = generate_cut_position_map(newick_str, args.threshold)
+        with open(treefile_path, 'wt') as tree:
+            tree.write(treedata_str)
+        print("Generated file: " + treefile_path)
+        call(['gzip', '-9fk', treefile_path])
+        print("Gzipped tree file")
+        with open(cutfile_path, 'wt') as cutfile:
+            cutfile.write(cutmap_str)
+        print("Generated file: " + cutfile_path)
+        call(['gzip', '-9fk', cutfile_path])
+        print("Gzipped cutmap file")
+        print("Copying date file {} to {}".format(datefile_inpath, datefile_outpath))
+        shutil.copyfile(datefile_inpath, datefile_outpath)
+        call(['gzip', '-9fk', datefile_outpath])
+        print("Gzipped date file")
+        print("Done")
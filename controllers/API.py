@@ -3,6 +3,7 @@ import sys
 import re
 from OZfunctions import punctuation_to_space, __check_version, is_logographic, child_leaf_query
 from OZfunctions import ids_from_otts_string, nodes_info_from_string
+from sponsorship import search_sponsor_text
 """
 This contains the API functions - node_details, image_details, search_names, and search_sponsors. search_node also exists, which is a combination of search_names and search_sponsors.
 # request.vars:
@@ -463,58 +464,19 @@ def search_sponsor(searchFor, searchType, language, order_by_recent=None, limit=
                        "verified_preferred_image_src": None,
                        "verified_preferred_image_src_id": None,
                        "verified_url": None}
-            alt_colnames = [(("'"+alt_txt[c]+"'" if alt_txt[c] else "NULL") + " AS " + c) if c in alt_txt else c for c in colnames]     
             colname_map = {nm:index for index,nm in enumerate(colnames)}
-            search_query = {'verif':"", 'unverif':""}
-            search_terms = []
-            
-            if searchType != "all":
-                search_query['verif'] = "verified_kind = " + db.placeholder
-                search_query['unverif'] = "user_sponsor_kind = " + db.placeholder
-                search_terms.append(searchType)
-                
-            for word in ["%"+w+"%" for w in searchFor if w]:
-                if search_terms:
-                    search_query['verif'] += " AND "
-                    search_query['unverif'] += " AND "
-                search_query['verif'] += ("(verified_name like " + db.placeholder + 
-                    " or verified_more_info like " + db.placeholder + ")")
-                search_query['unverif'] += ("(user_sponsor_name like " + db.placeholder +
-                    " or user_more_info like " + db.placeholder + ")")
-                search_terms.extend([word, word])
-    
-            # The logic here is complex. We might wish to allow people to search either 
-            # for their entered text if not yet verified, or their verified text once it
-            # appears. If the former, we should put up the holding text in alt_txt.
-            # We detect this by looking at verified_time (for verified text) or 
-            # user_sponsor_kind (for unverified text).
-            # We also need to not return expired or otherwise deactivated leaves
-                    
-            #The verified ones
-            query = "SELECT * FROM (SELECT " + ",".join(colnames) + " FROM reservations"
-            query += " WHERE verified_time IS NOT NULL AND (deactivated IS NULL OR deactivated = '')"
-            query += " AND (DATE_ADD(verified_time, INTERVAL sponsorship_duration_days DAY) > CURDATE())"
-            query += " AND " + search_query['verif']
-            if order_by_recent:
-                query += ' ORDER BY verified_time DESC'
-            query += ") AS t1"
-            
-            query += " UNION ALL "
-    
-            query += "SELECT * FROM (SELECT " + ",".join(alt_colnames) + " FROM reservations"
-            query += " WHERE verified_time IS NULL AND user_sponsor_kind IS NOT NULL AND user_sponsor_kind != ''"
-            query += " AND (deactivated IS NULL OR deactivated = '')"
-            query += " AND " + search_query['unverif']
-            if order_by_recent:
-                query += ' ORDER BY user_updated_time DESC'
-            query += ") AS t2"
-    
-            if limit:
-                query += ' LIMIT ' + str(int(limit))
-                if start:
-                    query += ' OFFSET ' + str(int(start))
-                  
-            reservations = db.executesql(query, search_terms + search_terms)
+            # We might wish to allow people to search either for their entered text if not
+            # yet verified, or their verified text once it appears. If the former, we
+            # should put up the holding text in alt_txt. search_sponsor_text() only
+            # returns sponsorships that have not expired or otherwise been deactivated,
+            # looking up the words in the sponsor_search_tokens table, rather than
+            # scanning the reservations table with LIKE '%word%'
+            alt_row = {c:(str(v) if v else None) for c, v in alt_txt.items()}
+            reservations = [
+                tuple(row[c] if verified or c not in alt_row else alt_row[c] for c in colnames)
+                for verified, row in search_sponsor_text(
+                    db, searchFor, colnames, request.now, None if searchType == "all" else searchType,
+                    order_by_recent, limit, start)]
             
             reservationsOttArray = []
             for row in reservations:
@@ -571,6 +533,28 @@ def otts2vns():
         return ret_otts
     except (AttributeError, ValueError):
         return {'lang':lang}
+
+def ancestors_of_otts():
+    """
+    Return the (real, i.e. not polytomy-resolving) ancestors of a comma-separated list
+    of up to 200 otts, e.g. API/ancestors_of_otts.json?otts=770315,872567
+    Returns {"header":{"id":0, "ott":1, ...}, "ancestors":{"770315":[[...],[...]], ...}}
+    where each list of ancestors goes from the root down to the immediate parent.
+    Can call with wikidata_only=1 to only return ancestors with a wikidata item
+    """
+    from nested_set import ancestor_paths, default_ancestor_fields
+    session.forget(response)
+    response.headers["Access-Control-Allow-Origin"] = '*'
+    header = {k:i for i,k in enumerate(default_ancestor_fields)}
+    try:
+        otts = [int(x) for x in request.vars.otts.split(',')][:200]
+    except (AttributeError, ValueError):
+        return {'header':header, 'ancestors':{}}
+    paths = ancestor_paths(db, otts,
+        query=(db.ordered_nodes.wikidata != None) if request.vars.wikidata_only else None)
+    return {
+        'header': header,
+        'ancestors': {ott: [[a[k] for k in default_ancestor_fields] for a in path] for ott, path in paths.items()}}
     
 def update_visit_count():
     session.forget(response)
@@ -7,10 +7,13 @@ from json import dumps
 from collections import OrderedDict
 
 from OZfunctions import (
-    clear_reservation,
     nice_species_name, get_common_name, get_common_names, sponsorable_children_query,
     language, __make_user_code, raise_incorrect_url, require_https_if_nonlocal, add_the,
-    ids_from_otts_array, nodes_info_from_array, nodes_info_from_string, extract_summary)
+    ids_from_otts_array, nodes_info_from_array, nodes_info_from_string, extract_summary,
+    first_lang)
+from sponsorship import (view_reservation, record_paypal_notification,
+    sponsorable_leaves_page, handpick_leaves, sponsored_stamp, leaf_card_images,
+    update_sponsor_search_tokens)
 
 
 """ Some settings for sponsorship"""
@@ -72,30 +75,17 @@ def index():
     # Remove the unused threatened ones
     startpoints_ott_map = {k: v for k, v in startpoints_ott_map.items() if v in keys}
     
-    # OTTs from the reservations table (i.e. sponsored)
-    query = (db.reservations.verified_time != None) & \
-        ((db.reservations.deactivated == None) | (db.reservations.deactivated == "")) & \
-        (db.reservations.verified_preferred_image_src != None)
-    sponsored_rows = db(query).select(
-        db.reservations.OTT_ID,
-        db.reservations.name,
-        db.reservations.user_nondefault_image,
-        db.reservations.verified_kind,
-        db.reservations.verified_name,
-        db.reservations.verified_more_info,
-        db.reservations.verified_preferred_image_src,
-        db.reservations.verified_preferred_image_src_id,
-        orderby=~db.reservations.verified_time|db.reservations.reserve_time,
+    # OTTs of sponsored leaves, from the recent_sponsorships copy of the reservations
+    # table, which also holds the image to show for each leaf
+    rs = db.recent_sponsorships
+    sponsored_rows = db(rs.verified_preferred_image_src != None).select(
+        rs.ALL,
+        orderby=~rs.verified_time|rs.reserve_time,
         limitby=(0, 20)
         )
     
-    spon_leaf_otts = set()
-    sponsored_by_ott = {}
     for r in sponsored_rows:
-        sponsored_by_ott[r.OTT_ID] = r
         hrefs[r.OTT_ID] = URL('life/@=%d' % r.OTT_ID, url_encode=False)
-        spon_leaf_otts.add(r.OTT_ID)
-        titles[r.OTT_ID] = r.name
     for ott, key in startpoints_ott_map.items():
         if key not in hrefs:
             hrefs[key] = URL('life/@=%d' % ott, url_encode=False)
@@ -126,12 +116,20 @@ def index():
                 text_titles[startpoint_key] = nice_species_name(
                     (titles[ott] if vn is None else None), vn, html=True,
                     leaf=ott not in st_node_otts, break_line=2)
-        # ... and another for the sponsored items (both common and sci in the string)
+        # ... and another keyed by ott (both common and sci in the string)
         if vn is not None:
             has_vernacular.add(ott)
         titles[ott] = nice_species_name(
             titles[ott], vn, html=True, leaf=ott not in st_node_otts, 
             first_upper=True, break_line=1)
+    # ... and another for the sponsored items (both common and sci in the string)
+    sponsored_vns = _vernaculars([r.OTT_ID for r in sponsored_rows])
+    for r in sponsored_rows:
+        vn = sponsored_vns[r.OTT_ID]
+        if vn is not None:
+            has_vernacular.add(r.OTT_ID)
+        titles[r.OTT_ID] = nice_species_name(
+            r.name, vn, html=True, leaf=True, first_upper=True, break_line=1)
     titles.update(text_titles)
 
     # Images
@@ -145,18 +143,12 @@ def index():
         if key not in images:
             images[key] = {'url':thumbnail_url(r.src, r.src_id)}
     # Sponsored images
-    for r in db(
-            (db.images_by_ott.ott.belongs(spon_leaf_otts)) & (db.images_by_ott.overall_best_any==1)
-        ).select(
-            db.images_by_ott.ott, db.images_by_ott.src, db.images_by_ott.src_id,
-            db.images_by_ott.rights, db.images_by_ott.licence):
-        reservations_row = sponsored_by_ott[r.ott]
-        if reservations_row.user_nondefault_image:
-            images[r.ott] = {'url':thumbnail_url(
-                reservations_row.verified_preferred_image_src,
-                reservations_row.verified_preferred_image_src_id)}
-        else:
-            images[r.ott] = {'url':thumbnail_url(r.src, r.src_id), 'rights':r.rights, 'licence': r.licence.split('(')[0]}
+    for r in sponsored_rows:
+        if r.user_nondefault_image:
+            images[r.OTT_ID] = {'url':thumbnail_url(
+                r.verified_preferred_image_src, r.verified_preferred_image_src_id)}
+        elif r.src is not None:
+            images[r.OTT_ID] = {'url':thumbnail_url(r.src, r.src_id), 'rights':r.rights, 'licence': (r.licence or '').split('(')[0]}
     blank = {'url': URL('static','images/noImage_transparent.png')}
     for key in titles.keys():
         if key not in images:
@@ -181,7 +173,7 @@ def index():
         carousel=carousel, anim=anim, threatened=threatened, sponsored=sponsored_rows,
         hrefs=hrefs, images=images, html_names=titles, has_vernacular=has_vernacular, add_the=add_the,
         n_total_sponsored=db(db.reservations.PP_e_mail != None).count(distinct=db.reservations.PP_e_mail),
-        n_sponsored_leaves=db((db.reservations.verified_time != None) & ((db.reservations.deactivated == None) | (db.reservations.deactivated == ""))).count(),
+        n_sponsored_leaves=db(db.recent_sponsorships).count(),
         menu_splash_images={
             sub_menu[0]:URL('static', 'images/oz-newssplash-%s.jpg' % sub_menu[0].lower().replace("for ", ""))
             for sub_menu in response.menu
@@ -332,10 +324,8 @@ def sponsor_leaf_check(use_form_data, form_data_to_db):
     if maint:
         status = "maintenance"
 
-    max_price = db.prices.price.max()
-    max_global_price = db().select(max_price).first()[max_price] / 100
-    min_price = db.prices.price.min()
-    min_global_price = db().select(min_price).first()[min_price] / 100
+    max_global_price = price_levels_pence()[-1] / 100
+    min_global_price = price_levels_pence()[0] / 100
     
     if (request.vars.get('form_reservation_code')):
         form_reservation_code = request.vars.form_reservation_code
@@ -420,118 +410,17 @@ def sponsor_leaf_check(use_form_data, form_data_to_db):
         except AttributeError:
             partner_data = {}
             
-        # find out if the leaf is banned
-        if db(db.banned.ott == OTT_ID_Varin).count() >= 1:
-            status = "banned"
-        # we need to update the reservations table regardless of banned status)
-        reservation_query = db(db.reservations.OTT_ID == OTT_ID_Varin)
-        reservation_row = reservation_query.select().first()
-        if reservation_row is None:
-            # there is no row in the database for this case so add one
-            if (status == ""):
-                status = "available"
-            if status == "available" and allow_sponsorship:
-                db.reservations.insert(
-                    OTT_ID = OTT_ID_Varin,
-                    name=leaf_entry.name,
-                    last_view=request.now,
-                    num_views=1,
-                    reserve_time=request.now,
-                    user_registration_id=form_reservation_code)
-            else:
-                # update with full viewing data but no reservation, even if e.g. banned
-                db.reservations.insert(
-                    OTT_ID = OTT_ID_Varin,
-                    name=leaf_entry.name,
-                    last_view=request.now,
-                    num_views=1)
-        else:
-            # there is already a row in the database so update if this is the main visit
-            if request.function == 'sponsor_leaf' and request.extension == "html":
-                reservation_query.update(
-                    last_view=request.now,
-                    num_views=reservation_row.num_views+1,
-                    name=sp_name)
-
-            # this may be available (because valid) but could be
-            #  sponsored, unverified, reserved or still available  
-            # easiest cases to rule out are relating sponsored and unverified cases.
-            # In either case they would appear in the leger
-            ledger_user_name = reservation_row.user_sponsor_name
-            ledger_PP_transaction_code = reservation_row.PP_transaction_code
-            ledger_verified_time = reservation_row.verified_time
-            # We know something is fully sponsored if PP transaction code is filled out  
-            # NB: this could be with us typing "yet to be paid" in which case
-            #  verified_paid can be NULL, so "verified paid " should not be used as a
-            #  test of whether something is available or not
-            # For forked sites, we do not pass PP transaction code (confidential), so we
-            #   have to check first if verified.
-            # Need to have another option here if verified_time is too long ago - we
-            #  should move this to the expired_reservations table and clear it.
-            if (ledger_verified_time):
-                status = "sponsored"
-            elif status != "banned":
-                if (ledger_user_name):
-                # something has been filled in
-                    if (ledger_PP_transaction_code):
-                        #we have a code (or have reserved this taxon)
-                        status = "unverified"
-                    else:
-                        # unverified and unpaid - test time
-                        startTime = reservation_row.reserve_time
-                        endTime = request.now
-                        timesince = ((endTime-startTime).total_seconds())
-                        # now we check if the time is too great
-                        if (timesince < (unpaid_time_limit)):
-                            status = "unverified waiting for payment"
-                        else:
-                            # We've waited too long and can zap the personal data
-                            # previously in the table then set available
-                            clear_reservation(OTT_ID_Varin)
-                            # Note that this e.g. clears deactivated taxa, etc etc. Even 
-                            # if status == available, allow_sponsorship can be False
-                            # status is then used to decide the text to show the user
-                            status = "available"
-                else:
-                    # The page has no user name entered & is also valid (not banned etc)
-                    # it could only be reserved or available
-                    # First thing is to determine time difference since reserved
-                    startTime = reservation_row.reserve_time   
-                    endTime = request.now
-                    if (startTime == None):
-                        status = "available"
-                        # reserve the leaf because there is no reservetime on record
-                        if allow_sponsorship:
-                            reservation_query.update(
-                                name=sp_name,
-                                reserve_time=request.now,
-                                user_registration_id=form_reservation_code)
-                    else:
-                        # compare times to figure out if there is a time difference
-                        timesince = ((endTime-startTime).total_seconds())
-                        if (timesince < (reservation_time_limit)):
-                            release_time = reservation_time_limit - timesince
-                            # we may be reserved if it wasn't us
-                            if(form_reservation_code == reservation_row.user_registration_id):
-                                # it was the same user anyway so reset timer
-                                status = "available only to user"
-                                if allow_sponsorship:
-                                    reservation_query.update(
-                                        name=sp_name,
-                                        reserve_time=request.now)
-                            else:
-                                status = "reserved"
-                        else:
-                            # it's available still
-                            status = "available"
-                            # reserve the leaf because there is no reservetime on record
-                            if allow_sponsorship:
-                                reservation_query.update(
-                                    name=sp_name,
-                                    reserve_time = request.now,
-                                    user_registration_id = form_reservation_code)
-        #re-do the query since we might have added the row ID now
-        reservation_row = reservation_query.select().first()
+        # find out the reservation status (sponsored, banned, reserved, etc), and update
+        # the reservations table regardless of banned status, in a single locked transaction
+        # (see modules/sponsorship.py). Views are only counted on the main visit.
+        # NB: this commits first, so that the lock is taken in a new transaction (and, in
+        # MySQL, reads the latest row rather than this request's snapshot). Nothing above
+        # writes to the database, so there is nothing to commit early here.
+        status, release_time, reservation_row = view_reservation(
+            db, OTT_ID_Varin, sp_name, form_reservation_code, request.now,
+            reservation_time_limit, unpaid_time_limit,
+            allow_sponsorship=allow_sponsorship,
+            count_view=(request.function == 'sponsor_leaf' and request.extension == "html"))
         if reservation_row is None:
             raise HTTP(400,"Error: row is not defined. Please try reloading the page")
     
@@ -661,6 +550,9 @@ def sponsor_leaf_check(use_form_data, form_data_to_db):
                     dbio=form_data_to_db,
                     onvalidation=lambda x: valid_spons(x, sp_name, price, partner_data)):
                 validated = True # indicates to follow the form submission to paypal
+                if form_data_to_db:
+                    #make the sponsor text searchable while it awaits verification
+                    update_sponsor_search_tokens(db, [OTT_ID_Varin])
             elif form.errors:
                 validated = False
             else:
@@ -838,40 +730,101 @@ def sponsored():
         sum = resv.user_paid.sum()
         tot = db(query).select(sum).first()[sum]
     limitby=(page*items_per_page,(page+1)*items_per_page+1)
-    curr_rows = db(query).select(
-        resv.OTT_ID,
-        resv.name,
-        resv.user_nondefault_image,
-        resv.verified_kind,
-        resv.verified_name,
-        resv.verified_more_info,
-        resv.verified_preferred_image_src,
-        resv.verified_preferred_image_src_id,
-        orderby=~resv.verified_time|resv.reserve_time,
-        limitby=limitby
-        )
+    if (request.vars.getfirst('search_mesg')):
+        curr_rows = db(query).select(
+            resv.OTT_ID,
+            resv.name,
+            resv.user_nondefault_image,
+            resv.verified_kind,
+            resv.verified_name,
+            resv.verified_more_info,
+            resv.verified_preferred_image_src,
+            resv.verified_preferred_image_src_id,
+            orderby=~resv.verified_time|resv.reserve_time,
+            limitby=limitby
+            )
+    else:
+        #messages are not copied to recent_sponsorships, but otherwise it has everything we need
+        rs = db.recent_sponsorships
+        curr_rows = db((rs.verified_preferred_image_src != None) if request.vars.omit_nopics else (rs.id > 0)).select(
+            rs.ALL,
+            orderby=~rs.verified_time|rs.reserve_time,
+            limitby=limitby
+            )
 
-    pds=set()
-    sci_names = {r.OTT_ID:r.name for r in curr_rows}
-    html_names = {ott:nice_species_name(sci_names[ott], vn, html=True, leaf=True, first_upper=True, break_line=2) for ott,vn in get_common_names(sci_names.keys(), return_nulls=True).items()}
-    #store the default image info (e.g. to get thumbnails, attribute correctly etc)
-    default_images = {r.ott:r for r in db(db.images_by_ott.ott.belongs(sci_names.keys()) & (db.images_by_ott.overall_best_any==1)).select(db.images_by_ott.ott, db.images_by_ott.src, db.images_by_ott.src_id,  db.images_by_ott.rights, db.images_by_ott.licence, orderby=~db.images_by_ott.src)}
-    #also look at the nondefault images if present - 
-    user_images = {}
-    for r in curr_rows:
-        if r.user_nondefault_image != 0:
-            user_images[r.OTT_ID] = db(
-                (db.images_by_ott.src_id==r.verified_preferred_image_src_id) &
-                (db.images_by_ott.src==r.verified_preferred_image_src)
-                ).select(
-                    db.images_by_ott.ott, db.images_by_ott.src, db.images_by_ott.src_id,
-                    db.images_by_ott.rights, db.images_by_ott.licence,
-                    orderby=~db.images_by_ott.src).first()
-    if (request.vars.highlight_pd):
-        pds.add(None) #ones without a src_id are public doman
-        pds |= set([l['src_id'] for k,l in default_images.items() if l['licence'].endswith(u'\u009C')]) #all pd pics should end with \u009C on the licence
-        pds |= set([l['src_id'] for k,l in user_images.items() if l['licence'].endswith(u'\u009C')]) #all pd pics should end with \u009C on the licence
-    return dict(rows=curr_rows, page=page, items_per_page=items_per_page, tot=tot, vars=request.vars, pds=pds, html_names=html_names, user_images=user_images, default_images=default_images)
+    cards = _leaf_cards(curr_rows[:items_per_page], highlight_pd=bool(request.vars.highlight_pd))
+    return dict(rows=curr_rows, page=page, items_per_page=items_per_page, tot=tot, vars=request.vars, cards=cards)
+
+def _leaf_cards(rows, highlight_pd=False):
+    """
+    The rendered HTML (views/default/leaf_card.html) for the name and image of each of
+    these sponsored leaves (rows from reservations or recent_sponsorships), keyed by ott.
+    A card only changes with the leaf's image, the language and the tree version, so cards
+    are cached under those, and names and images are only looked up (with one query per
+    table) for cards that are not already in the cache. Rows from recent_sponsorships
+    already hold the image to show, so the images table is not needed for those.
+    """
+    lang = first_lang(request)
+    tree_version = _tree_version()
+    cards = {}
+    missing = {}
+    stored_images = {}
+    for r in rows:
+        image = None
+        if r.user_nondefault_image and r.verified_preferred_image_src is not None \
+                and r.verified_preferred_image_src_id is not None:
+            image = (r.verified_preferred_image_src, r.verified_preferred_image_src_id)
+        key = 'leaf_card_{}_{}_{}_{}{}'.format(r.OTT_ID, lang, '{}-{}'.format(*image) if image else 'default',
+            tree_version, '_pd' if highlight_pd else '')
+        html = cache.ram(key, lambda: None, time_expire=24*60*60)
+        if html is None:
+            missing[r.OTT_ID] = (key, image, r.name)
+            if 'licence' in r:
+                stored_images[r.OTT_ID] = r
+        else:
+            cards[r.OTT_ID] = html
+    if missing:
+        sci_names = {ott:name for ott, (key, image, name) in missing.items()}
+        html_names = {ott:nice_species_name(sci_names[ott], vn, html=True, leaf=True, first_upper=True, break_line=2) for ott,vn in get_common_names(sci_names.keys(), return_nulls=True, lang=lang).items()}
+        default_images, chosen_images = {}, {}
+        if len(stored_images) < len(missing):
+            default_images, chosen_images = leaf_card_images(
+                db, [ott for ott in missing if ott not in stored_images],
+                [image for ott, (key, image, name) in missing.items() if image and ott not in stored_images])
+        for ott, (key, image, name) in missing.items():
+            row = stored_images.get(ott)
+            if row is not None:
+                img = row if row.src is not None else None
+            else:
+                img = chosen_images.get(image) or default_images.get(ott)
+            html = response.render('default/leaf_card.html',
+                dict(ott=ott, html_name=html_names[ott], img=img, highlight_pd=highlight_pd))
+            cards[ott] = cache.ram(key, lambda: html, time_expire=0)
+    return cards
+
+def _tree_version():
+    """The version of the tree, which is stored as a negative parent of the root node"""
+    root = db.ordered_nodes[1]
+    return root.parent if root else None
+
+def _vernaculars(otts):
+    """
+    get_common_names() for these otts in the current language, for leaves that are shown
+    on every visit to the home page. The names are kept in a cache.ram dict for each
+    language, which is started afresh when the tree changes, so each leaf is only
+    looked up once.
+    """
+    lang = first_lang(request)
+    tree_version = _tree_version()
+    key = 'vernaculars_{}'.format(lang)
+    cached = cache.ram(key, lambda: None, time_expire=24*60*60)
+    if cached is None or cached[0] != tree_version:
+        cached = (tree_version, {})
+    missing = [ott for ott in otts if ott not in cached[1]]
+    if missing:
+        cached[1].update(get_common_names(missing, return_nulls=True, lang=lang))
+        cache.ram(key, lambda: cached, time_expire=0)
+    return {ott:cached[1].get(ott) for ott in otts}
 
 def donor_list():
     '''list donors by name. Check manage/SHOW_SPONSOR_SUMS.html to see what names to add.
@@ -904,19 +857,15 @@ def donor_list():
     sci_names = {int(r[grouped_otts]):r.reservations.name for r in curr_rows if r[n_leaves]==1} #only get sci names etc for unary sponsors
     html_names = {ott:nice_species_name(sci_names[ott], vn, html=True, leaf=True, first_upper=True, break_line=2) for ott,vn in get_common_names(sci_names.keys(), return_nulls=True).items()}
     otts = [int(ott) for r in curr_rows for ott in r[grouped_otts].split(",") if r[grouped_otts]]
-    #store the default image info (e.g. to get thumbnails, attribute correctly etc)
-    default_images = {r.ott:r for r in db(db.images_by_ott.ott.belongs(otts) & (db.images_by_ott.overall_best_any==1)).select(db.images_by_ott.ott, db.images_by_ott.src, db.images_by_ott.src_id,  db.images_by_ott.rights, db.images_by_ott.licence, orderby=~db.images_by_ott.src)}
-    #also look at the nondefault images if present
-    user_images = {}
+    #store the default image info (e.g. to get thumbnails, attribute correctly etc) and
+    # the nondefault images if present, using one query for each
+    chosen = []
     for r in curr_rows:
-        for img_src, img_src_id in zip(
-            (r[grouped_img_src] or '').split(","), (r[grouped_img_src_id] or '').split(",")):
-            if img_src is not None and img_src_id is not None:
-                row = db((db.images_by_ott.src == img_src) & (db.images_by_ott.src_id == img_src_id)).select(
-                    db.images_by_ott.ott, db.images_by_ott.src, db.images_by_ott.src_id, 
-                    db.images_by_ott.rights, db.images_by_ott.licence).first()
-                if row:
-                    user_images[row.ott] = row
+        chosen.extend(zip(
+            (r[grouped_img_src] or '').split(","), (r[grouped_img_src_id] or '').split(",")))
+    default_images, chosen_images = leaf_card_images(
+        db, otts, [(img_src, img_src_id) for img_src, img_src_id in chosen if img_src and img_src_id])
+    user_images = {row.ott:row for row in chosen_images.values()}
     return dict(rows=curr_rows, n_col_name=n_leaves, otts_col_name=grouped_otts, paid_col_name=sum_paid, page=page, items_per_page=items_per_page, vars=request.vars, html_names=html_names, user_images=user_images, default_images=default_images)
 
 
@@ -968,10 +917,10 @@ def sponsor():
 def treecards():
     prices = []
     accumulate = 0
-    for row in db(db.prices).select(db.prices.ALL, orderby=db.prices.price):
-        accumulate += row.n_leaves
+    for band in price_bands():
+        accumulate += band['n_leaves']
         prices.append(
-            {'price_pounds': row.price/100, 'n': row.n_leaves, 'cumulative': accumulate})
+            {'price_pounds': band['price']/100, 'n': band['n_leaves'], 'cumulative': accumulate})
     for p in prices:
         p['quantile'] = p['cumulative']/accumulate
     return dict(
@@ -992,7 +941,7 @@ def sponsor_node_price():
       (if we don't get enough results returned) for leaves without an image, ranked
       by popularity.
     """
-    price_levels_pence = sorted([row.price for row in db().select(db.prices.price)])
+    levels = price_levels_pence()
     try:
         if request.vars.get('id'):
             query = sponsorable_children_query(int(request.vars.id), qtype="id")
@@ -1011,7 +960,7 @@ def sponsor_node_price():
         # Use some shortcuts
         img_tab = db.images_by_ott
         leaf_tab = db.ordered_leaves
-        if price_pence is None or price_pence > price_levels_pence[0]:
+        if price_pence is None or price_pence > levels[0]:
             rows_with_img = db(query & (img_tab.overall_best_any)).select(
                 db.ordered_leaves.ott,
                 db.ordered_leaves.name,
@@ -1090,7 +1039,7 @@ def sponsor_node_price():
         return dict(otts=otts, image_urls=image_urls, html_names = html_names, attributions=image_attributions, price_pence = price_pence)
         
     except:
-        raise_incorrect_url(URL(vars={'id':1, 'price':price_levels_pence[1]}, scheme=True, host=True),
+        raise_incorrect_url(URL(vars={'id':1, 'price':levels[1]}, scheme=True, host=True),
             T("Sorry, you passed in no ID or one that doesn't seem to correspond to a group on the tree."))
         
         
@@ -1116,7 +1065,7 @@ def sponsor_node():
             partner = None    
         first25 = db(query).select(limitby=(0, 25), orderby=db.ordered_leaves.name)
         if len(first25) > 0:
-            prices_pence = sorted([r.price for r in db().select(db.prices.price)])
+            prices_pence = price_levels_pence()
             prices_pence.append("")
             return(dict(prices_pence=prices_pence, first25=first25, vars=request.vars, common_name=common_name, partner=partner, error=None))
         else:
@@ -1138,58 +1087,64 @@ def sponsor_handpicks():
     They should not need to be paged
     """
     valid_dict = sponsor_picks()
-    orderby = "images_by_ott.rating DESC"
-    if request.vars.group_name in valid_dict and len(valid_dict[request.vars.group_name]['otts']):
+    group_name = request.vars.group_name
+    if group_name in valid_dict and len(valid_dict[group_name]['otts'] or ""):
         #this doesn't distinguish between sponsored and unsponsored, which is what we want
-        query = db.ordered_leaves.ott.belongs(valid_dict[request.vars.group_name]['otts'])
+        otts = [int(ott) for ott in valid_dict[group_name]['otts'].split(",") if ott.strip()]
     else:
         return dict(error="Error: no group given")
     try:
         max_returned = int(request.vars.n)
     except:
         max_returned = 8
-    
-    if db(query).count() > 0:
-        prices_pence = sorted([r.price for r in db().select(db.prices.price)]) + [None]
-        otts = OrderedDict()
-        image_urls = {}
-        sci_names = {}
-        html_names = {}
-        for p in prices_pence:
-            if (p):
-                if (float(p)/100).is_integer():
-                    price_pounds = '{:.0f}'.format(p/100.0)
-                else:
-                    price_pounds = '{:.2f}'.format(p/100.0)
-            else:
-                price_pounds = "contact us"
-            rows = db(query &
-                      (db.ordered_leaves.price==p) & 
-                      ((db.images_by_ott.overall_best_any == True) | (db.images_by_ott.overall_best_any == None))
-                      ).select(db.ordered_leaves.ott, 
-                               db.ordered_leaves.name,
-                               db.images_by_ott.src,
-                               db.images_by_ott.src_id,
-                               left = db.images_by_ott.on(db.images_by_ott.ott == db.ordered_leaves.ott),
-                               orderby = orderby)
-            otts[price_pounds] = [r.ordered_leaves.ott for r in rows]
-            image_urls.update({species.ordered_leaves.ott:thumbnail_url(species.images_by_ott.src, species.images_by_ott.src_id) for species in rows if species.images_by_ott.src})
-            sci_names.update({species.ordered_leaves.ott:species.ordered_leaves.name for species in rows})
-
-        #Now find the vernacular names for all these species
-        all_otts = [ott for price in otts for ott in otts[price]]
-        if all_otts:
-            html_names = {ott:nice_species_name(sci_names[ott], vn, html=True, leaf=True, first_upper=True) for ott,vn in get_common_names(all_otts, return_nulls=True).items()}
-            rows = db(db.reservations.OTT_ID.belongs(all_otts) & (db.reservations.verified_time != None)).select(db.reservations.OTT_ID, db.reservations.verified_kind, db.reservations.verified_name)
-            reserved = {r.OTT_ID:[r.verified_kind, r.verified_name] for r in rows}
-                    
-        return(dict(otts=otts, image_urls=image_urls, html_names=html_names, reserved=reserved, vars=request.vars, error=None))
-    else:
+
+    #The leaves, names and images only change with the tree, the language, the list itself,
+    # the prices (see manage/SET_PRICES), and the sponsorship details when a leaf is
+    # sponsored, so cache them, checking they are still current using a single cheap
+    # query on reservations
+    lang = first_lang(request)
+    key = 'sponsor_handpicks_{}_{}'.format(group_name, lang)
+    stamp = (valid_dict[group_name]['otts'], _tree_version(), sponsored_stamp(db),
+        tuple((b['price'], b['n_leaves']) for b in price_bands()))
+    cached = cache.ram(key, lambda: None, time_expire=60*60)
+    if cached is None or cached[0] != stamp:
+        cached = cache.ram(key, lambda: (stamp, _handpicks_data(otts)), time_expire=0)
+    data = cached[1]
+    if data is None:
         return(dict(otts=[], vars=request.vars, error="Sorry, there are no species you can sponsor in this group"))
+    return(dict(vars=request.vars, error=None, **data))
+
+def _handpicks_data(otts):
+    """The leaves for sponsor_handpicks, grouped by price, with their names, images and sponsors"""
+    prices_pence = price_levels_pence() + [None]
+    by_price, images, sci_names = handpick_leaves(db, otts, prices_pence)
+    if by_price is None:
+        return None
+    otts = OrderedDict()
+    for p, price_otts in by_price.items():
+        if (p):
+            if (float(p)/100).is_integer():
+                price_pounds = '{:.0f}'.format(p/100.0)
+            else:
+                price_pounds = '{:.2f}'.format(p/100.0)
+        else:
+            price_pounds = "contact us"
+        otts[price_pounds] = price_otts
+    image_urls = {ott:thumbnail_url(*src) for ott, src in images.items()}
+    html_names = {}
+    reserved = {}
+    all_otts = [ott for price in otts for ott in otts[price]]
+    if all_otts:
+        html_names = {ott:nice_species_name(sci_names[ott], vn, html=True, leaf=True, first_upper=True) for ott,vn in get_common_names(all_otts, return_nulls=True).items()}
+        rows = db(db.reservations.OTT_ID.belongs(all_otts) & (db.reservations.verified_time != None)).select(db.reservations.OTT_ID, db.reservations.verified_kind, db.reservations.verified_name)
+        reserved = {r.OTT_ID:[r.verified_kind, r.verified_name] for r in rows}
+    return dict(otts=otts, image_urls=image_urls, html_names=html_names, reserved=reserved)
 
 def list_sponsorable_children():
     """
-    This lists children in alphabetical order, paged
+    This lists children in alphabetical order, paged. Pages after the first are selected
+    using the id of the last leaf on the previous page, passed as the 'after' var (see
+    sponsorable_leaves_page), with the page number as the first arg
     """
     items_per_page=500
     try:
@@ -1199,25 +1154,30 @@ def list_sponsorable_children():
         
     try:
         if request.vars.get('id'):
-            query = sponsorable_children_query(int(request.vars.id), qtype="id")
+            query = sponsorable_children_query(int(request.vars.id), qtype="id", exclude_sponsored=False)
         elif request.vars.get('ott'):
-            query = sponsorable_children_query(int(request.vars.ott), qtype="ott")
-        limitby=(page*items_per_page,(page+1)*items_per_page+1)
-        species = db(query).select(db.ordered_leaves.ott, 
-                                   db.ordered_leaves.name,
-                                   db.ordered_leaves.price,
-                                   limitby=limitby, 
-                                   orderby=db.ordered_leaves.name)
-        return(dict(species=species,page=page,items_per_page=items_per_page, error=""))
+            query = sponsorable_children_query(int(request.vars.ott), qtype="ott", exclude_sponsored=False)
+        after = int(request.vars.after) if page and request.vars.get('after') else None
+        species = sponsorable_leaves_page(db, query, after, items_per_page)
+        first_vars = {k:v for k,v in request.vars.items() if k != 'after'}
+        next_vars = dict(first_vars, after=species[items_per_page-1].id) if len(species) > items_per_page else None
+        return(dict(species=species,page=page,items_per_page=items_per_page, error="",
+            first_vars=first_vars, next_vars=next_vars))
 
     except:
-        return(dict(species=[],page=page, items_per_page=items_per_page, error="Sorry, you passed in an ID that doesn't seem to correspond to a group on the tree"))
+        return(dict(species=[],page=page, items_per_page=items_per_page, error="Sorry, you passed in an ID that doesn't seem to correspond to a group on the tree",
+            first_vars=request.vars, next_vars=None))
 
 
 def pp_process_post():
     """
     Only visited by paypal, to confirm the payment has been made. For debugging problems, see
     https://developer.paypal.com/docs/classic/ipn/integration-guide/IPNOperations/
+    
+    The notification is only saved in the paypal_notifications table, so that we can reply
+    straight away: it is applied to the reservation by cron/process_paypal_notifications.py,
+    which saves any errors in paypal_notifications.process_error and tries again later. A
+    400 error is only returned if the notification cannot be saved, so that PayPal resends it.
      
     If paypal.save_to_tmp_file_dir in appconfig.ini is e.g. '/var/tmp' then save a temp
     file called `www.onezoom.org_paypal_OTTXXX_TIMESTAMPmilliseconds.json` to that dir
@@ -1231,47 +1191,9 @@ def pp_process_post():
         OTT_ID_Varin = int(request.args[0])
         if OTT_ID_Varin <= 0:
             raise ValueError("Passed in OTT is not a positive integer")
-        reservation_query = ((db.reservations.OTT_ID == OTT_ID_Varin) & 
-                             (db.reservations.user_sponsor_name != None) & 
-                             (db.reservations.user_paid > 4.5)
-                            )
-        
-        #it must be the case that this row exists in the db and that it has at a minimum a
-        # user_sponsor_name and a user_paid > £4.50
-        try:
-            paid = float(request.vars.mc_gross)
-        except:
-            paid = None
-        updated = db(reservation_query &
-                     #check the fields we are about to update are null (if not, this could be malicious)
-                     (db.reservations.PP_first_name == None) &
-                     (db.reservations.PP_second_name == None) &
-                     (db.reservations.PP_town == None) &
-                     (db.reservations.PP_country == None) &
-                     (db.reservations.PP_e_mail == None) &
-                     (db.reservations.verified_paid == None) &
-                     ((db.reservations.PP_transaction_code == None) | (db.reservations.PP_transaction_code == 'reserved')) &
-                     (db.reservations.sale_time == None)
-                    ).update(PP_first_name = request.vars.get('first_name'),
-                             PP_second_name = request.vars.get('last_name'),
-                             PP_town = ", ".join([t for t in [request.vars.get('address_city'), request.vars.get('address_state')] if t]),
-                             PP_country = request.vars.get('address_country'),
-                             PP_e_mail = request.vars.get('payer_email'),
-                             verified_paid = paid,
-                             PP_transaction_code = request.vars.get('txn_id'),
-                             sale_time = request.vars.get('payment_date')
-                            )
-        if not updated:
-            raise NameError('No row updated: some details may already be filled out, or the OTT/name/paid may be invalid')
-        #should only update house/st and postcode if giftaid is true
-        db(reservation_query & 
-           (db.reservations.user_giftaid == True) &
-           (db.reservations.PP_house_and_street == None) &
-           (db.reservations.PP_postcode == None)
-        ).update(
-            PP_house_and_street = request.vars.get('address_street'),
-            PP_postcode = request.vars.get('address_zip')
-        )
+        #save the notification, to be applied by cron/process_paypal_notifications.py.
+        #Repeated notifications are ignored
+        record_paypal_notification(db, OTT_ID_Varin, dict(request.vars), request.now)
         err = None
     except Exception as e:
         err = e
@@ -1364,8 +1286,8 @@ def terms():
     return dict()
 
 def FAQ():
-    price_levels_pence = sorted([row.price for row in db().select(db.prices.price)])
-    return dict(n_species =  db(db.ordered_leaves).count(), second_cheapest_price_pence=price_levels_pence[1])
+    levels = price_levels_pence()
+    return dict(n_species =  db(db.ordered_leaves).count(), second_cheapest_price_pence=levels[1])
 
 def gallery():
     return dict()
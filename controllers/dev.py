@@ -123,3 +123,20 @@ def TEST_POPUP():
 @auth.requires_membership(role='manager')
 def SAFARI_IFRAME_BUG():
     return dict();
+
+@auth.requires_membership(role='manager')
+def SQL_PROFILE():
+    """
+    The SQL statements taking the most total time in each controller/function, since
+    this web2py process started (or was reset with ?reset=1). Only available when
+    sql_profile is set in appconfig.ini
+    """
+    from sql_profile import top_statements, reset_stats
+    if request.vars.reset:
+        reset_stats()
+        redirect(URL())
+    try:
+        n = int(request.vars.n or 20)
+    except ValueError:
+        n = 20
+    return dict(enabled=bool(sql_profile), stats=top_statements(n), n=n)
@@ -229,6 +229,10 @@ def SPONSOR_UPDATE():
             verified_donor_name=request.vars.get('verified_donor_name'),
         
         )
+        #set the expiry date when first verified (re-verifying does not change it), so that
+        #cron/sweep_reservations.py can move the sponsorship to expired_reservations when it ends
+        from sponsorship import set_sponsorship_ends
+        set_sponsorship_ends(db, db.reservations.id==row_id)
         
         #grab important information
         twittername_t = read_only['twitter_name']
@@ -240,25 +244,28 @@ def SPONSOR_UPDATE():
         email_t = read_only['e_mail'] or read_only['PP_e_mail'] #default to the email they gave us. If not, use the paypal one
         if request.vars.auto_email and read_only['live_time'] is None and email_t:
             try:
-                if int(myconf.take('smtp.autosend_email')):
-                    #generate email
-                    if mail is None: #should be defined in db.py
-                        response.flash = 'SMTP email configuration is not set up in appconfig.ini'
-                    else:
-                        gen_email = emails(ott_t, binomial_name_t, common_name_t, verified_name_t, email_t, PP_first_name=read_only['PP_first_name'], 
-                            PP_second_name=read_only['PP_second_name'], sponsor_for=(request.vars.verified_kind=='for'))
-                        #for html, see http://web2py.com/books/default/chapter/29/08/emails-and-sms#Combining-text-and-HTML-emails
-                        if mail.send(to=email_t,
-                                     subject=gen_email['mail_subject'],
-                                     message=gen_email['mail_body']):
-                            #update the live_time (time when contacted)
-                            db.reservations[row_id]=dict(live_time=request.now)
-                        else:
-                            response.flash = "Could not send auto-email to " + email_t
-                else:
-                    raise BaseException()
-            except BaseException: #can't get the myconf.take
+                autosend_email = int(myconf.take('smtp.autosend_email'))
+            except: #can't get the myconf.take
+                autosend_email = 0
+            if not autosend_email:
                 response.flash = 'Auto-email is turned off. To turn it on, add "autosend_email = 1" to appconfig.ini'
+            elif mail is None: #should be defined in db.py
+                response.flash = 'SMTP email configuration is not set up in appconfig.ini'
+            else:
+                #generate email
+                from email_outbox import enqueue_email
+                from sponsorship import integrity_error
+                gen_email = sponsorship_email(ott_t, binomial_name_t, common_name_t, verified_name_t, email_t, PP_first_name=read_only['PP_first_name'], 
+                    PP_second_name=read_only['PP_second_name'], sponsor_for=(request.vars.verified_kind=='for'))
+                #queue the email to be sent by cron/send_emails.py, so we don't wait for the SMTP server
+                #for html, see http://web2py.com/books/default/chapter/29/08/emails-and-sms#Combining-text-and-HTML-emails
+                try:
+                    queued = enqueue_email(db, ott_t, 'live', email_t, gen_email['mail_subject'], gen_email['mail_body'], request.now)
+                except integrity_error(db): #the same email was queued by another request at the same time
+                    queued = None
+                #live_time (time when contacted) is set by cron/send_emails.py once the email is sent
+                if not queued:
+                    response.flash = "An auto-email to {} has already been queued (see the email_outbox table)".format(email_t)
             
         if request.vars.auto_tweet and read_only['live_time'] is None and twittername_t:          
             #set up verification tokens
@@ -340,6 +347,13 @@ def SPONSOR_UPDATE():
                     response.flash = "could not download image ({}). Try running \n{}".format(ret_text, " ".join(EoLQueryPicsNames))
                 except:
                     response.flash = "could not download image. Sorry."
+
+        #copy the verified (or deactivated) sponsorship, with any newly downloaded image,
+        # to the recent_sponsorships table used by the home and sponsored pages, and
+        # make the verified text searchable
+        from sponsorship import update_recent_sponsorships, update_sponsor_search_tokens
+        update_recent_sponsorships(db, request.now, [read_only['OTT_ID']])
+        update_sponsor_search_tokens(db, [read_only['OTT_ID']])
     else:
         if form.errors:
             for elem in form.elements():
@@ -399,6 +413,14 @@ def SPONSOR_UPDATE():
 @auth.requires_membership(role='manager')
 def LIST_IMAGES():
     """this mines the database for all images and shows them ranked by popularity
+    
+    Pages are fetched using keyset pagination: rather than slicing the full list, each
+    page is selected by a WHERE clause on (sort value, id) starting after the last row
+    shown on the previous page, one cursor per image source. The cursors are passed in
+    the url as after_<src flag>=<sort value>_<id> (a sort value of None means we have
+    reached the rows with no rating / popularity). If the page number (the first arg)
+    is >0, sources without a cursor have no more images and are omitted. The cursors for
+    the previous page are found by reading back items_per_page rows from each cursor.
     """
     from time import time #to apppend to href, so that caching does not happen
     from collections import OrderedDict
@@ -422,22 +444,42 @@ def LIST_IMAGES():
             OPTION('Sort by species popularity', _value='pop'),
             value=request.vars.get('sort') or 'qual',
             _id="sort", _name="sort"),
-        _method = "GET"
+        _method = "GET",
+        _action = URL('LIST_IMAGES') #changing the list goes back to the first page
     )
     form.element(_id='select_image_type')['_onchange']="this.form.submit()"
     form.element(_id='sort')['_onchange']="this.form.submit()"
     
+    sort_col = db.ordered_leaves.popularity if request.vars.get('sort')=="pop" else db.images_by_ott.rating
     images = OrderedDict()
+    counts = {}
+    next_cursors = {}
+    prev_cursors = {}
     for src_name in sorted(src_flags, key=src_flags.__getitem__):
         #show eol images separately from Arkive etc
-        query = (db.images_by_ott.src == src_flags[src_name])
-        if request.vars.get('select_image_type') == 'best_any':
-            query = query & (db.images_by_ott.best_any)
-        elif request.vars.get('select_image_type') == 'best_verified':
-            query = query & (db.images_by_ott.best_verified)
-        elif request.vars.get('select_image_type') == 'best_pd':
-            query = query & (db.images_by_ott.best_pd)
+        flag = src_flags[src_name]
+        cursor = request.vars.get('after_{}'.format(flag))
+        query = _list_images_query(flag, request.vars.get('select_image_type'))
+        if page and cursor is None:
+            # this source ran out of images on a previous page, which may be the one before this
+            if page > 1:
+                n_before = db(query).count() - (page - 1) * items_per_page
+                if n_before > 0:
+                    prev_cursors['after_{}'.format(flag)] = _cursor_back(query, sort_col, n_before)
+            continue
+        # the total is only used for display, so it can be a little stale
+        counts[src_name] = db(query).count(cache=(cache.ram, 120))
+        if cursor is not None:
+            try:
+                val, last_id = cursor.rsplit("_", 1)
+                after = _after_keyset(sort_col, None if val == "None" else float(val), int(last_id))
+            except ValueError:
+                raise HTTP(400, "Bad value for after_{}: {}".format(flag, cursor))
+            if page > 1:
+                prev_cursors['after_{}'.format(flag)] = _cursor_back(query & ~after, sort_col, items_per_page)
+            query = query & after
         rows = db(query).select(
+                           db.images_by_ott.id,
                            db.images_by_ott.src,
                            db.images_by_ott.src_id,
                            db.images_by_ott.ott,
@@ -447,10 +489,106 @@ def LIST_IMAGES():
                            db.ordered_leaves.id,
                            db.ordered_leaves.popularity,
                            left=db.ordered_leaves.on(db.images_by_ott.ott == db.ordered_leaves.ott),
-                           orderby="ordered_leaves.popularity DESC" if request.vars.get('sort')=="pop" else "images_by_ott.rating DESC")
+                           orderby=(~sort_col, ~db.images_by_ott.id),
+                           limitby=(0, items_per_page+1))
+        images[src_name] = rows
+        if len(rows) > items_per_page:
+            next_cursors['after_{}'.format(flag)] = _keyset_cursor(rows[items_per_page-1], sort_col)
+    first_vars = {k:v for k,v in request.vars.items() if not k.startswith('after_')}
+    next_vars = dict(first_vars, **next_cursors)
+    prev_vars = dict(first_vars, **{k:v for k,v in prev_cursors.items() if v is not None})
+    return dict(pics=images, counts=counts, time=time(), form=form, page=page,
+        items_per_page=items_per_page, vars=request.vars,
+        first_vars=first_vars,
+        prev_vars=prev_vars,
+        next_vars=next_vars if next_cursors else None)
 
-        images[src_name] = rows[(page*items_per_page):(1+(page+1)*items_per_page)]
-    return dict(pics=images, time=time(), form=form, page=page, items_per_page=items_per_page, vars=request.vars)
+@require_https_if_nonlocal()
+@auth.requires_membership(role='manager')
+def LIST_IMAGES_CSV():
+    """
+    Export the images listed by LIST_IMAGES (with the same select_image_type filter and
+    sort order) as a CSV file, for curators. Rows are read one at a time through a
+    server-side cursor and sent as they are read, so the full result is never held in
+    memory or written to disk.
+    """
+    import csv
+    import io
+    colnames = ['src_name', 'src', 'src_id', 'ott', 'rating', 'licence', 'rights', 'leaf_id', 'popularity']
+    sort_col = db.ordered_leaves.popularity if request.vars.get('sort')=="pop" else db.images_by_ott.rating
+    query = None
+    for src_name in sorted(src_flags, key=src_flags.__getitem__):
+        q = _list_images_query(src_flags[src_name], request.vars.get('select_image_type'))
+        query = q if query is None else (query | q)
+    sql = db(query)._select(
+        db.images_by_ott.src,
+        db.images_by_ott.src_id,
+        db.images_by_ott.ott,
+        db.images_by_ott.rating,
+        db.images_by_ott.licence,
+        db.images_by_ott.rights,
+        db.ordered_leaves.id,
+        db.ordered_leaves.popularity,
+        left=db.ordered_leaves.on(db.images_by_ott.ott == db.ordered_leaves.ott),
+        orderby=(db.images_by_ott.src, ~sort_col, ~db.images_by_ott.id))
+    rows = iter_query_rows(sql)
+    def csv_chunks(chunk_size=2**16):
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow(colnames)
+        for row in rows:
+            writer.writerow((inv_src_flags.get(row[0]),) + tuple(row))
+            if text.tell() >= chunk_size:
+                yield text.getvalue().encode('utf-8')
+                text.seek(0)
+                text.truncate()
+        yield text.getvalue().encode('utf-8')
+    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+    response.headers['Content-Disposition'] = 'attachment; filename="images_{}_{}.csv"'.format(
+        request.vars.get('select_image_type') or 'best_any', 'pop' if request.vars.get('sort')=="pop" else 'qual')
+    #as in response.stream(): web2py sends an iterable body chunk by chunk
+    raise HTTP(200, csv_chunks(), **response.headers)
+
+def _list_images_query(src_flag, image_type):
+    """The filter used by LIST_IMAGES for a single image source: all pushed into SQL"""
+    query = (db.images_by_ott.src == src_flag)
+    if image_type == 'best_any':
+        query = query & (db.images_by_ott.best_any)
+    elif image_type == 'best_verified':
+        query = query & (db.images_by_ott.best_verified)
+    elif image_type == 'best_pd':
+        query = query & (db.images_by_ott.best_pd)
+    return query
+
+def _keyset_cursor(row, sort_col):
+    """The LIST_IMAGES cursor for a row, i.e. <sort value>_<id>"""
+    val = row[sort_col]
+    return "{}_{}".format("None" if val is None else repr(float(val)), row.images_by_ott.id)
+
+def _cursor_back(query, sort_col, n):
+    """
+    The LIST_IMAGES cursor for the row n places back from the last row selected by query
+    (when ordered by sort_col DESC, id DESC), or None if there are not that many rows
+    """
+    row = db(query).select(
+        db.images_by_ott.id,
+        db.images_by_ott.rating,
+        db.ordered_leaves.popularity,
+        left=db.ordered_leaves.on(db.images_by_ott.ott == db.ordered_leaves.ott),
+        orderby=(sort_col, db.images_by_ott.id),
+        limitby=(n, n+1)).first()
+    return None if row is None else _keyset_cursor(row, sort_col)
+
+def _after_keyset(sort_col, last_val, last_id):
+    """
+    Select rows coming after (last_val, last_id) when ordered by sort_col DESC, id DESC
+    with NULLs last (as for a descending sort in MySQL)
+    """
+    if last_val is None:
+        return (sort_col == None) & (db.images_by_ott.id < last_id)
+    return ((sort_col < last_val) |
+            ((sort_col == last_val) & (db.images_by_ott.id < last_id)) |
+            (sort_col == None))
 
 @require_https_if_nonlocal()
 @auth.requires_membership(role='manager')
@@ -489,7 +627,7 @@ def SHOW_EMAILS():
     for s in sponsors:
         #we can't use the paypal emails etc because we haven't been paid!
         if s.e_mail:
-            details = emails(s.OTT_ID, s.name, cnames.get(s.OTT_ID), s.user_sponsor_name, s.e_mail, sponsor_for=s.user_sponsor_kind=='for', email_type='no_payment')
+            details = sponsorship_email(s.OTT_ID, s.name, cnames.get(s.OTT_ID), s.user_sponsor_name, s.e_mail, sponsor_for=s.user_sponsor_kind=='for', email_type='no_payment')
             if s.user_preferred_image_src and s.user_preferred_image_src_id:
                 details['local_pic'] = os.path.isfile(
                     os.path.join(
@@ -527,7 +665,7 @@ def SHOW_EMAILS():
     otts = [s.OTT_ID for s in sponsors]                                                         
     cnames = get_common_names(otts)
     for s in sponsors:
-        details = emails(s.OTT_ID, s.name, cnames.get(s.OTT_ID), s.user_sponsor_name, s.e_mail or s.PP_e_mail, s.PP_first_name, s.PP_second_name, sponsor_for= (s.user_sponsor_kind=='for'), email_type='to_verify')
+        details = sponsorship_email(s.OTT_ID, s.name, cnames.get(s.OTT_ID), s.user_sponsor_name, s.e_mail or s.PP_e_mail, s.PP_first_name, s.PP_second_name, sponsor_for= (s.user_sponsor_kind=='for'), email_type='to_verify')
         if s.user_preferred_image_src and s.user_preferred_image_src_id:
             details['local_pic'] = os.path.isfile(
                 os.path.join(
@@ -563,7 +701,7 @@ def SHOW_EMAILS():
     otts = [s.OTT_ID for s in sponsors]                                                         
     cnames = get_common_names(otts)
     for s in sponsors:
-        details = emails(s.OTT_ID, s.name, cnames.get(s.OTT_ID), s.verified_name, s.e_mail or s.PP_e_mail, s.PP_first_name, s.PP_second_name, sponsor_for= s.verified_kind=='for', email_type='live')
+        details = sponsorship_email(s.OTT_ID, s.name, cnames.get(s.OTT_ID), s.verified_name, s.e_mail or s.PP_e_mail, s.PP_first_name, s.PP_second_name, sponsor_for= s.verified_kind=='for', email_type='live')
         if s.verified_preferred_image_src and s.verified_preferred_image_src_id:
             # do we have a local picture: can't use thumbnail_url() as it might refer to
             # a remote location (e.g. image.onezoom.org)
@@ -624,63 +762,30 @@ def SET_PRICES():
     form = SQLFORM.factory(*fields)
     
     if form.process().accepted:
- 
-        #set the 'normal' prices first
-        queries = {}
-        cutoffs = {}
-        prev = None
-        for p in sorted(prices):
-            if prev is None:
-                cutoffs[p] = form.vars["max_pop_{}_pence".format(p)]
-                queries[p] = (db((db.ordered_leaves.popularity == None) | 
-                                     (db.ordered_leaves.popularity <  cutoffs[p])))
-            elif form.vars["max_pop_{}_pence".format(p)] is not None:
-                cutoffs[p] = form.vars["max_pop_{}_pence".format(p)]            
-                queries[p] = db((db.ordered_leaves.popularity >= cutoffs[prev]) & 
-                                        (db.ordered_leaves.popularity <  cutoffs[p]))
-            else:
-                #this is the last one, which does not have a defined top price
-                queries[p] = db((db.ordered_leaves.popularity >= cutoffs[prev]))
-            prev = p
-            
-        #we can replace the last one with an open-ended query             
-        
-        #save the results
+        from sponsorship import set_prices
+        cutoffs = [(p, form.vars.get("max_pop_{}_pence".format(p))) for p in sorted(prices)]
+        #the bespoke prices go from the highest price downwards, and are overridden by banned taxa
+        overrides = list(zip(sorted(prices, reverse=True), bespoke_prices))
+        bands = set_prices(db, cutoffs, overrides)
+
+        #show the results
         output = []
-        tot=db(db.ordered_leaves).count()
+        tot = sum(b['n_leaves'] for b in bands)
         revenue = 0
         #also None means 'call us'
-        db.prices.truncate()
-        for p in sorted(prices):
-            cnt=queries[p].update(price=p)
-            num=queries[p].count()
-            revenue += 1.0*num*p/100.0
-            output.append("£{}: {:>8} species ({:.2f}%) - {} changed".format(1.0/100*p, num, 100.0*num/tot, cnt))
+        for b in bands:
+            revenue += 1.0*b['n_leaves']*b['price']/100.0
+            output.append("£{}: {:>8} species ({:.2f}%) - {} changed".format(
+                1.0/100*b['price'], b['n_leaves'], 100.0*b['n_leaves']/tot if tot else 0, b['changed']))
             output.append(BR())
 
-            
         response.flash = DIV("SET THE FOLLOWING DEFAULT PRICE STRUCTURE for {} species:".format(tot),
                              BR(),PRE(*output), 
                              ". Total revenue: {}!\nNow overriding the following special exclusions (and setting banned):".format(revenue), BR(),
                              "{}".format(bespoke_prices)
                              )
-
-        #override with the bespoke ones
-        target_band = 0
-        for p in sorted(prices, reverse=True):
-            db(db.ordered_leaves.name.belongs(bespoke_prices[target_band])).update(price=p)
-            target_band+=1
-            if target_band>=len(bespoke_prices):
-                break
-
-        #make sure the banned ones are NULLified
-        rows = db().select(db.banned.ott)
-        for ban in rows:
-            db(db.ordered_leaves.ott == ban.ott).update(price=None)
-
-        for p in sorted(prices):
-            num=queries[p].count()
-            db.prices.insert(price=p, current_cutoff=(float(cutoffs[p]) if p in cutoffs else None), n_leaves=num)
+        cache.ram('price_bands', None)
+        cache.ram.clear(regex='^sponsor_handpicks_') #leaf prices are shown on default/sponsor_handpicks
 
 
     elif form.errors:
@@ -804,36 +909,3 @@ def REIMPORT_TREE_TABLES():
         db.leaves_in_unsponsored_tree.import_from_csv_file(open(unsponsoredleaffile,'r'))
     
     return dict(leaffile = leaffile, nodefile = nodefile, unsponsoredleaffile=unsponsoredleaffile, status=status, sql_cmds=[sql_cmd1, sql_cmd2, sql_cmd3], ret_text=ret_text)
-
-@require_https_if_nonlocal()
-def emails(ott, species_name, common_name, sponsor_name, email, PP_first_name=None, PP_second_name=None, sponsor_for=False, email_type='live'):
-    """
-    The email texts that we might want to send out
-    email_type can be 'no_payment', 'to_verify', or e.g. 'live'
-    """
-    if sponsor_for:
-        for_name = " for " + sponsor_name
-        if (PP_first_name or PP_second_name):
-            username = " ".join([PP_first_name or "", PP_second_name or ""]).strip()
-        else:
-            username = "sponsor"
-    else:
-        username = sponsor_name
-        for_name = ""
-
-        
-    if email_type=='no_payment':
-        return({'type':'Payment not gone through',
-                'email':email,
-                'mail_subject':'Your OneZoom sponsorship of '+species_name,
-                'mail_body':'Dear {username},\r\n\r\nThank you for visiting OneZoom and filling out the form to sponsor the {species} leaf{for_name}.\r\n\r\nWe noticed that something went wrong and we never received any donation from you on PayPal - you should not have been charged for this. If you would still like to sponsor {species} it may still be available at\r\nhttp://www.onezoom.org/sponsor_leaf?ott={ott}\r\n\r\nIf you’ve had any difficulties with our site or with PayPal, please write to let us know and we’d be very happy to help,\r\n\r\nThank you again for your interest in our tree of life project.\r\n\r\nThe OneZoom team (charity number 1163559)'.format(username=username, ott=ott, species= nice_species_name(species_name, common_name), for_name = for_name)})
-    elif email_type=='to_verify':
-        return({'type':'Paid, require verifying',
-                'email':email,
-                'mail_subject':'Your OneZoom sponsorship of '+ species_name,
-                'mail_body': 'Dear {username},\r\n\r\nThank you so much for your donation to OneZoom. We have received your payment for {the_species}, and are about to verify your sponsorship text. This should only take a few days. We will email you when your sponsorship goes live. \r\n\r\nThe OneZoom Team (UK charity number 1163559)'.format(username=username, ott=ott, the_species=nice_species_name(species_name, common_name, the=True))})              
-    else:
-        return({'type':'Verified on',
-                'email':email,
-                'mail_subject':'Your OneZoom sponsorship of '+ species_name +' has gone live',
-                'mail_body':'Dear {username},\r\n\r\nThank you so much for your donation to OneZoom.  This will help us in our aim to provide easy access to scientific knowledge about biodiversity and evolution, and raise awareness about the variety of life on earth together with the need to conserve it. \r\n\r\nWe are very pleased to be able to tell you that your sponsored leaf, {the_species}, has now appeared on the tree decorated with your sponsorship details. \r\n\r\nIt’s now there for all to see at \r\n\r\nhttp://www.onezoom.org/life/@={ott}\r\n\r\nor, if you’d like to fly through the tree to your sponsored leaf try \r\n\r\nhttp://www.onezoom.org/life/@={ott}?init=zoom\r\n\r\nThere’s also the more obvious link\r\n\r\nonezoom.org/life/@{species_name_with_underscores}\r\n\r\nbut this may be less stable (for example sometimes two very different creatures on the tree share the same scientific name, so you may end up going to the wrong place).\r\n\r\nPlease consider sharing the link with your friends and family!\r\n\r\nWe welcome your feedback and are always keen to find ways to make OneZoom better.\r\n\r\nThank you again for your donation, we hope you enjoy exploring our tree of life. \r\n\r\nThe OneZoom Team (UK charity number 1163559)'.format(username=username, ott=ott, species_name_with_underscores =species_name.replace(" ","_"), the_species=nice_species_name(species_name, common_name, the=True), for_name = for_name)})
\ No newline at end of file
@@ -25,46 +25,12 @@ def test():
     Pass in an OTT and get a list of the popularity ratings of the parents plus 
     a wikidata identifiers, so that we can query the current valuse using the wiki APIs
     
-    Uses a stored procedure in the DB like this:
-    
-    DELIMITER $$
-    DROP PROCEDURE IF EXISTS GetParents $$
-    CREATE PROCEDURE GetParents (GivenID INT, ColumnsReturned TEXT, WhereCondition TEXT)
-    /* This gets all the parents with wikidata IDs up to the root for a ordered_node ID */
-    BEGIN
-        DECLARE rv TEXT;
-        DECLARE cm CHAR(1);
-        DECLARE ch INT;
-        DECLARE loop_max INT;
-    
-        SET rv = '';
-        SET cm = '';
-        SET ch = GivenID;
-        SET loop_max = 5000; /* to avoid infinite loops - shouldn't have >5000 real parents in a tree */
-        WHILE ch <> 0  AND loop_max > 0 DO
-        	set loop_max = loop_max-1;
-            SELECT IFNULL(real_parent,0) INTO ch FROM
-            (SELECT real_parent, name FROM ordered_nodes WHERE id = ABS(ch)) A;
-            IF ch <> 0 THEN
-                SET rv = CONCAT(rv,cm,ch);
-                SET cm = ',';
-            END IF;
-        END WHILE;
-        SET @s = CONCAT('SELECT ', ColumnsReturned, ' FROM ordered_nodes');
-        IF WhereCondition = '' THEN
-            SET @s = CONCAT(@s, ' WHERE id IN (',rv,')');
-        ELSE
-            SET @s = CONCAT(@s, ' WHERE id IN (',rv,') AND (', WhereCondition, ')');
-        END IF;
-        SET @s = CONCAT(@s, ' ORDER BY id DESC');
-        PREPARE stmt1 FROM @s;
-        EXECUTE stmt1;
-    	DEALLOCATE PREPARE stmt1;
-        
-    END $$
-    DELIMITER ;
-
+    The (real, i.e. not polytomy-resolving) parents are found in a single query using
+    the leaf_lft and leaf_rgt nested set values in ordered_nodes: see
+    modules/nested_set.py. They are returned nearest first, as the old GetParents
+    stored procedure did.
     """
+    from nested_set import ancestor_path
     if request.vars.key:
         API_user = db(db.API_users.APIkey == request.vars.key).select(db.API_users.API_user_name).first()
     else:
@@ -76,26 +42,26 @@ def test():
                 headers = ['ott', 'name', 'wikidata', 'popularity', 'raw_popularity']
                 headers_index = {h:i for i,h in enumerate(headers)}
                 ott = int(request.vars.ott)
+                id_key = 'leaf_id'
                 taxon = db.executesql("SELECT {} FROM ordered_leaves WHERE ott = {}".format(
-                    ",".join(headers + ['real_parent']), db.placeholder), ott)
+                    ",".join(headers + ['id']), db.placeholder), (ott,))
                 if len(taxon)==0:
+                    id_key = 'node_id'
                     taxon = db.executesql("SELECT {} FROM ordered_nodes WHERE ott = {}".format(
-                        ",".join(headers + ['real_parent']), db.placeholder), ott)
+                        ",".join(headers + ['id']), db.placeholder), (ott,))
                 
                 if len(taxon):
-                    taxon_parent = taxon[0][len(headers)]
-                    parents = db.executesql("CALL GetParents({}, '{}', '{}')".format(
-                        taxon_parent, ",".join(headers), 'wikidata is not NULL'))
+                    parents = ancestor_path(db,
+                        fields=headers, query=(db.ordered_nodes.wikidata != None),
+                        **{id_key: taxon[0][len(headers)]})
                     return {
                         'error':'' if len(taxon)==1 else 'Caution: the ott {} matched against {} taxa'.format(ott, len(taxon)), 
-                        'taxa': [taxon[0]] + [p for p in parents], 'headers_index':headers_index
+                        'taxa': [taxon[0][:len(headers)]] + [[p[h] for h in headers] for p in reversed(parents)],
+                        'headers_index':headers_index
                         }
                 return {'error':'', 'taxa': [], 'headers_index':headers_index}
             except ValueError:
                 return {'error':"Something's not right: you need to provide an integer ott", 'taxa':[]}
-            except:
-                raise
-                return {'error':"Something's not right - have you defined the `GetParents()` stored procedure in your database?", 'taxa':[]}
         else:
             return {'error':'', 'taxa':False}
     else:
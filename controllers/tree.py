@@ -213,10 +213,7 @@ def eol_page_ID():
         raise HTTP(400,"No valid id provided")
     
     #we have inspected this EoL page - log it so we know to check EoL for changes   
-    db.eol_inspected.update_or_insert(db.eol_inspected.ott == OTTid,
-                               ott=OTTid,
-                               via=eol_inspect_via_flags['EoL_tab'],
-                               inspected=datetime.datetime.now())
+    log_eol_inspections([OTTid], via=eol_inspect_via_flags['EoL_tab'])
     redirect("//eol.org/pages/{}".format(EOLid))
 
 def eol_dataobject_ID():
@@ -232,19 +229,26 @@ def eol_dataobject_ID():
     
     #can redirect this to EoL, after logging so we can refresh e.g. cropped images
     rows = db(db.images_by_ott.src_id == src_id).select(db.images_by_ott.ott)
-    for row in rows:
-        db.eol_inspected.update_or_insert(db.eol_inspected.ott == row.ott,
-                                   ott=row.ott,
-                                   via=eol_inspect_via_flags['image'],
-                                   inspected=datetime.datetime.now())
+    log_eol_inspections([row.ott for row in rows], via=eol_inspect_via_flags['image'])
     # might as well also look for this image in the images_by_name table (probably won't find it)
-    rows = db(db.images_by_ott.src_id == src_id).select(db.images_by_name.name)
-    for row in rows:
-        db.eol_inspected.update_or_insert((db.eol_inspected.name != None) & (db.eol_inspected.name == row.name),
-                                   name=row.name,
-                                   via=eol_inspect_via_flags['image'],
-                                   inspected=datetime.datetime.now())
+    rows = db(db.images_by_name.src_id == src_id).select(db.images_by_name.name)
+    log_eol_inspections([row.name for row in rows], via=eol_inspect_via_flags['image'], by_name=True)
     redirect("//eol.org/media/{}".format(src_id))
+
+def log_eol_inspections(identifiers, via, by_name=False):
+    """
+    Queue up inspections of these otts (or names) in the per-process buffer, which is
+    written to the eol_inspected table once a minute by a background thread, rather than
+    on every click
+    """
+    from eol_inspection import inspection_buffer
+    buffer = inspection_buffer(flush_secs=60, connect=background_db)
+    now = datetime.datetime.now()
+    for i in identifiers:
+        if by_name:
+            buffer.add(now, via, name=i)
+        else:
+            buffer.add(now, via, ott=i)
         
 def eol_old_dataobject_ID():
     """
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+Apply the PayPal payment notifications saved by default/pp_process_post to the
+reservations table (see process_paypal_notifications in modules/sponsorship.py). If
+smtp.autosend_email is set in appconfig.ini, a 'to_verify' email is then queued for
+the sponsor, to be sent by cron/send_emails.py.
+
+Notifications that cannot be applied yet (e.g. because the database was busy) are tried
+again on later runs. This should be run every minute, by the system crontab when served by uwsgi (see README_SERVER.markdown
+and cron/system_crontab.example), or by the web2py cron (see cron/crontab). To run by hand, use
+
+web2py.py -S OZtree -M -R applications/OZtree/cron/process_paypal_notifications.py
+"""
+from OZfunctions import queue_to_verify_email
+from sponsorship import process_paypal_notifications
+
+try:
+    autosend_email = int(myconf.take('smtp.autosend_email'))
+except:
+    autosend_email = 0
+
+for ott, error in process_paypal_notifications(db, request.now,
+        on_applied=queue_to_verify_email if autosend_email else None):
+    if error:
+        print("{}: could not apply PayPal notification for OTT {}: {}".format(request.now, ott, error))
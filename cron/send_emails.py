@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Send the emails queued in the email_outbox table (see send_queued_emails in
+modules/email_outbox.py), using the SMTP settings in appconfig.ini. Emails that fail
+are retried on later runs, with increasing delays, until they are given up. When a 'live'
+email (queued by manage/SPONSOR_UPDATE) is sent, the live_time of the reservation is set,
+so that it is not sent again.
+
+This is run with the models loaded, by the system crontab when served by uwsgi (see
+README_SERVER.markdown and cron/system_crontab.example), or by the web2py cron (see
+cron/crontab), e.g.
+
+* * * * * root *applications/OZtree/cron/send_emails.py
+
+or by hand using
+
+web2py.py -S OZtree -M -R applications/OZtree/cron/send_emails.py
+"""
+from email_outbox import send_queued_emails
+
+if mail is None: #should be defined in db.py
+    print("SMTP email configuration is not set up in appconfig.ini: no emails sent")
+else:
+    def smtp_transport(recipient, subject, body):
+        if mail.send(to=recipient, subject=subject, message=body):
+            return True
+        raise IOError(mail.error or "Not sent")
+    def record_live_time(db, row):
+        if row.email_type == 'live':
+            db((db.reservations.OTT_ID == row.ott) & (db.reservations.live_time == None)).update(
+                live_time=request.now)
+    for email_id, recipient, error in send_queued_emails(db, smtp_transport, request.now,
+            on_sent=record_live_time):
+        if error:
+            print("{}: could not send email {} to {}: {}".format(request.now, email_id, recipient, error))
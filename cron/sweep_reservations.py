@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Periodically tidy up the reservations table (see sweep_reservations in
+modules/sponsorship.py): timed-out reservations and unpaid sponsorships are cleared,
+and if sponsorship.expiry_grace_days is set in appconfig.ini, sponsorships that ended
+longer ago than that are moved to expired_reservations.
+The images in the recent_sponsorships table are also refreshed, e.g. to pick up images
+that have been downloaded or replaced since the sponsorships were verified.
+
+This is run with the models loaded, by the system crontab when served by uwsgi (see
+README_SERVER.markdown and cron/system_crontab.example), or by the web2py cron (see
+cron/crontab), e.g.
+
+*/10 * * * * root *applications/OZtree/cron/sweep_reservations.py
+
+or by hand using
+
+web2py.py -S OZtree -M -R applications/OZtree/cron/sweep_reservations.py
+"""
+from sponsorship import sweep_reservations, refresh_recent_sponsorship_images
+
+try:
+    reservation_time_limit = float(myconf.take('sponsorship.reservation_time_limit_mins')) * 60.0
+except:
+    reservation_time_limit = 360.0 #seconds
+try:
+    unpaid_time_limit = float(myconf.take('sponsorship.unpaid_time_limit_mins')) * 60.0
+except:
+    unpaid_time_limit = 2.0*24.0*60.0*60.0 #seconds
+try:
+    expiry_grace_secs = float(myconf.take('sponsorship.expiry_grace_days')) * 24.0*60.0*60.0
+except:
+    expiry_grace_secs = None #do not move ended sponsorships
+
+counts = sweep_reservations(db, request.now, reservation_time_limit, unpaid_time_limit, expiry_grace_secs)
+db.commit()
+print("{}: moved {expired} ended sponsorships to expired_reservations, cleared {unpaid} unpaid sponsorships and {reserved} old reservations".format(
+    request.now, **counts))
+n_changed = refresh_recent_sponsorship_images(db, request.now)
+db.commit()
+print("{}: changed the images of {} sponsorships in recent_sponsorships".format(request.now, n_changed))
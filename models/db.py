@@ -33,13 +33,16 @@ if is_testing:
     # For unit testing, we might want to load a different appconfig.ini file, which can
     # be passed in to the rocket server as the last arg on the command-line.
     # (on the main server this is not used, and we default back to appconfig.ini
+    from mtime_cache import load_if_changed
     try:
         if os.path.isfile(request.env.cmd_options.args[-1]):
-            myconf = AppConfig(request.env.cmd_options.args[-1], reload=True)
+            appconfig_loc = request.env.cmd_options.args[-1]
         else:
             raise IOError("No such file")
     except (IOError, IndexError, AttributeError):
-        myconf = AppConfig(reload=True) #changes to appconfig.ini do not require restart
+        appconfig_loc = os.path.join(request.folder, 'private', 'appconfig.ini')
+    #changes to appconfig.ini do not require restart, but we only re-read it when it changes
+    myconf = load_if_changed(appconfig_loc, lambda f: AppConfig(f, reload=True))
     T.is_writable = True #allow translators to add new languages e.g. on the test (beta) site, but not on prod
 else:
     myconf = AppConfig() #faster to read once and never re-update
@@ -99,6 +102,35 @@ else:
     db.placeholder = "?" #for sqlite
 
 
+def background_db(folder=request.folder):
+    """
+    A new connection to the database that is not tied to a web request, e.g. for use in
+    a background thread. No tables are defined on it, so use db.executesql(), and call
+    close() when done.
+    """
+    if DALstring.startswith('mysql://'):
+        return DAL(DALstring,
+            driver_args={'read_default_file':os.path.join(folder, 'private','my.cnf')},
+            folder=os.path.join(folder, 'databases'),
+            migrate_enabled=False)
+    else:
+        return DAL(DALstring, folder=os.path.join(folder, 'databases'), migrate_enabled=False)
+
+## opt-in SQL profiling: see modules/sql_profile.py and dev/SQL_PROFILE
+try:
+    sql_profile = int(myconf.take('general.sql_profile'))
+except:
+    sql_profile = 0
+if sql_profile:
+    from sql_profile import SQLProfiler, slow_query_log
+    try:
+        slow_sql_secs = float(myconf.take('general.slow_sql_ms')) / 1000.0
+    except:
+        slow_sql_secs = 0.5
+    response.sql_profiler = SQLProfiler(
+        request.controller + "/" + request.function, slow_secs=slow_sql_secs,
+        slow_log=slow_query_log(os.path.join(request.folder, 'private', 'slow_sql.log'))).attach(db)
+
 current.db = db
 
 ## by default give a view/generic.extension to all actions from localhost
@@ -563,6 +595,72 @@ db.define_table('expired_reservations',
     *[f.clone() for f in db.reservations if f.name != 'OTT_ID' and f.name!='id'],
     format = '%(OTT_ID)s_%(name)s', migrate=is_testing)
 
+# an inbox for PayPal payment notifications, which are saved by default/pp_process_post
+# and then applied to the reservations table by cron/process_paypal_notifications.py.
+# A repeated notification (with the same txn_id) is only saved once
+db.define_table('paypal_notifications',
+    Field('txn_id', type = 'string', length=64, notnull=True, unique=True),
+    Field('OTT_ID', type = 'integer', notnull=True),
+    Field('pp_vars', type = 'text'), #the notification as a JSON dict
+    Field('received_time', type = 'datetime'),
+    Field('processed_time', type = 'datetime'),
+    Field('process_error', type = 'text'), #why the notification could not be applied, if so
+    Field('attempts', type = 'integer', default=0), #how many times we have tried to apply it
+    Field('next_attempt_time', type = 'datetime'), #when to try again, if it could not be applied
+    format = '%(txn_id)s', migrate=is_testing)
+
+# emails waiting to be sent by cron/send_emails.py (see modules/email_outbox.py). Only
+# one unsent email of each email_type is queued for each ott and recipient
+db.define_table('email_outbox',
+    Field('ott', type = 'integer'),
+    Field('email_type', type = 'string', length=20), #e.g. 'live' or 'to_verify'
+    Field('recipient', type = 'string', length=200),
+    Field('subject', type = 'text'),
+    Field('body', type = 'text'),
+    Field('queued_time', type = 'datetime'),
+    Field('attempts', type = 'integer', notnull=True, default=0),
+    Field('next_attempt_time', type = 'datetime'),
+    Field('sent_time', type = 'datetime'),
+    Field('pending', type = 'integer'), #1 until sent or given up, then NULL, so email_dedup_index ignores them
+    Field('last_error', type = 'text'),
+    format = '%(email_type)s_%(recipient)s', migrate=is_testing)
+
+# a copy of the live (verified and not deactivated) sponsorships, with the image to show for
+# each, read by the home page and default/sponsored without joins. It is updated for
+# individual leaves by update_recent_sponsorships() in modules/sponsorship.py when a
+# sponsorship is verified, changed, deactivated or ends. Images are refreshed by
+# cron/sweep_reservations.py (e.g. to pick up newly downloaded images). Filled out when
+# first created by OZprivate/ServerScripts/Utilities/OneOff/fill_recent_sponsorships.py
+db.define_table('recent_sponsorships',
+    Field('OTT_ID', type = 'integer', unique=True, notnull=True),
+    Field('name', type='string', length=name_length_chars), #scientific name
+    Field('reserve_time', type = 'datetime'),
+    Field('verified_time', type = 'datetime'),
+    Field('verified_kind', type = 'string', length=4),
+    Field('verified_name', type='string', length=40),
+    Field('verified_more_info', type='string', length=40),
+    Field('user_nondefault_image', type = 'integer'),
+    Field('verified_preferred_image_src', type='integer'),
+    Field('verified_preferred_image_src_id', type='integer'),
+    Field('src', type='integer'), #the image shown: the one chosen by the sponsor, or the best one for the leaf
+    Field('src_id', type='integer'),
+    Field('rights', type = 'text'),
+    Field('licence', type = 'string', length=name_length_chars),
+    Field('updated_time', type = 'datetime'),
+    format = '%(OTT_ID)s_%(name)s', migrate=is_testing)
+
+# the words in searchable sponsor text, for API/search_for_sponsor: each token is an ending
+# of a word (see sponsor_text_tokens() in modules/sponsorship.py), so that a search for
+# text anywhere in a word is a prefix lookup on the token index. Verified text is stored with
+# the date the sponsorship expires. Kept up to date by update_sponsor_search_tokens(), and
+# filled out when first created by OZprivate/ServerScripts/Utilities/OneOff/fill_sponsor_search_tokens.py
+db.define_table('sponsor_search_tokens',
+    Field('OTT_ID', type = 'integer', notnull=True),
+    Field('token', type = 'string', length=40, notnull=True),
+    Field('verified', type = boolean), #False for text given by the sponsor, awaiting verification
+    Field('expires', type = 'datetime'), #verified_time + sponsorship_duration_days
+    format = '%(OTT_ID)s_%(token)s', migrate=is_testing)
+
 # this table defines the current pricing cutoff points
 db.define_table('prices',
     Field('price', type = 'integer', unique=True, requires=IS_NOT_EMPTY()),
@@ -572,6 +670,19 @@ db.define_table('prices',
     Field('n_leaves', type = 'integer'),
     format = '%(price)s_%(n_leaves)s')
 
+def price_bands():
+    """
+    The rows of the prices table as a list of dicts, sorted by price. This is cached,
+    as it only changes when manage/SET_PRICES is run (which clears the cache in that
+    process: other processes will pick up the new prices within the hour)
+    """
+    return cache.ram('price_bands',
+        lambda: db().select(db.prices.ALL, orderby=db.prices.price).as_list(),
+        time_expire = 60*60)
+
+def price_levels_pence():
+    return [band['price'] for band in price_bands()]
+
 # this table collects data for recently 'visited' nodes (i.e. requested through the API) 
 db.define_table('visit_count',
     Field('ott', type = 'integer', notnull=True, unique=True),
@@ -33,21 +33,52 @@ def __check_version(): #this is a private function
         return str(e)
 
 def clear_reservation(reservations_table_id):
+    from sponsorship import reservation_keep_fields, cleared_reservation_fields, remove_sponsorship_copies
     db = current.db
-    keep_fields = ('id', 'OTT_ID', 'num_views', 'last_view')
-    del_fields = {f: None for f in db.reservations.fields if f not in keep_fields}
-    assert len(keep_fields) + len(del_fields) == len(db.reservations.fields)
+    del_fields = cleared_reservation_fields(db.reservations)
+    assert len(reservation_keep_fields) + len(del_fields) == len(db.reservations.fields)
     assert reservations_table_id is not None
     db(db.reservations.OTT_ID == reservations_table_id).update(**del_fields)
+    remove_sponsorship_copies(db, [reservations_table_id])
 
-def lang_primary(req):
+def iter_query_rows(sql):
+    """
+    Return an iterator over the rows (as tuples) of a raw SELECT, fetched from the server
+    as they are iterated over, rather than buffering the whole result client-side (the
+    default for the mysql drivers). Use for large exports. The query is run on a new
+    connection, opened when iteration starts and closed when the rows run out, so the
+    iterator can be used in a streamed response, which is sent after web2py has handed
+    db's own connection back to the pool.
+    """
+    db = current.db
+    server_side = db._uri.startswith("mysql://")
+    def rows():
+        connection = db._adapter.connector()
+        try:
+            if server_side:
+                cursor = connection.cursor(db._adapter.driver.cursors.SSCursor)
+            else:
+                cursor = connection.cursor() #SQLite cursors already step through results lazily
+            cursor.execute(sql)
+            for row in cursor:
+                yield row
+        finally:
+            connection.close()
+    return rows()
+
+def first_lang(req):
+    """The first language requested (e.g. 'en-gb'), e.g. for keying cached pages by language"""
     language=req.vars.lang or req.env.http_accept_language or 'en'
-    first_lang = language.split(',')[0]
-    return(first_lang.split("-")[0].lower())
+    return(language.split(',')[0].lower())
+
+def lang_primary(req):
+    return(first_lang(req).split("-")[0])
     
-def sponsorable_children_query(target_id, qtype="ott"):
+def sponsorable_children_query(target_id, qtype="ott", exclude_sponsored=True):
     """
     A function that returns a web2py query selecting the sponsorable children of this node.
+    If exclude_sponsored is False, leaves that have already been sponsored are not excluded
+    here, and the caller must exclude them (e.g. using sponsorship.sponsorable_leaves_page)
     TO DO: change javascript so that nodes without an OTT use qtype='id'
     """
     db = current.db
@@ -59,6 +90,9 @@ def sponsorable_children_query(target_id, qtype="ott"):
     #nodes without a space in the name are unsponsorable
     query = query & (db.ordered_leaves.name.contains(' ')) 
 
+    if not exclude_sponsored:
+        return query
+
     #check which have OTTs in the reservations table
     unavailable = db((db.reservations.verified_time != None))._select(db.reservations.OTT_ID)
     #the query above ony finds those with a name. We might prefer something like the below, but I can't get it to work
@@ -155,6 +189,58 @@ def nice_species_name(scientific=None, common=None, the=False, html=False, leaf=
             else:
                 return common + species_nicename
 
+def sponsorship_email(ott, species_name, common_name, sponsor_name, email, PP_first_name=None, PP_second_name=None, sponsor_for=False, email_type='live'):
+    """
+    The email texts that we might want to send out to a sponsor (see manage/SHOW_EMAILS)
+    email_type can be 'no_payment', 'to_verify', or e.g. 'live'
+    """
+    if sponsor_for:
+        for_name = " for " + sponsor_name
+        if (PP_first_name or PP_second_name):
+            username = " ".join([PP_first_name or "", PP_second_name or ""]).strip()
+        else:
+            username = "sponsor"
+    else:
+        username = sponsor_name
+        for_name = ""
+
+        
+    if email_type=='no_payment':
+        return({'type':'Payment not gone through',
+                'email':email,
+                'mail_subject':'Your OneZoom sponsorship of '+species_name,
+                'mail_body':'Dear {username},\r\n\r\nThank you for visiting OneZoom and filling out the form to sponsor the {species} leaf{for_name}.\r\n\r\nWe noticed that something went wrong and we never received any donation from you on PayPal - you should not have been charged for this. If you would still like to sponsor {species} it may still be available at\r\nhttp://www.onezoom.org/sponsor_leaf?ott={ott}\r\n\r\nIf you’ve had any difficulties with our site or with PayPal, please write to let us know and we’d be very happy to help,\r\n\r\nThank you again for your interest in our tree of life project.\r\n\r\nThe OneZoom team (charity number 1163559)'.format(username=username, ott=ott, species= nice_species_name(species_name, common_name), for_name = for_name)})
+    elif email_type=='to_verify':
+        return({'type':'Paid, require verifying',
+                'email':email,
+                'mail_subject':'Your OneZoom sponsorship of '+ species_name,
+                'mail_body': 'Dear {username},\r\n\r\nThank you so much for your donation to OneZoom. We have received your payment for {the_species}, and are about to verify your sponsorship text. This should only take a few days. We will email you when your sponsorship goes live. \r\n\r\nThe OneZoom Team (UK charity number 1163559)'.format(username=username, ott=ott, the_species=nice_species_name(species_name, common_name, the=True))})              
+    else:
+        return({'type':'Verified on',
+                'email':email,
+                'mail_subject':'Your OneZoom sponsorship of '+ species_name +' has gone live',
+                'mail_body':'Dear {username},\r\n\r\nThank you so much for your donation to OneZoom.  This will help us in our aim to provide easy access to scientific knowledge about biodiversity and evolution, and raise awareness about the variety of life on earth together with the need to conserve it. \r\n\r\nWe are very pleased to be able to tell you that your sponsored leaf, {the_species}, has now appeared on the tree decorated with your sponsorship details. \r\n\r\nIt’s now there for all to see at \r\n\r\nhttp://www.onezoom.org/life/@={ott}\r\n\r\nor, if you’d like to fly through the tree to your sponsored leaf try \r\n\r\nhttp://www.onezoom.org/life/@={ott}?init=zoom\r\n\r\nThere’s also the more obvious link\r\n\r\nonezoom.org/life/@{species_name_with_underscores}\r\n\r\nbut this may be less stable (for example sometimes two very different creatures on the tree share the same scientific name, so you may end up going to the wrong place).\r\n\r\nPlease consider sharing the link with your friends and family!\r\n\r\nWe welcome your feedback and are always keen to find ways to make OneZoom better.\r\n\r\nThank you again for your donation, we hope you enjoy exploring our tree of life. \r\n\r\nThe OneZoom Team (UK charity number 1163559)'.format(username=username, ott=ott, species_name_with_underscores =species_name.replace(" ","_"), the_species=nice_species_name(species_name, common_name, the=True), for_name = for_name)})
+
+def queue_to_verify_email(db, ott):
+    """
+    Queue a 'to_verify' email to the sponsor of `ott` (sent by cron/send_emails.py).
+    Used as the on_applied callback of process_paypal_notifications in modules/sponsorship.py
+    """
+    from email_outbox import enqueue_email
+    from sponsorship import integrity_error
+    r = db.reservations
+    row = db(r.OTT_ID == ott).select(r.name, r.user_sponsor_name, r.user_sponsor_kind, r.user_sponsor_lang,
+        r.e_mail, r.PP_e_mail, r.PP_first_name, r.PP_second_name).first()
+    email = row.e_mail or row.PP_e_mail
+    if email:
+        details = sponsorship_email(ott, row.name, get_common_name(ott, lang=row.user_sponsor_lang),
+            row.user_sponsor_name, email, row.PP_first_name, row.PP_second_name,
+            sponsor_for=(row.user_sponsor_kind=='for'), email_type='to_verify')
+        try:
+            enqueue_email(db, ott, 'to_verify', email, details['mail_subject'], details['mail_body'], current.request.now)
+        except integrity_error(db):
+            pass #the same email was queued by another connection at the same time
+
 def get_common_names(identifiers, return_nulls=False, OTT=True, lang=None,
     prefer_short_name=False, include_unpreferred=False, return_all=False):
     """
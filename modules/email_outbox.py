@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+A queue of emails to send, held in the email_outbox table, so that pages which send
+emails (e.g. manage/SPONSOR_UPDATE) only need to add a row to the table, rather than
+waiting for the SMTP server.
+
+Emails are queued with enqueue_email(), which ignores an email if one of the same type
+is already waiting to be sent to the same recipient for the same leaf. They are sent by
+send_queued_emails(), run from cron/send_emails.py, which takes a batch of due emails,
+leases them (by pushing back their next_attempt_time, so that another worker running at
+the same time will not also send them), then sends each one. Failed emails are retried
+with exponentially increasing delays, up to max_attempts times, after which they are
+given up (no longer pending), so that the same email can be queued again.
+
+The sending itself is done by a `transport` function, called as
+transport(recipient, subject, body), which returns True if the email was sent. In web2py
+this is a wrapper around mail.send(). FileTransport writes emails to a folder instead,
+for testing.
+"""
+
+import datetime
+import json
+import os
+
+from sponsorship import begin_locking
+
+def enqueue_email(db, ott, email_type, recipient, subject, body, now):
+    """
+    Add an email to the outbox, unless one with the same ott, email_type and recipient is
+    waiting to be sent (emails that have been sent or given up do not count, so e.g. a leaf
+    that is sponsored again can be emailed about again). The caller should commit. Returns the id
+    of the new row, or None if it was a duplicate. If the same email is queued by another
+    connection at the same time, email_dedup_index (in create_db_indexes.sql) makes one
+    of them raise the driver's IntegrityError (see integrity_error in sponsorship.py).
+    """
+    outbox = db.email_outbox
+    if not db((outbox.ott == ott) & (outbox.email_type == email_type) & (outbox.recipient == recipient) &
+              (outbox.pending == 1)).isempty():
+        return None
+    return outbox.insert(ott=ott, email_type=email_type, recipient=recipient, subject=subject, body=body,
+        queued_time=now, attempts=0, next_attempt_time=now, pending=1)
+
+def send_queued_emails(db, transport, now, batch_size=50, max_attempts=6, backoff_secs=60, lease_secs=600,
+        on_sent=None):
+    """
+    Send the emails in the outbox that are due, in the order they were queued, in batches
+    of batch_size, committing after each email. An email that fails is tried again after
+    backoff_secs, then twice that, and so on, until it has been tried max_attempts times,
+    when it is given up: it is no longer pending, and its last_error says so. If given,
+    on_sent(db, row) is called in the same transaction after each email is sent, e.g. to
+    record the time a sponsor was emailed. Returns a list of (id, recipient, error) for
+    each email tried, with error None if sent.
+    """
+    outbox = db.email_outbox
+    due = (outbox.pending == 1) & (outbox.attempts < max_attempts) & (outbox.next_attempt_time <= now)
+    lease_until = now + datetime.timedelta(seconds=lease_secs)
+    results = []
+    db.commit()
+    while True:
+        try:
+            batch = db(due).select(outbox.ALL, orderby=outbox.id,
+                limitby=(0, batch_size), for_update=begin_locking(db))
+            if batch:
+                db(outbox.id.belongs([row.id for row in batch])).update(next_attempt_time=lease_until)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        for row in batch:
+            try:
+                error = None if transport(row.recipient, row.subject, row.body) else "Not sent"
+            except Exception as e:
+                error = str(e) or e.__class__.__name__
+            if error is None:
+                row.update_record(sent_time=now, pending=None, attempts=row.attempts + 1, last_error=None)
+                if on_sent is not None:
+                    on_sent(db, row)
+            elif row.attempts + 1 >= max_attempts:
+                error = "Gave up after {} attempts: {}".format(row.attempts + 1, error)
+                row.update_record(pending=None, attempts=row.attempts + 1, last_error=error)
+            else:
+                row.update_record(attempts=row.attempts + 1, last_error=error,
+                    next_attempt_time=now + datetime.timedelta(seconds=backoff_secs * 2 ** row.attempts))
+            db.commit()
+            results.append((row.id, row.recipient, error))
+        if len(batch) < batch_size:
+            return results
+
+class FileTransport(object):
+    """
+    A transport that saves each email as a numbered JSON file in `folder`, rather than
+    sending it, so that tests (or a development server) can see what would have been sent.
+    Recipients in `fail_for` are refused, as if the SMTP server was unavailable.
+    """
+    def __init__(self, folder, fail_for=()):
+        self.folder = folder
+        self.fail_for = set(fail_for)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def __call__(self, recipient, subject, body):
+        if recipient in self.fail_for:
+            return False
+        n = len(self.sent())
+        with open(os.path.join(self.folder, "{:08d}.json".format(n)), "w") as f:
+            json.dump(dict(to=recipient, subject=subject, body=body), f)
+        return True
+
+    def sent(self):
+        """The emails saved so far, in the order they were sent"""
+        emails = []
+        for filename in sorted(os.listdir(self.folder)):
+            if filename.endswith(".json"):
+                with open(os.path.join(self.folder, filename)) as f:
+                    emails.append(json.load(f))
+        return emails
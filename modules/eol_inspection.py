@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Buffer the logging of EoL pages and images that users have jumped out to (see
+eol_page_ID and eol_dataobject_ID in controllers/tree.py), so that a click-through
+does not need a read-then-write on the eol_inspected table while the user waits.
+
+Inspections are aggregated in memory, one per taxon (keyed by ott, or by name if
+there is no ott, as the old update_or_insert calls did), keeping the latest
+inspection time for each. Every `flush_secs` (or as soon as `max_keys` taxa are
+waiting) a background thread writes them to the eol_inspected table, so web requests
+never wait for the write. Existing rows have only their inspection columns (via and
+inspected) updated, in one UPDATE, and new taxa are added in one multi-row INSERT. Since
+the inspection times are those of the original clicks, and the EoL harvester
+(check_recently_inspected in EoLQueryPicsNames.py) only picks up taxa inspected
+more than 5 minutes ago, this gives the same behaviour as long as flush_secs is
+well under 5 minutes.
+"""
+import datetime
+import threading
+import time
+
+datetime_format = "%Y-%m-%d %H:%M:%S"
+
+class InspectionBuffer(object):
+    def __init__(self, flush_secs=60, max_keys=500, connect=None):
+        """
+        `connect` is an optional function returning a new DAL connection which is not
+        tied to a web request. If given, a background timer uses it to flush the buffer
+        `flush_secs` after the first inspection is added (or straight away, once
+        `max_keys` taxa are waiting). Otherwise the caller must call flush().
+        """
+        self.flush_secs = flush_secs
+        self.max_keys = max_keys
+        self.connect = connect
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._first_added = None
+        self._timer = None
+        self._flushing_now = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, inspected, via, ott=None, name=None, eol=None):
+        """
+        Record an inspection. If there is a background timer, it flushes the buffer when
+        due, and this returns False. Otherwise, returns True if the buffer is due to be
+        flushed, in which case the caller should call flush() with its db connection.
+        """
+        if ott is None and name is None:
+            return False
+        entry = dict(ott=ott, name=None if ott is not None else name, eol=eol, via=via, inspected=inspected)
+        with self._lock:
+            self._merge(entry)
+            if self._first_added is None:
+                self._first_added = time.time()
+                self._start_timer(self.flush_secs)
+            due = (len(self._pending) >= self.max_keys or
+                time.time() - self._first_added >= self.flush_secs)
+            if self.connect is None:
+                return due
+            if due and not self._flushing_now:
+                # flush in the background straight away, rather than waiting for the timer
+                self._flushing_now = True
+                self._timer.cancel()
+                self._start_timer(0)
+            return False
+
+    def flush(self, db):
+        """
+        Write all waiting inspections to the db in one go. Returns the number of
+        taxa written (or skipped because the db already has a later inspection)
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._first_added = None
+            self._flushing_now = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return 0
+        try:
+            write_inspections(db, pending.values())
+        except Exception:
+            # put them back, so they get written next time
+            with self._lock:
+                for entry in pending.values():
+                    self._merge(entry)
+                if self._first_added is None:
+                    self._first_added = time.time()
+                    self._start_timer(self.flush_secs)
+            raise
+        return len(pending)
+
+    def _merge(self, entry):
+        """Must be called with the lock held"""
+        key = (entry['ott'], entry['name'])
+        prev = self._pending.get(key)
+        if prev is None or prev['inspected'] <= entry['inspected']:
+            self._pending[key] = entry
+
+    def _start_timer(self, delay):
+        """Must be called with the lock held"""
+        if self.connect is not None:
+            self._timer = threading.Timer(delay, self._flush_in_background)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_in_background(self):
+        db = self.connect()
+        try:
+            self.flush(db)
+        finally:
+            db.close()
+
+
+def write_inspections(db, entries):
+    """
+    Log the given inspections in the eol_inspected table: rows already there for these
+    taxa have their via and inspected columns updated in a single UPDATE (leaving their
+    eol column as it is, as the old update_or_insert calls did), and the remaining taxa
+    are added with a single multi-row INSERT. If another process has already logged a
+    later inspection for a taxon, that row is left as it is.
+    """
+    with _write_lock:
+        _write_inspections(db, entries)
+
+def _write_inspections(db, entries):
+    if db._uri.startswith("sqlite"):
+        ph, for_update = "?", ""
+        # take the write lock now, so nobody can log a later inspection (or add the same
+        # taxon) between our SELECT and UPDATE (sqlite otherwise only starts a transaction
+        # at the UPDATE)
+        if not db._adapter.connection.in_transaction:
+            db.executesql("BEGIN IMMEDIATE;")
+    else:
+        ph, for_update = "%s", " FOR UPDATE"
+    by_ott = {e['ott']: e for e in entries if e['ott'] is not None}
+    by_name = {e['name']: e for e in entries if e['ott'] is None}
+    new_rows = []
+    for col, entries_by_key in (('ott', by_ott), ('name', by_name)):
+        if not entries_by_key:
+            continue
+        keys = list(entries_by_key.keys())
+        in_list = ",".join([ph] * len(keys))
+        existing = []
+        for key, latest in db.executesql(
+            "SELECT {0}, MAX(inspected) FROM eol_inspected WHERE {0} IN ({1}) GROUP BY {0}{2};".format(
+                col, in_list, for_update), keys):
+            if latest is not None and _as_str(latest) > _as_str(entries_by_key[key]['inspected']):
+                del entries_by_key[key]
+            else:
+                existing.append(key)
+        if existing:
+            case = "CASE {} {} END".format(col, " ".join(["WHEN {0} THEN {0}".format(ph)] * len(existing)))
+            values = [v for key in existing for v in (key, entries_by_key[key]['via'])]
+            values += [v for key in existing for v in (key, _as_str(entries_by_key[key]['inspected']))]
+            db.executesql("UPDATE eol_inspected SET via = {0}, inspected = {0} WHERE {1} IN ({2});".format(
+                case, col, ",".join([ph] * len(existing))), values + existing)
+        existing = set(existing)
+        new_rows.extend(e for key, e in entries_by_key.items() if key not in existing)
+    if new_rows:
+        values = []
+        for e in new_rows:
+            values.extend([e['ott'], e['name'], e['eol'], e['via'], _as_str(e['inspected'])])
+        db.executesql(
+            "INSERT INTO eol_inspected (ott, name, eol, via, inspected) VALUES " +
+            ",".join(["({})".format(",".join([ph]*5))] * len(new_rows)) + ";", values)
+    db.commit()
+
+def _as_str(dt):
+    """Datetimes can come back from the db as datetime objects or as strings, depending on the driver"""
+    if isinstance(dt, datetime.datetime):
+        return dt.strftime(datetime_format)
+    return str(dt)[:len("YYYY-MM-DD HH:MM:SS")]
+
+
+_write_lock = threading.Lock()
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def inspection_buffer(**kwargs):
+    """
+    The buffer shared by all requests handled by this process. The kwargs are passed
+    to InspectionBuffer when it is first created.
+    """
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = InspectionBuffer(**kwargs)
+    return _buffer
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Keep the result of loading a file (e.g. appconfig.ini) in memory for the lifetime of the
+worker process, and only load it again when the file changes on disk. This means that
+on test or beta servers, edits to appconfig.ini still take effect without a restart,
+but the file is not re-parsed on every request: the cost is one os.stat() per request.
+"""
+import os
+import threading
+
+_loaded = {}
+_lock = threading.Lock()
+
+def file_stamp(path):
+    """Something that changes when the file at path is edited (or None if it is missing)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def load_if_changed(path, load):
+    """
+    Return load(path), calling load() again only if the modification time or size of
+    `path` has changed since it was last loaded (by any request in this process)
+    """
+    stamp = file_stamp(path)
+    with _lock:
+        cached = _loaded.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+    value = load(path)
+    with _lock:
+        _loaded[path] = (stamp, value)
+    return value
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Queries on the nested set representation of the tree in the ordered_nodes and
+ordered_leaves tables. Nodes and leaves are numbered in preorder, and each node stores
+the range of leaf ids below it (leaf_lft to leaf_rgt), so that the ancestors of leaf x
+are simply the nodes with leaf_lft <= x <= leaf_rgt, and can be found in one query
+without walking up the tree parent by parent.
+
+Nodes created when randomly resolving polytomies have a negative real_parent: by
+default these are excluded, so that the ancestors returned are the same as those found
+by following the real_parent links (as the old MySQL GetParents procedure did).
+"""
+
+default_ancestor_fields = ('id', 'ott', 'name', 'wikidata', 'popularity')
+
+def ancestor_path(db, leaf_id=None, node_id=None, fields=default_ancestor_fields, real_only=True, query=None):
+    """
+    Return the ordered_nodes rows for all the ancestors of a leaf (given by an
+    ordered_leaves id) or of a node (given by an ordered_nodes id), ordered from the
+    root downwards. `query` can be used to restrict the nodes returned further,
+    e.g. (db.ordered_nodes.wikidata != None).
+    """
+    nodes = db.ordered_nodes
+    if leaf_id is not None:
+        range_query = (nodes.leaf_lft <= leaf_id) & (nodes.leaf_rgt >= leaf_id)
+    elif node_id is not None:
+        bounds = db(nodes.id == node_id).select(nodes.leaf_lft, nodes.leaf_rgt).first()
+        if bounds is None:
+            return []
+        range_query = _node_ancestors_query(nodes, bounds.leaf_lft, bounds.leaf_rgt, node_id)
+    else:
+        raise ValueError("Either leaf_id or node_id must be given")
+    if real_only:
+        range_query &= (nodes.real_parent >= 0)
+    if query is not None:
+        range_query &= query
+    return db(range_query).select(
+        *[nodes[f] for f in fields], orderby=nodes.leaf_lft|nodes.id).as_list()
+
+def ancestor_paths(db, otts, fields=default_ancestor_fields, real_only=True, query=None):
+    """
+    The batched version of ancestor_path(). Given a list of OTTs, return a dict mapping
+    each ott found in the tree to a list of its ancestors (as dicts, root first).
+    If an ott is present as both a leaf and a node, the leaf is used.
+
+    All the ancestors are fetched in a single query (ordered by leaf_lft, i.e.
+    preorder), then allocated to each taxon in one sweep, by passing through the
+    sorted taxa while keeping a stack of the nodes enclosing the current position.
+    """
+    nodes = db.ordered_nodes
+    leaves = db.ordered_leaves
+    otts = set(otts)
+    if not otts:
+        return {}
+    targets = {} # ott => (leaf_lft, leaf_rgt, node id or None for a leaf)
+    for r in db(nodes.ott.belongs(otts)).select(nodes.id, nodes.ott, nodes.leaf_lft, nodes.leaf_rgt, orderby=nodes.id):
+        targets.setdefault(r.ott, (r.leaf_lft, r.leaf_rgt, r.id))
+    found_leaves = set()
+    for r in db(leaves.ott.belongs(otts)).select(leaves.id, leaves.ott, orderby=leaves.id):
+        if r.ott not in found_leaves:
+            found_leaves.add(r.ott)
+            targets[r.ott] = (r.id, r.id, None)
+    if not targets:
+        return {}
+
+    ranges = None
+    for lft, rgt, node_id in targets.values():
+        if node_id is None:
+            q = (nodes.leaf_lft <= lft) & (nodes.leaf_rgt >= lft)
+        else:
+            q = _node_ancestors_query(nodes, lft, rgt, node_id)
+        ranges = q if ranges is None else (ranges | q)
+    if real_only:
+        ranges = (ranges) & (nodes.real_parent >= 0)
+    if query is not None:
+        ranges &= query
+    select_fields = list(fields) + [f for f in ('id', 'leaf_lft', 'leaf_rgt') if f not in fields]
+    rows = db(ranges).select(*[nodes[f] for f in select_fields], orderby=nodes.leaf_lft|nodes.id).as_list()
+
+    paths = {}
+    stack = []
+    row_iter = iter(rows)
+    next_row = next(row_iter, None)
+    for ott, (lft, rgt, node_id) in sorted(targets.items(), key=lambda t: t[1]):
+        while next_row is not None and next_row['leaf_lft'] <= lft:
+            while stack and stack[-1]['leaf_rgt'] < next_row['leaf_lft']:
+                stack.pop()
+            stack.append(next_row)
+            next_row = next(row_iter, None)
+        while stack and stack[-1]['leaf_rgt'] < lft:
+            stack.pop()
+        # the stack now holds the nodes enclosing leaf_lft, outermost first. For a node
+        # we also need to exclude the node itself, and any of its leftmost descendants
+        paths[ott] = [
+            _subset(r, fields) for r in stack
+            if node_id is None or (r['leaf_rgt'] >= rgt and r['id'] < node_id)]
+    return paths
+
+def _node_ancestors_query(nodes, leaf_lft, leaf_rgt, node_id):
+    # ids are allocated in preorder, so an ancestor always has a smaller id
+    return (nodes.leaf_lft <= leaf_lft) & (nodes.leaf_rgt >= leaf_rgt) & (nodes.id < node_id)
+
+def _subset(row, fields):
+    return {f: row[f] for f in fields}
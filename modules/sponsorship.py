@@ -0,0 +1,774 @@
+# -*- coding: utf-8 -*-
+"""
+The reservation state machine used when someone views a sponsorship page (see
+sponsor_leaf_check in controllers/default.py).
+
+A row in the reservations table is in one of these states, worked out from its fields:
+
+    sponsored                        verified_time is set
+    unverified                       user_sponsor_name and PP_transaction_code are set
+    unverified waiting for payment   user_sponsor_name is set, but not PP_transaction_code,
+                                     and reserve_time is within unpaid_time_limit
+    reserved                         no user_sponsor_name, and another user's reserve_time
+                                     is within reservation_time_limit
+    available                        anything else (stale unpaid details are cleared)
+
+A banned taxon stays "banned" unless it has been sponsored. When sponsorship is
+allowed, viewing an "available" leaf reserves it for the viewer (identified by their
+reservation code), and viewing a leaf reserved by the same viewer ("available only to
+user") restarts their timer.
+
+To stop two visitors both reserving the same leaf, the row is read with SELECT ... FOR
+UPDATE (or after BEGIN IMMEDIATE on SQLite, which has no row locks), all the changes (including
+a server-side num_views + 1) are then written in a single UPDATE, and the transaction
+is committed straight away, so that the lock is not held while the page is built.
+
+PayPal payment notifications (IPNs) are recorded in the paypal_notifications table by
+record_paypal_notification(), so that pp_process_post can return straight away, and a
+repeated notification is only recorded once. They are then applied to the reservations
+table by process_paypal_notifications(), run from cron/process_paypal_notifications.py,
+which tries notifications that fail again later.
+
+Leaves that can be sponsored are listed a page at a time by sponsorable_leaves_page(),
+and the leaves in hand-picked lists are fetched in one go by handpick_leaves().
+
+The prices of leaves are set in bulk by set_prices(), called from manage/SET_PRICES.
+
+Rows which are not viewed are tidied up periodically by sweep_reservations(), run from
+cron/sweep_reservations.py.
+
+Two tables hold copies of sponsorship details, which must be updated whenever the
+reservations table changes: recent_sponsorships (live sponsorships with their images,
+for the home and sponsored pages, see update_recent_sponsorships()) and
+sponsor_search_tokens (the words in sponsor text, for search_sponsor_text(), see
+update_sponsor_search_tokens()). remove_sponsorship_copies() removes leaves from both.
+"""
+
+import datetime
+import json
+import unicodedata
+from collections import OrderedDict
+
+reservation_keep_fields = ('id', 'OTT_ID', 'num_views', 'last_view')
+
+def begin_locking(db):
+    """
+    Start a transaction in which rows can be locked before changing them. Returns the
+    value to pass as for_update to the next select: SQLite has no row locks (nor
+    SELECT ... FOR UPDATE), so instead we take the database write lock straight away.
+    """
+    if db._adapter.dbengine == "sqlite":
+        db.executesql("BEGIN IMMEDIATE;")
+        return False
+    return True
+
+def integrity_error(db):
+    """
+    The IntegrityError exception of db's DB-API driver, raised e.g. when an insert breaks
+    a unique index because another connection inserted the same row at the same time
+    """
+    return db._adapter.driver.IntegrityError
+
+def cleared_reservation_fields(table):
+    """The field values that remove all sponsorship details from a reservations row"""
+    return {f: None for f in table.fields if f not in reservation_keep_fields}
+
+def view_reservation(db, ott, name, user_code, now, reservation_time_limit, unpaid_time_limit,
+        allow_sponsorship=True, count_view=True, retries=1):
+    """
+    Record a view of the sponsorship page for a leaf, reserving it for `user_code` if
+    it is available and `allow_sponsorship` is True. `count_view` is False for views
+    that should not update num_views and last_view (e.g. form submissions).
+
+    Any open transaction on `db` is committed first, and the changes made here are
+    committed before returning. Returns (status, release_time, row), where release_time
+    is the number of seconds until a "reserved" leaf becomes free, and row is the
+    reservations row after any changes.
+    """
+    #start a new transaction, so that the row lock is taken straight away (on SQLite, the
+    #write lock) and, in MySQL, the row is read as it is now, not as at the caller's last read
+    db.commit()
+    try:
+        return _view_reservation(db, ott, name, user_code, now, reservation_time_limit,
+            unpaid_time_limit, allow_sponsorship, count_view)
+    except integrity_error(db):
+        db.rollback()
+        #two first-time visitors may race to insert a new row, which breaks the unique
+        #index on OTT_ID: the loser can try again, and will now find the winner's row
+        if retries > 0:
+            return view_reservation(db, ott, name, user_code, now, reservation_time_limit,
+                unpaid_time_limit, allow_sponsorship, count_view, retries - 1)
+        raise
+    except Exception:
+        db.rollback()
+        raise
+
+def _view_reservation(db, ott, name, user_code, now, reservation_time_limit, unpaid_time_limit,
+        allow_sponsorship, count_view):
+    reservations = db.reservations
+    locked = db(reservations.OTT_ID == ott).select(
+        reservations.ALL, db.banned.id,
+        left=db.banned.on(db.banned.ott == reservations.OTT_ID),
+        limitby=(0, 1), for_update=begin_locking(db)).first()
+    release_time = 0
+    if locked is None:
+        # there is no row in the database for this case so add one
+        status = "banned" if not db(db.banned.ott == ott).isempty() else "available"
+        new_row = dict(OTT_ID=ott, name=name, last_view=now, num_views=1)
+        if status == "available" and allow_sponsorship:
+            new_row.update(reserve_time=now, user_registration_id=user_code)
+        # update with full viewing data but no reservation, even if e.g. banned
+        row_id = reservations.insert(**new_row)
+        db.commit()
+        return status, release_time, reservations(row_id)
+
+    row = locked.reservations
+    changes = {}
+    if count_view:
+        changes.update(last_view=now, num_views=reservations.num_views.coalesce(0) + 1, name=name)
+    if row.verified_time:
+        status = "sponsored"
+    elif locked.banned.id is not None:
+        status = "banned"
+    elif row.user_sponsor_name:
+        if row.PP_transaction_code:
+            status = "unverified"
+        elif row.reserve_time and (now - row.reserve_time).total_seconds() < unpaid_time_limit:
+            status = "unverified waiting for payment"
+        else:
+            # We've waited too long and can zap the personal data. Even if status
+            # is available, allow_sponsorship can be False: status is then used to
+            # decide the text to show the user
+            changes.update(cleared_reservation_fields(reservations))
+            remove_sponsorship_copies(db, [ott])
+            status = "available"
+    elif row.reserve_time is None:
+        status = "available"
+        if allow_sponsorship:
+            changes.update(name=name, reserve_time=now, user_registration_id=user_code)
+    else:
+        timesince = (now - row.reserve_time).total_seconds()
+        if timesince < reservation_time_limit:
+            release_time = reservation_time_limit - timesince
+            if user_code == row.user_registration_id:
+                # it was the same user anyway so reset timer
+                status = "available only to user"
+                if allow_sponsorship:
+                    changes.update(name=name, reserve_time=now)
+            else:
+                status = "reserved"
+        else:
+            status = "available"
+            if allow_sponsorship:
+                changes.update(name=name, reserve_time=now, user_registration_id=user_code)
+    if changes:
+        db(reservations.id == row.id).update(**changes)
+        if 'num_views' in changes:
+            changes['num_views'] = (row.num_views or 0) + 1
+        row.update(changes)
+    db.commit()
+    return status, release_time, row
+
+def set_sponsorship_ends(db, query=None):
+    """
+    Set sponsorship_ends to verified_time + sponsorship_duration_days for the verified
+    reservations selected by `query` (default: all) that do not yet have an end date,
+    in a single UPDATE. This is called by manage/SPONSOR_UPDATE when a sponsorship is
+    verified, and once over the whole table by
+    OZprivate/ServerScripts/Utilities/OneOff/set_sponsorship_ends.py for sponsorships
+    verified before sponsorship_ends was filled out. Leaves which have been renewed (i.e.
+    have a row in expired_reservations with was_renewed set) are left alone, as their end
+    date is later than verified_time + sponsorship_duration_days and must be set by hand.
+    Returns the number of rows set.
+    """
+    r = db.reservations
+    expired = db.expired_reservations
+    if db._adapter.dbengine == "sqlite":
+        ends = "datetime({}, '+' || {} || ' days')"
+    else:
+        ends = "DATE_ADD({}, INTERVAL {} DAY)"
+    query = ((r.verified_time != None) & (r.sponsorship_duration_days != None) & (r.sponsorship_ends == None) &
+        ~r.OTT_ID.belongs(db(expired.was_renewed == True)._select(expired.OTT_ID)) &
+        (r.id > 0 if query is None else query))
+    db.executesql("UPDATE {} SET {} = {} WHERE {};".format(
+        r._rname, r.sponsorship_ends._rname,
+        ends.format(r.verified_time._rname, r.sponsorship_duration_days._rname), query))
+    n_set = db._adapter.cursor.rowcount
+    db.commit()
+    return n_set
+
+def renewed_leaves_without_ends(db):
+    """
+    Return the OTT_IDs of verified, renewed leaves with no sponsorship_ends, which
+    set_sponsorship_ends() does not fill out
+    """
+    r = db.reservations
+    expired = db.expired_reservations
+    return [row.OTT_ID for row in db(
+        (r.verified_time != None) & (r.sponsorship_ends == None) &
+        r.OTT_ID.belongs(db(expired.was_renewed == True)._select(expired.OTT_ID))
+        ).select(r.OTT_ID, orderby=r.OTT_ID)]
+
+def sweep_reservations(db, now, reservation_time_limit, unpaid_time_limit, expiry_grace_secs=None, batch_size=1000):
+    """
+    Tidy up the reservations table, rather than waiting for someone to view each leaf,
+    so that queries on the table do not have to wade through dead rows. This is run
+    periodically by cron/sweep_reservations.py, and does three things:
+
+    * if expiry_grace_secs is given, moves sponsorships which ended (see
+      set_sponsorship_ends) over expiry_grace_secs ago to expired_reservations, clearing
+      them from the reservations table. Sponsorships are not moved while the renewal
+      emails are still going out, i.e. if the first renewal email has been sent but the
+      final one has not, or if either was sent less than expiry_grace_secs ago. Moving
+      is off by default, and expiry_grace_secs must be positive, so that the leaves of
+      sponsors who are still being asked to renew cannot be sponsored by someone else
+    * clears the details of unpaid sponsorships older than unpaid_time_limit
+    * releases reservations older than reservation_time_limit
+
+    Each is done in batches of at most batch_size rows, each batch being one INSERT ...
+    SELECT and/or UPDATE on rows locked as in view_reservation(), then committed.
+    Returns a dict of the number of rows in each category.
+    """
+    r = db.reservations
+    not_verified = (r.verified_time == None)
+    has_name = (r.user_sponsor_name != None) & (r.user_sponsor_name != "")
+    unpaid_cutoff = now - datetime.timedelta(seconds=unpaid_time_limit)
+    reserve_cutoff = now - datetime.timedelta(seconds=reservation_time_limit)
+    if expiry_grace_secs is None:
+        n_expired = 0
+    else:
+        if expiry_grace_secs <= 0:
+            raise ValueError("expiry_grace_secs must be positive, not {}".format(expiry_grace_secs))
+        expiry_cutoff = now - datetime.timedelta(seconds=expiry_grace_secs)
+        n_expired = _sweep(db, batch_size, _move_to_expired,
+            (r.verified_time != None) & (r.sponsorship_ends != None) & (r.sponsorship_ends < expiry_cutoff) &
+            ((r.emailed_re_renewal_initial == None) | (r.emailed_re_renewal_initial < expiry_cutoff)) &
+            (((r.emailed_re_renewal_initial == None) & (r.emailed_re_renewal_final == None)) |
+             (r.emailed_re_renewal_final < expiry_cutoff)))
+    return {
+        'expired': n_expired,
+        'unpaid': _sweep(db, batch_size, lambda db, ids: _clear(db, ids, cleared_reservation_fields(r), True),
+            not_verified & has_name &
+            ((r.PP_transaction_code == None) | (r.PP_transaction_code == "")) &
+            ((r.reserve_time == None) | (r.reserve_time < unpaid_cutoff))),
+        'reserved': _sweep(db, batch_size, lambda db, ids: _clear(db, ids, dict(reserve_time=None, user_registration_id=None)),
+            not_verified & ~has_name & (r.reserve_time != None) & (r.reserve_time < reserve_cutoff)),
+    }
+
+def _sweep(db, batch_size, action, query):
+    """Call action(db, ids) on locked batches of the reservations ids selected by query"""
+    total = 0
+    db.commit()
+    while True:
+        try:
+            ids = [row.id for row in db(query).select(
+                db.reservations.id, orderby=db.reservations.id, limitby=(0, batch_size),
+                for_update=begin_locking(db))]
+            if ids:
+                action(db, ids)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        total += len(ids)
+        if len(ids) < batch_size:
+            return total
+
+def _clear(db, ids, fields, remove_copies=False):
+    r = db.reservations
+    if remove_copies:
+        remove_sponsorship_copies(db, db(r.id.belongs(ids))._select(r.OTT_ID))
+    db(r.id.belongs(ids)).update(**fields)
+
+def _move_to_expired(db, ids):
+    """
+    Copy the reservations rows with these ids into expired_reservations, then clear them
+    (and their copies in recent_sponsorships and sponsor_search_tokens)
+    """
+    r = db.reservations
+    expired = db.expired_reservations
+    columns = [f for f in expired.fields if f not in ('id', 'was_renewed')]
+    db.executesql("INSERT INTO {} ({}, {}) {}".format(
+        expired._rname,
+        ", ".join(expired[f]._rname for f in columns),
+        expired.was_renewed._rname,
+        db(r.id.belongs(ids))._select(*[r[f] for f in columns]).rstrip(";").replace(
+            " FROM ", ", {} FROM ".format(db._adapter.represent(False, expired.was_renewed.type)), 1)))
+    _clear(db, ids, cleared_reservation_fields(r), True)
+
+def set_prices(db, cutoffs, overrides=()):
+    """
+    Set the price of every leaf in ordered_leaves, and save the price bands in the
+    prices table, in a single transaction (so that readers never see a half-priced
+    tree: note that this means we cannot TRUNCATE the prices table, as that commits).
+
+    `cutoffs` is a list of (price, max_popularity) in increasing order of price: leaves
+    with a popularity below the first max_popularity (or with no popularity) get the
+    first price, and so on. The max_popularity of the last band is ignored. All leaves
+    are banded by a single UPDATE ... SET price = CASE ... END.
+
+    `overrides` is a list of (price, [names]), applied in order (so if a name is
+    repeated, the last price wins), after which banned taxa are set to a NULL price
+    (i.e. "contact us"). These are collected in a temporary table which is then joined
+    to ordered_leaves in a second UPDATE.
+
+    Returns a list of dicts, one per band, giving the price, cutoff, the number of
+    leaves in the band (n_leaves), and how many of them changed price (changed)
+    """
+    ol = db.ordered_leaves
+    band = cutoffs[-1][0]
+    for price, max_popularity in reversed(cutoffs[:-1]):
+        band = (ol.popularity < float(max_popularity)).case(price, band)
+    if len(cutoffs) > 1:
+        band = ((ol.popularity == None) | (ol.popularity < float(cutoffs[0][1]))).case(cutoffs[0][0], band)
+    changed = ((ol.price == None) | (ol.price != band)).case(1, 0).sum()
+    n_leaves = ol.id.count()
+    if db._adapter.dbengine == "sqlite":
+        drop_overrides = "DROP TABLE IF EXISTS temp.price_overrides;"
+        apply_overrides = "UPDATE {0} SET {1} = o.price FROM price_overrides AS o WHERE o.leaf = {0}.{2};"
+    else:
+        drop_overrides = "DROP TEMPORARY TABLE IF EXISTS price_overrides;"
+        apply_overrides = "UPDATE {0} JOIN price_overrides AS o ON o.leaf = {0}.{2} SET {0}.{1} = o.price;"
+    override_sql = "REPLACE INTO price_overrides (leaf, price) SELECT {}, {} FROM {} WHERE {};"
+    db.commit()
+    try:
+        counts = {row[band]: (row[n_leaves], row[changed])
+            for row in db(ol).select(band, n_leaves, changed, groupby=band)}
+        db(ol).update(price=band)
+        db.executesql(drop_overrides)
+        db.executesql("CREATE TEMPORARY TABLE price_overrides (leaf INTEGER PRIMARY KEY, price INTEGER);")
+        for price, names in overrides:
+            if names:
+                db.executesql(override_sql.format(
+                    ol.id._rname, int(price), ol._rname, ol.name.belongs(names)))
+        db.executesql(override_sql.format(
+            ol.id._rname, "NULL", ol._rname, ol.ott.belongs(db(db.banned)._select(db.banned.ott))))
+        db.executesql(apply_overrides.format(ol._rname, ol.price._rname, ol.id._rname))
+        db.executesql(drop_overrides)
+        db(db.prices).delete()
+        bands = []
+        for i, (price, max_popularity) in enumerate(cutoffs):
+            cutoff = float(max_popularity) if i < len(cutoffs) - 1 else None
+            n, n_changed = counts.get(price, (0, 0))
+            db.prices.insert(price=price, current_cutoff=cutoff, n_leaves=n)
+            bands.append(dict(price=price, cutoff=cutoff, n_leaves=n, changed=n_changed))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return bands
+
+def record_paypal_notification(db, ott, pp_vars, now):
+    """
+    Save a PayPal notification for `ott` in the paypal_notifications inbox, unless one
+    with the same transaction id (txn_id) has already been saved. Returns the id of the
+    new row, or None if it was a repeat. Raises ValueError if there is no txn_id.
+    """
+    txn_id = pp_vars.get('txn_id')
+    if not txn_id:
+        raise ValueError("No txn_id in the PayPal notification")
+    inbox = db.paypal_notifications
+    if not db(inbox.txn_id == txn_id).isempty():
+        return None
+    try:
+        row_id = inbox.insert(txn_id=txn_id, OTT_ID=ott, pp_vars=json.dumps(pp_vars), received_time=now,
+            attempts=0, next_attempt_time=now)
+        db.commit()
+    except Exception:
+        db.rollback()
+        #PayPal may send a repeat before we have saved the first: the unique txn_id stops both being saved
+        if not db(inbox.txn_id == txn_id).isempty():
+            return None
+        raise
+    return row_id
+
+def process_paypal_notifications(db, now, limit=None, on_applied=None, max_attempts=8, backoff_secs=60):
+    """
+    Apply the notifications in the paypal_notifications inbox that are due to the
+    reservations table, oldest first, committing after each one. If given,
+    on_applied(db, ott) is called in the same transaction after each notification is
+    applied, e.g. to queue an email to the sponsor.
+
+    A notification that conflicts with the reservation (NameError, i.e. the PayPal details
+    have already been filled out) is marked as processed with the reason saved in its
+    process_error field, as trying again cannot help. Any other error (e.g. no paid
+    reservation for the leaf yet, or the database being busy) undoes the changes for that
+    notification and leaves it unprocessed, with the error in process_error, to be tried
+    again after backoff_secs, then twice that, and so on, until it has been tried
+    max_attempts times. Notifications which have been tried that often are left with no
+    processed_time, for an admin to look at. One bad notification does not hold up the
+    rest. Returns a list of (OTT_ID, error) for each notification tried, with error None
+    if it was applied.
+    """
+    inbox = db.paypal_notifications
+    due = (inbox.processed_time == None) & (inbox.attempts < max_attempts) & (inbox.next_attempt_time <= now)
+    db.commit()
+    notifications = [(r.id, r.OTT_ID, r.attempts) for r in db(due).select(inbox.id, inbox.OTT_ID, inbox.attempts,
+        orderby=inbox.id, limitby=None if limit is None else (0, limit))]
+    done = []
+    for notification_id, ott, attempts in notifications:
+        try:
+            #lock the notification, so that it is only processed once, even if two workers run at once
+            notification = db((inbox.id == notification_id) & due).select(
+                inbox.ALL, for_update=begin_locking(db)).first()
+            if notification is None:
+                db.commit()
+                continue
+            try:
+                apply_paypal_notification(db, ott, json.loads(notification.pp_vars))
+                error = None
+                if on_applied is not None:
+                    on_applied(db, ott)
+            except NameError as e:
+                error = str(e)
+            notification.update_record(processed_time=now, process_error=error, attempts=attempts + 1)
+            db.commit()
+        except Exception as e:
+            #undo any partial changes, then record the error against the notification, to try again later
+            db.rollback()
+            error = "{}: {}".format(e.__class__.__name__, e)
+            updated = db((inbox.id == notification_id) & due).update(
+                process_error=error, attempts=attempts + 1,
+                next_attempt_time=now + datetime.timedelta(seconds=backoff_secs * 2 ** attempts))
+            db.commit()
+            if not updated:
+                continue
+        done.append((ott, error))
+    return done
+
+def apply_paypal_notification(db, ott, pp_vars):
+    """
+    Fill out the PayPal details of the reservation for `ott` from a notification. This
+    is only done if the reservation has a sponsor name and has been paid for (otherwise
+    LookupError is raised), and the PayPal details have not been filled out already
+    (otherwise NameError is raised).
+    """
+    r = db.reservations
+    reservation_query = ((r.OTT_ID == ott) &
+                         (r.user_sponsor_name != None) &
+                         (r.user_paid > 4.5)
+                        )
+    try:
+        paid = float(pp_vars.get('mc_gross'))
+    except (TypeError, ValueError):
+        paid = None
+    updated = db(reservation_query &
+                 #check the fields we are about to update are null (if not, this could be malicious)
+                 (r.PP_first_name == None) &
+                 (r.PP_second_name == None) &
+                 (r.PP_town == None) &
+                 (r.PP_country == None) &
+                 (r.PP_e_mail == None) &
+                 (r.verified_paid == None) &
+                 ((r.PP_transaction_code == None) | (r.PP_transaction_code == 'reserved')) &
+                 (r.sale_time == None)
+                ).update(PP_first_name = pp_vars.get('first_name'),
+                         PP_second_name = pp_vars.get('last_name'),
+                         PP_town = ", ".join([t for t in [pp_vars.get('address_city'), pp_vars.get('address_state')] if t]),
+                         PP_country = pp_vars.get('address_country'),
+                         PP_e_mail = pp_vars.get('payer_email'),
+                         verified_paid = paid,
+                         PP_transaction_code = pp_vars.get('txn_id'),
+                         sale_time = pp_vars.get('payment_date')
+                        )
+    if not updated:
+        if db(reservation_query).isempty():
+            raise LookupError('No row updated: the OTT may be invalid, or the sponsor name or payment not yet saved')
+        raise NameError('No row updated: some details are already filled out')
+    #should only update house/st and postcode if giftaid is true
+    db(reservation_query &
+       (r.user_giftaid == True) &
+       (r.PP_house_and_street == None) &
+       (r.PP_postcode == None)
+    ).update(
+        PP_house_and_street = pp_vars.get('address_street'),
+        PP_postcode = pp_vars.get('address_zip')
+    )
+
+def sponsorable_leaves_page(db, query, after=None, n=500):
+    """
+    A page of the leaves selected by `query` (on ordered_leaves) that have not been
+    sponsored, in alphabetical order, as a list of n+1 rows (the extra one showing that
+    there are more pages). If `after` is the id of the last leaf on the previous page, the
+    page starts after that leaf.
+
+    This uses keyset pagination on (name, id), so that later pages are as fast as the
+    first, rather than using OFFSET, which has to find and skip all the earlier rows.
+    Sponsored leaves are excluded with an anti-join (a left join on reservations, keeping
+    leaves with no matching row), which can use the (OTT_ID, verified_time) index, rather
+    than a NOT IN subquery on every sponsored leaf.
+    """
+    ol = db.ordered_leaves
+    r = db.reservations
+    if after is not None:
+        last = db(ol.id == after).select(ol.name).first()
+        if last is None:
+            raise ValueError("No leaf with id {}".format(after))
+        query = query & ((ol.name > last.name) | ((ol.name == last.name) & (ol.id > after)))
+    return db(query & (r.id == None)).select(
+        ol.id, ol.ott, ol.name, ol.price,
+        left=r.on((r.OTT_ID == ol.ott) & (r.verified_time != None)),
+        orderby=ol.name|ol.id,
+        limitby=(0, n + 1))
+
+def handpick_leaves(db, otts, prices_pence):
+    """
+    The leaves with these otts (e.g. from a sponsor_picks list), grouped by price, using a
+    single query rather than one per price band. Returns (by_price, images, sci_names),
+    where by_price is an OrderedDict mapping each price in prices_pence (None for "contact
+    us") to a list of otts, best rated image first, images maps ott to the (src, src_id) of
+    its best image, and sci_names maps ott to name. Leaves with images, none of which is
+    the overall best, are left out. If there are no leaves at all, by_price is None.
+    """
+    ol = db.ordered_leaves
+    img = db.images_by_ott
+    rows = db(ol.ott.belongs(otts)).select(
+        ol.ott, ol.name, ol.price, img.src, img.src_id, img.overall_best_any,
+        left=img.on(img.ott == ol.ott),
+        orderby=~img.rating|ol.ott)
+    if not rows:
+        return None, {}, {}
+    by_price = OrderedDict((p, []) for p in prices_pence)
+    images = {}
+    sci_names = {}
+    for r in rows:
+        if r.images_by_ott.overall_best_any in (True, None) and r.ordered_leaves.price in by_price:
+            ott = r.ordered_leaves.ott
+            by_price[r.ordered_leaves.price].append(ott)
+            sci_names[ott] = r.ordered_leaves.name
+            if r.images_by_ott.src:
+                images[ott] = (r.images_by_ott.src, r.images_by_ott.src_id)
+    return by_price, images, sci_names
+
+def sponsored_stamp(db):
+    """
+    Something that changes whenever a leaf is sponsored, or a sponsorship is re-verified
+    or removed, for checking whether cached sponsorship details are out of date
+    """
+    r = db.reservations
+    n, latest = r.id.count(), r.verified_time.max()
+    row = db(r.verified_time != None).select(n, latest).first()
+    return (row[n], row[latest])
+
+def leaf_card_images(db, otts, chosen=()):
+    """
+    The images shown on the cards for a page of sponsored leaves (e.g. on the sponsored
+    and donor_list pages), using one query for the default images of all the leaves and
+    one for all the images chosen by sponsors, rather than a query per card. `chosen` is
+    a list of (src, src_id) pairs. Returns (default_images, chosen_images): the first maps
+    each ott to the images_by_ott row for its overall best image, and the second maps each
+    (src, src_id) to a row for that image. Rows have ott, src, src_id, rights and licence.
+    """
+    img = db.images_by_ott
+    fields = (img.ott, img.src, img.src_id, img.rights, img.licence)
+    default_images = {}
+    chosen_images = {}
+    otts = set(otts)
+    if otts:
+        for r in db(img.ott.belongs(otts) & (img.overall_best_any == True)).select(*fields, orderby=~img.src):
+            default_images[r.ott] = r
+    by_src = {}
+    for src, src_id in chosen:
+        by_src.setdefault(int(src), set()).add(int(src_id))
+    if by_src:
+        # one clause per src (there are only a few), so the (src, src_id) index can be used
+        query = None
+        for src, src_ids in by_src.items():
+            clause = (img.src == src) & img.src_id.belongs(src_ids)
+            query = clause if query is None else (query | clause)
+        for r in db(query).select(*fields, orderby=img.id):
+            chosen_images.setdefault((r.src, r.src_id), r)
+    return default_images, chosen_images
+
+recent_sponsorship_fields = ('OTT_ID', 'name', 'reserve_time', 'verified_time', 'verified_kind',
+    'verified_name', 'verified_more_info', 'user_nondefault_image',
+    'verified_preferred_image_src', 'verified_preferred_image_src_id')
+
+def recent_sponsorship_images(db, rows):
+    """
+    The image to show for each of these reservations or recent_sponsorships rows: the
+    one chosen by the sponsor, or the best one for the leaf. Returns a dict mapping each
+    ott to the src, src_id, rights and licence values to store in recent_sponsorships.
+    """
+    chosen = {row.OTT_ID: (row.verified_preferred_image_src, row.verified_preferred_image_src_id)
+        for row in rows if row.user_nondefault_image and row.verified_preferred_image_src is not None
+            and row.verified_preferred_image_src_id is not None}
+    default_images, chosen_images = leaf_card_images(db, [row.OTT_ID for row in rows], chosen.values())
+    images = {}
+    for row in rows:
+        img = chosen_images.get(chosen.get(row.OTT_ID)) or default_images.get(row.OTT_ID)
+        images[row.OTT_ID] = dict(src=img.src if img else None, src_id=img.src_id if img else None,
+            rights=img.rights if img else None, licence=img.licence if img else None)
+    return images
+
+def update_recent_sponsorships(db, now, otts=None):
+    """
+    Copy the live (verified and not deactivated) sponsorships of these leaves from
+    reservations into recent_sponsorships, along with the image to show for each, and
+    remove any of the leaves that are no longer sponsored. Call this when a sponsorship
+    is verified, edited, deactivated or ends. If otts is None, the whole table is rebuilt,
+    which is only needed once, to fill out the table (see
+    OZprivate/ServerScripts/Utilities/OneOff/fill_recent_sponsorships.py). This uses the
+    same few queries however many leaves there are. The caller should commit. Returns
+    the number of live sponsorships copied.
+    """
+    r = db.reservations
+    rs = db.recent_sponsorships
+    query = (r.verified_time != None) & ((r.deactivated == None) | (r.deactivated == ""))
+    if otts is not None:
+        otts = set(otts)
+        if not otts:
+            return 0
+        query &= r.OTT_ID.belongs(otts)
+    rows = db(query).select(*[r[f] for f in recent_sponsorship_fields])
+    images = recent_sponsorship_images(db, rows)
+    db(rs.id > 0 if otts is None else rs.OTT_ID.belongs(otts)).delete()
+    new_rows = []
+    for row in rows:
+        values = {f: row[f] for f in recent_sponsorship_fields}
+        values.update(images[row.OTT_ID], updated_time=now)
+        new_rows.append(values)
+    if new_rows:
+        rs.bulk_insert(new_rows)
+    return len(new_rows)
+
+def refresh_recent_sponsorship_images(db, now, batch_size=1000):
+    """
+    Update the images in recent_sponsorships that no longer match those in images_by_ott,
+    e.g. because new images have been downloaded for a leaf, changing its best image. The
+    table is read in batches of batch_size rows, and only the rows whose image has changed
+    are written. This is run by cron/sweep_reservations.py: sponsorship changes are copied
+    as they happen by update_recent_sponsorships(). The caller should commit. Returns the
+    number of rows changed.
+    """
+    rs = db.recent_sponsorships
+    fields = [rs.id, rs.OTT_ID, rs.user_nondefault_image, rs.verified_preferred_image_src,
+        rs.verified_preferred_image_src_id, rs.src, rs.src_id, rs.rights, rs.licence]
+    changed = 0
+    last_id = 0
+    while True:
+        rows = db(rs.id > last_id).select(*fields, orderby=rs.id, limitby=(0, batch_size))
+        images = recent_sponsorship_images(db, rows)
+        for row in rows:
+            values = images[row.OTT_ID]
+            if any(row[f] != v for f, v in values.items()):
+                db(rs.id == row.id).update(updated_time=now, **values)
+                changed += 1
+        if len(rows) < batch_size:
+            return changed
+        last_id = rows[-1].id
+
+def remove_sponsorship_copies(db, otts):
+    """
+    Remove these leaves (a list of otts, or a _select() of them) from the tables that hold
+    copies of sponsorship details, when their sponsorship details are cleared
+    """
+    db(db.recent_sponsorships.OTT_ID.belongs(otts)).delete()
+    db(db.sponsor_search_tokens.OTT_ID.belongs(otts)).delete()
+
+sponsor_token_length = 40
+
+def normalize_sponsor_text(text):
+    """
+    Lower case and without accents, so that comparisons are case and accent insensitive,
+    like those in MySQL with a _ci collation
+    """
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c)).lower()
+
+def sponsor_text_tokens(*texts):
+    """
+    The search tokens for some sponsor text: every ending of each (normalized) word in
+    the texts. A search word, which has no spaces, appears in the text exactly when it is
+    the start of one of these tokens, so that LIKE '%word%' on the text can be replaced
+    by an indexed LIKE 'word%' on the tokens.
+    """
+    tokens = set()
+    for text in texts:
+        for word in normalize_sponsor_text(text or "").split():
+            tokens.update(word[i:i + sponsor_token_length] for i in range(len(word)))
+    return tokens
+
+def update_sponsor_search_tokens(db, otts=None):
+    """
+    Replace the rows in sponsor_search_tokens for these leaves with the tokens of their
+    current sponsor text: the verified name and more info of a verified sponsorship,
+    along with the date it expires, or the name and more info given by the sponsor
+    while it awaits verification. Deactivated sponsorships are not searchable. Call this
+    when sponsor text is entered, verified, changed or cleared. If otts is None, the
+    whole table is rebuilt, which is only needed once, to fill out the table (see
+    OZprivate/ServerScripts/Utilities/OneOff/fill_sponsor_search_tokens.py). The caller
+    should commit. Returns the number of tokens.
+    """
+    r = db.reservations
+    t = db.sponsor_search_tokens
+    query = ((r.deactivated == None) | (r.deactivated == "")) & \
+        ((r.verified_time != None) | ((r.user_sponsor_kind != None) & (r.user_sponsor_kind != "")))
+    if otts is not None:
+        otts = set(otts)
+        if not otts:
+            return 0
+        query &= r.OTT_ID.belongs(otts)
+        db(t.OTT_ID.belongs(otts)).delete()
+    else:
+        db(t.id > 0).delete()
+    new_rows = []
+    for row in db(query).select(r.OTT_ID, r.verified_time, r.sponsorship_duration_days,
+            r.verified_name, r.verified_more_info, r.user_sponsor_name, r.user_more_info):
+        if row.verified_time:
+            expires = None
+            if row.sponsorship_duration_days is not None:
+                expires = row.verified_time + datetime.timedelta(days=row.sponsorship_duration_days)
+            tokens = sponsor_text_tokens(row.verified_name, row.verified_more_info)
+        else:
+            expires = None
+            tokens = sponsor_text_tokens(row.user_sponsor_name, row.user_more_info)
+        new_rows.extend(dict(OTT_ID=row.OTT_ID, token=token, verified=bool(row.verified_time), expires=expires)
+            for token in tokens)
+    if new_rows:
+        t.bulk_insert(new_rows)
+    return len(new_rows)
+
+def search_sponsor_text(db, words, fields, now, kind=None, order_by_recent=False, limit=None, start=0):
+    """
+    The sponsorships whose text contains all of these words (each in the name or the more
+    info), using indexed prefix lookups on sponsor_search_tokens, joined back to
+    reservations. Returns a list of (verified, row) with the named fields of reservations:
+    first the verified sponsorships that have not expired (by the start of today), then
+    those awaiting verification. If kind is given, only sponsorships 'by' or 'for' are
+    returned. Each group is ordered by id, or most recent first if order_by_recent.
+    Tokens are cut at sponsor_token_length characters, so a longer word is looked up by
+    its start, then matched in the text itself (only in the few rows the tokens select).
+    """
+    t = db.sponsor_search_tokens
+    r = db.reservations
+    words = [w for w in (normalize_sponsor_text(w) for w in words) if w]
+    if not words:
+        return []
+    today = datetime.datetime.combine(now.date(), datetime.time())
+    end = int(start) + int(limit) if limit else None
+    results = []
+    for verified in (True, False):
+        tokens = (t.verified == verified)
+        query = (r.deactivated == None) | (r.deactivated == "")
+        if verified:
+            tokens &= (t.expires > today)
+            query &= (r.verified_time != None)
+            kind_field, recent_field = r.verified_kind, r.verified_time
+            text_fields = (r.verified_name, r.verified_more_info)
+        else:
+            query &= (r.verified_time == None) & (r.user_sponsor_kind != None) & (r.user_sponsor_kind != "")
+            kind_field, recent_field = r.user_sponsor_kind, r.user_updated_time
+            text_fields = (r.user_sponsor_name, r.user_more_info)
+        if kind:
+            query &= (kind_field == kind)
+        for word in words:
+            query &= r.OTT_ID.belongs(db(tokens & t.token.startswith(word[:sponsor_token_length]))._select(t.OTT_ID))
+            if len(word) > sponsor_token_length:
+                query &= (text_fields[0].contains(word) | text_fields[1].contains(word))
+        rows = db(query).select(*[r[f] for f in fields],
+            orderby=~recent_field if order_by_recent else r.id,
+            limitby=(0, end - len(results)) if end else None)
+        results.extend((verified, row) for row in rows)
+        if end and len(results) >= end:
+            break
+    return results[int(start):end] if end else results
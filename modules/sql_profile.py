@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of the SQL sent to the database by the DAL (including db.executesql).
+When enabled (set sql_profile = 1 in the [general] section of appconfig.ini), each
+request gets an SQLProfiler attached to its db adapter, which records the normalized
+text, duration and row count of every statement. Statements slower than a threshold
+are appended to a rotating log file, and totals for each controller/function are kept
+in memory for this process, to be shown on the dev/SQL_PROFILE page.
+
+The profiler is added as a pydal execution handler, so when profiling is disabled
+nothing is added to the adapter, and there is no overhead at all.
+"""
+import logging
+import logging.handlers
+import re
+import threading
+import time
+
+from pydal.helpers.classes import ExecutionHandler
+
+max_statement_chars = 2000
+max_stats_entries = 5000
+
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number_literal = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_value_list = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_whitespace = re.compile(r"\s+")
+
+def normalize_sql(command):
+    """
+    Replace the literal values in an SQL statement by ?, so that statements which only
+    differ in the values used can be grouped together. Lists of values, as in
+    IN (1,2,3) or multi-row INSERTs, are collapsed to (...)
+    """
+    sql = _string_literal.sub("?", command)
+    sql = _number_literal.sub("?", sql)
+    sql = _value_list.sub("(...)", sql)
+    sql = _whitespace.sub(" ", sql).strip()
+    return sql[:max_statement_chars]
+
+
+class SQLProfiler(object):
+    """
+    Records the SQL statements executed on a db during one request. `label` is used to
+    group the statements in the per-process totals (e.g. "default/sponsor_leaf").
+    """
+    def __init__(self, label, slow_secs=None, slow_log=None):
+        self.label = label
+        self.slow_secs = slow_secs
+        self.slow_log = slow_log
+        self.statements = [] # (normalized sql, seconds, rowcount or None)
+        profiler = self
+        class Handler(ExecutionHandler):
+            def before_execute(self, command):
+                self.start = time.perf_counter()
+
+            def after_execute(self, command):
+                profiler.record(command, time.perf_counter() - self.start, self.adapter.cursor.rowcount)
+        self.handler = Handler
+
+    def attach(self, db):
+        db._adapter.execution_handlers.append(self.handler)
+        return self
+
+    def detach(self, db):
+        if self.handler in db._adapter.execution_handlers:
+            db._adapter.execution_handlers.remove(self.handler)
+
+    def record(self, command, secs, rowcount):
+        sql = normalize_sql(command)
+        if rowcount is not None and rowcount < 0:
+            # e.g. SELECTs on sqlite, where the count is only known once fetched
+            rowcount = None
+        self.statements.append((sql, secs, rowcount))
+        add_to_stats(self.label, sql, secs, rowcount)
+        if self.slow_log is not None and self.slow_secs is not None and secs >= self.slow_secs:
+            self.slow_log.warning("%.1fms\t%s\t%s\t%s", secs*1000, self.label,
+                "" if rowcount is None else rowcount, command[:max_statement_chars].replace("\n", " "))
+
+    def total_secs(self):
+        return sum(s[1] for s in self.statements)
+
+
+_stats = {} # (label, normalized sql) => [count, total secs, max secs, total rows]
+_stats_lock = threading.Lock()
+
+def add_to_stats(label, sql, secs, rowcount):
+    key = (label, sql)
+    with _stats_lock:
+        entry = _stats.get(key)
+        if entry is None:
+            if len(_stats) >= max_stats_entries:
+                return
+            entry = _stats[key] = [0, 0.0, 0.0, 0]
+        entry[0] += 1
+        entry[1] += secs
+        entry[2] = max(entry[2], secs)
+        entry[3] += rowcount or 0
+
+def top_statements(n=20):
+    """
+    Return {label: [(sql, count, total secs, max secs, total rows), ...]}, with the n
+    statements taking the most total time for each label, labels ordered by total time
+    """
+    with _stats_lock:
+        items = [(k[0], k[1]) + tuple(v) for k, v in _stats.items()]
+    by_label = {}
+    for item in items:
+        by_label.setdefault(item[0], []).append(item[1:])
+    totals = {label: sum(s[2] for s in stmts) for label, stmts in by_label.items()}
+    return {
+        label: sorted(by_label[label], key=lambda s: s[2], reverse=True)[:n]
+        for label in sorted(by_label, key=totals.get, reverse=True)}
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+_slow_logs = {}
+_slow_logs_lock = threading.Lock()
+
+def slow_query_log(path, max_bytes=10*1024*1024, backup_count=3):
+    """A logger appending to a rotating file at `path`, shared by all requests in this process"""
+    with _slow_logs_lock:
+        if path not in _slow_logs:
+            logger = logging.getLogger("OZ.slow_sql." + path)
+            logger.propagate = False
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(asctime)s\t%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.WARNING)
+            _slow_logs[path] = logger
+        return _slow_logs[path]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time the generation of the cut position maps in make_js_treefiles.py on large random
+binary trees (in brief newick format), optionally comparing against the original
+quadratic-time implementations kept in tests/unit/test_make_js_treefiles.py, e.g.
+
+    tests/benchmarking/cut_position_maps.py --leaves 100000 1000000 --compare
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(script_path, "..", ".."))
+sys.path.insert(0, os.path.join(script_path, "..", "..", "OZprivate", "ServerScripts", "Utilities"))
+import make_js_treefiles
+
+def random_brief_newick(rnd, n_leaves, poly_prob=0.3):
+    """As in test_make_js_treefiles.py, but without recursion, so it works on huge trees"""
+    out = []
+    stack = [(n_leaves, True)]
+    while stack:
+        n, root = stack.pop()
+        if isinstance(n, str):
+            out.append(n)
+        elif n > 1:
+            k = rnd.randint(1, n - 1)
+            curly = not root and rnd.random() < poly_prob
+            out.append("{" if curly else "(")
+            stack.extend([("}" if curly else ")", False), (n - k, False), (k, False)])
+    return "".join(out)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--leaves', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--threshold', type=int, default=10000)
+    parser.add_argument('--compare', action='store_true',
+        help="Also time the original implementations (slow on large trees), checking the output is identical")
+    args = parser.parse_args()
+    if args.compare:
+        from tests.unit import test_make_js_treefiles as old
+
+    rnd = random.Random(1)
+    for n in args.leaves:
+        newick_str = random_brief_newick(rnd, n)
+        # small thresholds on these trees give a similar number of cuts to the real tree
+        threshold = min(args.threshold, max(1, len(newick_str) // 400))
+        new, t_new = timed(make_js_treefiles.generate_cut_position_map, newick_str, threshold)
+        print("{:>9} chars: {:8.2f}s".format(len(newick_str), t_new), end="")
+        if args.compare:
+            old_binary, t_binary = timed(old.old_generate_binary_cut_position_map, newick_str, threshold)
+            old_poly, t_poly = timed(old.old_generate_polytomy_cut_position_map, newick_str, threshold)
+            assert new.split("\n\n")[:2] == [old_binary, old_poly], "Output differs from the original"
+            print(" (original: {:8.2f}s)".format(t_binary + t_poly), end="")
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the time taken to find the images for a page of sponsored leaf cards (as on the
+sponsored page) using the original query per sponsor-chosen image, using
+leaf_card_images() in modules/sponsorship.py (one query per table), and when the rendered
+cards are already cached, so that only a dictionary lookup is needed per card, e.g.
+
+    tests/benchmarking/leaf_cards.py --cards 1000
+
+The images and reservations are held in a temporary sqlite database (the default
+fixture has 1000 cards, half with an image chosen by the sponsor), so no web2py server
+is needed. Cards are "rendered" with a simple format string.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+from pydal import DAL, Field
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(script_path, "..", ".."))
+sys.path.insert(0, os.path.join(script_path, "..", "..", "modules"))
+from sponsorship import leaf_card_images
+from tests.unit.test_leaf_cards import old_leaf_card_images
+
+card_template = '<figure><img src="{}/{}.jpg" title="{}" /></figure>'
+
+def make_fixture(db, n_cards, n_leaves):
+    db.define_table('images_by_ott',
+        Field('ott', type='integer'),
+        Field('src', type='integer'),
+        Field('src_id', type='integer'),
+        Field('rights', type='text'),
+        Field('licence', type='text'),
+        Field('overall_best_any', type='boolean'))
+    db.define_table('reservations',
+        Field('OTT_ID', type='integer', unique=True),
+        Field('user_nondefault_image', type='integer'),
+        Field('verified_preferred_image_src', type='integer'),
+        Field('verified_preferred_image_src_id', type='integer'))
+    db.executesql("CREATE INDEX ott_index ON images_by_ott (ott);")
+    db.executesql("CREATE INDEX src_index ON images_by_ott (src, src_id);")
+    rnd = random.Random(1)
+    src_id = 0
+    for ott in range(1, n_leaves + 1):
+        for i in range(3):
+            src_id += 1
+            db.images_by_ott.insert(ott=ott, src=rnd.choice([1, 2]), src_id=src_id,
+                rights="Owner", licence="CC0", overall_best_any=(i == 0))
+    for ott in rnd.sample(range(1, n_leaves + 1), n_cards):
+        if rnd.random() < 0.5:
+            row = db(db.images_by_ott.ott == ott).select(limitby=(0, 1), orderby=~db.images_by_ott.id).first()
+            db.reservations.insert(OTT_ID=ott, user_nondefault_image=1,
+                verified_preferred_image_src=row.src, verified_preferred_image_src_id=row.src_id)
+        else:
+            db.reservations.insert(OTT_ID=ott, user_nondefault_image=0)
+    db.commit()
+
+def render(rows, default_images, image_for):
+    cards = {}
+    for r in rows:
+        img = image_for(r) or default_images.get(r.OTT_ID)
+        cards[r.OTT_ID] = card_template.format(img.src, img.src_id, img.rights)
+    return cards
+
+def before(db, rows):
+    default_images, user_images = old_leaf_card_images(db, rows)
+    return render(rows, default_images, lambda r: user_images.get(r.OTT_ID))
+
+def after(db, rows):
+    default_images, chosen_images = leaf_card_images(db, [r.OTT_ID for r in rows],
+        [(r.verified_preferred_image_src, r.verified_preferred_image_src_id) for r in rows if r.user_nondefault_image])
+    return render(rows, default_images, lambda r: chosen_images.get(
+        (r.verified_preferred_image_src, r.verified_preferred_image_src_id)) if r.user_nondefault_image else None)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cards', type=int, default=1000, help="Number of cards on the page")
+    parser.add_argument('--leaves', type=int, default=20000, help="Number of leaves with images")
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp()
+    try:
+        db = DAL('sqlite://leaf_cards.sqlite', folder=folder)
+        make_fixture(db, args.cards, args.leaves)
+        rows = db().select(db.reservations.ALL)
+        cached = after(db, rows)
+        assert before(db, rows) == cached, "Different cards from the batched queries"
+        timings = (
+            ("per card", lambda: before(db, rows)),
+            ("batched", lambda: after(db, rows)),
+            ("cached", lambda: {r.OTT_ID: cached[r.OTT_ID] for r in rows}),
+        )
+        print("{} cards:".format(len(rows)))
+        for label, func in timings:
+            best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+            print("  {:10} {:8.2f} ms".format(label, best * 1000))
+        db.close()
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the per-request cost of reading the app configuration and the
+price bands in the models, as done before and after caching them across requests.
+
+Before: appconfig.ini was re-parsed on every request when is_testing was set
+(AppConfig(reload=True)), and the prices table was queried each time it was needed.
+After: the config is only re-parsed when the file's mtime changes (modules/mtime_cache.py),
+and the price bands are held in cache.ram.
+
+Run directly, e.g.
+
+    tests/benchmarking/model_overhead.py private/appconfig.ini.example
+
+The config is parsed with configparser, which is what web2py's AppConfig uses for .ini
+files, and the prices table is a temporary sqlite table, so no web2py server is needed.
+"""
+import argparse
+import configparser
+import os
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(script_path, "..", "..", "modules"))
+from mtime_cache import load_if_changed
+
+def parse_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return {s: dict(config.items(s)) for s in config.sections()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('appconfig', nargs='?',
+        default=os.path.join(script_path, "..", "..", "private", "appconfig.ini.example"))
+    parser.add_argument('-n', '--number', type=int, default=10000, help="Number of simulated requests")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        conn = sqlite3.connect(os.path.join(folder, "prices.sqlite"))
+        conn.execute("CREATE TABLE prices (id INTEGER PRIMARY KEY, price INTEGER, perpetuity_price INTEGER, current_cutoff DOUBLE, n_leaves INTEGER);")
+        conn.executemany("INSERT INTO prices (price, current_cutoff, n_leaves) VALUES (?,?,?);",
+            [(p, 0.1*i, 1000*i) for i, p in enumerate([500, 1000, 2000, 5000, 10000, 15000])])
+        conn.commit()
+        price_cache = {}
+
+        def before():
+            parse_config(args.appconfig)
+            sorted([r[0] for r in conn.execute("SELECT price FROM prices;")])
+
+        def after():
+            load_if_changed(args.appconfig, parse_config)
+            if 'price_bands' not in price_cache:
+                price_cache['price_bands'] = conn.execute("SELECT * FROM prices ORDER BY price;").fetchall()
+            [r[1] for r in price_cache['price_bands']]
+
+        for name, func in (("before", before), ("after", after)):
+            secs = timeit.timeit(func, number=args.number)
+            print("{:>7}: {:8.1f} µs per request".format(name, secs / args.number * 1e6))
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time leave_only() from prune_trees_from_dict.py on large random trees, keeping a random
+selection of tips, optionally comparing against the original version kept in
+tests/unit/test_prune_trees.py (which is quadratic in the number of taxa), e.g.
+
+    tests/benchmarking/prune_trees.py --tips 1000000 --keep 1000
+    tests/benchmarking/prune_trees.py --tips 10000 100000 --compare
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from dendropy import Tree
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(script_path, "..", ".."))
+sys.path.insert(0, os.path.join(script_path, "..", "..", "OZprivate", "ServerScripts", "TreeBuild"))
+import prune_trees_from_dict
+
+def random_newick(rnd, n_tips, max_children=4):
+    """A random tree with named tips and internal nodes, made without recursion so it works on huge trees"""
+    out = []
+    labels = iter(range(1, 10 * n_tips))
+    stack = [n_tips]
+    while stack:
+        n = stack.pop()
+        if isinstance(n, str):
+            out.append(n)
+        elif n == 1:
+            out.append("Taxon_ott{}".format(next(labels)))
+        else:
+            k = rnd.randint(2, min(n, max_children))
+            cuts = sorted(rnd.sample(range(1, n), k - 1))
+            sizes = [b - a for a, b in zip([0] + cuts, cuts + [n])]
+            out.append("(")
+            stack.append(")Node_ott{}".format(next(labels)))
+            for s in reversed(sizes[1:]):
+                stack.extend([s, ","])
+            stack.append(sizes[0])
+    return "".join(out) + ";"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tips', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--keep', type=int, default=1000, help="The number of tips to keep")
+    parser.add_argument('--compare', action='store_true',
+        help="Also time the original implementation (very slow on large trees), checking the output is identical")
+    args = parser.parse_args()
+    if args.compare:
+        from tests.unit import test_prune_trees as old
+
+    rnd = random.Random(1)
+    for n in args.tips:
+        newick = random_newick(rnd, n)
+        labels = [t for t in newick.replace("(", ",").replace(")", ",").split(",") if t.startswith("Taxon")]
+        keep = {label: 0 for label in rnd.sample(labels, min(args.keep, len(labels)))}
+        versions = [("new", lambda tree, keep: tree.leave_only(keep))]
+        if args.compare:
+            versions.append(("old", old.old_leave_only))
+        results = []
+        for version, leave_only in versions:
+            start = time.perf_counter()
+            tree = Tree.get(data=newick, schema="newick", preserve_underscores=True, rooting='default-rooted')
+            loaded = time.perf_counter()
+            kept = dict(keep)
+            leave_only(tree, kept)
+            done = time.perf_counter()
+            results.append((tree.as_string(schema="newick", unquoted_underscores=True, suppress_rooting=True), kept))
+            print("{:>9} tips, keeping {}: read tree {:.2f}s, leave_only ({}) {:.2f}s".format(
+                n, len(keep), loaded - start, version, done - loaded))
+        assert all(r == results[0] for r in results), "Different results from the two versions"
+
+if __name__ == '__main__':
+    main()
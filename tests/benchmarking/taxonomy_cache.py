@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the time and peak memory (max RSS) taken to read the source ids and the
+list of species from a synthetic OpenTree taxonomy.tsv file, by parsing the file and by
+using the cache in taxonomy_cache.py (both when first creating it, and when reusing it), e.g.
+
+    tests/benchmarking/taxonomy_cache.py --rows 1000000
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import subprocess
+import time
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(script_path, "..", ".."))
+sys.path.insert(0, os.path.join(script_path, "..", "..", "OZprivate", "ServerScripts", "TaxonMappingAndPopularity"))
+from OTT_popularity_mapping import create_from_taxonomy
+from CSV_base_table_creator import get_OTT_species
+from taxonomy_cache import TaxonomyCache
+from tests.unit.test_taxonomy_cache import synthetic_taxonomy, sources
+
+def measure(filename, cache_dir):
+    """Read the taxonomy in a new process, so that its peak memory use can be measured"""
+    output = subprocess.check_output(
+        [sys.executable, __file__, "--single", filename] + (["--cache_dir", cache_dir] if cache_dir else []),
+        stderr=subprocess.DEVNULL)
+    return json.loads(output.decode().strip().split("\n")[-1])
+
+def read_taxonomy(filename, cache_dir):
+    with open(filename, encoding="utf-8") as f:
+        cache = TaxonomyCache.for_file(f, cache_dir) if cache_dir else None
+        OTT_ptrs = {}
+        create_from_taxonomy(f, sources, OTT_ptrs, 0, None, cache)
+        return len(OTT_ptrs), len(get_OTT_species(f, cache))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    parser.add_argument('--cache_dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.single:
+        from OTT_popularity_mapping import memory_usage_resource
+        start = time.perf_counter()
+        result = read_taxonomy(args.single, args.cache_dir)
+        print(json.dumps([result, time.perf_counter() - start, memory_usage_resource()]))
+        return
+    folder = tempfile.mkdtemp()
+    try:
+        for n in args.rows:
+            filename = os.path.join(folder, "taxonomy{}.tsv".format(n))
+            with open(filename, "w", encoding="utf-8") as f:
+                f.write(synthetic_taxonomy(random.Random(1), n))
+            cache_dir = os.path.join(folder, "cache")
+            print("{:>9} rows:".format(n))
+            results = []
+            for label, directory in (("parse", None), ("build cache", cache_dir), ("use cache", cache_dir)):
+                result, elapsed, peak = measure(filename, directory)
+                results.append(result)
+                print("  {:12} {:8.2f}s {:8.1f} MB max RSS".format(label, elapsed, peak))
+            assert results[0] == results[1] == results[2], "Different results when using the cache"
+            shutil.rmtree(cache_dir)
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
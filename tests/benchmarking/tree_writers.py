@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time the iterative brief newick, popularity newick and csv writers in dendropy_extras.py
+on large random binary trees, against the original recursive versions kept in
+tests/unit/test_dendropy_writers.py, checking that the output is identical, e.g.
+
+    tests/benchmarking/tree_writers.py --leaves 100000 1000000
+"""
+import argparse
+import filecmp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from dendropy import Tree, Node
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(script_path, "..", ".."))
+sys.path.insert(0, os.path.join(script_path, "..", "..", "OZprivate", "ServerScripts", "TaxonMappingAndPopularity"))
+import dendropy_extras
+from tests.unit import test_dendropy_writers as old
+
+def random_binary_tree(rnd, n_leaves):
+    """A random binary tree, built without recursion so it works on huge trees"""
+    tree = Tree()
+    stack = [(tree.seed_node, n_leaves)]
+    while stack:
+        node, n = stack.pop()
+        if n > 1:
+            k = rnd.randint(1, n - 1)
+            stack.append((node.add_child(Node()), k))
+            stack.append((node.add_child(Node()), n - k))
+    return tree
+
+def timed_to_file(filename, func):
+    with open(filename, "w", encoding="utf-8") as out:
+        start = time.process_time()
+        func(out)
+        return time.process_time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--leaves', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeats', type=int, default=3, help="Report the fastest of this many runs")
+    args = parser.parse_args()
+    sys.setrecursionlimit(100000)  # for the original recursive versions
+
+    rnd = random.Random(1)
+    folder = tempfile.mkdtemp()
+    try:
+        for n in args.leaves:
+            tree = old.decorate(rnd, random_binary_tree(rnd, n))
+            print("{:>9} leaves:".format(n))
+            writers = [
+                ("brief newick",
+                    lambda out: old.old_write_brief_newick(tree.seed_node, out, "{}"),
+                    lambda out: dendropy_extras.write_brief_newick(tree.seed_node, out, "{}")),
+                ("pop newick",
+                    lambda out: old.old_write_pop_newick(tree.seed_node, out),
+                    lambda out: dendropy_extras.write_pop_newick(tree.seed_node, out)),
+            ]
+            for label, old_writer, new_writer in writers:
+                for version, writer in (("old", old_writer), ("new", new_writer)):
+                    elapsed = min(timed_to_file(os.path.join(folder, label + version), writer) for i in range(args.repeats))
+                    print("  {:14} {}: {:8.2f}s".format(label, version, elapsed))
+                assert filecmp.cmp(os.path.join(folder, label + "old"), os.path.join(folder, label + "new"), shallow=False)
+
+            for version, writer in (("old", old.old_write_preorder_to_csv), ("new", dendropy_extras.write_preorder_to_csv)):
+                leaves, nodes = (os.path.join(folder, name + version) for name in ("leaves", "nodes"))
+                times = []
+                for i in range(args.repeats):
+                    with open(leaves, "w", encoding="utf-8") as l, open(nodes, "w", encoding="utf-8") as n:
+                        start = time.process_time()
+                        writer(tree, l, old.leaf_extras, n, old.node_extras, -1)
+                        times.append(time.process_time() - start)
+                print("  {:14} {}: {:8.2f}s".format("csv", version, min(times)))
+            for name in ("leaves", "nodes"):
+                assert filecmp.cmp(os.path.join(folder, name + "old"), os.path.join(folder, name + "new"), shallow=False)
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
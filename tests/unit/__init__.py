@@ -0,0 +1,139 @@
+"""
+Unit tests that run without a web2py server, against a temporary SQLite database
+(using pydal, the web2py database layer) or on the offline tree-building scripts.
+
+    nosetests -vs tests/unit
+
+The modules tested here (e.g. modules/sponsorship.py, modules/email_outbox.py) must not
+import gluon, so that they can be used with a plain pydal DAL, outside web2py.
+"""
+import os.path
+import shutil
+import sys
+import tempfile
+
+web2py_app_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..'))
+modules_dir = os.path.join(web2py_app_dir, 'modules')
+if modules_dir not in sys.path:
+    sys.path.insert(0, modules_dir)
+
+
+def define_sponsorship_tables(db):
+    """
+    The parts of the tables in models/db.py used by modules/sponsorship.py, with the same
+    field types (SQLite has no TINYINT, so the custom boolean type is a plain boolean)
+    """
+    from pydal import Field
+    db.define_table('ordered_leaves',
+        Field('name', type='string', length=190),
+        Field('ott', type='integer'),
+        Field('popularity', type='double'),
+        Field('price', type='integer'))
+    db.define_table('images_by_ott',
+        Field('ott', type='integer'),
+        Field('src', type='integer'),
+        Field('src_id', type='integer'),
+        Field('rating', type='integer'),
+        Field('rights', type='text'),
+        Field('licence', type='string', length=190),
+        Field('overall_best_any', type='boolean'))
+    db.define_table('reservations',
+        Field('OTT_ID', type='integer', unique=True),
+        Field('name', type='text'),
+        Field('num_views', type='integer'),
+        Field('last_view', type='datetime'),
+        Field('reserve_time', type='datetime'),
+        Field('user_registration_id', type='text'),
+        Field('e_mail', type='string', length=200),
+        Field('user_sponsor_kind', type='string', length=4),
+        Field('user_sponsor_name', type='string', length=40),
+        Field('user_more_info', type='string', length=40),
+        Field('user_nondefault_image', type='integer'),
+        Field('user_updated_time', type='datetime'),
+        Field('user_paid', type='double'),
+        Field('user_giftaid', type='boolean'),
+        Field('PP_transaction_code', type='text'),
+        Field('PP_e_mail', type='string', length=200),
+        Field('PP_first_name', type='text'),
+        Field('PP_second_name', type='text'),
+        Field('PP_town', type='text'),
+        Field('PP_country', type='text'),
+        Field('PP_house_and_street', type='text'),
+        Field('PP_postcode', type='text'),
+        Field('sale_time', type='text'),
+        Field('verified_kind', type='string', length=4),
+        Field('verified_name', type='string', length=40),
+        Field('verified_more_info', type='string', length=40),
+        Field('verified_preferred_image_src', type='integer'),
+        Field('verified_preferred_image_src_id', type='integer'),
+        Field('verified_time', type='datetime'),
+        Field('verified_paid', type='text'),
+        Field('verified_url', type='text'),
+        Field('emailed_re_renewal_initial', type='datetime'),
+        Field('emailed_re_renewal_final', type='datetime'),
+        Field('sponsorship_duration_days', type='integer'),
+        Field('sponsorship_ends', type='datetime'),
+        Field('deactivated', type='text'))
+    db.define_table('expired_reservations',
+        Field('OTT_ID', type='integer', unique=False),
+        Field('was_renewed', type='boolean'),
+        *[f.clone() for f in db.reservations if f.name != 'OTT_ID' and f.name != 'id'])
+    db.define_table('paypal_notifications',
+        Field('txn_id', type='string', length=64, notnull=True, unique=True),
+        Field('OTT_ID', type='integer', notnull=True),
+        Field('pp_vars', type='text'),
+        Field('received_time', type='datetime'),
+        Field('processed_time', type='datetime'),
+        Field('process_error', type='text'),
+        Field('attempts', type='integer', default=0),
+        Field('next_attempt_time', type='datetime'))
+    db.define_table('banned',
+        Field('ott', type='integer'),
+        Field('cname', type='string', length=190))
+    db.define_table('prices',
+        Field('price', type='integer', unique=True),
+        Field('perpetuity_price', type='integer'),
+        Field('current_cutoff', type='double'),
+        Field('n_leaves', type='integer'))
+    db.define_table('recent_sponsorships',
+        Field('OTT_ID', type='integer', unique=True, notnull=True),
+        Field('name', type='string', length=190),
+        *[db.reservations[f].clone() for f in ('reserve_time', 'verified_time',
+            'verified_kind', 'verified_name', 'verified_more_info', 'user_nondefault_image',
+            'verified_preferred_image_src', 'verified_preferred_image_src_id')] + [
+        Field('src', type='integer'),
+        Field('src_id', type='integer'),
+        Field('rights', type='text'),
+        Field('licence', type='string', length=190),
+        Field('updated_time', type='datetime')])
+    db.define_table('sponsor_search_tokens',
+        Field('OTT_ID', type='integer', notnull=True),
+        Field('token', type='string', length=40, notnull=True),
+        Field('verified', type='boolean'),
+        Field('expires', type='datetime'))
+    return db
+
+
+class SponsorshipDB(object):
+    """
+    A base for test classes of modules/sponsorship.py, which creates the tables from
+    define_sponsorship_tables() in a new SQLite database, self.db, for each class.
+    Classes that add test data override setup_class, calling super().setup_class() first.
+    """
+    @classmethod
+    def setup_class(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = self.connect()
+        self.db.commit()
+
+    @classmethod
+    def teardown_class(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    @classmethod
+    def connect(self):
+        """Another connection to the database, e.g. for a second worker"""
+        from pydal import DAL
+        return define_sponsorship_tables(DAL('sqlite://sponsorship.sqlite', folder=self.folder,
+            migrate_enabled=True, driver_args=dict(timeout=60)))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that no function in the controllers assigns to the name of a function defined in
+the models (e.g. `price_levels_pence = price_levels_pence()`). Python then treats the
+name as local throughout the controller function, so calling the model function raises
+UnboundLocalError on every request.
+"""
+import ast
+import glob
+import os
+
+from . import web2py_app_dir
+
+
+def model_functions():
+    names = set()
+    for path in glob.glob(os.path.join(web2py_app_dir, 'models', '*.py')):
+        with open(path, encoding="utf-8") as f:
+            tree = ast.parse(f.read(), path)
+        names.update(node.name for node in tree.body if isinstance(node, ast.FunctionDef))
+    return names
+
+
+def shadowed_calls(function, names):
+    """The model function names that are both assigned and called in this function"""
+    assigned, called = set(), set()
+    for node in ast.walk(function):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            assigned.add(node.id)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            called.add(node.func.id)
+    return assigned & called & names
+
+
+class TestControllerGlobals(object):
+    def test_no_shadowed_model_functions(self):
+        names = model_functions()
+        assert 'price_levels_pence' in names
+        problems = []
+        for path in glob.glob(os.path.join(web2py_app_dir, 'controllers', '*.py')):
+            with open(path, encoding="utf-8") as f:
+                tree = ast.parse(f.read(), path)
+            for node in tree.body:
+                if isinstance(node, ast.FunctionDef):
+                    for name in shadowed_calls(node, names):
+                        problems.append("{}:{} {}()".format(os.path.basename(path), node.lineno, node.name))
+        assert problems == []
+
+    def test_detects_shadowing(self):
+        tree = ast.parse("def FAQ():\n    price_levels_pence = price_levels_pence()\n    return price_levels_pence[1]\n")
+        assert shadowed_calls(tree.body[0], {'price_levels_pence'}) == {'price_levels_pence'}
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the iterative tree writers in dendropy_extras.py give byte-identical output
+to the original recursive versions (copied below), and that they can write trees which
+are too deep for the recursive versions
+"""
+import io
+import os
+import random
+import sys
+from collections import OrderedDict
+
+from dendropy import Tree, Node
+
+from . import web2py_app_dir
+from .test_tree_arrays import random_newick, read_tree
+
+popularity_dir = os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'TaxonMappingAndPopularity')
+if popularity_dir not in sys.path:
+    sys.path.insert(0, popularity_dir)
+import dendropy_extras
+
+
+def old_write_brief_newick(self, out, polytomy_braces="()", write_otts=False):
+    """The original recursive version of dendropy_extras.write_brief_newick"""
+    child_nodes = self.child_nodes()
+    if child_nodes:
+        if self.edge and self.edge.length==0: #if 0, this is a polytomy
+            out.write(polytomy_braces[0]) #added
+        else:
+            out.write('(')
+        assert(len(child_nodes)==2) #added
+        f_child = child_nodes[0]
+        for child in child_nodes:
+            if child is not f_child:
+                out.write(',')
+            old_write_brief_newick(child, out, polytomy_braces)
+        if self.edge and self.edge.length==0:
+            out.write(polytomy_braces[1]) #added
+            if write_otts and 'ott' in self.data:
+                out.write(str(self.data['ott']))
+        else:
+            out.write(')')
+            if write_otts and 'ott' in self.data:
+                out.write(str(self.data['ott']))
+
+
+def old_write_pop_newick(self, out):
+    """
+    The original recursive version of dendropy_extras.write_pop_newick, with the
+    undefined `sel` set to the pop_store attribute, as described in the docstring
+    """
+    child_nodes = self.child_nodes()
+    if child_nodes:
+        out.write('(')
+        f_child = child_nodes[0]
+        for child in child_nodes:
+            if child is not f_child:
+                out.write(',')
+            old_write_pop_newick(child, out)
+        out.write(')')
+    label = self._get_node_token(
+            suppress_leaf_node_labels=False,
+            suppress_rooting=True,
+            unquoted_underscores = True)
+    try:
+        ott = self.data['ott']
+        if label.endswith('\''):
+            out.write(label[:-1] + '_ott{}\''.format(ott))
+        else:
+            out.write(label + '_ott{}'.format(ott))
+    except (AttributeError, KeyError):
+        out.write(label)
+    sel = getattr(self, 'pop_store', None)
+    if sel is not None:
+        s = ""
+        try:
+            s = float(sel)
+            s = str(s)
+        except ValueError:
+            s = str(sel)
+        if s:
+            out.write(":%s" % s)
+
+
+def old_write_preorder_to_csv(self, leaf_file, extra_leaf_data_properties, node_file, extra_node_data_properties, root_parent_id):
+    """The original version of dendropy_extras.write_preorder_to_csv"""
+    import csv
+    leaf_csv = csv.writer(leaf_file, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+    leaf_csv.writerow(['parent','real_parent','name', 'extinction_date'] + list(extra_leaf_data_properties.keys()))
+    node_csv = csv.writer(node_file, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+    node_csv.writerow(['parent','real_parent','node_rgt','leaf_lft','leaf_rgt','name', 'age'] + list(extra_node_data_properties.keys()))
+    internal_node_number = 0
+    for node in self.preorder_internal_node_iter():
+        internal_node_number += 1
+        node.id = internal_node_number
+    internal_leaf_count = 0
+    prev_node = None
+    for node in self.postorder_node_iter():
+        if node.is_leaf():
+            internal_leaf_count += 1
+        else:
+            node.last_leaf = internal_leaf_count
+            if prev_node.is_leaf():
+                node.node_rgt = node.id
+            else:
+                node.node_rgt = prev_node.node_rgt
+        prev_node = node
+    leaf_count = 1
+    extra_leaf_output = OrderedDict()
+    extra_node_output = OrderedDict()
+    for node in self.preorder_node_iter():
+        if node.is_leaf():
+            base_output = [node.parent_node.id,
+                           -node.real_parent_node.id if node.edge.length==0 else node.real_parent_node.id,
+                           node.label,
+                           getattr(node, 'extinction_date', None)]
+            for colname, keys in extra_leaf_data_properties.items():
+                try:
+                    extra_leaf_output[colname] = node.data
+                    for k in keys:
+                        extra_leaf_output[colname] = extra_leaf_output[colname][k]
+                except (KeyError, TypeError, AttributeError):
+                    extra_leaf_output[colname] = None
+            leaf_csv.writerow(base_output + list(extra_leaf_output.values()))
+            leaf_count += 1
+        else:
+            base_output = [node.parent_node.id if node.parent_node else root_parent_id,
+                           (-node.real_parent_node.id if node.edge.length==0 else node.real_parent_node.id) if hasattr(node,'real_parent_node') else 0,
+                           node.node_rgt,
+                           leaf_count,
+                           node.last_leaf,
+                           node.label,
+                           getattr(node, 'age', None)]
+            for colname, keys in extra_node_data_properties.items():
+                try:
+                    extra_node_output[colname] = node.data
+                    for k in keys:
+                        extra_node_output[colname] = extra_node_output[colname][k]
+                except (KeyError, TypeError, AttributeError):
+                    extra_node_output[colname] = None
+            node_csv.writerow(base_output + list(extra_node_output.values()))
+
+
+leaf_extras = OrderedDict([('ott', ['ott']), ('wikidata', ['wd', 'final_wiki_item', 'Q']),
+    ('popularity', ['popularity']), ('price', None), ('ncbi', ['sources', 'ncbi', 'id'])])
+node_extras = OrderedDict([('ott', ['ott']), ('wikidata', ['wd', 'final_wiki_item', 'Q']),
+    ('vern_synth', None), ('rep1', None)])
+
+
+def decorate(rnd, tree):
+    """
+    Add the sort of edge lengths, labels, data and attributes that the writers expect
+    after the tree building steps in CSV_base_table_creator.py
+    """
+    labels = ["Homo sapiens", "Homo_sapiens", "Homo sapiens_x", "Rosa 'Peace'_x", "", None, "Taxon,1"]
+    for i, node in enumerate(tree.preorder_node_iter()):
+        if node.parent_node is not None:
+            node.edge.length = rnd.choice([0, 0, 1.5, None])
+        if rnd.random() < 0.9:
+            node.label = rnd.choice(labels)
+        if rnd.random() < 0.8:
+            node.data = rnd.choice([
+                {'ott': i},
+                {'ott': i, 'popularity': rnd.random() * 100, 'wd': {'final_wiki_item': {'Q': 1000 + i}}},
+                {'ott': i, 'sources': {'ncbi': {'id': str(i * 7)}, 'gbif': None}},
+                {'sources': {'ncbi': None}},
+            ])
+        if rnd.random() < 0.7:
+            node.pop_store = rnd.choice([0, 1, rnd.random() * 1e6, 1e-20, "12"])
+        if rnd.random() < 0.3:
+            node.age = rnd.choice([0, 12.5, 100])
+        if rnd.random() < 0.1:
+            node.extinction_date = 66.0
+    dendropy_extras.set_real_parent_nodes(tree)
+    tree.ladderize(ascending=True)
+    return tree
+
+
+def caterpillar(depth):
+    """A ladderized binary tree with `depth` internal nodes, each with a leaf as its first child"""
+    tree = Tree()
+    node = tree.seed_node
+    node.data = {'ott': 0}
+    for i in range(depth):
+        node.add_child(Node(label="Leaf_{}".format(i)))
+        if i == depth - 1:
+            node.add_child(Node(label="Leaf_{}".format(depth)))
+        else:
+            node = node.add_child(Node(label="Node_{}".format(i + 1)))
+            node.edge.length = i % 2
+    return tree
+
+
+def output(writer, *args):
+    out = io.StringIO()
+    writer(out, *args)
+    return out.getvalue()
+
+
+def csv_output(writer, tree, chunk=None):
+    leaves, nodes = io.StringIO(), io.StringIO()
+    if chunk is None:
+        writer(tree, leaves, leaf_extras, nodes, node_extras, -12)
+    else:
+        writer(tree, leaves, leaf_extras, nodes, node_extras, -12, chunk)
+    return leaves.getvalue(), nodes.getvalue()
+
+
+class TestDendropyWriters(object):
+    def test_brief_newick(self):
+        rnd = random.Random(37)
+        for i in range(30):
+            tree = decorate(rnd, read_tree(random_newick(rnd, rnd.randint(2, 300), 2, 0)))
+            for braces in ("()", "{}"):
+                for write_otts in (False, True):
+                    if write_otts:
+                        tree.seed_node.data = {'ott': 123}
+                    expected = output(lambda out: old_write_brief_newick(tree.seed_node, out, braces, write_otts))
+                    assert output(lambda out: dendropy_extras.write_brief_newick(tree.seed_node, out, braces, write_otts)) == expected
+                    assert output(lambda out: dendropy_extras.write_brief_newick(tree.seed_node, out, braces, write_otts, 2)) == expected
+
+    def test_pop_newick(self):
+        rnd = random.Random(37)
+        for i in range(30):
+            tree = decorate(rnd, read_tree(random_newick(rnd, rnd.randint(1, 300))))
+            expected = output(lambda out: old_write_pop_newick(tree.seed_node, out))
+            assert output(lambda out: dendropy_extras.write_pop_newick(tree.seed_node, out)) == expected
+            assert output(lambda out: dendropy_extras.write_pop_newick(tree.seed_node, out, 2)) == expected
+
+    def test_preorder_to_csv(self):
+        rnd = random.Random(37)
+        for i in range(30):
+            tree = decorate(rnd, read_tree(random_newick(rnd, rnd.randint(2, 300))))
+            expected = csv_output(old_write_preorder_to_csv, tree)
+            assert csv_output(dendropy_extras.write_preorder_to_csv, tree) == expected
+            assert csv_output(dendropy_extras.write_preorder_to_csv, tree, 3) == expected
+
+    def test_deep_caterpillar(self):
+        depth = sys.getrecursionlimit() * 5
+        tree = caterpillar(depth)
+        dendropy_extras.set_real_parent_nodes(tree)
+        try:
+            output(lambda out: old_write_brief_newick(tree.seed_node, out))
+            assert False, "The recursive version should have exceeded the recursion limit"
+        except RecursionError:
+            pass
+        brief = output(lambda out: dendropy_extras.write_brief_newick(tree.seed_node, out))
+        assert brief == "(," * depth + ")" * depth
+        poly = output(lambda out: dendropy_extras.write_brief_newick(tree.seed_node, out, "{}", True))
+        assert poly.count("{") == poly.count("}") == depth // 2 and poly.endswith(")0")
+        pop = output(lambda out: dendropy_extras.write_pop_newick(tree.seed_node, out))
+        assert pop.startswith("(Leaf_0,(Leaf_1,(") and pop.endswith(")Node_1)_ott0")
+        assert csv_output(dendropy_extras.write_preorder_to_csv, tree) == csv_output(old_write_preorder_to_csv, tree)
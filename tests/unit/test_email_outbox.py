@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check the email outbox (modules/email_outbox.py): that duplicate emails are only queued
+once while unsent, and that the worker sends emails in order, in batches, retrying failures with
+increasing delays and then giving up, using a FileTransport in place of an SMTP server
+"""
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from pydal import DAL, Field
+
+from . import modules_dir
+from email_outbox import enqueue_email, send_queued_emails, FileTransport
+from sponsorship import integrity_error
+
+
+def define_tables(db):
+    """The email_outbox table in models/db.py, with its unique index from create_db_indexes.sql"""
+    db.define_table('email_outbox',
+        Field('ott', type='integer'),
+        Field('email_type', type='string', length=20),
+        Field('recipient', type='string', length=200),
+        Field('subject', type='text'),
+        Field('body', type='text'),
+        Field('queued_time', type='datetime'),
+        Field('attempts', type='integer', notnull=True, default=0),
+        Field('next_attempt_time', type='datetime'),
+        Field('sent_time', type='datetime'),
+        Field('pending', type='integer'),
+        Field('last_error', type='text'))
+    db.executesql("CREATE UNIQUE INDEX IF NOT EXISTS email_dedup_index ON email_outbox (ott, email_type, recipient, pending);")
+    return db
+
+
+class TestEmailOutbox(object):
+    @classmethod
+    def setup_class(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = define_tables(DAL('sqlite://outbox.sqlite', folder=self.folder, migrate_enabled=True))
+        self.db.commit()
+
+    @classmethod
+    def teardown_class(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def setup_method(self, method=None):
+        self.db.email_outbox.truncate()
+        self.db.commit()
+        self.transport_dir = tempfile.mkdtemp(dir=self.folder)
+
+    def queue(self, ott, email_type, recipient, now):
+        return enqueue_email(self.db, ott, email_type, recipient,
+            "Subject {} {}".format(ott, email_type), "Dear {}".format(recipient), now)
+
+    def test_dedup_and_order(self):
+        db = self.db
+        now = datetime(2020, 1, 1, 12, 0, 0)
+        assert self.queue(1, 'live', "a@example.com", now)
+        assert self.queue(2, 'live', "b@example.com", now)
+        assert self.queue(1, 'to_verify', "a@example.com", now)
+        assert self.queue(1, 'live', "a@example.com", now) is None
+        assert self.queue(1, 'live', "c@example.com", now)
+        db.commit()
+        transport = FileTransport(self.transport_dir)
+        results = send_queued_emails(db, transport, now, batch_size=2)
+        assert [error for email_id, recipient, error in results] == [None] * 4
+        assert [(e['to'], e['subject']) for e in transport.sent()] == [
+            ("a@example.com", "Subject 1 live"), ("b@example.com", "Subject 2 live"),
+            ("a@example.com", "Subject 1 to_verify"), ("c@example.com", "Subject 1 live")]
+        assert transport.sent()[1]['body'] == "Dear b@example.com"
+        # sent emails are not sent again, but the same email can be queued again once sent
+        assert send_queued_emails(db, transport, now + timedelta(days=1)) == []
+        assert len(transport.sent()) == 4
+        assert db(db.email_outbox.sent_time == now).count() == 4
+        assert self.queue(2, 'live', "b@example.com", now + timedelta(days=1))
+        assert self.queue(2, 'live', "b@example.com", now + timedelta(days=1)) is None
+        db.commit()
+        assert len(send_queued_emails(db, transport, now + timedelta(days=1))) == 1
+        assert db(db.email_outbox.ott == 2).count() == 2
+
+    def test_unique_index(self):
+        db = self.db
+        now = datetime(2020, 1, 1, 12, 0, 0)
+        assert self.queue(3, 'live', "a@example.com", now)
+        db.commit()
+        # as if another connection queued the same email after enqueue_email checked for duplicates
+        try:
+            db.email_outbox.insert(ott=3, email_type='live', recipient="a@example.com", pending=1)
+            assert False, "should have raised IntegrityError"
+        except integrity_error(db):
+            db.rollback()
+        assert db(db.email_outbox).count() == 1
+
+    def test_retry_and_backoff(self):
+        db = self.db
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        self.queue(1, 'live', "down@example.com", start)
+        self.queue(2, 'live', "up@example.com", start)
+        db.commit()
+        broken = FileTransport(self.transport_dir, fail_for=["down@example.com"])
+        tried = []
+        # try every minute for a day, with emails to down@example.com failing
+        for minute in range(24*60):
+            now = start + timedelta(minutes=minute)
+            for email_id, recipient, error in send_queued_emails(db, broken, now, max_attempts=5, backoff_secs=60):
+                tried.append((minute, recipient, error))
+        assert [(m, r) for m, r, e in tried] == [
+            (0, "down@example.com"), (0, "up@example.com"),
+            (1, "down@example.com"), (3, "down@example.com"), (7, "down@example.com"), (15, "down@example.com")]
+        assert [e for m, r, e in tried if r == "down@example.com"] == ["Not sent"] * 4 + [
+            "Gave up after 5 attempts: Not sent"]
+        row = db(db.email_outbox.recipient == "down@example.com").select().first()
+        assert row.attempts == 5 and row.sent_time is None and row.pending is None
+        assert row.last_error == "Gave up after 5 attempts: Not sent"
+        # once it has been fixed, the given-up email is not retried, but can be queued again
+        working = FileTransport(self.transport_dir)
+        now = start + timedelta(days=1)
+        assert send_queued_emails(db, working, now, max_attempts=6) == []
+        new_id = self.queue(1, 'live', "down@example.com", now)
+        assert new_id
+        db.commit()
+        sent = []
+        assert send_queued_emails(db, working, now, on_sent=lambda db, row: sent.append(row.ott)) == [
+            (new_id, "down@example.com", None)]
+        assert sent == [1]
+        assert [e['to'] for e in working.sent()] == ["up@example.com", "down@example.com"]
+
+    def test_exceptions_and_leases(self):
+        db = self.db
+        now = datetime(2020, 1, 1, 12, 0, 0)
+        for i in range(3):
+            self.queue(i, 'live', "{}@example.com".format(i), now)
+        db.commit()
+        transport = FileTransport(self.transport_dir)
+        def flaky(recipient, subject, body):
+            if recipient == "1@example.com":
+                raise IOError("Connection refused")
+            return transport(recipient, subject, body)
+        results = send_queued_emails(db, flaky, now)
+        assert [error for email_id, recipient, error in results] == [None, "Connection refused", None]
+        # a worker that dies after taking a batch leaves the emails leased, so they are not
+        # sent by another worker until the lease runs out
+        self.queue(3, 'live', "3@example.com", now)
+        db.commit()
+        def crash(recipient, subject, body):
+            raise KeyboardInterrupt()
+        try:
+            send_queued_emails(db, crash, now + timedelta(minutes=5))
+        except KeyboardInterrupt:
+            pass
+        assert send_queued_emails(db, transport, now + timedelta(minutes=6)) == []
+        results = send_queued_emails(db, transport, now + timedelta(minutes=16))
+        assert sorted(recipient for email_id, recipient, error in results) == ["1@example.com", "3@example.com"]
+        assert [e['to'] for e in transport.sent()] == ["0@example.com", "2@example.com", "1@example.com", "3@example.com"]
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that buffered eol_inspected logging (modules/eol_inspection.py) ends up with one
+row per taxon holding the latest inspection time, even when many threads are logging
+and flushing the same taxa at once, without losing the other columns of existing rows
+"""
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pydal import DAL, Field
+
+from . import modules_dir
+from eol_inspection import InspectionBuffer, _as_str
+
+
+class TestEolInspection(object):
+    @classmethod
+    def setup_class(self):
+        self.folder = tempfile.mkdtemp()
+        self.uri = 'sqlite://eol_inspected.sqlite'
+        db = self.connect()
+        db.define_table('eol_inspected',
+            Field('ott', type = 'integer'),
+            Field('name', type='string', length=190),
+            Field('eol', type = 'integer'),
+            Field('via', type = 'integer', notnull=True),
+            Field('inspected', type = 'datetime', notnull=True))
+        db.commit()
+        db.close()
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.folder)
+
+    @classmethod
+    def connect(self):
+        return DAL(self.uri, folder=self.folder, migrate_enabled=True, adapter_args=dict(foreign_keys=False))
+
+    def setup_method(self, method=None):
+        db = self.connect()
+        db.executesql("DELETE FROM eol_inspected;")
+        db.commit()
+        db.close()
+
+    def rows(self):
+        db = self.connect()
+        rows = db.executesql("SELECT ott, name, via, inspected FROM eol_inspected;")
+        db.close()
+        return [r[:3] + (_as_str(r[3]),) for r in rows]
+
+    def test_dedup_keeps_latest(self):
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        buffer = InspectionBuffer(flush_secs=1000)
+        assert not buffer.add(start + timedelta(seconds=10), 1, ott=123)
+        buffer.add(start, 2, ott=123)
+        buffer.add(start, 2, name="Homo sapiens")
+        buffer.add(start + timedelta(seconds=1), 1, name="Homo sapiens")
+        assert len(buffer) == 2
+        db = self.connect()
+        assert buffer.flush(db) == 2
+        db.close()
+        rows = sorted(self.rows(), key=lambda r: r[0] or 0)
+        assert len(rows) == 2
+        assert rows[0][1:] == ("Homo sapiens", 1, "2020-01-01 12:00:01")
+        assert rows[1][0] == 123 and rows[1][2:] == (1, "2020-01-01 12:00:10")
+
+    def test_does_not_overwrite_later_inspection(self):
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        db = self.connect()
+        db.executesql("INSERT INTO eol_inspected (ott, via, inspected) VALUES (5, 1, '2020-01-01 13:00:00');")
+        db.commit()
+        buffer = InspectionBuffer()
+        buffer.add(start, 2, ott=5)
+        buffer.add(start, 2, ott=6)
+        buffer.flush(db)
+        db.close()
+        assert sorted(self.rows()) == [(5, None, 1, "2020-01-01 13:00:00"), (6, None, 2, "2020-01-01 12:00:00")]
+
+    def test_keeps_other_columns(self):
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        db = self.connect()
+        db.executesql("INSERT INTO eol_inspected (ott, eol, via, inspected) VALUES (7, 1234, 1, '2020-01-01 11:00:00');")
+        db.executesql("INSERT INTO eol_inspected (name, eol, via, inspected) VALUES ('Aloe', 5678, 1, '2020-01-01 11:00:00');")
+        db.commit()
+        buffer = InspectionBuffer()
+        buffer.add(start, 2, ott=7)
+        buffer.add(start, 2, name="Aloe")
+        buffer.add(start, 2, ott=8)
+        assert buffer.flush(db) == 3
+        rows = db.executesql("SELECT ott, name, eol, via, inspected FROM eol_inspected ORDER BY id;")
+        db.close()
+        assert [r[:4] + (_as_str(r[4]),) for r in rows] == [
+            (7, None, 1234, 2, "2020-01-01 12:00:00"),
+            (None, "Aloe", 5678, 2, "2020-01-01 12:00:00"),
+            (8, None, None, 2, "2020-01-01 12:00:00")]
+
+    def test_concurrent_adds_and_flushes(self):
+        """Many threads click on overlapping taxa and flush in parallel, as web2py workers would"""
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        otts = list(range(1, 51))
+        buffer = InspectionBuffer(flush_secs=1000, max_keys=20)
+        latest = {}
+        latest_lock = threading.Lock()
+        errors = []
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            db = self.connect()
+            try:
+                for i in range(200):
+                    ott = rnd.choice(otts)
+                    t = start + timedelta(seconds=rnd.randint(0, 3600))
+                    with latest_lock:
+                        latest[ott] = max(latest.get(ott, t), t)
+                    if buffer.add(t, 1, ott=ott):
+                        buffer.flush(db)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.close()
+
+        threads = [threading.Thread(target=worker, args=(s,)) for s in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        db = self.connect()
+        buffer.flush(db)
+        db.close()
+        assert errors == []
+        rows = self.rows()
+        assert len(rows) == len(latest), "There should be exactly one row per inspected ott"
+        assert {r[0]: r[3] for r in rows} == {k: v.strftime("%Y-%m-%d %H:%M:%S") for k, v in latest.items()}
+
+    def test_background_flush(self):
+        buffer = InspectionBuffer(flush_secs=0.1, connect=self.connect)
+        buffer.add(datetime(2020, 1, 1), 1, ott=99)
+        buffer._timer.join(5)
+        assert len(buffer) == 0
+        assert [r[0] for r in self.rows()] == [99]
+
+    def test_background_flush_when_full(self):
+        """A full buffer is flushed in the background straight away, not by the caller"""
+        buffer = InspectionBuffer(flush_secs=1000, max_keys=3, connect=self.connect)
+        assert not buffer.add(datetime(2020, 1, 1), 1, ott=1)
+        assert not buffer.add(datetime(2020, 1, 1), 1, ott=2)
+        assert not buffer.add(datetime(2020, 1, 1), 1, ott=3)
+        for i in range(500):
+            if len(buffer) == 0 and len(self.rows()) == 3:
+                break
+            time.sleep(0.01)
+        assert sorted(r[0] for r in self.rows()) == [1, 2, 3]
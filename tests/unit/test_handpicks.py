@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that fetching the leaves for a hand-picked sponsorship list in one query
+(handpick_leaves in modules/sponsorship.py) gives the same leaves, order and images as
+the original query per price band in sponsor_handpicks, and that sponsored_stamp()
+changes whenever the sponsorship details shown on that page could have changed
+"""
+import random
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from . import SponsorshipDB
+from sponsorship import handpick_leaves, sponsored_stamp
+
+prices_pence = [500, 1000, 2000, 4000, 7500, 15000, None]
+
+
+def old_handpick_leaves(db, otts):
+    """The per-price band queries from the original sponsor_handpicks (with ties in rating broken by ott)"""
+    query = db.ordered_leaves.ott.belongs(otts)
+    if db(query).count() == 0:
+        return None, {}, {}
+    by_price = OrderedDict()
+    images = {}
+    sci_names = {}
+    for p in prices_pence:
+        rows = db(query &
+                  (db.ordered_leaves.price==p) &
+                  ((db.images_by_ott.overall_best_any == True) | (db.images_by_ott.overall_best_any == None))
+                  ).select(db.ordered_leaves.ott,
+                           db.ordered_leaves.name,
+                           db.images_by_ott.src,
+                           db.images_by_ott.src_id,
+                           left = db.images_by_ott.on(db.images_by_ott.ott == db.ordered_leaves.ott),
+                           orderby = ~db.images_by_ott.rating|db.ordered_leaves.ott)
+        by_price[p] = [r.ordered_leaves.ott for r in rows]
+        images.update({r.ordered_leaves.ott:(r.images_by_ott.src, r.images_by_ott.src_id) for r in rows if r.images_by_ott.src})
+        sci_names.update({r.ordered_leaves.ott:r.ordered_leaves.name for r in rows})
+    return by_price, images, sci_names
+
+
+class TestHandpicks(SponsorshipDB):
+    @classmethod
+    def setup_class(self):
+        super().setup_class()
+        db = self.db
+        rnd = random.Random(47)
+        for ott in range(1, 1001):
+            db.ordered_leaves.insert(name="Genus species{}".format(ott), ott=ott,
+                price=rnd.choice(prices_pence + [123]))
+            n_images = rnd.choice([0, 0, 1, 1, 2, 4])
+            best = rnd.randrange(n_images + 1) # sometimes none of the images is the best
+            for i in range(n_images):
+                db.images_by_ott.insert(ott=ott, src=rnd.choice([1, 2]), src_id=rnd.randint(1, 10**6),
+                    rating=rnd.randint(10000, 50000), overall_best_any=(i == best))
+        db.commit()
+        self.rnd = rnd
+
+    def test_same_as_old(self):
+        for n in (1, 5, 30, 200):
+            otts = self.rnd.sample(range(1, 1001), n)
+            assert handpick_leaves(self.db, otts, prices_pence) == old_handpick_leaves(self.db, otts)
+        assert handpick_leaves(self.db, [5000, 5001], prices_pence) == (None, {}, {})
+
+    def test_sponsored_stamp(self):
+        db = self.db
+        stamps = [sponsored_stamp(db)]
+        db.reservations.insert(OTT_ID=1, verified_time=datetime(2020, 1, 1), verified_name="Jo")
+        stamps.append(sponsored_stamp(db))
+        # not yet sponsored
+        db.reservations.insert(OTT_ID=2)
+        assert sponsored_stamp(db) == stamps[-1]
+        db(db.reservations.OTT_ID == 2).update(verified_time=datetime(2019, 1, 1), verified_name="Al")
+        stamps.append(sponsored_stamp(db))
+        # re-verified with a different name
+        db(db.reservations.OTT_ID == 1).update(verified_time=datetime(2020, 1, 2), verified_name="Jo B")
+        stamps.append(sponsored_stamp(db))
+        # expired or removed
+        db(db.reservations.OTT_ID == 2).update(verified_time=None)
+        stamps.append(sponsored_stamp(db))
+        assert len(set(stamps)) == len(stamps)
+        db.rollback()
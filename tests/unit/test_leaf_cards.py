@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that fetching the images for a page of sponsored leaves with one query per table
+(leaf_card_images in modules/sponsorship.py) finds the same images as the original
+per-leaf queries in the sponsored and donor_list pages
+"""
+import random
+
+from . import SponsorshipDB
+from sponsorship import leaf_card_images
+
+
+def image_tuple(row):
+    return None if row is None else (row.ott, row.src, row.src_id, row.rights, row.licence)
+
+
+def old_leaf_card_images(db, reservations):
+    """The queries from the original sponsored(), returning (default_images, user_images)"""
+    img = db.images_by_ott
+    fields = (img.ott, img.src, img.src_id, img.rights, img.licence)
+    otts = [r.OTT_ID for r in reservations]
+    default_images = {r.ott:r for r in db(img.ott.belongs(otts) & (img.overall_best_any==1)).select(*fields, orderby=~img.src)}
+    user_images = {}
+    for r in reservations:
+        if r.user_nondefault_image != 0:
+            user_images[r.OTT_ID] = db(
+                (img.src_id==r.verified_preferred_image_src_id) &
+                (img.src==r.verified_preferred_image_src)
+                ).select(*fields, orderby=~img.src).first()
+    return default_images, user_images
+
+
+class TestLeafCards(SponsorshipDB):
+    @classmethod
+    def setup_class(self):
+        super().setup_class()
+        db = self.db
+        rnd = random.Random(48)
+        for ott in range(1, 1001):
+            n_images = rnd.choice([0, 1, 1, 2, 4])
+            best = rnd.randrange(n_images + 1) # sometimes none of the images is the best
+            images = []
+            for i in range(n_images):
+                images.append((rnd.choice([1, 2]), rnd.randint(1, 10**6)))
+                db.images_by_ott.insert(ott=ott, src=images[-1][0], src_id=images[-1][1],
+                    rights="Owner {}".format(i), licence="CC0", overall_best_any=(i == best))
+            if rnd.random() < 0.5:
+                if images and rnd.random() < 0.5:
+                    src, src_id = rnd.choice(images)
+                    db.reservations.insert(OTT_ID=ott, user_nondefault_image=1,
+                        verified_preferred_image_src=src, verified_preferred_image_src_id=src_id)
+                else:
+                    db.reservations.insert(OTT_ID=ott, user_nondefault_image=0)
+        db.commit()
+        self.rnd = rnd
+
+    def test_same_as_old(self):
+        db = self.db
+        all_rows = db().select(db.reservations.ALL)
+        for n in (1, 5, 20, 200, len(all_rows)):
+            rows = self.rnd.sample(list(all_rows), n)
+            old_default, old_user = old_leaf_card_images(db, rows)
+            default_images, chosen_images = leaf_card_images(db, [r.OTT_ID for r in rows],
+                [(r.verified_preferred_image_src, r.verified_preferred_image_src_id)
+                    for r in rows if r.user_nondefault_image])
+            assert {k:image_tuple(v) for k, v in default_images.items()} == \
+                {k:image_tuple(v) for k, v in old_default.items()}
+            for r in rows:
+                if r.user_nondefault_image:
+                    image = (r.verified_preferred_image_src, r.verified_preferred_image_src_id)
+                    assert image_tuple(chosen_images[image]) == image_tuple(old_user[r.OTT_ID])
+            assert len(chosen_images) == len({
+                (r.verified_preferred_image_src, r.verified_preferred_image_src_id)
+                    for r in rows if r.user_nondefault_image})
+
+    def test_strings_and_missing(self):
+        # donor_list passes (src, src_id) pairs as strings, from GROUP_CONCAT
+        db = self.db
+        row = db(db.images_by_ott.id > 0).select(orderby=db.images_by_ott.id).first()
+        default_images, chosen_images = leaf_card_images(db, [],
+            [(str(row.src), str(row.src_id)), ("1", "0")])
+        assert default_images == {}
+        assert list(chosen_images.keys()) == [(row.src, row.src_id)]
+        assert chosen_images[(row.src, row.src_id)].ott == row.ott
+        assert leaf_card_images(db, [5000], []) == ({}, {})
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the linear-time cut position maps in make_js_treefiles.py give exactly the
+same output as the original implementations (copied below), which scanned backwards
+for matching brackets, on random binary trees and on a fixture tree file
+"""
+import json
+import os
+import random
+import sys
+
+from . import web2py_app_dir
+
+utilities_dir = os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'Utilities')
+if utilities_dir not in sys.path:
+    sys.path.insert(0, utilities_dir)
+import make_js_treefiles
+
+fixture_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def random_brief_newick(rnd, n_leaves, poly_prob=0.3):
+    """
+    A random binary tree in the format output by write_brief_newick: leaves are empty
+    strings, and nodes are brackets around their 2 children, curly if the node was
+    created when resolving a polytomy (zero edge length). The root is never curly.
+    """
+    def node(n, root=False):
+        if n == 1:
+            return ""
+        k = rnd.randint(1, n - 1)
+        curly = not root and rnd.random() < poly_prob
+        return ("{" if curly else "(") + node(k) + node(n - k) + ("}" if curly else ")")
+    return node(n_leaves, root=True)
+
+
+class TestCutPositionMaps(object):
+    def compare(self, newick_str, threshold):
+        assert make_js_treefiles.generate_binary_cut_position_map(newick_str, threshold) == \
+            old_generate_binary_cut_position_map(newick_str, threshold)
+        assert make_js_treefiles.generate_polytomy_cut_position_map(newick_str, threshold) == \
+            old_generate_polytomy_cut_position_map(newick_str, threshold)
+
+    def test_random_trees(self):
+        rnd = random.Random(31)
+        for i in range(200):
+            newick_str = random_brief_newick(rnd, rnd.randint(2, 300), poly_prob=rnd.random())
+            for threshold in (0, 1, 5, 20):
+                self.compare(newick_str, threshold)
+
+    def test_fixture_tree(self):
+        path = os.path.join(fixture_dir, 'ordered_tree_test.poly')
+        newick_str = make_js_treefiles.tidy_newick(path)
+        assert newick_str == old_tidy_newick(path)
+        for threshold in (0, 3, 10, 50):
+            self.compare(newick_str, threshold)
+        cut_maps = make_js_treefiles.generate_cut_position_map(newick_str, 10)
+        binary_json = cut_maps.split("\n")[0][len("var cut_position_map_json_str = '"):-2]
+        assert len(json.loads(binary_json)) > 0
+
+    def test_matching_brackets(self):
+        assert make_js_treefiles.matching_brackets("(()){}") == [3, 2, 1, 0, 5, 4]
+        for bad in ("(()", "())(", "(a)"):
+            try:
+                make_js_treefiles.matching_brackets(bad)
+                assert False, "Should have raised for " + bad
+            except ValueError:
+                pass
+
+
+## The original implementations, for comparison
+
+def old_tidy_newick(newick_filepath):
+    import fileinput
+    res = ""
+    for line in fileinput.input(files=(newick_filepath)):
+        res += line.replace(',', '').replace(';', '').replace('\n', '')
+    return res
+
+def old_generate_binary_cut_position_map(newick_str, threshold):
+    count_arr = [None] * len(newick_str)
+    count = 0
+    for index, c in enumerate(reversed(newick_str)):
+        index = len(newick_str) - index - 1
+        if c == '(' or c == '{':
+            count = count-1
+        elif c == ')' or c == '}':
+            count = count + 1
+        else:
+            raise ValueError("newick str contains non bracket character: " + c)
+        count_arr[index] = count
+
+    start_end_arr = [0, len(count_arr)-1]
+    cut_position_map = {}
+    while len(start_end_arr) > 0:
+        start = start_end_arr.pop(0)
+        end = start_end_arr.pop(0)
+        old_build_cut_position_map(start, end, start_end_arr, count_arr, cut_position_map, threshold)
+    cut_position_map = json.dumps(cut_position_map)
+    cut_position_map = "var cut_position_map_json_str = '" + cut_position_map +"';"
+    return cut_position_map
+
+def old_generate_polytomy_cut_position_map(newick_str, threshold):
+    start_end_arr = [0, len(newick_str) - 1]
+    cut_position_map = {}
+    while len(start_end_arr) > 0:
+        start = start_end_arr.pop(0)
+        end = start_end_arr.pop(0)
+        cut_position_map[end] = old_get_polytomy_substring_pos(start, end, start_end_arr, threshold, newick_str)
+    cut_position_map = json.dumps(cut_position_map)
+    cut_position_map = "var polytomy_cut_position_map_json_str = '" + cut_position_map + "';"
+    return cut_position_map
+
+def old_build_cut_position_map(start, end, start_end_arr, count_arr, cut_position_map, threshold):
+    endValue = count_arr[end];
+    for index in reversed(range(start, end)):
+        if count_arr[index] == endValue:
+            cut_position_map[end] = index-1
+            if (index-start-2) >= threshold:
+                start_end_arr.append(start+1)
+                start_end_arr.append(index-1)
+            if (end-index-1) >= threshold:
+                start_end_arr.append(index)
+                start_end_arr.append(end-1)
+            break
+
+def old_get_polytomy_substring_pos(start, end, start_end_arr, threshold, newick_str, called_by_self = False):
+    res = []
+    if (end <= start or (called_by_self and newick_str[end] == ')')):
+        res = res + [start, end]
+        if ((end - start) > threshold):
+            start_end_arr.append(start)
+            start_end_arr.append(end)
+        return res
+
+    cut_point = None
+    bracket_count = 0
+    for index in reversed(range(start, end+1)):
+        c = newick_str[index]
+        if c == ')' or c == '}':
+            bracket_count = bracket_count + 1
+        elif c == '(' or c == '{':
+            bracket_count = bracket_count - 1
+            if (bracket_count == 1):
+                cut_point = index - 1
+                break
+    if (cut_point is not None):
+        res = res + old_get_polytomy_substring_pos(start+1, cut_point, start_end_arr, threshold, newick_str, True)
+        res = res + old_get_polytomy_substring_pos(cut_point+1, end-1, start_end_arr, threshold, newick_str, True)
+    else:
+        res = res + [start, start, end, end]
+    return res
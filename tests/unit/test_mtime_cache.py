@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that modules/mtime_cache.py only reloads a file (e.g. appconfig.ini) when it has
+been changed on disk
+"""
+import os
+import shutil
+import tempfile
+
+from . import modules_dir
+from mtime_cache import load_if_changed
+
+
+class TestMtimeCache(object):
+    @classmethod
+    def setup_class(self):
+        self.folder = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.folder)
+
+    def test_reload_on_change(self):
+        path = os.path.join(self.folder, 'appconfig.ini')
+        with open(path, 'w') as f:
+            f.write("[db]\nuri = sqlite://storage.sqlite\n")
+        loads = []
+        def load(p):
+            loads.append(p)
+            with open(p) as f:
+                return f.read()
+
+        first = load_if_changed(path, load)
+        assert load_if_changed(path, load) is first
+        assert len(loads) == 1
+
+        with open(path, 'a') as f:
+            f.write("pool_size = 1\n")
+        assert "pool_size" in load_if_changed(path, load)
+        assert len(loads) == 2
+
+        # same size, but touched later
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        load_if_changed(path, load)
+        assert len(loads) == 3
+        load_if_changed(path, load)
+        assert len(loads) == 3
+
+    def test_missing_file(self):
+        path = os.path.join(self.folder, 'missing.ini')
+        loads = []
+        assert load_if_changed(path, lambda p: loads.append(p) or "default") == "default"
+        assert load_if_changed(path, lambda p: loads.append(p) or "default") == "default"
+        assert len(loads) == 1
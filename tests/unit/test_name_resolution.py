@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check the local name resolution used by Add_OTT_numbers_to_trees.py, using the small
+taxonomy and synonyms files in fixtures/ott_taxonomy, and that only names which cannot
+be resolved locally are sent to the (here, fake) TNRS API, whose answers are cached
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+from . import web2py_app_dir
+
+ottmapping_dir = os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'TreeBuild', 'OTTMapping')
+if ottmapping_dir not in sys.path:
+    sys.path.insert(0, ottmapping_dir)
+from name_resolution import LocalNameIndex, TNRSCache, match_names, normalize_name, resolved_ott
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures', 'ott_taxonomy')
+
+
+class FakeTNRS(object):
+    """
+    Answers match_names requests from a dict of name: [(ott, is_synonym), ...], recording the
+    names sent. Names are listed as unambiguous if they have one non-synonym match, unless
+    they are in `ambiguous` (as the real API may decide otherwise)
+    """
+    def __init__(self, answers, ambiguous=()):
+        self.answers = answers
+        self.ambiguous = set(ambiguous)
+        self.sent = []
+
+    def __call__(self, names, context):
+        self.sent.append((list(names), context))
+        return {'results': [
+            {'name': name, 'matches': [
+                {'matched_name': name, 'is_synonym': syn, 'taxon': {'ott_id': ott}} for ott, syn in self.answers[name]]}
+            for name in names if name in self.answers],
+            'unambiguous_names': [name for name in names if name in self.answers and name not in self.ambiguous and
+                sum(not syn for ott, syn in self.answers[name]) == 1]}
+
+
+def otts(response):
+    """The resolved ott for each name in a match_names style response (None if not resolved)"""
+    resolved = {res['name']: resolved_ott(res['matches']) for res in response['results']}
+    resolved.update({name: None for name in response['unmatched_names']})
+    return resolved
+
+
+class TestNameResolution(object):
+    @classmethod
+    def setup_class(self):
+        self.index = LocalNameIndex(
+            os.path.join(fixtures_dir, "taxonomy.tsv"), os.path.join(fixtures_dir, "synonyms.tsv"))
+        self.folder = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.folder)
+
+    def test_normalize(self):
+        assert normalize_name("Homo_sapiens") == normalize_name(" homo  SAPIENS ") == "homo sapiens"
+        assert normalize_name("Aloë") == "aloe"
+        assert normalize_name("'Homo sapiens'") == "homo sapiens"
+
+    def test_exact_and_normalized(self):
+        response = self.index.match_names(["Homo sapiens", "HOMO SAPIENS", "Aloe", "Phoca  vitulina", "Nonexistus"])
+        assert otts(response) == {
+            "Homo sapiens": 770315, "HOMO SAPIENS": 770315, "Aloe": 5551116, "Phoca  vitulina": 699407, "Nonexistus": None}
+        assert response['unmatched_names'] == ["Nonexistus"]
+        assert sorted(response['unambiguous_names']) == sorted(["Homo sapiens", "HOMO SAPIENS", "Aloe", "Phoca  vitulina"])
+
+    def test_synonyms(self):
+        response = self.index.match_names(["Sula bassana", "brunella vulgaris", "Bacillus rossii", "Homo"])
+        assert otts(response) == {
+            "Sula bassana": 1040012, "brunella vulgaris": 313219,
+            "Bacillus rossii": None,  # a synonym of two different taxa
+            "Homo": 770311}  # a real name takes precedence over a synonym
+        matches = {res['name']: res['matches'] for res in response['results']}
+        assert all(m['is_synonym'] for m in matches["Sula bassana"])
+        assert [m['matched_name'] for m in matches["brunella vulgaris"]] == ["Brunella vulgaris"]
+
+    def test_context(self):
+        assert otts(self.index.match_names(["Morus", "Prunella"]))["Morus"] is None
+        assert otts(self.index.match_names(["Morus", "Prunella"], "Birds")) == {"Morus": 1040004, "Prunella": 579455}
+        assert otts(self.index.match_names(["Morus", "Prunella"], "Land plants")) == {"Morus": 740599, "Prunella": 313218}
+        assert otts(self.index.match_names(["Morus alba", "Homo sapiens"], "Animals")) == {"Morus alba": None, "Homo sapiens": 770315}
+        assert otts(self.index.match_names(["Bacillus"], "Insecta")) == {"Bacillus": 458427}
+
+    def test_kingdom(self):
+        # with no context, homonyms are resolved using the kingdom of most of the other names
+        animals = ["Morus", "Bacillus", "Homo sapiens", "Phoca vitulina", "Morus bassanus"]
+        assert otts(self.index.match_names(animals)) == {
+            "Morus": 1040004, "Bacillus": 458427, "Homo sapiens": 770315, "Phoca vitulina": 699407, "Morus bassanus": 1040012}
+        plants = ["Prunella", "Morus alba", "Prunella vulgaris", "Homo sapiens"]
+        assert otts(self.index.match_names(plants))["Prunella"] == 313218
+
+    def test_flags(self):
+        response = self.index.match_names(["Amanita muscaria"])
+        assert otts(response) == {"Amanita muscaria": 5551112}
+        assert len(response['results'][0]['matches']) == 1
+
+    def test_remote_fallback_and_cache(self):
+        cache_file = os.path.join(self.folder, "tnrs_cache.json")
+        tnrs = FakeTNRS({"Morus": [(1040004, False), (740599, False)], "Felis catus": [(563166, False)]})
+        # Morus cannot be resolved locally, as there are as many plants as animals
+        names = ["Homo sapiens", "Felis catus", "Morus", "Nonexistus", "Prunella vulgaris"]
+        expected = {"Homo sapiens": 770315, "Felis catus": 563166, "Morus": None, "Nonexistus": None, "Prunella vulgaris": 313219}
+        response = match_names(names, "All life", self.index, TNRSCache(cache_file), request=tnrs)
+        assert otts(response) == expected
+        assert tnrs.sent == [(["Felis catus", "Morus", "Nonexistus"], "All life")]
+        assert [res['name'] for res in response['results']] == ["Homo sapiens", "Felis catus", "Morus", "Prunella vulgaris"]
+        # answers (including no match) are now cached on disk, so nothing more is sent
+        response = match_names(names, "All life", self.index, TNRSCache(cache_file), request=tnrs)
+        assert otts(response) == expected
+        assert len(tnrs.sent) == 1
+        # but the cache is per context
+        match_names(["Felis catus"], "Animals", None, TNRSCache(cache_file), request=tnrs)
+        assert tnrs.sent[-1] == (["Felis catus"], "Animals")
+
+    def test_remote_unambiguous_names(self):
+        cache_file = os.path.join(self.folder, "tnrs_unambiguous_cache.json")
+        # the API's own list of unambiguous names is kept, rather than worked out from the matches
+        tnrs = FakeTNRS({"Felis catus": [(563166, False)], "Canis lupus": [(247333, False)]}, ambiguous=["Canis lupus"])
+        names = ["Homo sapiens", "Felis catus", "Canis lupus"]
+        for i in range(2):
+            response = match_names(names, "All life", self.index, TNRSCache(cache_file), request=tnrs)
+            assert response['unambiguous_names'] == ["Homo sapiens", "Felis catus"]
+            assert response['matched_names'] == names
+        assert len(tnrs.sent) == 1
+
+    def test_offline(self):
+        tnrs = FakeTNRS({})
+        response = match_names(["Homo sapiens", "Felis catus", "Morus", "Morus alba"], "All life", self.index, remote=False, request=tnrs)
+        assert otts(response) == {"Homo sapiens": 770315, "Felis catus": None, "Morus": None, "Morus alba": 740600}
+        assert tnrs.sent == []
+
+    def test_batches(self):
+        names = ["Name {}".format(i) for i in range(2500)]
+        tnrs = FakeTNRS({name: [(i, False)] for i, name in enumerate(names)})
+        response = match_names(names, "All life", request=tnrs)
+        assert [len(batch) for batch, context in tnrs.sent] == [995, 995, 510]
+        assert otts(response) == {name: i for i, name in enumerate(names)}
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the nested set ancestor queries in modules/nested_set.py return the same
+ancestors as walking up the tree via the parent (or real_parent) links, on random trees
+containing polytomy-resolving nodes
+"""
+import random
+import shutil
+import tempfile
+
+from pydal import DAL, Field
+
+from . import modules_dir
+from nested_set import ancestor_path, ancestor_paths
+
+
+def random_nested_set_tree(rnd, n_leaves, zero_length_prob=0.3):
+    """
+    Make ordered_nodes and ordered_leaves rows (as dicts) for a random tree, in the
+    same way as write_preorder_to_csv() in dendropy_extras.py: nodes and leaves are
+    numbered in preorder, and nodes or leaves whose parent is on a zero-length branch
+    (i.e. created by resolving a polytomy) have a negative real_parent
+    """
+    nodes, leaves = [], []
+
+    def add(tips, parent, real_parent, zero_length):
+        rp = -real_parent if zero_length else real_parent
+        if len(tips) == 1:
+            leaves.append(dict(id=len(leaves) + 1, parent=parent, real_parent=rp, ott=tips[0],
+                name="leaf{}".format(tips[0]), wikidata=rnd.choice([None, tips[0]])))
+            return
+        node = dict(id=len(nodes) + 1, parent=parent, real_parent=rp, leaf_lft=len(leaves) + 1,
+            ott=10000 + len(nodes), name="node{}".format(len(nodes)), wikidata=rnd.choice([None, len(nodes)]))
+        nodes.append(node)
+        # children's real parent is this node, unless this node is itself a polytomy node
+        child_real_parent = real_parent if zero_length else node['id']
+        cuts = sorted(rnd.sample(range(1, len(tips)), min(len(tips) - 1, rnd.randint(1, 3))))
+        for start, end in zip([0] + cuts, cuts + [len(tips)]):
+            add(tips[start:end], node['id'], child_real_parent, rnd.random() < zero_length_prob)
+        node['leaf_rgt'] = len(leaves)
+        node['node_rgt'] = len(nodes)
+
+    add(list(range(1, n_leaves + 1)), -1, 0, False)
+    nodes[0]['real_parent'] = 0
+    return nodes, leaves
+
+
+class TestNestedSet(object):
+    @classmethod
+    def setup_class(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = db = DAL('sqlite://nested_set.sqlite', folder=self.folder)
+        db.define_table('ordered_nodes',
+            Field('parent', type='integer', notnull=True),
+            Field('real_parent', type='integer', notnull=True),
+            Field('node_rgt', type='integer', notnull=True),
+            Field('leaf_lft', type='integer', notnull=True),
+            Field('leaf_rgt', type='integer', notnull=True),
+            Field('name', type='string'),
+            Field('ott', type='integer'),
+            Field('wikidata', type='integer'),
+            Field('popularity', type='double'))
+        db.define_table('ordered_leaves',
+            Field('parent', type='integer', notnull=True),
+            Field('real_parent', type='integer', notnull=True),
+            Field('name', type='string'),
+            Field('ott', type='integer'),
+            Field('wikidata', type='integer'))
+        self.nodes, self.leaves = random_nested_set_tree(random.Random(123), 500)
+        db.ordered_nodes.bulk_insert(self.nodes)
+        db.ordered_leaves.bulk_insert(self.leaves)
+        db.commit()
+
+    @classmethod
+    def teardown_class(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def walk_up(self, row, real_only=True):
+        """The ancestor ids found by following parent links, root first"""
+        ids = []
+        ch = abs(row['real_parent']) if real_only else row['parent']
+        while ch > 0:
+            ids.append(ch)
+            node = self.nodes[ch - 1]
+            ch = abs(node['real_parent']) if real_only else node['parent']
+        return ids[::-1]
+
+    def test_leaf_ancestors(self):
+        for leaf in self.leaves[::7]:
+            for real_only in (True, False):
+                path = ancestor_path(self.db, leaf_id=leaf['id'], real_only=real_only)
+                assert [r['id'] for r in path] == self.walk_up(leaf, real_only)
+
+    def test_node_ancestors(self):
+        for node in self.nodes[::5]:
+            for real_only in (True, False):
+                path = ancestor_path(self.db, node_id=node['id'], real_only=real_only)
+                assert [r['id'] for r in path] == self.walk_up(node, real_only)
+
+    def test_batched_matches_single(self):
+        rnd = random.Random(1)
+        targets = rnd.sample(self.leaves, 40) + rnd.sample(self.nodes, 40)
+        wikidata = (self.db.ordered_nodes.wikidata != None)
+        paths = ancestor_paths(self.db, [t['ott'] for t in targets] + [-1], query=wikidata)
+        assert len(paths) == len(targets), "Unknown otts should be omitted"
+        for t in targets:
+            id_key = 'node_id' if 'leaf_lft' in t else 'leaf_id'
+            expected = ancestor_path(self.db, query=wikidata, **{id_key: t['id']})
+            assert paths[t['ott']] == expected
+            assert all(r['wikidata'] is not None for r in expected)
+
+    def test_unknown(self):
+        assert ancestor_paths(self.db, []) == {}
+        assert ancestor_paths(self.db, [-5]) == {}
+        assert ancestor_path(self.db, node_id=10**6) == []
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the tokenizer for the wikipedia `page` SQL dump in OTT_popularity_mapping.py
+finds the same page sizes as the original csv-based parser (copied below), and also
+copes with escaped quotes, which the csv parser mangled
+"""
+import csv
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from . import web2py_app_dir
+
+popularity_dir = os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'TaxonMappingAndPopularity')
+if popularity_dir not in sys.path:
+    sys.path.insert(0, popularity_dir)
+from OTT_popularity_mapping import add_pagesize_for_titles, pagesizes_in_line
+
+
+def page_tuple(page_id, namespace, quoted_title, pagelen):
+    """A row of the page table, as in recent dumps, where the page length is column 11"""
+    return "({},{},{},'',{},0,0.{},'20190924002226','20190924010543',{},{},'wikitext',NULL)".format(
+        page_id, namespace, quoted_title, page_id % 2, page_id, 600000 + page_id, pagelen)
+
+
+class TestPagesizeDump(object):
+    @classmethod
+    def setup_class(self):
+        self.folder = tempfile.mkdtemp()
+        rnd = random.Random(32)
+        plain = ["Ursus_arctos", "Canis_lupus", "Pokémon", "狐", "Ελάφι", "Homo_(genus)",
+            "Comma,_in_title"] + ["Taxon_{}".format(i) for i in range(300)]
+        escaped = ["Carl's_frog", "Bishop's_mitre_(plant)", 'The_"quoted"_moth', "Back\\slash"]
+        self.plain, self.escaped = plain, escaped
+        self.expected = {}
+        lines = ["-- MySQL dump 10.16", "DROP TABLE IF EXISTS `page`;", "CREATE TABLE `page` (", ") ENGINE=InnoDB;"]
+        page_id = 1
+        tuples = []
+        for title in plain + escaped + ["Not_a_taxon_{}".format(i) for i in range(500)]:
+            for namespace in (0, 1):
+                pagelen = rnd.randint(1, 500000)
+                quoted = sql_quote(title)
+                tuples.append(page_tuple(page_id, namespace, quoted, pagelen))
+                if namespace == 0:
+                    self.expected[title] = pagelen
+                page_id += 1
+        rnd.shuffle(tuples)
+        for i in range(0, len(tuples), 100):
+            lines.append("INSERT INTO `page` VALUES " + ",".join(tuples[i:i+100]) + ";")
+        lines.append("/*!40000 ALTER TABLE `page` ENABLE KEYS */;")
+        self.dump = os.path.join(self.folder, "enwiki-latest-page.sql.gz")
+        with gzip.open(self.dump, "wt", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.folder)
+
+    def title_ptrs(self, titles):
+        return {t: {'Q': i} for i, t in enumerate(titles)}
+
+    def test_same_as_csv_parser(self):
+        titles = self.plain + ["Missing_title"]
+        new = self.title_ptrs(titles)
+        old = self.title_ptrs(titles)
+        add_pagesize_for_titles(new, self.dump, 0)
+        old_add_pagesize_for_titles(old, self.dump, 0)
+        assert new == old
+        assert all(new[t]['PGsz'] == self.expected[t] for t in self.plain)
+        assert 'PGsz' not in new["Missing_title"]
+
+    def test_escaped_quotes(self):
+        titles = self.escaped
+        new = self.title_ptrs(titles)
+        old = self.title_ptrs(titles)
+        add_pagesize_for_titles(new, self.dump, 0)
+        old_add_pagesize_for_titles(old, self.dump, 0)
+        assert {t: new[t].get('PGsz') for t in titles} == {t: self.expected[t] for t in titles}
+        assert not any('PGsz' in v for v in old.values()), "The csv parser cannot read escaped quotes"
+
+    def test_processes(self):
+        titles = self.plain + self.escaped
+        single = self.title_ptrs(titles)
+        multi = self.title_ptrs(titles)
+        add_pagesize_for_titles(single, self.dump, 0)
+        add_pagesize_for_titles(multi, self.dump, 0, processes=2)
+        assert single == multi
+
+    def test_titles_like_tuples(self):
+        titles = {"(1,0,'x')", "A)", "(B"}
+        line = "INSERT INTO `page` VALUES " + ",".join(
+            page_tuple(i, 0, sql_quote(t), i*10) for i, t in enumerate(sorted(titles), 1)) + ";\n"
+        assert sorted(pagesizes_in_line(line, titles)) == [("(1,0,'x')", 10), ("(B", 20), ("A)", 30)]
+
+
+def sql_quote(title):
+    """Quote a title for an SQL dump, escaping as mysqldump does"""
+    return "'" + title.replace("\\", "\\\\").replace("'", "\\'").replace('"', '\\"') + "'"
+
+
+## The original implementation, for comparison
+
+def old_add_pagesize_for_titles(wiki_title_ptrs, wikipedia_SQL_dump, verbosity):
+    used = 0
+    page_table_namespace_column = 2
+    page_table_title_column = 3
+    page_table_pagelen_column = 11
+    with gzip.open(wikipedia_SQL_dump, 'rt', encoding='utf-8') as file:
+        pagelen_file = csv.reader(file, quotechar='\'',doublequote=True)
+        match_line = "INSERT INTO `page` VALUES"
+        for fields in filter(lambda x: False if len(x)==0 else x[0].startswith(match_line), pagelen_file):
+            field_num=0
+            for f in fields:
+                try:
+                    if f.lstrip()[0]=="(":
+                        field_num=0
+                        namespace = None
+                        title = None
+                except IndexError:
+                    pass
+                field_num+=1;
+                if field_num == page_table_namespace_column:
+                    namespace = f
+                if field_num == page_table_title_column:
+                    title = f
+                elif field_num == page_table_pagelen_column and namespace == '0':
+                    if title in wiki_title_ptrs:
+                        wiki_title_ptrs[title]['PGsz'] = int(f)
+                        used += 1
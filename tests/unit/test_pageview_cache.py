@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the per-month pageview caches in OTT_popularity_mapping.py give the same
+PGviews as parsing the pagecounts files directly, and that only new months get parsed
+"""
+import bz2
+import os
+import random
+import shutil
+import sys
+import tempfile
+from urllib.parse import quote
+
+from . import web2py_app_dir
+
+popularity_dir = os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'TaxonMappingAndPopularity')
+if popularity_dir not in sys.path:
+    sys.path.insert(0, popularity_dir)
+from OTT_popularity_mapping import add_pageviews_for_titles, pageview_caches
+
+
+class TestPageviewCache(object):
+    @classmethod
+    def setup_class(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.folder, "cache")
+        rnd = random.Random(33)
+        self.titles = ["Ursus_arctos", "Canis_lupus", "Pokémon", "狐", "Ελάφι", "Homo_(genus)",
+            "Carl's_frog"] + ["Taxon_{}".format(i) for i in range(300)]
+        others = ["Not_a_taxon_{}".format(i) for i in range(500)]
+        self.months = []
+        for month in range(4):
+            lines = []
+            for title in self.titles + others:
+                if rnd.random() < 0.2:
+                    continue  # fewer than 5 views this month
+                lines.append("en.z {} {}".format(title, rnd.randint(5, 100000)))
+                if rnd.random() < 0.1:
+                    # the same title under a different encoding, whose views should be added
+                    lines.append("en.z {} {}".format(quote(title.replace("_", " ")), rnd.randint(5, 100)))
+                if rnd.random() < 0.1:
+                    lines.append("fr.z {} {}".format(title, rnd.randint(5, 100000)))
+            lines.append("en.z Bad_count x")
+            lines.append("en.z %FF%FE_not_utf8 12")
+            rnd.shuffle(lines)
+            path = os.path.join(self.folder, "pagecounts-2016-{:02}-views-ge-5-totals.bz2".format(month + 1))
+            with bz2.open(path, "wt", encoding="utf-8") as f:
+                f.write("\n".join(["en.b Some_book 20"] + lines) + "\n")
+            self.months.append(path)
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.folder)
+
+    def pageviews(self, files, lang='en', **kwargs):
+        wiki_title_ptrs = {t: {'Q': i} for i, t in enumerate(self.titles + ["Missing_title"])}
+        add_pageviews_for_titles(wiki_title_ptrs, files, lang, 0, **kwargs)
+        return wiki_title_ptrs
+
+    def test_cached_same_as_uncached(self):
+        uncached = self.pageviews(self.months)
+        assert any(v['PGviews'][0] > 0 for v in uncached.values())
+        assert uncached["Missing_title"]['PGviews'] == [0] * len(self.months)
+        for processes in (None, 2):
+            cache_dir = os.path.join(self.folder, "cache{}".format(processes))
+            assert self.pageviews(self.months, cache_dir=cache_dir, processes=processes) == uncached
+            assert len(os.listdir(cache_dir)) == len(self.months)
+            # second run entirely from the cache
+            assert self.pageviews(self.months, cache_dir=cache_dir, processes=processes) == uncached
+
+    def test_opened_files(self):
+        files = [open(path, "rb") for path in self.months[:2]]
+        try:
+            uncached = self.pageviews(files)
+            for f in files:
+                f.seek(0)
+            assert self.pageviews(files, cache_dir=self.cache_dir) == uncached
+        finally:
+            for f in files:
+                f.close()
+
+    def test_only_new_months_parsed(self):
+        cache_dir = os.path.join(self.folder, "incremental")
+        old_caches = pageview_caches(self.months[:2], "en.z", cache_dir)
+        stamps = [os.stat(c).st_mtime_ns for c in old_caches]
+        new_caches = pageview_caches(self.months, "en.z", cache_dir, processes=2)
+        assert new_caches[:2] == old_caches
+        assert [os.stat(c).st_mtime_ns for c in old_caches] == stamps
+        assert len(set(new_caches)) == len(self.months)
+        assert self.pageviews(self.months, cache_dir=cache_dir) == self.pageviews(self.months)
+
+    def test_wikicode_in_key(self):
+        cache_dir = os.path.join(self.folder, "languages")
+        en = pageview_caches(self.months[:1], "en.z", cache_dir)
+        fr = pageview_caches(self.months[:1], "fr.z", cache_dir)
+        assert en != fr
+        assert self.pageviews(self.months, 'fr', cache_dir=cache_dir) == self.pageviews(self.months, 'fr')
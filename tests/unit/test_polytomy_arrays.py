@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that resolving polytomies, ladderizing, and ranking leaf popularity using arrays
+(ChildArrays in tree_arrays.py) gives exactly the same trees and ranks as the dendropy
+based functions in CSV_base_table_creator.py, for the same random seed
+"""
+import os
+import random
+import sys
+
+import numpy as np
+
+from . import web2py_app_dir
+from .test_tree_arrays import random_newick, read_tree
+
+popularity_dir = os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'TaxonMappingAndPopularity')
+if popularity_dir not in sys.path:
+    sys.path.insert(0, popularity_dir)
+from tree_arrays import TreeArrays, ChildArrays, descending_ranks
+from CSV_base_table_creator import resolve_polytomies_add_popularity, create_leaf_popularity_rankings, \
+    resolve_polytomies_and_ladderize, create_leaf_popularity_rankings_arrays
+
+
+def add_popularity(rnd, tree, missing_prob=0.02):
+    """
+    Set the attributes used by resolve_polytomies_add_popularity() as if they had been
+    calculated by inherit_popularity(), with a few left undefined, and a limited
+    number of distinct leaf popularities, so that there are plenty of tied ranks
+    """
+    for node in tree.preorder_node_iter():
+        node.data = {'popularity': rnd.choice([None, 1, 2.5, 10, 10.0, 100]) if rnd.random() < 0.1 else rnd.randint(1, 20)}
+        if rnd.random() < missing_prob:
+            continue
+        node.ancestors_popsum = rnd.random() * 100
+        node.descendants_popsum = rnd.random() * 100
+        node.n_ancestors = rnd.randint(1, 20)
+        node.n_descendants = rnd.randint(0, 20)
+    return tree
+
+
+def node_summary(tree):
+    """The label, edge length, popularity and rank of each node, and the size of its subtree, in preorder"""
+    summary = []
+    for node in tree.preorder_node_iter():
+        for child in node.child_node_iter():
+            assert child.parent_node is node
+        data = getattr(node, 'data', None)
+        summary.append((node.label, node.edge.length, len(node.child_nodes()),
+            None if data is None else (data.get('popularity'), data.get('popularity_rank'))))
+    return summary
+
+
+def old_resolve_and_rank(tree, seed, ascending=True):
+    """The original sequence of calls in output_simplified_tree()"""
+    resolve_polytomies_add_popularity(tree, seed)
+    create_leaf_popularity_rankings(tree)
+    tree.ladderize(ascending=ascending)
+    return tree
+
+
+def new_resolve_and_rank(tree, seed, ascending=True, pass_nodes=True):
+    nodes = resolve_polytomies_and_ladderize(tree, seed, ascending)
+    create_leaf_popularity_rankings_arrays(tree, nodes if pass_nodes else None)
+    return tree
+
+
+class TestPolytomyArrays(object):
+    def test_child_arrays(self):
+        rnd = random.Random(40)
+        for i in range(30):
+            tree = read_tree(random_newick(rnd, rnd.randint(1, 200), 6))
+            arrays = TreeArrays(tree)
+            child_arrays = ChildArrays.from_tree_arrays(arrays)
+            assert child_arrays.preorder_rank().tolist() == list(range(len(arrays)))
+            assert child_arrays.postorder.tolist() == arrays.postorder.tolist()
+            index = {id(n): i for i, n in enumerate(arrays.nodes)}
+            for i, node in enumerate(arrays.nodes):
+                assert child_arrays.child_nodes(i).tolist() == [index[id(c)] for c in node.child_nodes()]
+            # shuffling the node indices should make no difference to the traversal orders
+            perm = np.array(rnd.sample(range(len(arrays)), len(arrays)))
+            inverse = np.argsort(perm)
+            parent = np.where(arrays.parent >= 0, inverse[np.maximum(arrays.parent, 0)], -1)
+            shuffled = ChildArrays(parent[perm], perm)
+            assert perm[shuffled.postorder].tolist() == arrays.postorder.tolist()
+            assert perm[np.argsort(shuffled.preorder_rank())].tolist() == list(range(len(arrays)))
+
+    def test_same_as_dendropy(self):
+        rnd = random.Random(40)
+        n_new = 0
+        for i in range(100):
+            newick = random_newick(rnd, rnd.randint(1, 300), rnd.choice([3, 6, 20]))
+            seed = rnd.randint(0, 10000)
+            ascending = (i % 4 != 0)
+            pop_seed = rnd.random()
+            old_tree = old_resolve_and_rank(add_popularity(random.Random(pop_seed), read_tree(newick)), seed, ascending)
+            new_tree = new_resolve_and_rank(add_popularity(random.Random(pop_seed), read_tree(newick)), seed, ascending, i % 2 == 0)
+            assert node_summary(new_tree) == node_summary(old_tree), newick
+            n_new += sum(1 for n in new_tree.preorder_node_iter() if n.edge.length == 0)
+        assert n_new > 1000
+
+    def test_no_popularity(self):
+        rnd = random.Random(40)
+        newick = random_newick(rnd, 100, 10)
+        trees = []
+        for resolve_and_rank in (old_resolve_and_rank, new_resolve_and_rank):
+            tree = read_tree(newick)
+            for node in tree.preorder_node_iter():
+                node.data = {}
+            trees.append(resolve_and_rank(tree, 1234))
+        assert node_summary(trees[0]) == node_summary(trees[1])
+        assert all(leaf.data['popularity_rank'] == 1 for leaf in trees[1].leaf_node_iter())
+
+    def test_descending_ranks(self):
+        assert descending_ranks([5, 7, 5, 1]).tolist() == [2, 1, 2, 4]
+        assert descending_ranks([0.5]).tolist() == [1]
+        assert descending_ranks([]).tolist() == []
+        rnd = random.Random(40)
+        values = [rnd.randint(0, 50) for i in range(1000)]
+        assert descending_ranks(values).tolist() == [1 + sum(v > x for v in values) for x in values]
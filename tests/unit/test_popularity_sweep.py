@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the sweep mode of calc_phylogenetic_popularity.py, which evaluates many
+popularity functions at once using arrays, gives the same leaf popularities as
+calculating each one using calc_popularities_for_wikitaxa and sum_popularity_over_tree
+"""
+import csv
+import io
+import math
+import os
+import random
+import re
+import sys
+
+import numpy as np
+
+from . import web2py_app_dir
+from .test_tree_arrays import random_newick, read_tree
+
+popularity_dir = os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'TaxonMappingAndPopularity')
+if popularity_dir not in sys.path:
+    sys.path.insert(0, popularity_dir)
+import calc_phylogenetic_popularity as calc
+from OTT_popularity_mapping import calc_popularities_for_wikitaxa, sum_popularity_over_tree
+
+
+def random_raw_pop_csv(rnd, otts, n_months=6):
+    """A csv file as output by OTT_popularity_mapping.py, with some missing data"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["OTT_ID", "Qid", "PopBase", "PageSize"] +
+        ["pagecounts-2016-{:02}-views-ge-5".format(m + 1) for m in range(n_months)])
+    for ott in otts:
+        if rnd.random() < 0.2:
+            writer.writerow([ott])  # no wikidata item
+        else:
+            views = [rnd.choice(["", 0, rnd.randint(5, 10000)]) for m in range(n_months)]
+            writer.writerow([ott, ott + 1000, "", rnd.choice(["", rnd.randint(100, 100000)])] + views)
+    return out.getvalue()
+
+
+class TestPopularitySweep(object):
+    @classmethod
+    def setup_class(self):
+        rnd = random.Random(35)
+        self.newick = random_newick(rnd, 300)
+        otts = [int(o) for o in re.findall(r"_ott(\d+)", self.newick)]
+        self.csv = random_raw_pop_csv(rnd, otts)
+        self.exclude = ["Taxon_ott{}".format(o) for o in rnd.sample(otts, 3)]
+
+    def expected(self, params):
+        """Leaf popularities for a single parameter set, using the dendropy code"""
+        OTT_ptrs = {ott: {'wd': {'final_wiki_item': d}}
+            for ott, d in calc.create_structure_from_file(io.StringIO(self.csv)).items()}
+        items = [p['wd']['final_wiki_item'] for p in OTT_ptrs.values()]
+        calc_popularities_for_wikitaxa(items, '', trim_highest=params['trim_highest'])
+        for d in items:
+            if 'pop' in d:
+                # calc_popularities_for_wikitaxa fixes the powers at 0.5
+                d['pop'] = (d['pop']**2 / d['PGsz'])**params['views_power'] * d['PGsz']**params['size_power']
+        tree = sum_popularity_over_tree(read_tree(self.newick), OTT_ptrs, self.exclude, use_arrays=False)
+        return {
+            leaf.label: (params['ancestor_weight'] * leaf.ancestors_popsum + params['descendant_weight'] * leaf.descendants_popsum)
+                / math.log(leaf.n_ancestors + leaf.n_descendants)**params['log_power']
+            for leaf in tree.leaf_node_iter()}
+
+    def sweep(self, specs):
+        param_sets = calc.sweep_parameters(specs)
+        otts, page_sizes, page_views = calc.load_popularity_arrays(io.StringIO(self.csv))
+        labels, matrix = calc.sweep_popularity(
+            read_tree(self.newick), otts, page_sizes, page_views, param_sets, self.exclude)
+        return param_sets, labels, matrix
+
+    def test_default_is_standard_popularity(self):
+        param_sets, labels, matrix = self.sweep([])
+        assert len(param_sets) == 1 and matrix.shape == (len(labels), 1)
+        expected = self.expected(param_sets[0])
+        assert sorted(labels) == sorted(expected)
+        assert np.allclose(matrix[:, 0], [expected[label] for label in labels], rtol=1e-12)
+        assert calc.sweep_column_name(param_sets[0], param_sets) == "popularity"
+
+    def test_grid(self):
+        specs = ["trim_highest=0,1,2", "log_power=0,0.5,1", "ancestor_weight=0,1", "views_power=0.5,1"]
+        param_sets, labels, matrix = self.sweep(specs)
+        assert matrix.shape == (len(labels), 3 * 3 * 2 * 2)
+        names = [calc.sweep_column_name(p, param_sets) for p in param_sets]
+        assert len(set(names)) == len(names)
+        assert names[0] == "trim_highest=0 views_power=0.5 ancestor_weight=0.0 log_power=0.0"
+        for column, params in enumerate(param_sets):
+            expected = self.expected(params)
+            assert np.allclose(matrix[:, column], [expected[label] for label in labels], rtol=1e-12), names[column]
+
+    def test_bad_parameter(self):
+        for bad in (["popularity=1"], ["trim_highest"]):
+            try:
+                calc.sweep_parameters(bad)
+                assert False, "Should have raised for {}".format(bad)
+            except ValueError:
+                pass
+
+    def test_spearman(self):
+        x = np.array([1.0, 5.0, 3.0, 3.0, np.nan])
+        assert calc.average_ranks(x).tolist() == [2.0, 5.0, 3.5, 3.5, 1.0]
+        correlations = calc.spearman_correlations(np.column_stack([x, 2 * x + 1, x**2]))
+        assert np.allclose(correlations, 1.0)
+        y = np.array([1.0, 2.0, 3.0, 4.0])
+        correlations = calc.spearman_correlations(np.column_stack([y, -y, [1, 3, 2, 4]]))
+        assert np.allclose(correlations[0], [1.0, -1.0, 0.8])
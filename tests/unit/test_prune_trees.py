@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the single pass leave_only() in prune_trees_from_dict.py prunes random trees
+in exactly the same way as the original version (copied below)
+"""
+import os
+import random
+import re
+import sys
+
+from dendropy import Tree, Taxon
+
+from . import web2py_app_dir
+from .test_tree_arrays import random_newick
+
+treebuild_dir = os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'TreeBuild')
+if treebuild_dir not in sys.path:
+    sys.path.insert(0, treebuild_dir)
+import prune_trees_from_dict
+
+
+def old_leave_only(self, to_keep_dict):
+    """The original version of prune_trees_from_dict.leave_only"""
+    to_keep = self.taxon_namespace.get_taxa(labels=to_keep_dict.keys())
+    for nd in self.postorder_node_iter():
+        if hasattr(nd, 'keep') or (nd.taxon and nd.taxon in to_keep):
+            if (nd.parent_node):
+                nd.parent_node.keep = True
+    to_prune = set([t for t in self.taxon_namespace if t not in to_keep])
+    for lf in self.leaf_node_iter(lambda n: n.taxon in to_prune):
+        lf.spp=1;
+    for nd in self.postorder_node_iter():
+        if (hasattr(nd, 'spp')):
+            if (nd.parent_node and not hasattr(nd.parent_node, 'keep')):
+                if (hasattr(nd.parent_node, 'spp')):
+                    nd.parent_node.spp += nd.spp
+                else:
+                    nd.parent_node.spp = nd.spp
+            else:
+                if (nd.spp > 1):
+                    if (nd.taxon):
+                        nd.taxon.label += '#%d' % (nd.spp)
+                    else:
+                        if (nd.label):
+                            nd.taxon = Taxon(label=nd.label + '#%d' % (nd.spp))
+                        else:
+                            nd.taxon = Taxon(label='unknown#%d' % (nd.spp))
+                    nd.set_child_nodes([])
+    self.prune_leaves_without_taxa(update_bipartitions=False,suppress_unifurcations=False)
+    for n in to_keep_dict:
+        if self.taxon_namespace.has_taxon_label(n):
+            to_keep_dict[n] += 1
+
+
+def random_prunable_newick(rnd, n_leaves):
+    """A random tree as in test_tree_arrays.py, with some unlabelled tips and internal nodes"""
+    newick = random_newick(rnd, n_leaves, unifurcation_prob=0.2)
+    newick = re.sub(r"(?<=[(,])Taxon_ott\d+(?=[,)])", lambda m: "" if rnd.random() < 0.05 else m.group(0), newick)
+    return re.sub(r"(?<=\))Taxon_ott\d+", lambda m: "" if rnd.random() < 0.3 else m.group(0), newick)
+
+
+def random_keep_dict(rnd, newick):
+    labels = re.findall(r"Taxon_ott\d+", newick)
+    keep = rnd.sample(labels, rnd.randint(0, min(len(labels), rnd.choice([2, 10, 50]))))
+    keep = [label.upper() if rnd.random() < 0.1 else label for label in keep]  # dendropy matches any case
+    return {label: 0 for label in keep + ["Not_in_tree_ott1"]}
+
+
+def read_tree(newick):
+    return Tree.get(data=newick, schema="newick", preserve_underscores=True, rooting='default-rooted')
+
+
+def as_string(tree):
+    return tree.as_string(schema="newick", unquoted_underscores=True, suppress_rooting=True).strip()
+
+
+class TestPruneTrees(object):
+    def test_same_as_original(self):
+        rnd = random.Random(38)
+        n_collapsed = 0
+        for i in range(200):
+            newick = random_prunable_newick(rnd, rnd.randint(1, 150))
+            keep = random_keep_dict(rnd, newick)
+            old_tree, old_keep = read_tree(newick), dict(keep)
+            old_leave_only(old_tree, old_keep)
+            tree, new_keep = read_tree(newick), dict(keep)
+            tree.leave_only(new_keep)
+            assert as_string(tree) == as_string(old_tree), newick
+            assert new_keep == old_keep
+            n_collapsed += as_string(tree).count("#")
+        assert n_collapsed > 100
+
+    def test_pruned_counts(self):
+        tree = read_tree("((A,B)C,((D,E)F,G)H,(I,J),K)root;")
+        keep = {"B": 0, "g": 0, "X": 0}
+        tree.leave_only(keep)
+        assert as_string(tree) == "((A,B)C,(F#2,G)H,unknown#2,K)root;"
+        assert keep == {"B": 1, "g": 1, "X": 0}
+
+    def test_keep_nothing(self):
+        tree = read_tree("((A,B)C,(D,E))root;")
+        keep = {}
+        tree.leave_only(keep)
+        assert as_string(tree) == "root#4;"
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the recent_sponsorships table, as kept up to date by
+update_recent_sponsorships() in modules/sponsorship.py, lists the same sponsored leaves in
+the same order, with the same images, as the original queries on reservations and
+images_by_ott in the home and sponsored pages, both when rebuilt and when updated leaf by leaf,
+and after the images have changed and been refreshed
+"""
+import random
+from datetime import datetime, timedelta
+
+from . import SponsorshipDB
+from sponsorship import update_recent_sponsorships, refresh_recent_sponsorship_images
+from .test_leaf_cards import old_leaf_card_images, image_tuple
+
+
+def old_sponsored(db, omit_nopics=False):
+    """The leaves on the original sponsored page, with the image shown for each"""
+    resv = db.reservations
+    query = (resv.verified_time != None)
+    query &= ((resv.deactivated == None) | (resv.deactivated == ""))
+    if omit_nopics:
+        query = query & (resv.verified_preferred_image_src != None)
+    rows = db(query).select(resv.ALL, orderby=~resv.verified_time|resv.reserve_time)
+    default_images, user_images = old_leaf_card_images(db, rows)
+    return [(r.OTT_ID, r.verified_name, image_tuple(user_images.get(r.OTT_ID) or default_images.get(r.OTT_ID)))
+        for r in rows]
+
+
+def new_sponsored(db, omit_nopics=False):
+    rs = db.recent_sponsorships
+    rows = db((rs.verified_preferred_image_src != None) if omit_nopics else (rs.id > 0)).select(
+        rs.ALL, orderby=~rs.verified_time|rs.reserve_time)
+    return [(r.OTT_ID, r.verified_name, None if r.src is None else (r.OTT_ID, r.src, r.src_id, r.rights, r.licence))
+        for r in rows]
+
+
+class TestRecentSponsorships(SponsorshipDB):
+    @classmethod
+    def setup_class(self):
+        super().setup_class()
+        db = self.db
+        self.rnd = rnd = random.Random(49)
+        self.start = start = datetime(2020, 1, 1)
+        for ott in range(1, 301):
+            images = []
+            n_images = rnd.choice([0, 1, 2, 3])
+            for i in range(n_images):
+                images.append((rnd.choice([1, 2]), ott * 10 + i))
+                db.images_by_ott.insert(ott=ott, src=images[-1][0], src_id=images[-1][1],
+                    rights="Owner {}".format(i), licence="CC BY (3.0)", overall_best_any=(i == 0))
+            if rnd.random() < 0.7:
+                src, src_id = rnd.choice(images) if images else (None, None)
+                db.reservations.insert(OTT_ID=ott, name="Genus species{}".format(ott),
+                    reserve_time=start + timedelta(hours=rnd.randint(0, 1000)),
+                    # plenty of ties in verified_time, which are ordered by reserve_time
+                    verified_time=start + timedelta(days=rnd.randint(0, 50)) if rnd.random() < 0.8 else None,
+                    verified_kind=rnd.choice(["by", "for"]), verified_name="Sponsor {}".format(ott),
+                    user_nondefault_image=int(images != [] and rnd.random() < 0.3),
+                    verified_preferred_image_src=src, verified_preferred_image_src_id=src_id,
+                    deactivated=rnd.choice([None] * 8 + ["", "complaint"]))
+        db.commit()
+
+    def test_rebuild(self):
+        db = self.db
+        n = update_recent_sponsorships(db, self.start)
+        db.commit()
+        assert n == db(db.recent_sponsorships).count() > 100
+        for omit_nopics in (False, True):
+            assert new_sponsored(db, omit_nopics) == old_sponsored(db, omit_nopics)
+        # rebuilding again gives the same table
+        assert update_recent_sponsorships(db, self.start) == n
+        assert new_sponsored(db) == old_sponsored(db)
+
+    def test_incremental(self):
+        db = self.db
+        r = db.reservations
+        update_recent_sponsorships(db, self.start)
+        now = self.start + timedelta(days=100)
+        for i in range(30):
+            row = self.rnd.choice(db(r).select())
+            change = self.rnd.choice(["verify", "deactivate", "reactivate", "clear", "image"])
+            if change == "verify":
+                row.update_record(verified_time=now + timedelta(minutes=i), verified_name="New {}".format(i))
+            elif change == "deactivate":
+                row.update_record(deactivated="removed")
+            elif change == "reactivate":
+                row.update_record(deactivated=None)
+            elif change == "clear":
+                row.update_record(verified_time=None)
+            else:
+                row.update_record(user_nondefault_image=0)
+            update_recent_sponsorships(db, now, [row.OTT_ID])
+            assert new_sponsored(db) == old_sponsored(db)
+        # leaves that were never sponsored, or have no reservation, make no difference
+        assert update_recent_sponsorships(db, now, [5000]) == 0
+        assert update_recent_sponsorships(db, now, []) == 0
+        assert new_sponsored(db) == old_sponsored(db)
+        db.rollback()
+
+    def test_refresh_images(self):
+        db = self.db
+        img = db.images_by_ott
+        update_recent_sponsorships(db, self.start)
+        assert refresh_recent_sponsorship_images(db, self.start) == 0
+        now = self.start + timedelta(days=100)
+        live = set(r.OTT_ID for r in db(db.recent_sponsorships).select())
+        # new best images for some leaves, and new rights for others
+        for ott in self.rnd.sample(sorted(live), 40):
+            if self.rnd.random() < 0.5:
+                db(img.ott == ott).update(overall_best_any=False)
+                img.insert(ott=ott, src=1, src_id=ott * 10 + 9, rights="New", licence="CC0", overall_best_any=True)
+            else:
+                db(img.ott == ott).update(rights="Changed")
+        assert new_sponsored(db) != old_sponsored(db)
+        changed = [r for r in new_sponsored(db) if r not in old_sponsored(db)]
+        assert refresh_recent_sponsorship_images(db, now, batch_size=7) == len(changed) > 0
+        assert new_sponsored(db) == old_sponsored(db)
+        rs = db.recent_sponsorships
+        assert db(rs.updated_time == now).count() == len(changed)
+        assert refresh_recent_sponsorship_images(db, now) == 0
+        db.rollback()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that setting prices in bulk (set_prices in modules/sponsorship.py) gives the same
+leaf prices and price bands as the original per-band updates in manage/SET_PRICES
+"""
+import random
+
+from . import SponsorshipDB
+from sponsorship import set_prices
+
+prices = [500, 1000, 2000, 4000, 7500, 15000]
+bespoke_prices = [
+    [],
+    ['Quercus_robur'],
+    ['Latimeria_chalumnae', 'Dionaea_muscipula', 'Quercus_robur'],
+    ['Coccinella_septempunctata', 'Macrocystis_pyrifera', 'Amanita_muscaria'],
+]
+
+
+def old_set_prices(db, max_pop):
+    """The original database updates in manage/SET_PRICES, given the form values in max_pop"""
+    queries = {}
+    cutoffs = {}
+    prev = None
+    for p in sorted(prices):
+        if prev is None:
+            cutoffs[p] = max_pop[p]
+            queries[p] = (db((db.ordered_leaves.popularity == None) |
+                                 (db.ordered_leaves.popularity <  cutoffs[p])))
+        elif max_pop.get(p) is not None:
+            cutoffs[p] = max_pop[p]
+            queries[p] = db((db.ordered_leaves.popularity >= cutoffs[prev]) &
+                                    (db.ordered_leaves.popularity <  cutoffs[p]))
+        else:
+            queries[p] = db((db.ordered_leaves.popularity >= cutoffs[prev]))
+        prev = p
+    db.prices.truncate()
+    for p in sorted(prices):
+        queries[p].update(price=p)
+    target_band = 0
+    for p in sorted(prices, reverse=True):
+        db(db.ordered_leaves.name.belongs(bespoke_prices[target_band])).update(price=p)
+        target_band+=1
+        if target_band>=len(bespoke_prices):
+            break
+    rows = db().select(db.banned.ott)
+    for ban in rows:
+        db(db.ordered_leaves.ott == ban.ott).update(price=None)
+    for p in sorted(prices):
+        num=queries[p].count()
+        db.prices.insert(price=p, current_cutoff=(float(cutoffs[p]) if p in cutoffs else None), n_leaves=num)
+    db.commit()
+
+
+class TestSetPrices(SponsorshipDB):
+    @classmethod
+    def setup_class(self):
+        super().setup_class()
+        rnd = random.Random(43)
+        names = [n for names in bespoke_prices for n in names] + ["Species_{}".format(i) for i in range(3000)]
+        for i in range(5000):
+            self.db.ordered_leaves.insert(name=rnd.choice(names), ott=i if rnd.random() < 0.9 else None,
+                popularity=rnd.choice([None, 0.0, 10.0, 20.0, 50.0]) if rnd.random() < 0.2 else rnd.random() * 100,
+                price=rnd.choice([None, 500, 15000]))
+        for i in range(40):
+            self.db.banned.insert(ott=rnd.randint(0, 5000))
+        self.db.commit()
+        self.original = self.db(self.db.ordered_leaves).select().as_list()
+
+    def state(self):
+        db = self.db
+        leaves = {r.id: r.price for r in db(db.ordered_leaves).select(db.ordered_leaves.id, db.ordered_leaves.price)}
+        bands = db(db.prices).select(db.prices.price, db.prices.current_cutoff, db.prices.n_leaves,
+            orderby=db.prices.price).as_list()
+        return leaves, bands
+
+    def reset(self):
+        db = self.db
+        for row in self.original:
+            db(db.ordered_leaves.id == row['id']).update(price=row['price'])
+        db.prices.insert(price=1, n_leaves=1)
+        db.commit()
+
+    def test_same_as_old(self):
+        for max_pop in ([10.0, 20.0, 50.0, 70.0, 90.0], [1.0, 10.0, 10.0, 50.5, 99.0], [0.0, 0.0, 0.0, 0.0, 0.0]):
+            max_pop = dict(zip(prices, max_pop))
+            self.reset()
+            old_set_prices(self.db, max_pop)
+            expected = self.state()
+            self.reset()
+            bands = set_prices(self.db, [(p, max_pop.get(p)) for p in prices], zip(sorted(prices, reverse=True), bespoke_prices))
+            assert self.state() == expected
+            assert None in expected[0].values()
+            assert [b['n_leaves'] for b in bands] == [b['n_leaves'] for b in expected[1]]
+            assert sum(b['n_leaves'] for b in bands) == len(self.original)
+            # changed counts the leaves whose price differs from their band before any overrides
+            def band(popularity):
+                for p in prices[:-1]:
+                    if popularity is None or popularity < max_pop[p]:
+                        return p
+                return prices[-1]
+            changed = {p: 0 for p in prices}
+            for r in self.original:
+                if r['price'] != band(r['popularity']):
+                    changed[band(r['popularity'])] += 1
+            assert [b['changed'] for b in bands] == [changed[p] for p in prices]
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that searching sponsor text using the sponsor_search_tokens table
+(search_sponsor_text in modules/sponsorship.py) finds the same sponsorships, in the same
+order, as the original LIKE '%word%' query in search_sponsor (controllers/API.py),
+with its expiry calculation changed from MySQL's DATE_ADD to the SQLite equivalent
+"""
+import random
+from datetime import datetime, timedelta
+
+from . import SponsorshipDB
+from sponsorship import (search_sponsor_text, update_sponsor_search_tokens, sponsor_text_tokens,
+    remove_sponsorship_copies, sponsor_token_length)
+
+colnames = [
+    'OTT_ID', 'name', 'verified_name', 'verified_more_info', 'verified_kind',
+    'verified_url', 'verified_preferred_image_src', 'verified_preferred_image_src_id']
+alt_txt = {"verified_name": "This leaf has been sponsored",
+           "verified_more_info": "text awaiting confirmation",
+           "verified_kind": "",
+           "verified_preferred_image_src": None,
+           "verified_preferred_image_src_id": None,
+           "verified_url": None}
+words = ["Smith", "Jones", "the", "Family", "in", "memory", "of", "O'Brien", "Anne-Marie",
+    "grandad", "Zoe", "from", "class", "3B", "Jonesy", "smithson", "MEMORIAL", "and", "love"]
+
+
+def old_search_sponsor(db, searchFor, searchType, now, order_by_recent=None, limit=None, start=0):
+    """The query from the original search_sponsor, for SQLite"""
+    alt_colnames = [(("'"+alt_txt[c]+"'" if alt_txt[c] else "NULL") + " AS " + c) if c in alt_txt else c for c in colnames]
+    search_query = {'verif':"", 'unverif':""}
+    search_terms = []
+    if searchType != "all":
+        search_query['verif'] = "verified_kind = ?"
+        search_query['unverif'] = "user_sponsor_kind = ?"
+        search_terms.append(searchType)
+    for word in ["%"+w+"%" for w in searchFor if w]:
+        if search_terms:
+            search_query['verif'] += " AND "
+            search_query['unverif'] += " AND "
+        search_query['verif'] += "(verified_name like ? or verified_more_info like ?)"
+        search_query['unverif'] += "(user_sponsor_name like ? or user_more_info like ?)"
+        search_terms.extend([word, word])
+    query = "SELECT * FROM (SELECT " + ",".join(colnames) + " FROM reservations"
+    query += " WHERE verified_time IS NOT NULL AND (deactivated IS NULL OR deactivated = '')"
+    query += " AND (datetime(verified_time, '+' || sponsorship_duration_days || ' days') > '{}')".format(
+        now.strftime("%Y-%m-%d 00:00:00"))
+    query += " AND " + search_query['verif']
+    if order_by_recent:
+        query += ' ORDER BY verified_time DESC'
+    query += ") AS t1"
+    query += " UNION ALL "
+    query += "SELECT * FROM (SELECT " + ",".join(alt_colnames) + " FROM reservations"
+    query += " WHERE verified_time IS NULL AND user_sponsor_kind IS NOT NULL AND user_sponsor_kind != ''"
+    query += " AND (deactivated IS NULL OR deactivated = '')"
+    query += " AND " + search_query['unverif']
+    if order_by_recent:
+        query += ' ORDER BY user_updated_time DESC'
+    query += ") AS t2"
+    if limit:
+        query += ' LIMIT ' + str(int(limit))
+        if start:
+            query += ' OFFSET ' + str(int(start))
+    return [tuple(row) for row in db.executesql(query, search_terms + search_terms)]
+
+
+def new_search_sponsor(db, searchFor, searchType, now, order_by_recent=None, limit=None, start=0):
+    """As in search_sponsor, but without translating the alternative text"""
+    return [
+        tuple(row[c] if verified or c not in alt_txt else (alt_txt[c] or None) for c in colnames)
+        for verified, row in search_sponsor_text(db, searchFor, colnames, now,
+            None if searchType == "all" else searchType, order_by_recent, limit, start)]
+
+
+class TestSponsorSearch(SponsorshipDB):
+    @classmethod
+    def setup_class(self):
+        super().setup_class()
+        db = self.db
+        self.rnd = rnd = random.Random(50)
+        self.now = now = datetime(2020, 6, 1, 12, 0, 0)
+
+        def text(n):
+            return " ".join(rnd.choice(words) for i in range(n)) or None
+        for ott in range(1, 501):
+            kind = rnd.choice(["by", "for", "", None])
+            row = dict(OTT_ID=ott, name="Genus species{}".format(ott), user_sponsor_kind=kind,
+                user_sponsor_name=text(rnd.randint(0, 3)), user_more_info=text(rnd.randint(0, 3)),
+                user_updated_time=now - timedelta(minutes=ott * 7 % 501),
+                deactivated=rnd.choice([None] * 10 + ["", "complaint"]))
+            if kind and rnd.random() < 0.6:
+                row.update(verified_kind=kind, verified_name=text(rnd.randint(1, 3)),
+                    verified_more_info=text(rnd.randint(0, 3)), verified_url="http://example.com/{}".format(ott),
+                    verified_preferred_image_src=1, verified_preferred_image_src_id=ott,
+                    verified_time=now - timedelta(days=rnd.randint(0, 100), minutes=ott),
+                    sponsorship_duration_days=rnd.choice([None, 5, 50, 1000]))
+            db.reservations.insert(**row)
+        update_sponsor_search_tokens(db)
+        db.commit()
+
+    def searches(self):
+        """Random search words: whole words, parts of words, in any case, and combinations"""
+        rnd = self.rnd
+        for i in range(150):
+            terms = []
+            for j in range(rnd.choice([1, 1, 2, 3])):
+                word = rnd.choice(words)
+                start = rnd.randint(0, len(word) - 1)
+                word = word[start:rnd.randint(start + 1, len(word))]
+                terms.append(rnd.choice([word, word.upper(), word.lower()]))
+            yield terms
+        yield ["nothing"]
+        yield ["Jones", "Smith"]
+        yield ["Brien", "o'b"]
+
+    def test_same_as_like(self):
+        db = self.db
+        n_found = 0
+        for terms in self.searches():
+            for search_type in ("all", "by", "for"):
+                old = old_search_sponsor(db, terms, search_type, self.now)
+                # with no ordering, both return rows in the order of the reservations table
+                assert new_search_sponsor(db, terms, search_type, self.now) == old, terms
+                n_found += len(old)
+            old = old_search_sponsor(db, terms, "all", self.now, order_by_recent=True)
+            assert new_search_sponsor(db, terms, "all", self.now, order_by_recent=True) == old, terms
+            for limit, start in ((5, 0), (5, 3), (20, 10), (1, 0)):
+                assert new_search_sponsor(db, terms, "all", self.now, True, limit, start) == \
+                    old_search_sponsor(db, terms, "all", self.now, True, limit, start), terms
+        assert n_found > 1000
+
+    def test_updates(self):
+        db = self.db
+        r = db.reservations
+        later = self.now + timedelta(days=10)
+        searches = list(self.searches())[:40]
+        for i in range(40):
+            row = self.rnd.choice(db(r).select())
+            change = self.rnd.choice(["verify", "edit", "deactivate", "clear"])
+            if change == "verify":
+                row.update_record(verified_time=later, verified_kind=row.user_sponsor_kind or "by",
+                    verified_name="Newly Verified {}".format(i), sponsorship_duration_days=100)
+            elif change == "edit":
+                row.update_record(user_sponsor_kind="for", user_sponsor_name="Edited Sponsor",
+                    verified_more_info="edited text")
+            elif change == "deactivate":
+                row.update_record(deactivated="removed")
+            if change == "clear":
+                row.update_record(verified_time=None, user_sponsor_kind=None)
+                remove_sponsorship_copies(db, [row.OTT_ID])
+            else:
+                update_sponsor_search_tokens(db, [row.OTT_ID])
+        for terms in searches + [["verified"], ["EDITED"], ["sponsor"]]:
+            assert new_search_sponsor(db, terms, "all", later) == old_search_sponsor(db, terms, "all", later), terms
+        # rebuilding the table from scratch gives the same tokens
+        tokens = sorted((t.OTT_ID, t.token, t.verified, t.expires) for t in db(db.sponsor_search_tokens).select())
+        update_sponsor_search_tokens(db)
+        assert sorted((t.OTT_ID, t.token, t.verified, t.expires) for t in db(db.sponsor_search_tokens).select()) == tokens
+        db.rollback()
+
+    def test_tokens(self):
+        assert sponsor_text_tokens("Zoë  O'Brien", None, "") == {
+            "zoe", "oe", "e", "o'brien", "'brien", "brien", "rien", "ien", "en", "n"}
+        assert search_sponsor_text(self.db, ["", " "], colnames, self.now) == []
+
+    def test_long_words(self):
+        db = self.db
+        word = "Llanfairpwllgwyngyllgogerychwyrndrobwllllantysiliogogogoch"
+        assert len(word) > sponsor_token_length
+        db.reservations.insert(OTT_ID=1001, user_sponsor_kind="by", user_sponsor_name="From " + word,
+            user_updated_time=self.now)
+        update_sponsor_search_tokens(db, [1001])
+        assert max(len(t.token) for t in db(db.sponsor_search_tokens).select()) == sponsor_token_length
+        for terms in ([word], [word.upper()], [word[5:]], [word[:-1]], [word[:-1] + "x"], [word + "s"]):
+            assert new_search_sponsor(db, terms, "all", self.now) == old_search_sponsor(db, terms, "all", self.now), terms
+        assert [row[0] for row in new_search_sponsor(db, [word], "all", self.now)] == [1001]
+        assert new_search_sponsor(db, [word[:-1] + "x"], "all", self.now) == []
+        db.rollback()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that walking through every page of the sponsorable leaves in a clade (using
+sponsorable_leaves_page in modules/sponsorship.py) lists exactly the leaves selected by
+the original NOT IN query, in the same alphabetical order
+"""
+import random
+from datetime import datetime
+
+from . import SponsorshipDB
+from sponsorship import sponsorable_leaves_page
+
+
+def old_sponsorable_children(db, lft, rgt):
+    """sponsorable_children_query() in OZfunctions.py for a node with leaves lft..rgt, unpaged"""
+    query = (db.ordered_leaves.id >= lft) & (db.ordered_leaves.id <= rgt)
+    query = query & (db.ordered_leaves.ott != None)
+    query = query & (db.ordered_leaves.name.contains(' '))
+    unavailable = db((db.reservations.verified_time != None))._select(db.reservations.OTT_ID)
+    query = query & (~db.ordered_leaves.ott.belongs(unavailable))
+    return db(query).select(db.ordered_leaves.id, orderby=db.ordered_leaves.name|db.ordered_leaves.id)
+
+
+class TestSponsorablePages(SponsorshipDB):
+    @classmethod
+    def setup_class(self):
+        super().setup_class()
+        db = self.db
+        rnd = random.Random(46)
+        genera = ["Genus{}".format(i) for i in range(50)]
+        for i in range(1, 6001):
+            # plenty of repeated names, and some unsponsorable leaves with no ott or space in the name
+            name = "{} species{}".format(rnd.choice(genera), rnd.randint(0, 1000))
+            if rnd.random() < 0.05:
+                name = name.replace(" ", "_")
+            db.ordered_leaves.insert(name=name, ott=None if rnd.random() < 0.05 else i, price=rnd.choice([None, 500, 1000]))
+        for ott in rnd.sample(range(1, 6001), 1500):
+            db.reservations.insert(OTT_ID=ott, verified_time=datetime(2020, 1, 1) if rnd.random() < 0.7 else None)
+        db.commit()
+
+    def walk(self, lft, rgt, n):
+        db = self.db
+        query = (db.ordered_leaves.id >= lft) & (db.ordered_leaves.id <= rgt)
+        query = query & (db.ordered_leaves.ott != None) & (db.ordered_leaves.name.contains(' '))
+        pages = []
+        after = None
+        while True:
+            rows = sponsorable_leaves_page(db, query, after, n)
+            assert len(rows) <= n + 1
+            pages.append([r.id for r in rows[:n]])
+            if len(rows) <= n:
+                return pages
+            after = rows[n - 1].id
+
+    def test_pages_match_unpaged(self):
+        for lft, rgt, n in ((1, 6000, 500), (1, 6000, 37), (1000, 1999, 100), (2000, 2000, 10), (100, 150, 500)):
+            pages = self.walk(lft, rgt, n)
+            expected = [r.id for r in old_sponsorable_children(self.db, lft, rgt)]
+            assert [leaf for page in pages for leaf in page] == expected
+            assert all(len(page) == n for page in pages[:-1])
+            if lft == 1:
+                assert len(pages) > 1 and len(expected) > 3000
+
+    def test_sponsored_while_paging(self):
+        db = self.db
+        query = (db.ordered_leaves.ott != None) & (db.ordered_leaves.name.contains(' '))
+        first = sponsorable_leaves_page(db, query, None, 100)
+        # sponsoring a leaf on the first page does not change where the next page starts
+        db(db.reservations.OTT_ID == first[0].ott).delete()
+        db.reservations.insert(OTT_ID=first[0].ott, verified_time=datetime(2020, 1, 1))
+        second = sponsorable_leaves_page(db, query, first[99].id, 100)
+        assert second[0].id == first[100].id
+        db.rollback()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check the reservation state machine used by the sponsorship pages (modules/sponsorship.py),
+that when many visitors view the same leaf at once, exactly one of them reserves it, and
+that the periodic sweep of old reservations (sweep_reservations) clears the right rows,
+and that repeated PayPal notifications are only applied once
+"""
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from . import SponsorshipDB
+from sponsorship import view_reservation, sweep_reservations, set_sponsorship_ends, \
+    renewed_leaves_without_ends, record_paypal_notification, process_paypal_notifications
+
+reservation_time_limit = 360.0
+unpaid_time_limit = 2.0*24.0*60.0*60.0
+
+
+class TestSponsorship(SponsorshipDB):
+    def setup_method(self, method=None):
+        self.db.reservations.truncate()
+        self.db.expired_reservations.truncate()
+        self.db.paypal_notifications.truncate()
+        self.db.banned.truncate()
+        self.db.commit()
+
+    def view(self, ott, user_code, now, **kwargs):
+        return view_reservation(self.db, ott, "Homo sapiens", user_code, now,
+            reservation_time_limit, unpaid_time_limit, **kwargs)
+
+    def test_reserve_and_release(self):
+        db = self.db
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        status, release_time, row = self.view(1, "userA", start)
+        assert status == "available" and row.user_registration_id == "userA" and row.num_views == 1
+        status, release_time, row = self.view(1, "userB", start + timedelta(seconds=60))
+        assert status == "reserved" and release_time == 300
+        assert row.user_registration_id == "userA" and row.num_views == 2
+        status, release_time, row = self.view(1, "userA", start + timedelta(seconds=120))
+        assert status == "available only to user" and row.reserve_time == start + timedelta(seconds=120)
+        # userA's reservation times out
+        status, release_time, row = self.view(1, "userB", start + timedelta(seconds=600))
+        assert status == "available" and row.user_registration_id == "userB"
+        # form submissions do not count as views
+        status, release_time, row = self.view(1, "userB", start + timedelta(seconds=610), count_view=False)
+        assert status == "available only to user" and row.num_views == 4
+        stored = db.reservations(row.id)
+        assert stored.num_views == 4 and stored.last_view == start + timedelta(seconds=600)
+        assert stored.reserve_time == start + timedelta(seconds=610)
+
+    def test_no_sponsorship(self):
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        status, release_time, row = self.view(2, "userA", start, allow_sponsorship=False)
+        assert status == "available" and row.reserve_time is None and row.user_registration_id is None
+        status, release_time, row = self.view(2, "userB", start, allow_sponsorship=False)
+        assert status == "available" and row.reserve_time is None and row.num_views == 2
+
+    def test_unpaid_and_sponsored(self):
+        db = self.db
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        self.view(3, "userA", start)
+        db(db.reservations.OTT_ID == 3).update(user_sponsor_name="Jo", e_mail="jo@example.com")
+        db.commit()
+        assert self.view(3, "userB", start + timedelta(days=1))[0] == "unverified waiting for payment"
+        status, release_time, row = self.view(3, "userB", start + timedelta(days=3))
+        assert status == "available" and row.user_sponsor_name is None and row.e_mail is None
+        stored = db.reservations(row.id)
+        assert stored.user_sponsor_name is None and stored.name is None and stored.num_views == 3
+        assert stored.reserve_time is None
+        db(db.reservations.OTT_ID == 3).update(
+            user_sponsor_name="Jo", PP_transaction_code="PP1", reserve_time=start)
+        db.commit()
+        assert self.view(3, "userB", start + timedelta(days=10))[0] == "unverified"
+        db(db.reservations.OTT_ID == 3).update(verified_time=start, verified_name="Jo")
+        db.banned.insert(ott=3)
+        db.commit()
+        assert self.view(3, "userB", start + timedelta(days=10))[0] == "sponsored"
+
+    def test_banned(self):
+        db = self.db
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        db.banned.insert(ott=4)
+        db.commit()
+        status, release_time, row = self.view(4, "userA", start)
+        assert status == "banned" and row.reserve_time is None and row.num_views == 1
+        status, release_time, row = self.view(4, "userA", start)
+        assert status == "banned" and row.reserve_time is None and row.num_views == 2
+
+    def contend(self, ott, now, n_threads=12):
+        """Have n_threads visitors, each with their own db connection, view a leaf at the same time"""
+        barrier = threading.Barrier(n_threads)
+        results = {}
+        def visit(user_code):
+            db = self.connect()
+            execute = db._adapter.execute
+            def slow_execute(*args, **kwargs):
+                time.sleep(0.005) #as if the database were on another server, to widen any race
+                return execute(*args, **kwargs)
+            db._adapter.execute = slow_execute
+            try:
+                barrier.wait()
+                results[user_code] = view_reservation(db, ott, "Homo sapiens", user_code, now,
+                    reservation_time_limit, unpaid_time_limit)[0]
+            finally:
+                db.close()
+        threads = [threading.Thread(target=visit, args=("user{}".format(i),)) for i in range(n_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results) == n_threads
+        return results
+
+    def test_one_winner(self):
+        db = self.db
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        for i, now in enumerate([start, start + timedelta(seconds=60), start + timedelta(seconds=1000)]):
+            # first a new row, then an existing reservation, then an expired one
+            results = self.contend(5, now)
+            winners = [user for user, status in results.items() if status == "available"]
+            row = db(db.reservations.OTT_ID == 5).select().first()
+            db.commit()
+            if i == 1:
+                assert winners == []
+            else:
+                assert len(winners) == 1
+                assert row.user_registration_id == winners[0]
+                assert all(status == "reserved" for user, status in results.items() if user != winners[0])
+            assert row.num_views == len(results) * (i + 1)
+            assert db(db.reservations.OTT_ID == 5).count() == 1
+
+    def test_retry_only_on_duplicate_insert(self):
+        db = self.db
+        now = datetime(2020, 1, 1, 12, 0, 0)
+        execute = db._adapter.execute
+        for error, retried in ((sqlite3.IntegrityError, True), (sqlite3.OperationalError, False)):
+            inserts = []
+            def failing_execute(sql, *args, **kwargs):
+                if sql.startswith("INSERT INTO") and "reservations" in sql.split("(")[0]:
+                    inserts.append(sql)
+                    if len(inserts) == 1:
+                        #as if another visitor had inserted the row first, or the database failed
+                        raise error("simulated")
+                return execute(sql, *args, **kwargs)
+            db._adapter.execute = failing_execute
+            try:
+                if retried:
+                    assert self.view(6, "userA", now)[0] == "available"
+                else:
+                    try:
+                        self.view(6, "userA", now)
+                        assert False, "should have raised OperationalError"
+                    except sqlite3.OperationalError:
+                        pass
+            finally:
+                db._adapter.execute = execute
+            assert len(inserts) == (2 if retried else 1)
+            assert db(db.reservations.OTT_ID == 6).count() == (1 if retried else 0)
+            db(db.reservations.OTT_ID == 6).delete()
+            db.commit()
+
+    def test_sweep(self):
+        db = self.db
+        now = datetime(2020, 6, 1, 12, 0, 0)
+        def ago(**kwargs):
+            return now - timedelta(**kwargs)
+        ends = {}
+        for ott in range(100, 110):
+            # sponsorships, some of which have ended
+            ends[ott] = ago(days=105 - ott)
+            db.reservations.insert(OTT_ID=ott, num_views=ott, reserve_time=ago(days=500),
+                user_sponsor_name="Sponsor {}".format(ott), e_mail="{}@example.com".format(ott),
+                PP_transaction_code="PP{}".format(ott), user_paid=20.0,
+                verified_time=ago(days=400), verified_name="Name {}".format(ott), sponsorship_ends=ends[ott])
+            db.recent_sponsorships.insert(OTT_ID=ott)
+        db.reservations.insert(OTT_ID=200, num_views=1, reserve_time=ago(days=3), user_sponsor_name="Late")
+        db.reservations.insert(OTT_ID=201, num_views=1, reserve_time=ago(days=1), user_sponsor_name="Waiting")
+        db.reservations.insert(OTT_ID=202, num_views=1, reserve_time=ago(days=3), user_sponsor_name="Paid",
+            PP_transaction_code="PP202")
+        db.reservations.insert(OTT_ID=300, num_views=1, reserve_time=ago(seconds=600), user_registration_id="userA")
+        db.reservations.insert(OTT_ID=301, num_views=1, reserve_time=ago(seconds=60), user_registration_id="userB")
+        db.reservations.insert(OTT_ID=302, num_views=1)
+        db.commit()
+
+        # ended sponsorships are left alone unless a grace period is given
+        counts = sweep_reservations(db, now, reservation_time_limit, unpaid_time_limit)
+        assert counts == {'expired': 0, 'unpaid': 1, 'reserved': 1}
+        assert db(db.reservations.verified_time != None).count() == 10
+        with pytest.raises(ValueError):
+            sweep_reservations(db, now, reservation_time_limit, unpaid_time_limit, expiry_grace_secs=0)
+        counts = sweep_reservations(db, now, reservation_time_limit, unpaid_time_limit,
+            expiry_grace_secs=1, batch_size=2)
+        assert counts == {'expired': 5, 'unpaid': 0, 'reserved': 0}
+        rows = {r.OTT_ID: r for r in db(db.reservations).select()}
+        assert len(rows) == 16
+        for ott in range(100, 110):
+            row = rows[ott]
+            if ott < 105:
+                assert row.verified_time is None and row.user_sponsor_name is None and row.e_mail is None
+                assert row.sponsorship_ends is None and row.reserve_time is None
+            else:
+                assert row.verified_name == "Name {}".format(ott) and row.sponsorship_ends == ends[ott]
+            assert row.num_views == ott
+        expired = {r.OTT_ID: r for r in db(db.expired_reservations).select()}
+        assert sorted(expired) == list(range(100, 105))
+        assert sorted(r.OTT_ID for r in db(db.recent_sponsorships).select()) == list(range(105, 110))
+        for ott, row in expired.items():
+            assert row.was_renewed is False and row.num_views == ott and row.user_paid == 20.0
+            assert row.verified_name == "Name {}".format(ott) and row.sponsorship_ends == ends[ott]
+            assert row.reserve_time == ago(days=500) and row.PP_transaction_code == "PP{}".format(ott)
+        assert rows[200].user_sponsor_name is None and rows[200].reserve_time is None
+        assert rows[201].user_sponsor_name == "Waiting" and rows[202].user_sponsor_name == "Paid"
+        assert rows[300].reserve_time is None and rows[300].user_registration_id is None
+        assert rows[301].reserve_time == ago(seconds=60) and rows[301].user_registration_id == "userB"
+        # the swept leaves can now be viewed (and reserved) as normal
+        assert self.view(100, "userC", now)[0] == "available"
+        assert self.view(300, "userC", now)[0] == "available"
+        # a day later, the next two sponsorships have ended, but a grace period can delay moving them
+        later = now + timedelta(days=1, seconds=1)
+        counts = sweep_reservations(db, later, reservation_time_limit, unpaid_time_limit,
+            expiry_grace_secs=7*24*60*60)
+        assert counts == {'expired': 0, 'unpaid': 1, 'reserved': 3}
+        # nor are sponsorships moved while the renewal emails are going out
+        db(db.reservations.OTT_ID == 105).update(emailed_re_renewal_initial=ago(days=30))
+        db(db.reservations.OTT_ID == 106).update(
+            emailed_re_renewal_initial=ago(days=30), emailed_re_renewal_final=now)
+        db.commit()
+        counts = sweep_reservations(db, later, reservation_time_limit, unpaid_time_limit, expiry_grace_secs=1)
+        assert counts == {'expired': 0, 'unpaid': 0, 'reserved': 0}
+        counts = sweep_reservations(db, later + timedelta(days=2), reservation_time_limit, unpaid_time_limit,
+            expiry_grace_secs=24*60*60)
+        assert counts == {'expired': 2, 'unpaid': 0, 'reserved': 0}
+        assert sorted(r.OTT_ID for r in db(db.expired_reservations).select()) == list(range(100, 105)) + [106, 107]
+        db(db.reservations.OTT_ID == 105).update(emailed_re_renewal_final=now)
+        db.commit()
+        counts = sweep_reservations(db, later + timedelta(days=2), reservation_time_limit, unpaid_time_limit,
+            expiry_grace_secs=24*60*60)
+        assert counts == {'expired': 1, 'unpaid': 0, 'reserved': 0}
+        assert db(db.reservations.user_sponsor_name != None).count() == 3
+
+    def test_set_sponsorship_ends(self):
+        db = self.db
+        now = datetime(2020, 6, 1, 12, 0, 0)
+        verified = now - timedelta(days=400)
+        for ott, duration in ((120, 365), (121, 500), (122, None)):
+            db.reservations.insert(OTT_ID=ott, user_sponsor_name="Sponsor", PP_transaction_code="PP",
+                verified_time=verified, sponsorship_duration_days=duration)
+        # a renewed sponsorship, whose end date has already been set
+        db.reservations.insert(OTT_ID=123, user_sponsor_name="Sponsor", PP_transaction_code="PP",
+            verified_time=verified, sponsorship_duration_days=365, sponsorship_ends=verified + timedelta(days=730))
+        # paid, but not yet verified
+        db.reservations.insert(OTT_ID=124, user_sponsor_name="Sponsor", PP_transaction_code="PP",
+            sponsorship_duration_days=365)
+        # renewed, but with no end date: this cannot be worked out from verified_time
+        db.reservations.insert(OTT_ID=125, user_sponsor_name="Sponsor", PP_transaction_code="PP",
+            verified_time=verified, sponsorship_duration_days=365)
+        db.expired_reservations.insert(OTT_ID=125, was_renewed=True)
+        db.commit()
+        assert set_sponsorship_ends(db, db.reservations.OTT_ID == 121) == 1
+        assert set_sponsorship_ends(db) == 1
+        assert set_sponsorship_ends(db) == 0
+        ends = {r.OTT_ID: r.sponsorship_ends for r in db(db.reservations).select()}
+        assert ends == {120: verified + timedelta(days=365), 121: verified + timedelta(days=500),
+            122: None, 123: verified + timedelta(days=730), 124: None, 125: None}
+        assert renewed_leaves_without_ends(db) == [125]
+        db.expired_reservations.truncate()
+        counts = sweep_reservations(db, now, reservation_time_limit, unpaid_time_limit, expiry_grace_secs=1)
+        assert counts['expired'] == 1
+        assert [r.OTT_ID for r in db(db.expired_reservations).select()] == [120]
+
+    def test_paypal_replay(self):
+        db = self.db
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        for ott, giftaid in ((400, True), (401, False)):
+            self.view(ott, "userA", start)
+            db(db.reservations.OTT_ID == ott).update(
+                user_sponsor_name="Jo", user_paid=20.0, user_giftaid=giftaid, PP_transaction_code="reserved")
+        db.commit()
+        def notification(ott, txn_id, **kwargs):
+            pp_vars = dict(txn_id=txn_id, mc_gross="20.00", first_name="Jo", last_name="Bloggs",
+                address_city="Oxford", address_state="Oxon", address_country="UK", payer_email="jo@example.com",
+                payment_date="12:00:00 Jan 01, 2020 PST", address_street="1 High St", address_zip="OX1 1AA")
+            pp_vars.update(kwargs)
+            return record_paypal_notification(db, ott, pp_vars, start)
+        # PayPal retries, and may send the same notification more than once
+        assert notification(400, "TXN400") is not None
+        for i in range(3):
+            assert notification(400, "TXN400") is None
+        assert notification(401, "TXN401") is not None
+        assert notification(402, "TXN402") is not None # no such reservation
+        assert db(db.paypal_notifications).count() == 3
+        applied = []
+        results = process_paypal_notifications(db, start + timedelta(minutes=1),
+            on_applied=lambda db, ott: applied.append(ott))
+        assert [(ott, error is None) for ott, error in results] == [(400, True), (401, True), (402, False)]
+        assert results[2][1].startswith("LookupError: No row updated")
+        assert applied == [400, 401]
+        # repeats after processing are also ignored
+        assert notification(401, "TXN401", first_name="Someone else") is None
+        assert process_paypal_notifications(db, start + timedelta(minutes=1, seconds=59)) == []
+        # a different notification for the same leaf cannot overwrite the details, and is not retried
+        assert notification(400, "TXN400b", first_name="Someone else") is not None
+        results = process_paypal_notifications(db, start + timedelta(minutes=3))
+        assert [ott for ott, error in results] == [402, 400]
+        assert results[1][1] == "No row updated: some details are already filled out"
+        # the notification for a leaf with no reservation is tried with increasing delays, then left
+        for minutes in (4, 5, 9, 17, 33, 65, 129, 500):
+            assert [ott for ott, error in process_paypal_notifications(db, start + timedelta(minutes=minutes))] == \
+                ([402] if minutes not in (4, 500) else [])
+        assert process_paypal_notifications(db, start + timedelta(days=10)) == []
+
+        rows = {r.OTT_ID: r for r in db(db.reservations).select()}
+        assert rows[400].PP_first_name == "Jo" and rows[400].PP_transaction_code == "TXN400"
+        assert rows[400].PP_town == "Oxford, Oxon" and rows[400].verified_paid == "20.0"
+        assert rows[400].PP_postcode == "OX1 1AA" and rows[401].PP_postcode is None
+        assert rows[401].PP_first_name == "Jo" and rows[401].PP_transaction_code == "TXN401"
+        assert self.view(400, "userB", start + timedelta(days=10))[0] == "unverified"
+        inbox = db(db.paypal_notifications).select(orderby=db.paypal_notifications.id)
+        assert [r.processed_time for r in inbox] == [start + timedelta(minutes=m) if m else None for m in (1, 1, None, 3)]
+        assert [r.attempts for r in inbox] == [1, 1, 8, 1]
+        assert inbox[2].process_error.startswith("LookupError")
+        assert json.loads(inbox[0].pp_vars)['payer_email'] == "jo@example.com"
+
+    def test_paypal_unexpected_error(self):
+        db = self.db
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        for ott in (410, 411, 412):
+            self.view(ott, "userA", start)
+            db(db.reservations.OTT_ID == ott).update(user_sponsor_name="Jo", user_paid=20.0)
+        db.commit()
+        for ott in (410, 411, 412):
+            record_paypal_notification(db, ott, dict(txn_id="TXN{}".format(ott), mc_gross="20.00"), start)
+        def on_applied(db, ott):
+            if ott == 410:
+                raise RuntimeError("mail server down")
+        results = process_paypal_notifications(db, start, on_applied=on_applied)
+        # the error is recorded, the changes for that notification undone, and later ones still applied
+        assert results == [(410, "RuntimeError: mail server down"), (411, None), (412, None)]
+        inbox = {r.OTT_ID: r for r in db(db.paypal_notifications).select()}
+        assert inbox[410].processed_time is None and inbox[410].attempts == 1
+        assert inbox[410].process_error == "RuntimeError: mail server down"
+        rows = {r.OTT_ID: r for r in db(db.reservations).select()}
+        assert rows[410].PP_transaction_code is None and rows[411].PP_transaction_code == "TXN411"
+        # the notification is tried again once the delay is up
+        assert process_paypal_notifications(db, start + timedelta(seconds=30)) == []
+        assert process_paypal_notifications(db, start + timedelta(minutes=1)) == [(410, None)]
+        inbox = {r.OTT_ID: r for r in db(db.paypal_notifications).select()}
+        assert inbox[410].processed_time == start + timedelta(minutes=1) and inbox[410].attempts == 2
+        assert inbox[410].process_error is None
+        assert db.reservations(OTT_ID=410).PP_transaction_code == "TXN410"
+
+    def test_paypal_no_txn_id(self):
+        try:
+            record_paypal_notification(self.db, 400, dict(mc_gross="20.00"), datetime(2020, 1, 1))
+            assert False, "should have raised ValueError"
+        except ValueError:
+            pass
+        assert self.db(self.db.paypal_notifications).isempty()
+
+    def test_paypal_concurrent_repeats(self, n_threads=8):
+        barrier = threading.Barrier(n_threads)
+        results = []
+        def post():
+            db = self.connect()
+            execute = db._adapter.execute
+            def slow_execute(*args, **kwargs):
+                time.sleep(0.005)
+                return execute(*args, **kwargs)
+            db._adapter.execute = slow_execute
+            try:
+                barrier.wait()
+                results.append(record_paypal_notification(db, 500, dict(txn_id="TXN500"), datetime(2020, 1, 1)))
+            finally:
+                db.close()
+        threads = [threading.Thread(target=post) for i in range(n_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results) == n_threads and len([r for r in results if r is not None]) == 1
+        assert self.db(self.db.paypal_notifications.txn_id == "TXN500").count() == 1
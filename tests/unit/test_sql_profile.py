@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the opt-in SQL profiler (modules/sql_profile.py) records the statements run
+through the DAL and db.executesql, logs slow ones, and records nothing once detached
+"""
+import os
+import shutil
+import tempfile
+
+from pydal import DAL, Field
+
+from . import modules_dir
+from sql_profile import SQLProfiler, normalize_sql, slow_query_log, top_statements, reset_stats
+
+
+class TestSQLProfile(object):
+    @classmethod
+    def setup_class(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = db = DAL('sqlite://profile.sqlite', folder=self.folder)
+        db.define_table('ordered_leaves', Field('ott', type='integer'), Field('name', type='string'))
+        db.ordered_leaves.bulk_insert([dict(ott=i, name="leaf{}".format(i)) for i in range(100)])
+        db.commit()
+
+    @classmethod
+    def teardown_class(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def setup_method(self, method=None):
+        reset_stats()
+
+    def test_normalize(self):
+        assert normalize_sql("SELECT * FROM x WHERE ott = 123 AND name='it''s'  AND t1.a > -4.5;") == \
+            "SELECT * FROM x WHERE ott = ? AND name=? AND t1.a > ?;"
+        assert normalize_sql("SELECT a FROM x WHERE ott IN (1, 2,3);") == normalize_sql("SELECT a FROM x WHERE ott IN (5);")
+        assert normalize_sql("INSERT INTO x (a,b) VALUES (1,'x'),(2,'y');") == "INSERT INTO x (a,b) VALUES (...),(...);"
+
+    def test_records_statements(self):
+        db = self.db
+        profiler = SQLProfiler("default/test").attach(db)
+        try:
+            db(db.ordered_leaves.ott < 10).select()
+            db(db.ordered_leaves.ott < 20).select()
+            db.executesql("SELECT name FROM ordered_leaves WHERE ott = ?;", (5,))
+            db(db.ordered_leaves.ott >= 90).update(name="updated")
+            db.commit()
+        finally:
+            profiler.detach(db)
+        db(db.ordered_leaves.ott < 10).select()
+        sqls = [s[0] for s in profiler.statements]
+        assert len(sqls) == 4, "Statements after detaching should not be recorded"
+        assert sqls[0] == sqls[1]
+        assert "ott = ?" in sqls[2]
+        assert profiler.statements[3][2] == 10, "UPDATE row count should be recorded"
+        assert all(s[1] >= 0 for s in profiler.statements)
+
+        stats = top_statements()
+        assert list(stats.keys()) == ["default/test"]
+        assert {s[0]: s[1] for s in stats["default/test"]}[sqls[0]] == 2
+
+    def test_slow_log(self):
+        db = self.db
+        path = os.path.join(self.folder, "slow_sql.log")
+        profiler = SQLProfiler("tree/test", slow_secs=0, slow_log=slow_query_log(path)).attach(db)
+        try:
+            db.executesql("SELECT COUNT(*) FROM ordered_leaves WHERE name LIKE 'leaf%';")
+        finally:
+            profiler.detach(db)
+        for handler in slow_query_log(path).handlers:
+            handler.flush()
+        with open(path) as f:
+            lines = f.readlines()
+        assert len(lines) == 1
+        assert "tree/test" in lines[0] and "LIKE 'leaf%'" in lines[0]
+
+    def test_disabled_adds_no_handler(self):
+        handlers = list(self.db._adapter.execution_handlers)
+        profiler = SQLProfiler("x").attach(self.db)
+        profiler.detach(self.db)
+        assert self.db._adapter.execution_handlers == handlers
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that reading source ids from the cached taxonomy (taxonomy_cache.py) gives exactly
+the same data structures as parsing the taxonomy.tsv file in create_from_taxonomy()
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from . import web2py_app_dir
+
+popularity_dir = os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'TaxonMappingAndPopularity')
+if popularity_dir not in sys.path:
+    sys.path.insert(0, popularity_dir)
+from OTT_popularity_mapping import create_from_taxonomy
+from taxonomy_cache import TaxonomyCache
+from CSV_base_table_creator import get_OTT_species
+
+sources = ['ncbi', 'if', 'worms', 'irmng', 'gbif']
+
+
+def synthetic_taxonomy(rnd, n_rows):
+    """
+    Lines of a taxonomy.tsv file, with source ids shared between taxa, ncbi ids via silva,
+    non-numeric ids, unlabelled (negative) otts and sources that are not used
+    """
+    lines = ["uid\t|\tparent_uid\t|\tname\t|\trank\t|\tsourceinfo\t|\tuniqname\t|\tflags\t|\t"]
+    ranks = ["species"] * 6 + ["genus", "family", "no rank", "subspecies", "no rank - terminal"]
+    flags = ["", "", "sibling_higher", "extinct", "incertae_sedis,extinct", "environmental"]
+    for i in range(n_rows):
+        ott = 1000 + i if rnd.random() > 0.001 else -i
+        info = []
+        for src in rnd.sample(["ncbi", "gbif", "worms", "if", "irmng", "silva", "curated", "study713"], rnd.randint(1, 4)):
+            if src == "silva":
+                info.append("ncbi:{},silva:A{}/#{}".format(rnd.randint(1, 50000), rnd.randint(1, 99), rnd.randint(1, 9)))
+            elif src == "curated":
+                info.append("curated:otu{}".format(rnd.randint(1, 100)))
+            elif src == "worms" and rnd.random() < 0.01:
+                info.append("worms:0{}".format(rnd.randint(1, 100)))  # not round-trippable through int()
+            else:
+                info.append("{}:{}".format(src, rnd.randint(1, n_rows // 2 + 1)))
+        if rnd.random() < 0.05:
+            info.append("ncbi:{}".format(rnd.randint(1, 50000)))  # a second ncbi id
+        name = "Taxon {}".format(i)
+        lines.append("\t|\t".join([str(ott), str(ott - 1), name, rnd.choice(ranks), ",".join(info), "", rnd.choice(flags), ""]))
+    return "\n".join(lines) + "\n"
+
+
+class TestTaxonomyCache(object):
+    @classmethod
+    def setup_class(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.folder, "cache")
+        self.taxonomy = os.path.join(self.folder, "taxonomy.tsv")
+        with open(self.taxonomy, "w", encoding="utf-8") as f:
+            f.write(synthetic_taxonomy(random.Random(36), 5000))
+        self.extra = os.path.join(self.folder, "extra.tsv")
+        with open(self.extra, "w", encoding="utf-8") as f:
+            f.write("uid\tsourceinfo\n1001\tncbi:999999\nmrcaott1ott2\tgbif:888888\n")
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.folder)
+
+    def sources(self, use_cache, extra=None):
+        OTT_ptrs = {1002: {'sources': {k: None for k in sources}}}
+        with open(self.taxonomy, encoding="utf-8") as f:
+            cache = TaxonomyCache.for_file(f, self.cache_dir) if use_cache else None
+            source_ptrs = create_from_taxonomy(f, sources, OTT_ptrs, 0, extra, cache)
+        return source_ptrs, OTT_ptrs
+
+    def test_same_as_parsing(self):
+        for extra in (None, self.extra):
+            parsed_source_ptrs, parsed_OTT_ptrs = self.sources(False, extra)
+            cached_source_ptrs, cached_OTT_ptrs = self.sources(True, extra)
+            assert cached_source_ptrs == parsed_source_ptrs
+            assert cached_OTT_ptrs == parsed_OTT_ptrs
+            assert list(cached_OTT_ptrs) == list(parsed_OTT_ptrs)
+            # source ids shared by several taxa are only linked from source_ptrs for the last of them
+            def linked(OTT_ptrs, source_ptrs):
+                return [[d['sources'][src] is source_ptrs[src].get(d['sources'][src]['id'])
+                    for src in sorted(d['sources']) if d['sources'][src]] for d in OTT_ptrs.values()]
+            cached_links = linked(cached_OTT_ptrs, cached_source_ptrs)
+            assert cached_links == linked(parsed_OTT_ptrs, parsed_source_ptrs)
+            assert any(False in links for links in cached_links)
+
+    def test_species(self):
+        with open(self.taxonomy, encoding="utf-8") as f:
+            cache = TaxonomyCache.for_file(f, self.cache_dir)
+            assert get_OTT_species(f, cache) == get_OTT_species(f)
+        assert len(get_OTT_species(None, cache)) > 0
+
+    def test_keyed_by_checksum(self):
+        cache = TaxonomyCache.for_file(self.taxonomy, self.cache_dir)
+        stamp = os.stat(os.path.join(cache.path, "meta.json")).st_mtime_ns
+        assert TaxonomyCache.for_file(self.taxonomy, self.cache_dir).path == cache.path
+        assert os.stat(os.path.join(cache.path, "meta.json")).st_mtime_ns == stamp
+        changed = os.path.join(self.folder, "changed.tsv")
+        with open(self.taxonomy, encoding="utf-8") as f, open(changed, "w", encoding="utf-8") as out:
+            out.write(f.read().replace("Taxon 10\t", "Taxon ten\t"))
+        assert TaxonomyCache.for_file(changed, self.cache_dir).path != cache.path
+        assert cache.array("ott").dtype.kind == 'i'
+        assert cache.array("ids_{}".format(cache.meta['sources'].index('curated'))).dtype.kind == 'U'
+
+    def test_chunked_replay(self):
+        cache = TaxonomyCache.for_file(self.taxonomy, self.cache_dir)
+        results = []
+        for chunksize in (97, 1000000):
+            OTT_ptrs = {}
+            source_ptrs = {k: {} for k in sources}
+            cache.add_sources(sources, OTT_ptrs, source_ptrs, chunksize=chunksize)
+            results.append((source_ptrs, list(OTT_ptrs.items())))
+        assert results[0] == results[1]
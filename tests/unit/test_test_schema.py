@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the tables used by the unit tests (define_sponsorship_tables() in
+tests/unit/__init__.py and the email_outbox table in test_email_outbox.py), which are
+copies of parts of models/db.py, still match it: each field must exist in the model,
+with the same type (and length, for strings). The model is read with ast, as it needs
+web2py to run.
+"""
+import ast
+import os
+import re
+import shutil
+import tempfile
+
+from pydal import DAL, Field
+
+from . import web2py_app_dir, define_sponsorship_tables
+from .test_email_outbox import define_tables as define_email_tables
+
+
+def model_tables():
+    """
+    {table: (fields, patterns)} for the tables in models/db.py, where fields is
+    {name: (type, length)} for each Field written out in full, and patterns is a list of
+    (regex, type, length) for Fields generated in a list comprehension from a format
+    string, e.g. '{}best_{}'. A table cloned from another (e.g. expired_reservations)
+    also gets the fields of that table.
+    """
+    path = os.path.join(web2py_app_dir, 'models', 'db.py')
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    constants = {'boolean': 'boolean'} # the custom TINYINT type in MySQL
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    constants[target.id] = node.value.value
+    def value(node):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            return constants.get(node.id)
+        return None
+    def field_args(call):
+        kwargs = {k.arg: value(k.value) for k in call.keywords}
+        args = [value(a) for a in call.args]
+        return (kwargs.get('type', args[1] if len(args) > 1 else 'string'), kwargs.get('length'))
+    def is_call(node, name):
+        return isinstance(node, ast.Call) and getattr(node.func, 'id', getattr(node.func, 'attr', None)) == name
+    tables = {}
+    for node in (n for statement in tree.body for n in ast.walk(statement)): #in the order they are defined
+        if not (is_call(node, 'define_table') and node.args and isinstance(node.args[0], ast.Constant)):
+            continue
+        fields, patterns = {}, []
+        for arg in node.args[1:]:
+            if is_call(arg, 'Field') and isinstance(arg.args[0], ast.Constant):
+                fields[arg.args[0].value] = field_args(arg)
+            elif isinstance(arg, ast.Starred) and isinstance(arg.value, ast.ListComp):
+                elt = arg.value.elt
+                if is_call(elt, 'Field') and is_call(elt.args[0], 'format'):
+                    fmt = elt.args[0].func.value.value
+                    regex = "^{}$".format(".*".join(re.escape(part) for part in fmt.split("{}")))
+                    patterns.append((regex,) + field_args(elt))
+                elif is_call(elt, 'clone'):
+                    source = arg.value.generators[0].iter
+                    fields.update((k, v) for k, v in tables[source.attr][0].items() if k not in fields)
+        tables[node.args[0].value] = (fields, patterns)
+    return tables
+
+
+def mismatches(db, tables):
+    """Descriptions of the fields in the tables of db that do not match the model tables"""
+    problems = []
+    for table in db.tables:
+        if table not in tables:
+            problems.append("{}: not in models/db.py".format(table))
+            continue
+        fields, patterns = tables[table]
+        for field in db[table]:
+            if field.name == 'id':
+                continue
+            expected = fields.get(field.name)
+            if expected is None:
+                expected = next((p[1:] for p in patterns if re.match(p[0], field.name)), None)
+            if expected is None:
+                problems.append("{}.{}: not in models/db.py".format(table, field.name))
+                continue
+            model_type, model_length = expected
+            if field.type != model_type:
+                problems.append("{}.{}: type {} in the tests, {} in models/db.py".format(
+                    table, field.name, field.type, model_type))
+            elif field.type == 'string' and model_length is not None and field.length != model_length:
+                problems.append("{}.{}: length {} in the tests, {} in models/db.py".format(
+                    table, field.name, field.length, model_length))
+    return problems
+
+
+class TestTestSchema(object):
+    @classmethod
+    def setup_class(self):
+        self.tables = model_tables()
+        self.folder = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.folder)
+
+    def check(self, define, tables=None):
+        db = define(DAL('sqlite:memory', folder=self.folder, migrate_enabled=True))
+        try:
+            return mismatches(db, self.tables if tables is None else tables)
+        finally:
+            db.close()
+
+    def test_sponsorship_tables(self):
+        assert self.check(define_sponsorship_tables) == []
+
+    def test_email_outbox_table(self):
+        assert self.check(define_email_tables) == []
+
+    def test_model_tables(self):
+        fields, patterns = self.tables['expired_reservations']
+        assert fields['was_renewed'] == ('boolean', None) and fields['sponsorship_ends'] == ('datetime', None)
+        assert self.tables['images_by_ott'][0]['licence'] == ('string', 190)
+        assert [p[1:] for p in self.tables['images_by_ott'][1]] == [('boolean', None)]
+
+    def test_detects_mismatches(self):
+        tables = {'prices': ({'price': ('integer', None)}, []),
+                  'images_by_ott': ({'licence': ('string', 190)}, [('^.*best_.*$', 'boolean', None)])}
+        def define(db):
+            db.define_table('prices', Field('price', type='double'), Field('n_leaves', type='integer'))
+            db.define_table('images_by_ott', Field('licence', type='string', length=100),
+                Field('overall_best_any', type='boolean'))
+            db.define_table('nonexistent', Field('x', type='integer'))
+            return db
+        assert sorted(self.check(define, tables)) == [
+            "images_by_ott.licence: length 100 in the tests, 190 in models/db.py",
+            "nonexistent: not in models/db.py",
+            "prices.n_leaves: not in models/db.py",
+            "prices.price: type double in the tests, integer in models/db.py"]
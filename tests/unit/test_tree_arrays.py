@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that summing popularity over the array representation of a tree (tree_arrays.py)
+gives exactly the same values as walking the dendropy nodes, on random trees
+"""
+import os
+import random
+import re
+import sys
+
+from dendropy import Tree
+
+from . import web2py_app_dir
+
+popularity_dir = os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'TaxonMappingAndPopularity')
+if popularity_dir not in sys.path:
+    sys.path.insert(0, popularity_dir)
+from tree_arrays import TreeArrays
+from OTT_popularity_mapping import sum_popularity_over_tree
+
+node_attributes = ('pop_store', 'descendants_popsum', 'n_descendants', 'ancestors_popsum',
+    'n_ancestors', 'n_pop_ancestors', 'seedplant')
+
+
+def random_newick(rnd, n_leaves, max_children=4, unifurcation_prob=0.1):
+    """A random tree with polytomies and unifurcations, and labels of the form Name_ottN"""
+    ott = iter(range(1, 10 * n_leaves))
+    def node(n):
+        label = "Taxon_ott{}".format(next(ott))
+        if n == 1:
+            return label
+        if rnd.random() < unifurcation_prob:
+            return "(" + node(n) + ")" + label
+        k = rnd.randint(2, min(n, max_children))
+        cuts = sorted(rnd.sample(range(1, n), k - 1))
+        sizes = [b - a for a, b in zip([0] + cuts, cuts + [n])]
+        return "(" + ",".join(node(s) for s in sizes) + ")" + label
+    return node(n_leaves) + ";"
+
+
+def read_tree(newick):
+    return Tree.get(data=newick, schema='newick', suppress_edge_lengths=True,
+        preserve_underscores=True, suppress_leaf_node_taxa=True)
+
+
+class TestTreeArrays(object):
+    def test_orders(self):
+        rnd = random.Random(34)
+        for i in range(50):
+            tree = read_tree(random_newick(rnd, rnd.randint(1, 200)))
+            arrays = TreeArrays(tree)
+            index = {id(n): i for i, n in enumerate(arrays.nodes)}
+            assert [id(n) for n in tree.preorder_node_iter()] == [id(arrays.nodes[i]) for i in arrays.preorder]
+            assert [id(n) for n in tree.postorder_node_iter()] == [id(arrays.nodes[i]) for i in arrays.postorder]
+            assert [index.get(id(n.parent_node), -1) for n in arrays.nodes] == arrays.parent.tolist()
+            assert [n.level() for n in arrays.nodes] == arrays.depth.tolist()
+
+    def test_sums(self):
+        rnd = random.Random(34)
+        for i in range(50):
+            tree = read_tree(random_newick(rnd, rnd.randint(2, 200)))
+            arrays = TreeArrays(tree)
+            values = [rnd.randint(0, 10) for n in arrays.nodes]
+            for n, v in zip(arrays.nodes, values):
+                n.value = v
+            assert arrays.descendant_sums(arrays.depth * 0 + values).tolist() == \
+                [sum(d.value for d in n.preorder_iter()) - n.value for n in arrays.nodes]
+            assert arrays.ancestor_sums(arrays.depth * 0 + values).tolist() == \
+                [sum(a.value for a in n.ancestor_iter(inclusive=True) if a.parent_node) for n in arrays.nodes]
+
+    def compare(self, newick, pops, exclude):
+        """Sum over the same tree using arrays and dendropy, with popularity stored in OTT_ptrs"""
+        trees = []
+        OTT_ptrs_list = []
+        for use_arrays in (True, False):
+            OTT_ptrs = {ott: {'wd': {'final_wiki_item': {'pop': pop}}} for ott, pop in pops.items()}
+            tree = sum_popularity_over_tree(read_tree(newick), OTT_ptrs, exclude, use_arrays=use_arrays)
+            trees.append(tree)
+            OTT_ptrs_list.append(OTT_ptrs)
+        arrays_tree, nodes_tree = trees
+        for a, b in zip(arrays_tree.preorder_node_iter(), nodes_tree.preorder_node_iter()):
+            assert a.label == b.label
+            for attr in node_attributes:
+                assert getattr(a, attr) == getattr(b, attr), (a.label, attr)
+        assert any(n.seedplant for n in arrays_tree) == ("Spermatophyta" in newick)
+        assert OTT_ptrs_list[0] == OTT_ptrs_list[1]
+
+    def test_same_as_dendropy(self):
+        rnd = random.Random(34)
+        for i in range(100):
+            newick = random_newick(rnd, rnd.randint(2, 300))
+            otts = [int(o) for o in re.findall(r"_ott(\d+)", newick)]
+            pops = {ott: rnd.random() * 1000 for ott in otts if rnd.random() < 0.7}
+            exclude = ["Taxon_ott{}".format(o) for o in rnd.sample(otts, 3)]
+            if i % 2:
+                # label an internal node (but not the root) as the seed plants
+                newick = re.sub(r"\)Taxon_ott\d+([,)])", r")Spermatophyta\1", newick, count=1)
+            self.compare(newick, pops, exclude)
+
+    def test_node_data(self):
+        """Popularity can also be stored in the node objects, as in CSV_base_table_creator.py"""
+        rnd = random.Random(34)
+        newick = random_newick(rnd, 500)
+        trees = []
+        for use_arrays in (True, False):
+            tree = read_tree(newick)
+            for n in tree.preorder_node_iter():
+                n.data = {'wd': {'final_wiki_item': {'pop': len(n.label) * 1.5}}} if n.label.endswith("1") else {}
+            trees.append(sum_popularity_over_tree(tree, exclude=[], use_arrays=use_arrays))
+        for a, b in zip(trees[0].preorder_node_iter(), trees[1].preorder_node_iter()):
+            assert [getattr(a, attr) for attr in node_attributes] == [getattr(b, attr) for attr in node_attributes]